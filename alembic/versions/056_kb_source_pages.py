@@ -0,0 +1,58 @@
+"""kb source pages for incremental URL crawling
+
+Revision ID: 056_kb_source_pages
+Revises: 055_billing_payment_attempts
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = "056_kb_source_pages"
+down_revision = "055_billing_payment_attempts"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("kb_sources", sa.Column("max_pages", sa.Integer(), nullable=False, server_default="1"))
+    op.add_column("kb_sources", sa.Column("last_crawled_at", sa.DateTime(), nullable=True))
+    op.create_table(
+        "kb_source_pages",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("source_id", sa.Integer(), sa.ForeignKey("kb_sources.id", ondelete="CASCADE"), nullable=False),
+        sa.Column("portal_id", sa.Integer(), sa.ForeignKey("portals.id"), nullable=False),
+        sa.Column("file_id", sa.Integer(), sa.ForeignKey("kb_files.id", ondelete="SET NULL"), nullable=True),
+        sa.Column("url", sa.Text(), nullable=False),
+        sa.Column("url_hash", sa.String(length=64), nullable=False),
+        sa.Column("etag", sa.String(length=256), nullable=True),
+        sa.Column("last_modified", sa.String(length=64), nullable=True),
+        sa.Column("content_sha256", sa.String(length=64), nullable=True),
+        sa.Column("links_json", postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+        sa.Column("title", sa.String(length=256), nullable=True),
+        sa.Column("http_status", sa.Integer(), nullable=True),
+        sa.Column("status", sa.String(length=32), nullable=False, server_default="new"),
+        sa.Column("error_message", sa.Text(), nullable=True),
+        sa.Column("fetched_at", sa.DateTime(), nullable=True),
+        sa.Column("changed_at", sa.DateTime(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=False, server_default=sa.text("now()")),
+        sa.Column("updated_at", sa.DateTime(), nullable=False, server_default=sa.text("now()")),
+    )
+    op.create_index("ix_kb_source_pages_id", "kb_source_pages", ["id"])
+    op.create_index("ix_kb_source_pages_source_id", "kb_source_pages", ["source_id"])
+    op.create_index("ix_kb_source_pages_portal_id", "kb_source_pages", ["portal_id"])
+    op.create_index("ix_kb_source_pages_file_id", "kb_source_pages", ["file_id"])
+    op.create_index("ix_kb_source_pages_source_url", "kb_source_pages", ["source_id", "url_hash"], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index("ix_kb_source_pages_source_url", table_name="kb_source_pages")
+    op.drop_index("ix_kb_source_pages_file_id", table_name="kb_source_pages")
+    op.drop_index("ix_kb_source_pages_portal_id", table_name="kb_source_pages")
+    op.drop_index("ix_kb_source_pages_source_id", table_name="kb_source_pages")
+    op.drop_index("ix_kb_source_pages_id", table_name="kb_source_pages")
+    op.drop_table("kb_source_pages")
+    op.drop_column("kb_sources", "last_crawled_at")
+    op.drop_column("kb_sources", "max_pages")
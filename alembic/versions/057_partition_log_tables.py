@@ -0,0 +1,221 @@
+"""range-partition log/event tables by created_at
+
+The existing table is renamed to ``<table>_legacy`` and attached as the first
+partition (MINVALUE .. cutoff) of a new partitioned parent, so no rows are
+copied. Future partitions are created here and then by services.partitions
+maintenance.
+
+Everything that reads the whole table runs first, outside the migration
+transaction, under locks that let writes continue: the CHECK constraint with
+the partition bound is validated, and the ``(id, created_at)`` unique index is
+built CONCURRENTLY. The swap itself (SET NOT NULL, rename, primary key from
+that index, ATTACH) then needs no scan and no index build, so its ACCESS
+EXCLUSIVE lock is held only briefly.
+
+Revision ID: 057_partition_log_tables
+Revises: 056_kb_source_pages
+Create Date: 2026-10-19
+"""
+
+import re
+from datetime import datetime, timedelta
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "057_partition_log_tables"
+down_revision = "056_kb_source_pages"
+branch_labels = None
+depends_on = None
+
+
+# table -> (interval, future partitions to premake)
+TABLES = {
+    "bitrix_inbound_events": ("day", 3),
+    "bitrix_http_logs": ("day", 3),
+    "activity_events": ("month", 2),
+    "outbox": ("month", 2),
+    "billing_usage": ("month", 2),
+}
+
+
+def _period_start(ts: datetime, interval: str) -> datetime:
+    if interval == "month":
+        return datetime(ts.year, ts.month, 1)
+    return datetime(ts.year, ts.month, ts.day)
+
+
+def _next_period(start: datetime, interval: str) -> datetime:
+    if interval == "month":
+        return datetime(start.year + (start.month // 12), start.month % 12 + 1, 1)
+    return start + timedelta(days=1)
+
+
+def _partition_name(table: str, start: datetime, interval: str) -> str:
+    suffix = start.strftime("%Y%m") if interval == "month" else start.strftime("%Y%m%d")
+    return f"{table}_p{suffix}"
+
+
+def _ts(value: datetime) -> str:
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _is_partitioned(bind, table: str) -> bool:
+    row = bind.execute(
+        sa.text(
+            "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+            "WHERE c.relname = :t AND c.relnamespace = 'public'::regnamespace"
+        ),
+        {"t": table},
+    ).first()
+    return row is not None
+
+
+def _prepare_table(bind, table: str, interval: str) -> datetime:
+    """Online steps: validate the bound and build the new key without blocking writes. Returns the cutoff."""
+    bound = f"{table}_partition_bound"
+    key = f"{table}_id_created_at_key"
+    with op.get_context().autocommit_block():
+        op.execute(f'UPDATE "{table}" SET created_at = now() WHERE created_at IS NULL')
+        max_created = bind.execute(sa.text(f'SELECT max(created_at) FROM "{table}"')).scalar()
+        latest = datetime.utcnow()
+        if max_created is not None:
+            latest = max(latest, max_created.replace(tzinfo=None))
+        # one period of margin: rows written while the index builds must stay inside the bound
+        cutoff = _next_period(_next_period(_period_start(latest, interval), interval), interval)
+
+        op.execute(f'ALTER TABLE "{table}" DROP CONSTRAINT IF EXISTS "{bound}"')
+        op.execute(
+            f'ALTER TABLE "{table}" ADD CONSTRAINT "{bound}" '
+            f"CHECK (created_at IS NOT NULL AND created_at < '{_ts(cutoff)}') NOT VALID"
+        )
+        # VALIDATE takes SHARE UPDATE EXCLUSIVE: reads and writes go on during the scan.
+        op.execute(f'ALTER TABLE "{table}" VALIDATE CONSTRAINT "{bound}"')
+        # an index left INVALID by an interrupted run is rebuilt
+        op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{key}"')
+        op.execute(f'CREATE UNIQUE INDEX CONCURRENTLY "{key}" ON "{table}" (id, created_at)')
+    return cutoff
+
+
+def _partition_table(bind, table: str, interval: str, premake: int, cutoff: datetime) -> None:
+    legacy = f"{table}_legacy"
+    bound = f"{table}_partition_bound"
+    # the validated CHECK proves there are no NULLs, so this does not scan
+    op.execute(f'ALTER TABLE "{table}" ALTER COLUMN created_at SET NOT NULL')
+
+    indexes = bind.execute(
+        sa.text(
+            "SELECT i.indexname, i.indexdef FROM pg_indexes i "
+            "JOIN pg_class ic ON ic.relname = i.indexname "
+            "JOIN pg_index x ON x.indexrelid = ic.oid "
+            "WHERE i.schemaname = 'public' AND i.tablename = :t AND NOT x.indisunique"
+        ),
+        {"t": table},
+    ).all()
+    fkeys = bind.execute(
+        sa.text(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = CAST(:t AS regclass) AND contype = 'f'"
+        ),
+        {"t": table},
+    ).all()
+    seq = bind.execute(sa.text("SELECT pg_get_serial_sequence(:t, 'id')"), {"t": table}).scalar()
+
+    op.execute(f'ALTER TABLE "{table}" RENAME TO "{legacy}"')
+    # A partition cannot keep PRIMARY KEY (id); the prebuilt (id, created_at) index becomes the key,
+    # and ATTACH adopts it for the parent's primary key instead of building one.
+    op.execute(f'ALTER TABLE "{legacy}" DROP CONSTRAINT "{table}_pkey"')
+    op.execute(f'ALTER TABLE "{legacy}" ADD CONSTRAINT "{legacy}_pkey" PRIMARY KEY USING INDEX "{table}_id_created_at_key"')
+    for name, _definition in indexes:
+        op.execute(f'ALTER INDEX "{name}" RENAME TO "{(name + "_legacy")[:63]}"')
+
+    op.execute(
+        f'CREATE TABLE "{table}" (LIKE "{legacy}" INCLUDING DEFAULTS INCLUDING STORAGE) '
+        f"PARTITION BY RANGE (created_at)"
+    )
+    op.execute(f'ALTER TABLE "{table}" ADD CONSTRAINT "{table}_pkey" PRIMARY KEY (id, created_at)')
+    for name, definition in indexes:
+        definition = re.sub(r" ON (ONLY )?(public\.)?\S+ ", f' ON "{table}" ', definition, count=1)
+        op.execute(definition)
+    for name, definition in fkeys:
+        op.execute(f'ALTER TABLE "{table}" ADD CONSTRAINT "{name}" {definition}')
+    if seq:
+        op.execute(f'ALTER SEQUENCE {seq} OWNED BY "{table}".id')
+
+    # The validated CHECK lets ATTACH skip scanning the legacy rows.
+    op.execute(
+        f'ALTER TABLE "{table}" ATTACH PARTITION "{legacy}" '
+        f"FOR VALUES FROM (MINVALUE) TO ('{_ts(cutoff)}')"
+    )
+    op.execute(f'ALTER TABLE "{legacy}" DROP CONSTRAINT "{bound}"')
+
+    start = cutoff
+    for _ in range(premake):
+        end = _next_period(start, interval)
+        op.execute(
+            f'CREATE TABLE "{_partition_name(table, start, interval)}" PARTITION OF "{table}" '
+            f"FOR VALUES FROM ('{_ts(start)}') TO ('{_ts(end)}')"
+        )
+        start = end
+    op.execute(f'CREATE TABLE "{table}_default" PARTITION OF "{table}" DEFAULT')
+
+
+def _unpartition_table(bind, table: str) -> None:
+    legacy = f"{table}_legacy"
+    parts = bind.execute(
+        sa.text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = CAST(:t AS regclass)"
+        ),
+        {"t": table},
+    ).scalars().all()
+    seq = bind.execute(sa.text("SELECT pg_get_serial_sequence(:t, 'id')"), {"t": table}).scalar()
+    indexes = bind.execute(
+        sa.text("SELECT indexname FROM pg_indexes WHERE schemaname = 'public' AND tablename = :t"),
+        {"t": table},
+    ).scalars().all()
+    for name in parts:
+        op.execute(f'ALTER TABLE "{table}" DETACH PARTITION "{name}"')
+    if legacy not in parts:
+        op.execute(f'CREATE TABLE "{legacy}" (LIKE "{table}" INCLUDING ALL)')
+    for name in parts:
+        if name == legacy:
+            continue
+        op.execute(f'INSERT INTO "{legacy}" SELECT * FROM "{name}"')
+        op.execute(f'DROP TABLE "{name}"')
+    if seq:
+        op.execute(f'ALTER SEQUENCE {seq} OWNED BY "{legacy}".id')
+    op.execute(f'DROP TABLE "{table}"')
+    op.execute(f'ALTER TABLE "{legacy}" RENAME TO "{table}"')
+    pkey = bind.execute(
+        sa.text("SELECT conname FROM pg_constraint WHERE conrelid = CAST(:t AS regclass) AND contype = 'p'"),
+        {"t": table},
+    ).scalar()
+    if pkey:
+        op.execute(f'ALTER TABLE "{table}" DROP CONSTRAINT "{pkey}"')
+    op.execute(f'ALTER TABLE "{table}" ADD CONSTRAINT "{table}_pkey" PRIMARY KEY (id)')
+    for name in indexes:
+        if name == f"{table}_pkey":
+            continue
+        op.execute(f'ALTER INDEX IF EXISTS "{(name + "_legacy")[:63]}" RENAME TO "{name}"')
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    if bind.dialect.name != "postgresql":
+        return
+    for table, (interval, premake) in TABLES.items():
+        if _is_partitioned(bind, table):
+            continue
+        cutoff = _prepare_table(bind, table, interval)
+        _partition_table(bind, table, interval, premake, cutoff)
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    if bind.dialect.name != "postgresql":
+        return
+    for table in TABLES:
+        if _is_partitioned(bind, table):
+            _unpartition_table(bind, table)
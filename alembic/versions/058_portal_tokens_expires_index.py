@@ -0,0 +1,22 @@
+"""index portal_tokens.expires_at for the refresh scheduler
+
+Revision ID: 058_portal_tokens_expires_index
+Revises: 057_partition_log_tables
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+
+
+revision = "058_portal_tokens_expires_index"
+down_revision = "057_partition_log_tables"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index("ix_portal_tokens_expires_at", "portal_tokens", ["expires_at"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_portal_tokens_expires_at", table_name="portal_tokens")
@@ -0,0 +1,83 @@
+"""billing usage counters and daily rollups
+
+Counters are backfilled from billing_usage so limit checks are correct right
+after the upgrade; services.usage_rollup keeps them current.
+
+Revision ID: 059_billing_usage_rollups
+Revises: 058_portal_tokens_expires_index
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "059_billing_usage_rollups"
+down_revision = "058_portal_tokens_expires_index"
+branch_labels = None
+depends_on = None
+
+
+def _measures() -> list[sa.Column]:
+    return [
+        sa.Column("requests_ok", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("events", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("tokens_total", sa.BigInteger(), nullable=False, server_default="0"),
+        sa.Column("cost_rub", sa.Numeric(14, 6), nullable=False, server_default="0"),
+        sa.Column("updated_at", sa.DateTime(), nullable=False, server_default=sa.text("now()")),
+    ]
+
+
+_MEASURES_SQL = (
+    "sum(CASE WHEN u.status = 'ok' THEN 1 ELSE 0 END), count(*), "
+    "coalesce(sum(u.tokens_total), 0), coalesce(sum(u.cost_rub), 0), now()"
+)
+
+
+def upgrade() -> None:
+    op.create_table(
+        "billing_usage_counters",
+        sa.Column("scope", sa.String(length=16), nullable=False),
+        sa.Column("scope_id", sa.Integer(), nullable=False),
+        sa.Column("period_start", sa.Date(), nullable=False),
+        sa.Column("kind", sa.String(length=32), nullable=False),
+        *_measures(),
+        sa.PrimaryKeyConstraint("scope", "scope_id", "period_start", "kind"),
+    )
+    op.create_table(
+        "billing_usage_daily",
+        sa.Column("portal_id", sa.Integer(), nullable=False),
+        sa.Column("day", sa.Date(), nullable=False),
+        sa.Column("kind", sa.String(length=32), nullable=False),
+        sa.Column("account_id", sa.Integer(), nullable=True),
+        *_measures(),
+        sa.PrimaryKeyConstraint("portal_id", "day", "kind"),
+    )
+    op.create_index("ix_billing_usage_daily_account_id", "billing_usage_daily", ["account_id"])
+
+    op.execute(
+        "INSERT INTO billing_usage_counters "
+        "(scope, scope_id, period_start, kind, requests_ok, events, tokens_total, cost_rub, updated_at) "
+        f"SELECT 'portal', u.portal_id, date_trunc('month', u.created_at)::date, u.kind, {_MEASURES_SQL} "
+        "FROM billing_usage u GROUP BY u.portal_id, date_trunc('month', u.created_at)::date, u.kind"
+    )
+    op.execute(
+        "INSERT INTO billing_usage_counters "
+        "(scope, scope_id, period_start, kind, requests_ok, events, tokens_total, cost_rub, updated_at) "
+        f"SELECT 'account', p.account_id, date_trunc('month', u.created_at)::date, u.kind, {_MEASURES_SQL} "
+        "FROM billing_usage u JOIN portals p ON p.id = u.portal_id WHERE p.account_id IS NOT NULL "
+        "GROUP BY p.account_id, date_trunc('month', u.created_at)::date, u.kind"
+    )
+    op.execute(
+        "INSERT INTO billing_usage_daily "
+        "(portal_id, day, kind, account_id, requests_ok, events, tokens_total, cost_rub, updated_at) "
+        f"SELECT u.portal_id, u.created_at::date, u.kind, max(p.account_id), {_MEASURES_SQL} "
+        "FROM billing_usage u LEFT JOIN portals p ON p.id = u.portal_id "
+        "GROUP BY u.portal_id, u.created_at::date, u.kind"
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_billing_usage_daily_account_id", table_name="billing_usage_daily")
+    op.drop_table("billing_usage_daily")
+    op.drop_table("billing_usage_counters")
@@ -0,0 +1,56 @@
+"""billing account snapshots for the admin revenue list
+
+Rows are computed lazily by services.revenue_snapshots: accounts without a
+snapshot are treated as stale, so no backfill is needed here.
+
+Revision ID: 060_billing_account_snapshots
+Revises: 059_billing_usage_rollups
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "060_billing_account_snapshots"
+down_revision = "059_billing_usage_rollups"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "billing_account_snapshots",
+        sa.Column("account_id", sa.Integer(), sa.ForeignKey("accounts.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("plan_id", sa.Integer(), nullable=True),
+        sa.Column("plan_code", sa.String(length=32), nullable=True),
+        sa.Column("plan_version_id", sa.Integer(), nullable=True),
+        sa.Column("subscription_status", sa.String(length=32), nullable=True),
+        sa.Column("final_price_month", sa.Numeric(12, 2), nullable=True),
+        sa.Column("currency", sa.String(length=16), nullable=True),
+        sa.Column("adjustments_count", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("runtime_source", sa.String(length=32), nullable=True),
+        sa.Column("error", sa.String(length=64), nullable=True),
+        sa.Column("valid_until", sa.DateTime(), nullable=True),
+        sa.Column("stale_since", sa.DateTime(), nullable=True),
+        sa.Column("computed_at", sa.DateTime(), nullable=False, server_default=sa.text("now()")),
+    )
+    op.create_index("ix_billing_account_snapshots_plan_code", "billing_account_snapshots", ["plan_code"])
+    op.create_index("ix_billing_account_snapshots_subscription_status", "billing_account_snapshots", ["subscription_status"])
+    op.create_index("ix_billing_account_snapshots_stale_since", "billing_account_snapshots", ["stale_since"])
+    op.create_table(
+        "billing_account_snapshot_cohorts",
+        sa.Column("account_id", sa.Integer(), sa.ForeignKey("accounts.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("cohort_id", sa.Integer(), sa.ForeignKey("billing_cohorts.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("source", sa.String(length=16), nullable=False, server_default="auto"),
+    )
+    op.create_index("ix_billing_account_snapshot_cohorts_cohort_id", "billing_account_snapshot_cohorts", ["cohort_id"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_billing_account_snapshot_cohorts_cohort_id", table_name="billing_account_snapshot_cohorts")
+    op.drop_table("billing_account_snapshot_cohorts")
+    op.drop_index("ix_billing_account_snapshots_stale_since", table_name="billing_account_snapshots")
+    op.drop_index("ix_billing_account_snapshots_subscription_status", table_name="billing_account_snapshots")
+    op.drop_index("ix_billing_account_snapshots_plan_code", table_name="billing_account_snapshots")
+    op.drop_table("billing_account_snapshots")
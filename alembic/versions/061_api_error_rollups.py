@@ -0,0 +1,38 @@
+"""api error rollups (minute/hour) for the admin errors dashboard
+
+Filled by services.error_analytics.rollup_errors; the first run backfills
+hour buckets from the retained raw logs.
+
+Revision ID: 061_api_error_rollups
+Revises: 060_billing_account_snapshots
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = "061_api_error_rollups"
+down_revision = "060_billing_account_snapshots"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "api_error_rollups",
+        sa.Column("grain", sa.String(length=8), nullable=False),
+        sa.Column("bucket_start", sa.DateTime(), nullable=False),
+        sa.Column("channel", sa.String(length=16), nullable=False),
+        sa.Column("portal_id", sa.Integer(), nullable=False),
+        sa.Column("code", sa.String(length=128), nullable=False),
+        sa.Column("requests", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("latency_hist", postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+        sa.Column("updated_at", sa.DateTime(), nullable=False, server_default=sa.text("now()")),
+        sa.PrimaryKeyConstraint("grain", "bucket_start", "channel", "portal_id", "code"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("api_error_rollups")
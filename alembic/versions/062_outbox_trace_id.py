@@ -0,0 +1,37 @@
+"""outbox.trace_id: indexed trace correlation instead of scanning payload_json
+
+Backfilled from the ``"trace_id"`` key of payload_json with a regexp, so rows
+with malformed JSON are skipped rather than failing a cast. bitrix_http_logs,
+bitrix_inbound_events and kb_jobs already carry an indexed trace_id.
+
+Revision ID: 062_outbox_trace_id
+Revises: 061_api_error_rollups
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "062_outbox_trace_id"
+down_revision = "061_api_error_rollups"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("outbox", sa.Column("trace_id", sa.String(length=64), nullable=True))
+    bind = op.get_bind()
+    if bind.dialect.name == "postgresql":
+        bind.execute(
+            sa.text(
+                "UPDATE outbox SET trace_id = substring(payload_json FROM '\"trace_id\"\\s*:\\s*\"([^\"]{1,64})\"') "
+                "WHERE payload_json LIKE '%\"trace_id\"%'"
+            )
+        )
+    op.create_index("ix_outbox_trace_id", "outbox", ["trace_id"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_outbox_trace_id", table_name="outbox")
+    op.drop_column("outbox", "trace_id")
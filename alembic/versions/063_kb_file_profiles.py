@@ -0,0 +1,61 @@
+"""kb file profiles: topic memberships, top lemmas and summary per file
+
+Filled by services.kb_file_profiles at ingest time; files chunked earlier are
+profiled lazily on first scoped query / topics panel read, so no backfill here.
+
+Revision ID: 063_kb_file_profiles
+Revises: 062_outbox_trace_id
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = "063_kb_file_profiles"
+down_revision = "062_outbox_trace_id"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "kb_file_profiles",
+        sa.Column("file_id", sa.Integer(), sa.ForeignKey("kb_files.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("portal_id", sa.Integer(), nullable=False),
+        sa.Column("summary", sa.Text(), nullable=True),
+        sa.Column("top_terms", postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+        sa.Column("chunk_count", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("updated_at", sa.DateTime(), nullable=False, server_default=sa.text("now()")),
+    )
+    op.create_index("ix_kb_file_profiles_portal_id", "kb_file_profiles", ["portal_id"])
+    op.create_table(
+        "kb_file_topics",
+        sa.Column("file_id", sa.Integer(), sa.ForeignKey("kb_files.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("topic_id", sa.String(length=64), primary_key=True),
+    )
+    op.create_index("ix_kb_file_topics_topic_file", "kb_file_topics", ["topic_id", "file_id"])
+    op.create_table(
+        "kb_file_terms",
+        sa.Column("file_id", sa.Integer(), sa.ForeignKey("kb_files.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("term", sa.String(length=40), primary_key=True),
+        sa.Column("tf", sa.Integer(), nullable=False, server_default="1"),
+    )
+    op.create_index("ix_kb_file_terms_term_file", "kb_file_terms", ["term", "file_id"])
+    op.create_table(
+        "kb_portal_term_df",
+        sa.Column("portal_id", sa.Integer(), primary_key=True),
+        sa.Column("term", sa.String(length=40), primary_key=True),
+        sa.Column("df", sa.Integer(), nullable=False, server_default="0"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("kb_portal_term_df")
+    op.drop_index("ix_kb_file_terms_term_file", table_name="kb_file_terms")
+    op.drop_table("kb_file_terms")
+    op.drop_index("ix_kb_file_topics_topic_file", table_name="kb_file_topics")
+    op.drop_table("kb_file_topics")
+    op.drop_index("ix_kb_file_profiles_portal_id", table_name="kb_file_profiles")
+    op.drop_table("kb_file_profiles")
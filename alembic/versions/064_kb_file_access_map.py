@@ -0,0 +1,39 @@
+"""kb file access map: materialized effective KB access per file and principal
+
+Kept current by the services.kb_access_map session hook. Files created before
+this revision are evaluated in memory until
+``python -m apps.backend.scripts.kb_access_map --backfill`` stores them.
+
+Revision ID: 064_kb_file_access_map
+Revises: 063_kb_file_profiles
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "064_kb_file_access_map"
+down_revision = "063_kb_file_profiles"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "kb_file_access_map",
+        sa.Column("file_id", sa.Integer(), sa.ForeignKey("kb_files.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("principal_type", sa.String(length=32), primary_key=True),
+        sa.Column("principal_id", sa.String(length=128), primary_key=True),
+        sa.Column("access_level", sa.String(length=16), nullable=False, server_default="read"),
+    )
+    op.create_index(
+        "ix_kb_file_access_map_principal",
+        "kb_file_access_map",
+        ["principal_type", "principal_id", "file_id"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_kb_file_access_map_principal", table_name="kb_file_access_map")
+    op.drop_table("kb_file_access_map")
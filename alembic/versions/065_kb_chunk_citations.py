@@ -0,0 +1,33 @@
+"""kb chunk citations: per-chunk answer citation counters
+
+Written in batches by services.kb_query_stats together with kb_files.query_count.
+
+Revision ID: 065_kb_chunk_citations
+Revises: 064_kb_file_access_map
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "065_kb_chunk_citations"
+down_revision = "064_kb_file_access_map"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "kb_chunk_citations",
+        sa.Column("chunk_id", sa.Integer(), sa.ForeignKey("kb_chunks.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("file_id", sa.Integer(), nullable=True),
+        sa.Column("citations", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("last_cited_at", sa.DateTime(), nullable=True),
+    )
+    op.create_index("ix_kb_chunk_citations_file_id", "kb_chunk_citations", ["file_id"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_kb_chunk_citations_file_id", table_name="kb_chunk_citations")
+    op.drop_table("kb_chunk_citations")
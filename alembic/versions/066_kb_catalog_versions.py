@@ -0,0 +1,31 @@
+"""kb catalog versions: per-portal KB change counter for file listing ETags
+
+Bumped by services.kb_catalog after commits touching KB files, chunks,
+folders, collections or ACL rows. Missing rows read as version 0.
+
+Revision ID: 066_kb_catalog_versions
+Revises: 065_kb_chunk_citations
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "066_kb_catalog_versions"
+down_revision = "065_kb_chunk_citations"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "kb_catalog_versions",
+        sa.Column("portal_id", sa.Integer(), primary_key=True),
+        sa.Column("version", sa.BigInteger(), nullable=False, server_default="0"),
+        sa.Column("updated_at", sa.DateTime(), nullable=False, server_default=sa.text("now()")),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("kb_catalog_versions")
@@ -0,0 +1,29 @@
+"""portal bot flows: published_version for the compiled flow cache
+
+Incremented on every publish; workers recompile a cached flow when the
+version they hold differs.
+
+Revision ID: 067_bot_flow_published_version
+Revises: 066_kb_catalog_versions
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "067_bot_flow_published_version"
+down_revision = "066_kb_catalog_versions"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "portal_bot_flows",
+        sa.Column("published_version", sa.Integer(), nullable=False, server_default="0"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("portal_bot_flows", "published_version")
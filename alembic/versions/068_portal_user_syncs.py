@@ -0,0 +1,39 @@
+"""portal user syncs: progress and cursor of the Bitrix user directory sync
+
+Revision ID: 068_portal_user_syncs
+Revises: 067_bot_flow_published_version
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "068_portal_user_syncs"
+down_revision = "067_bot_flow_published_version"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "portal_user_syncs",
+        sa.Column("portal_id", sa.Integer(), sa.ForeignKey("portals.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("status", sa.String(length=16), nullable=False, server_default="idle"),
+        sa.Column("mode", sa.String(length=16), nullable=True),
+        sa.Column("total", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("fetched", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("linked", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("memberships_created", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("skipped", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("http_calls", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("error", sa.String(length=255), nullable=True),
+        sa.Column("result_json", sa.Text(), nullable=True),
+        sa.Column("started_at", sa.DateTime(), nullable=True),
+        sa.Column("finished_at", sa.DateTime(), nullable=True),
+        sa.Column("synced_at", sa.DateTime(), nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("portal_user_syncs")
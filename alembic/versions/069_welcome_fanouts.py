@@ -0,0 +1,47 @@
+"""welcome fanouts: background welcome-message runs with progress
+
+Revision ID: 069_welcome_fanouts
+Revises: 068_portal_user_syncs
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "069_welcome_fanouts"
+down_revision = "068_portal_user_syncs"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "welcome_fanouts",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("portal_id", sa.Integer(), sa.ForeignKey("portals.id", ondelete="CASCADE"), nullable=False),
+        sa.Column("trace_id", sa.String(length=64), nullable=False),
+        sa.Column("bot_id", sa.Integer(), nullable=False),
+        sa.Column("status", sa.String(length=16), nullable=False, server_default="queued"),
+        sa.Column("message", sa.Text(), nullable=False),
+        sa.Column("welcome_hash", sa.String(length=64), nullable=False),
+        sa.Column("recipients_json", sa.Text(), nullable=False),
+        sa.Column("total", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("sent", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("skipped", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("failed", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("http_calls", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("failed_json", sa.Text(), nullable=True),
+        sa.Column("error", sa.String(length=255), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=False, server_default=sa.func.now()),
+        sa.Column("started_at", sa.DateTime(), nullable=True),
+        sa.Column("finished_at", sa.DateTime(), nullable=True),
+    )
+    op.create_index("ix_welcome_fanouts_portal_id", "welcome_fanouts", ["portal_id"])
+    op.create_index("ix_welcome_fanouts_trace_id", "welcome_fanouts", ["trace_id"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_welcome_fanouts_trace_id", table_name="welcome_fanouts")
+    op.drop_index("ix_welcome_fanouts_portal_id", table_name="welcome_fanouts")
+    op.drop_table("welcome_fanouts")
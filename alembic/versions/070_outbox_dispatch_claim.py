@@ -0,0 +1,34 @@
+"""outbox: claimed_at and a partial index for the batch dispatcher
+
+The dispatcher claims pending rows (status created, or sending with a stale
+claimed_at) oldest first; the partial index keeps that lookup off the
+sent/error history.
+
+Revision ID: 070_outbox_dispatch_claim
+Revises: 069_welcome_fanouts
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "070_outbox_dispatch_claim"
+down_revision = "069_welcome_fanouts"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("outbox", sa.Column("claimed_at", sa.DateTime(), nullable=True))
+    op.create_index(
+        "ix_outbox_pending",
+        "outbox",
+        ["id"],
+        postgresql_where=sa.text("status IN ('created', 'sending')"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_outbox_pending", table_name="outbox")
+    op.drop_column("outbox", "claimed_at")
@@ -0,0 +1,32 @@
+"""portal_tokens: persisted refresh backoff
+
+The refresh scheduler stores consecutive failures and the next attempt time
+on the token row and filters on it in the due query, instead of keeping the
+backoff in process memory.
+
+Revision ID: 071_portal_token_refresh_backoff
+Revises: 070_outbox_dispatch_claim
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "071_portal_token_refresh_backoff"
+down_revision = "070_outbox_dispatch_claim"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "portal_tokens",
+        sa.Column("refresh_failures", sa.Integer(), nullable=False, server_default="0"),
+    )
+    op.add_column("portal_tokens", sa.Column("refresh_retry_at", sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("portal_tokens", "refresh_retry_at")
+    op.drop_column("portal_tokens", "refresh_failures")
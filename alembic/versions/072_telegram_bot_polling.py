@@ -0,0 +1,34 @@
+"""portal_telegram_settings: per-bot getUpdates polling opt-in
+
+Polling replaces the webhook of a bot, so it is switched on per bot (bots
+behind NAT) instead of for every bot by one global setting.
+
+Revision ID: 072_telegram_bot_polling
+Revises: 071_portal_token_refresh_backoff
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "072_telegram_bot_polling"
+down_revision = "071_portal_token_refresh_backoff"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "portal_telegram_settings",
+        sa.Column("staff_bot_polling", sa.Boolean(), nullable=False, server_default=sa.false()),
+    )
+    op.add_column(
+        "portal_telegram_settings",
+        sa.Column("client_bot_polling", sa.Boolean(), nullable=False, server_default=sa.false()),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("portal_telegram_settings", "client_bot_polling")
+    op.drop_column("portal_telegram_settings", "staff_bot_polling")
@@ -1,12 +1,21 @@
 """Единый клиент Bitrix24 REST API. Логи без домена портала и без токенов (mask)."""
 import json
 import logging
+import os
+import threading
 import time
+from urllib.parse import urlencode
 
 import httpx
 
+from apps.backend.config import get_settings
+
 logger = logging.getLogger(__name__)
 
+# REST-вызовы процесса идут через один keep-alive клиент (BITRIX_POOL_MAX_CONNECTIONS).
+_client: httpx.Client | None = None
+_client_lock = threading.Lock()
+
 # Коды ошибок для установки (без утечки секретов)
 BITRIX_ERR_AUTH_INVALID = "bitrix_auth_invalid"
 BITRIX_ERR_METHOD_FORBIDDEN = "bitrix_method_forbidden"
@@ -15,6 +24,10 @@ BITRIX_ERR_TIMEOUT = "bitrix_timeout"
 BITRIX_ERR_BOT_NOT_REGISTERED = "bot_not_registered"
 BITRIX_ERR_REST = "bitrix_rest_error"
 
+# Лимиты Bitrix: команд в одном batch и записей на странице списочных методов.
+BITRIX_BATCH_MAX_COMMANDS = 50
+BITRIX_PAGE_SIZE = 50
+
 # Единый источник истины для имени/кода бота (imbot.register)
 BOT_NAME_DEFAULT = "Teachbase Ассистент"
 BOT_CODE_DEFAULT = "teachbase_assistant"
@@ -28,6 +41,43 @@ def _base_url(domain: str) -> str:
     d = domain.replace("https://", "").replace("http://", "").rstrip("/")
     return f"https://{d}"
 
+
+def _http() -> httpx.Client:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                size = max(1, int(get_settings().bitrix_pool_max_connections or 20))
+                _client = httpx.Client(
+                    timeout=30,
+                    limits=httpx.Limits(
+                        max_connections=size,
+                        max_keepalive_connections=size,
+                        keepalive_expiry=60,
+                    ),
+                )
+    return _client
+
+
+def close_client() -> None:
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+def _forget_client_after_fork() -> None:
+    """RQ work-horse: сокеты родителя не переиспользуем, клиент создаётся заново."""
+    global _client, _client_lock
+    _client = None
+    _client_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_client_after_fork)
+
+
 def _oauth_token_urls(domain: str) -> list[str]:
     """OAuth endpoints to try (global first, then portal)."""
     urls = [OAUTH_TOKEN_URL]
@@ -162,24 +212,23 @@ def rest_call_result(
     last_body: dict | None = None
     for attempt in range(max_retries_429 + 1):
         try:
-            with httpx.Client(timeout=timeout_sec) as c:
-                r = c.post(url, data=params)
-                try:
-                    last_body = r.json()
-                except Exception:
-                    last_body = None
-                if r.status_code == 429:
-                    if attempt < max_retries_429:
-                        retry_after = max(1, min(15, int(r.headers.get("Retry-After", 5))))
-                        time.sleep(retry_after)
-                        continue
-                    return None, BITRIX_ERR_RATE_LIMITED
-                if r.status_code >= 400:
-                    return None, _map_rest_error(r.status_code, last_body)
-                if last_body and last_body.get("error"):
-                    logger.warning("Bitrix REST error: %s", _safe_error_description(last_body))
-                    return None, _map_rest_error(r.status_code, last_body)
-                return last_body or {}, None
+            r = _http().post(url, data=params, timeout=timeout_sec)
+            try:
+                last_body = r.json()
+            except Exception:
+                last_body = None
+            if r.status_code == 429:
+                if attempt < max_retries_429:
+                    retry_after = max(1, min(15, int(r.headers.get("Retry-After", 5))))
+                    time.sleep(retry_after)
+                    continue
+                return None, BITRIX_ERR_RATE_LIMITED
+            if r.status_code >= 400:
+                return None, _map_rest_error(r.status_code, last_body)
+            if last_body and last_body.get("error"):
+                logger.warning("Bitrix REST error: %s", _safe_error_description(last_body))
+                return None, _map_rest_error(r.status_code, last_body)
+            return last_body or {}, None
         except httpx.TimeoutException:
             logger.warning("Bitrix REST timeout method=%s", method)
             return None, BITRIX_ERR_TIMEOUT
@@ -205,24 +254,23 @@ def rest_call_result_detailed(
     last_status = 0
     for attempt in range(max_retries_429 + 1):
         try:
-            with httpx.Client(timeout=timeout_sec) as c:
-                r = c.post(url, data=params)
-                last_status = r.status_code
-                try:
-                    last_body = r.json()
-                except Exception:
-                    last_body = None
-                if r.status_code == 429:
-                    if attempt < max_retries_429:
-                        retry_after = max(1, min(15, int(r.headers.get("Retry-After", 5))))
-                        time.sleep(retry_after)
-                        continue
-                    return None, BITRIX_ERR_RATE_LIMITED, _safe_error_description(last_body), last_status
-                if r.status_code >= 400:
-                    return None, _map_rest_error(r.status_code, last_body), _safe_error_description(last_body), last_status
-                if last_body and last_body.get("error"):
-                    return None, _map_rest_error(r.status_code, last_body), _safe_error_description(last_body), last_status
-                return last_body or {}, None, "", last_status
+            r = _http().post(url, data=params, timeout=timeout_sec)
+            last_status = r.status_code
+            try:
+                last_body = r.json()
+            except Exception:
+                last_body = None
+            if r.status_code == 429:
+                if attempt < max_retries_429:
+                    retry_after = max(1, min(15, int(r.headers.get("Retry-After", 5))))
+                    time.sleep(retry_after)
+                    continue
+                return None, BITRIX_ERR_RATE_LIMITED, _safe_error_description(last_body), last_status
+            if r.status_code >= 400:
+                return None, _map_rest_error(r.status_code, last_body), _safe_error_description(last_body), last_status
+            if last_body and last_body.get("error"):
+                return None, _map_rest_error(r.status_code, last_body), _safe_error_description(last_body), last_status
+            return last_body or {}, None, "", last_status
         except httpx.TimeoutException:
             return None, BITRIX_ERR_TIMEOUT, "timeout", last_status or 0
         except Exception as e:
@@ -539,19 +587,88 @@ def user_get(
         {"start": start, "filter": {"ACTIVE": True}},
     )
     if err:
-        desc = (err_desc or "").lower()
-        if "insufficient" in desc or "scope" in desc or "access" in desc:
-            return [], "missing_scope_user"
-        return [], err
+        return [], _user_scope_error(err, err_desc)
     if result and result.get("error"):
-        desc = (result.get("error_description") or "").lower()
-        if "insufficient" in desc or "scope" in desc or "access" in desc:
-            return [], "missing_scope_user"
-        return [], result.get("error", "unknown")
+        return [], _user_scope_error(result.get("error", "unknown"), result.get("error_description"))
     items = (result or {}).get("result") or []
     return items[:limit], None
 
 
+def _user_scope_error(err: str, err_desc: str | None) -> str:
+    desc = (err_desc or "").lower()
+    if "insufficient" in desc or "scope" in desc or "access" in desc:
+        return "missing_scope_user"
+    return err
+
+
+def _user_get_params(start: int, filter: dict | None) -> dict[str, str]:
+    params: dict[str, str] = {"start": str(int(start)), "SORT": "ID", "ORDER": "ASC"}
+    for key, value in (filter or {}).items():
+        params[f"FILTER[{key}]"] = str(value)
+    return params
+
+
+def user_get_query(start: int = 0, filter: dict | None = None) -> str:
+    """
+    Команда user.get для batch: страница с offset start, сортировка по ID.
+    filter — поля FILTER (например {"ACTIVE": "Y", ">TIMESTAMP_X": "2026-01-01T00:00:00"}).
+    """
+    return "user.get?" + urlencode(_user_get_params(start, filter))
+
+
+def user_get_page(
+    domain: str,
+    access_token: str,
+    start: int = 0,
+    filter: dict | None = None,
+) -> tuple[list[dict], int, str | None]:
+    """
+    Одна страница user.get (50 записей) и общее число пользователей по фильтру.
+    Возвращает (list пользователей, total, error_code или None).
+    """
+    result, err, err_desc, _status = rest_call_result_detailed(
+        domain, access_token, "user.get", _user_get_params(start, filter)
+    )
+    if err:
+        return [], 0, _user_scope_error(err, err_desc)
+    items = (result or {}).get("result") or []
+    return items, int((result or {}).get("total") or len(items)), None
+
+
+def rest_batch(
+    domain: str,
+    access_token: str,
+    commands: dict[str, str],
+    halt: bool = False,
+    timeout_sec: int = 60,
+) -> tuple[dict[str, object], dict[str, object], str | None, str]:
+    """
+    batch: до BITRIX_BATCH_MAX_COMMANDS команд за один HTTP-запрос.
+    commands — {ключ: "method?query"}. Возвращает (результаты по ключам, ошибки по ключам,
+    error_code, error_description_safe); error_code относится к самому batch-вызову.
+    """
+    if len(commands) > BITRIX_BATCH_MAX_COMMANDS:
+        raise ValueError(f"batch accepts at most {BITRIX_BATCH_MAX_COMMANDS} commands")
+    params: dict[str, str] = {"halt": "1" if halt else "0"}
+    for key, cmd in commands.items():
+        params[f"cmd[{key}]"] = cmd
+    result, err, err_desc, _status = rest_call_result_detailed(
+        domain, access_token, "batch", params, timeout_sec=timeout_sec
+    )
+    if err:
+        return {}, {}, err, err_desc
+    body = (result or {}).get("result") or {}
+    # Bitrix отдаёт пустые секции как [], а не {}
+    results = body.get("result") or {}
+    errors = body.get("result_error") or {}
+    return (
+        results if isinstance(results, dict) else {},
+        errors if isinstance(errors, dict) else {},
+        None,
+        "",
+    )
+
+
 def user_current(
     domain: str,
     access_token: str,
@@ -1,70 +1,177 @@
-"""Telegram Bot API client."""
+"""Telegram Bot API client.
+
+All calls share one pooled keep-alive ``httpx.Client`` per process. Outgoing
+messages go through a per-bot limiter (``TELEGRAM_GLOBAL_RATE_PER_SECOND`` per
+bot, ``TELEGRAM_CHAT_RATE_PER_SECOND`` per chat), matching the Bot API limits.
+``TELEGRAM_API_BASE_URL`` can point at a local fake Bot API server.
+"""
 from __future__ import annotations
 
+import os
+import threading
+import time
+
 import httpx
 
+from apps.backend.config import get_settings
+
+_client: httpx.Client | None = None
+_client_lock = threading.Lock()
+_MAX_RETRY_AFTER_SECONDS = 30
+
+
+def _base_url() -> str:
+    return (get_settings().telegram_api_base_url or "https://api.telegram.org").rstrip("/")
+
 
 def _api_url(token: str, method: str) -> str:
-    return f"https://api.telegram.org/bot{token}/{method}"
+    return f"{_base_url()}/bot{token}/{method}"
 
 
-def telegram_get_me(token: str) -> tuple[dict | None, str | None]:
+def _http() -> httpx.Client:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                s = get_settings()
+                _client = httpx.Client(
+                    timeout=20,
+                    limits=httpx.Limits(
+                        max_connections=max(1, int(s.telegram_pool_max_connections or 20)),
+                        max_keepalive_connections=max(1, int(s.telegram_pool_max_connections or 20)),
+                        keepalive_expiry=60,
+                    ),
+                )
+    return _client
+
+
+def close_client() -> None:
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+class _RateLimiter:
+    """Reserves send slots per bot and per (bot, chat); callers sleep until their slot."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bot_next: dict[str, float] = {}
+        self._chat_next: dict[tuple[str, str], float] = {}
+
+    def reserve(self, token: str, chat_id: str | int, now: float | None = None) -> float:
+        """Return seconds to wait before sending to ``chat_id``."""
+        s = get_settings()
+        bot_gap = 1.0 / max(0.001, float(s.telegram_global_rate_per_second or 30))
+        chat_gap = 1.0 / max(0.001, float(s.telegram_chat_rate_per_second or 1))
+        now = time.monotonic() if now is None else now
+        chat_key = (token, str(chat_id))
+        with self._lock:
+            # A chat waiting for its own slot must not hold back other chats of the bot.
+            bot_slot = max(now, self._bot_next.get(token, 0.0))
+            slot = max(bot_slot, self._chat_next.get(chat_key, 0.0))
+            self._bot_next[token] = bot_slot + bot_gap
+            self._chat_next[chat_key] = slot + chat_gap
+            if len(self._chat_next) > 10000:
+                self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+        return slot - now
+
+    def wait(self, token: str, chat_id: str | int) -> None:
+        delay = self.reserve(token, chat_id)
+        if delay > 0:
+            time.sleep(delay)
+
+
+rate_limiter = _RateLimiter()
+
+
+def _call(token: str, method: str, payload: dict | None = None, timeout: float = 20) -> tuple[dict | None, str | None]:
+    """POST a Bot API method; returns (response json, error)."""
     try:
-        r = httpx.get(_api_url(token, "getMe"), timeout=15)
+        r = _http().post(_api_url(token, method), json=payload or {}, timeout=timeout)
         data = r.json()
         if not data.get("ok"):
-            return None, data.get("description") or "error"
-        return data.get("result"), None
+            return data, data.get("description") or "error"
+        return data, None
     except Exception as e:
         return None, str(e)[:200]
 
 
+def telegram_get_me(token: str) -> tuple[dict | None, str | None]:
+    data, err = _call(token, "getMe", timeout=15)
+    if err:
+        return None, err
+    return data.get("result"), None
+
+
 def telegram_set_webhook(token: str, url: str, secret_token: str) -> tuple[bool, str | None]:
-    payload = {"url": url, "secret_token": secret_token}
-    try:
-        r = httpx.post(_api_url(token, "setWebhook"), json=payload, timeout=20)
-        data = r.json()
-        if not data.get("ok"):
-            return False, data.get("description") or "error"
-        return True, None
-    except Exception as e:
-        return False, str(e)[:200]
+    _, err = _call(token, "setWebhook", {"url": url, "secret_token": secret_token})
+    return err is None, err
+
+
+def telegram_delete_webhook(token: str) -> tuple[bool, str | None]:
+    _, err = _call(token, "deleteWebhook", {"drop_pending_updates": False})
+    return err is None, err
 
 
 def telegram_send_message(token: str, chat_id: str | int, text: str) -> tuple[bool, str | None]:
     payload = {"chat_id": chat_id, "text": text}
-    try:
-        r = httpx.post(_api_url(token, "sendMessage"), json=payload, timeout=20)
-        data = r.json()
-        if not data.get("ok"):
-            return False, data.get("description") or "error"
-        return True, None
-    except Exception as e:
-        return False, str(e)[:200]
+    for attempt in range(2):
+        rate_limiter.wait(token, chat_id)
+        data, err = _call(token, "sendMessage", payload)
+        if err is None:
+            return True, None
+        retry_after = ((data or {}).get("parameters") or {}).get("retry_after")
+        if attempt or (data or {}).get("error_code") != 429 or not retry_after:
+            return False, err
+        time.sleep(min(_MAX_RETRY_AFTER_SECONDS, max(1, int(retry_after))))
+    return False, "rate_limited"
 
 
 def telegram_get_file(token: str, file_id: str) -> tuple[dict | None, str | None]:
-    payload = {"file_id": file_id}
-    try:
-        r = httpx.post(_api_url(token, "getFile"), json=payload, timeout=20)
-        data = r.json()
-        if not data.get("ok"):
-            return None, data.get("description") or "error"
-        return data.get("result"), None
-    except Exception as e:
-        return None, str(e)[:200]
+    data, err = _call(token, "getFile", {"file_id": file_id})
+    if err:
+        return None, err
+    return data.get("result"), None
+
+
+def telegram_get_updates(
+    token: str,
+    offset: int | None = None,
+    timeout: int = 50,
+    limit: int = 100,
+) -> tuple[list[dict] | None, str | None]:
+    """Long-poll getUpdates; the HTTP timeout is the poll timeout plus a margin."""
+    payload = {"timeout": int(timeout), "limit": int(limit), "allowed_updates": ["message", "edited_message"]}
+    if offset is not None:
+        payload["offset"] = int(offset)
+    data, err = _call(token, "getUpdates", payload, timeout=int(timeout) + 10)
+    if err:
+        return None, err
+    return list(data.get("result") or []), None
 
 
 def telegram_download_file(token: str, file_path: str, dst_path: str) -> tuple[bool, str | None]:
-    url = f"https://api.telegram.org/file/bot{token}/{file_path}"
+    """Stream the file to ``dst_path`` via a ``.part`` file, never holding it in memory."""
+    url = f"{_base_url()}/file/bot{token}/{file_path}"
+    tmp_path = dst_path + ".part"
     try:
-        with httpx.stream("GET", url, timeout=60) as r:
+        with _http().stream("GET", url, timeout=60) as r:
             if r.status_code >= 400:
                 return False, f"http_{r.status_code}"
-            with open(dst_path, "wb") as f:
-                for chunk in r.iter_bytes():
+            with open(tmp_path, "wb") as f:
+                for chunk in r.iter_bytes(64 * 1024):
                     if chunk:
                         f.write(chunk)
+        os.replace(tmp_path, dst_path)
         return True, None
     except Exception as e:
         return False, str(e)[:200]
+    finally:
+        if os.path.exists(tmp_path):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
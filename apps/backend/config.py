@@ -37,7 +37,16 @@ class Settings(BaseSettings):
     debug_endpoints_enabled: bool = False
     kb_storage_path: str = "/app/storage/kb"
     token_refresh_enabled: bool = True
-    token_refresh_interval_minutes: int = 30
+    token_refresh_interval_minutes: int = 30  # устарело: планировщик работает тиками token_refresh_tick_seconds
+    token_refresh_tick_seconds: int = 30
+    token_refresh_lead_seconds: int = 600
+    token_refresh_jitter_seconds: int = 300
+    token_refresh_workers: int = 8
+    token_refresh_per_domain_rps: float = 2.0
+    token_refresh_batch_size: int = 500
+    token_refresh_lease_seconds: int = 120
+    bitrix_portal_rps: float = 2.0  # welcome fan-out and outbox: Bitrix calls per second per portal, shared via Redis
+    bitrix_pool_max_connections: int = 20
     kb_watchdog_enabled: bool = True
     kb_watchdog_interval_seconds: int = 120
     kb_processing_stale_seconds: int = 600
@@ -45,7 +54,65 @@ class Settings(BaseSettings):
     kb_job_timeout_seconds: int = 3600
     rq_ingest_queue_name: str = "ingest"
     rq_outbox_queue_name: str = "outbox"
+    outbox_claim_batch: int = 200  # rows one process_outbox job claims and delivers
+    outbox_dispatch_concurrency: int = 8  # destinations delivered in parallel
+    outbox_claim_ttl_seconds: int = 300  # a sending row not refreshed for this long is reclaimed
+    outbox_dispatch_budget_seconds: int = 120  # one job drains for this long, then requeues itself
+    rq_preview_queue_name: str = "preview"
+    rq_welcome_queue_name: str = "welcome"
+    kb_preview_max_concurrency: int = 2
+    kb_preview_timeout_seconds: int = 180
+    kb_preview_memory_limit_mb: int = 2048
+    kb_crawler_max_pages: int = 500
+    kb_crawler_per_host_concurrency: int = 2
+    kb_crawler_delay_ms: int = 500
+    kb_crawler_timeout_seconds: int = 20
     kb_pgvector_enabled: bool = False
+    inbound_log_queue_max_events: int = 10000
+    inbound_log_queue_max_mb: int = 64
+    inbound_log_batch_size: int = 200
+    inbound_log_flush_interval_ms: int = 500
+    inbound_log_sample_watermark: float = 0.8
+    inbound_log_sample_every: int = 10
+    inbound_log_retention_interval_seconds: int = 300
+    # bitrix_http_logs: sampling of successful requests (errors/slow always logged)
+    bitrix_http_log_sample_rate: float = 1.0
+    bitrix_http_log_slow_ms: int = 1000
+    bitrix_http_log_capture_bytes: int = 65536
+    bitrix_http_log_queue_max_events: int = 10000
+    bitrix_http_log_queue_max_mb: int = 32
+    # billing_usage / activity_events: group-committed by services.usage_recorder
+    usage_recorder_queue_max_events: int = 20000
+    usage_recorder_batch_size: int = 500
+    usage_recorder_flush_interval_ms: int = 1000
+    # kb_files.query_count / kb_chunk_citations: write-behind by services.kb_query_stats
+    kb_query_stats_queue_max_events: int = 20000
+    kb_query_stats_batch_size: int = 1000
+    kb_query_stats_flush_interval_ms: int = 5000
+    # dialog_states / dialog_rag_cache / recent messages: cached by services.dialog_context
+    dialog_context_cache_size: int = 5000
+    dialog_context_ttl_seconds: int = 900
+    partition_maintenance_interval_seconds: int = 3600
+    telegram_api_base_url: str = "https://api.telegram.org"
+    telegram_pool_max_connections: int = 20
+    telegram_global_rate_per_second: float = 30.0
+    telegram_chat_rate_per_second: float = 1.0
+    # getUpdates long-polling вместо вебхука (боты за NAT)
+    telegram_polling_timeout_seconds: int = 50
+    telegram_polling_rescan_seconds: int = 60
+    bitrix_http_logs_retention_days: int = 14
+    activity_events_retention_days: int = 400
+    outbox_retention_days: int = 90
+    billing_usage_retention_days: int = 0  # 0 — хранить без ограничения
+    billing_usage_reconcile_interval_seconds: int = 3600
+    # api_error_rollups: минутные/часовые агрегаты для /admin/errors/summary
+    error_rollup_interval_seconds: int = 60
+    error_rollup_lag_seconds: int = 120
+    error_rollup_minute_retention_hours: int = 48
+    error_rollup_hour_retention_days: int = 35
+    # /metrics (Prometheus): отдаётся только с Authorization: Bearer <metrics_token>; пустой токен — эндпоинт выключен
+    metrics_token: str = ""
+    metrics_flush_interval_seconds: int = 15
     yookassa_shop_id: str = ""
     yookassa_secret_key: str = ""
     yookassa_return_url: str | None = None
@@ -52,3 +52,9 @@ def _compile_jsonb_sqlite(_element, _compiler, **_kw):
 def get_session_factory(engine=None):
     eng = engine or get_engine()
     return sessionmaker(autocommit=False, autoflush=False, bind=eng)
+
+
+# Pool events are registered on the Pool class, so engines created later are covered too.
+from apps.backend.services.metrics import instrument_db_pool  # noqa: E402
+
+instrument_db_pool()
@@ -13,7 +13,7 @@ from starlette.exceptions import HTTPException as StarletteHTTPException
 
 from apps.backend.middleware.bitrix_log import BitrixLogMiddleware
 from apps.backend.middleware.bitrix_inbound_events import BitrixInboundEventsMiddleware
-from apps.backend.routers import health, admin_auth, admin_portals
+from apps.backend.routers import health, metrics, admin_auth, admin_portals
 from apps.backend.routers import admin_dialogs, admin_events, admin_outbox
 from apps.backend.routers import admin_system, admin_logs, admin_traces, admin_debug
 from apps.backend.routers import admin_settings, admin_inbound_events, admin_billing, admin_registrations
@@ -21,8 +21,20 @@ from apps.backend.routers import admin_revenue_v2
 from apps.backend.routers import admin_errors
 from apps.backend.routers import bitrix, bitrix_botflow, bitrix_dialogs, portal, debug, admin_kb, telegram, web_auth, billing_public
 from apps.backend.routers import web_rbac_v2
-from apps.backend.services.token_refresh_daemon import refresh_tokens_once
+from apps.backend.services.token_refresh_daemon import refresh_tokens_once, shutdown_refresh_pool
 from apps.backend.services.kb_job_watchdog import run_kb_watchdog_cycle
+from apps.backend.services.bitrix_inbound_log import run_retention_cycle
+from apps.backend.services.inbound_log_writer import get_inbound_writer
+from apps.backend.services.http_log_writer import get_http_log_writer
+from apps.backend.services.usage_recorder import get_usage_recorder
+from apps.backend.services.kb_query_stats import get_kb_query_stats
+from apps.backend.services.partitions import run_partition_maintenance
+from apps.backend.services.usage_rollup import run_usage_reconciliation
+from apps.backend.services.error_analytics import run_error_rollups
+from apps.backend.services.metrics import flush_shared as flush_metrics
+from apps.backend.services.telegram_polling import run_polling_supervisor
+from apps.backend.clients.bitrix import close_client as close_bitrix_client
+from apps.backend.clients.telegram import close_client as close_telegram_client
 from apps.backend.config import get_settings
 from apps.backend.utils.api_errors import error_envelope
 
@@ -63,14 +75,17 @@ async def lifespan(app: FastAPI):
     stop_event = threading.Event()
     s = get_settings()
     if s.token_refresh_enabled and not (bool(os.environ.get("PYTEST_CURRENT_TEST")) or os.environ.get("TESTING") == "1"):
-        interval_sec = max(300, int(s.token_refresh_interval_minutes or 30) * 60)
+        tick_sec = max(5, int(s.token_refresh_tick_seconds or 30))
 
         def _loop():
             # initial delay to allow app startup
             time.sleep(5)
             while not stop_event.is_set():
-                refresh_tokens_once(skew_seconds=interval_sec)
-                stop_event.wait(interval_sec)
+                try:
+                    refresh_tokens_once()
+                except Exception as e:
+                    logging.getLogger(__name__).warning("refresh_daemon tick failed: %s", e)
+                stop_event.wait(tick_sec)
 
         t = threading.Thread(target=_loop, name="token_refresh_daemon", daemon=True)
         t.start()
@@ -87,8 +102,96 @@ async def lifespan(app: FastAPI):
         t2 = threading.Thread(target=_kb_watchdog_loop, name="kb_watchdog_daemon", daemon=True)
         t2.start()
         app.state.kb_watchdog_thread = t2
+    inbound_writer = None
+    http_log_writer = None
+    usage_recorder = None
+    kb_query_stats = None
+    if not (bool(os.environ.get("PYTEST_CURRENT_TEST")) or os.environ.get("TESTING") == "1"):
+        inbound_writer = get_inbound_writer()
+        inbound_writer.start()
+        http_log_writer = get_http_log_writer()
+        http_log_writer.start()
+        usage_recorder = get_usage_recorder()
+        usage_recorder.start()
+        kb_query_stats = get_kb_query_stats()
+        kb_query_stats.start()
+        retention_sec = max(30, int(s.inbound_log_retention_interval_seconds or 300))
+
+        def _inbound_retention_loop():
+            time.sleep(15)
+            while not stop_event.is_set():
+                run_retention_cycle()
+                stop_event.wait(retention_sec)
+
+        t3 = threading.Thread(target=_inbound_retention_loop, name="inbound_retention_daemon", daemon=True)
+        t3.start()
+        app.state.inbound_retention_thread = t3
+        partition_sec = max(300, int(s.partition_maintenance_interval_seconds or 3600))
+
+        def _partition_loop():
+            time.sleep(20)
+            while not stop_event.is_set():
+                run_partition_maintenance()
+                stop_event.wait(partition_sec)
+
+        t4 = threading.Thread(target=_partition_loop, name="partition_maintenance_daemon", daemon=True)
+        t4.start()
+        app.state.partition_maintenance_thread = t4
+        reconcile_sec = max(300, int(s.billing_usage_reconcile_interval_seconds or 3600))
+
+        def _usage_reconcile_loop():
+            time.sleep(30)
+            while not stop_event.is_set():
+                try:
+                    run_usage_reconciliation()
+                except Exception as e:
+                    logging.getLogger(__name__).warning("billing_usage_reconcile failed: %s", e)
+                stop_event.wait(reconcile_sec)
+
+        t6 = threading.Thread(target=_usage_reconcile_loop, name="billing_usage_reconcile", daemon=True)
+        t6.start()
+        app.state.billing_usage_reconcile_thread = t6
+        error_rollup_sec = max(15, int(s.error_rollup_interval_seconds or 60))
+
+        def _error_rollup_loop():
+            time.sleep(20)
+            while not stop_event.is_set():
+                try:
+                    run_error_rollups()
+                except Exception as e:
+                    logging.getLogger(__name__).warning("api_error_rollups failed: %s", e)
+                stop_event.wait(error_rollup_sec)
+
+        t7 = threading.Thread(target=_error_rollup_loop, name="api_error_rollups", daemon=True)
+        t7.start()
+        app.state.error_rollup_thread = t7
+        metrics_sec = max(5, int(s.metrics_flush_interval_seconds or 15))
+
+        def _metrics_flush_loop():
+            while not stop_event.wait(metrics_sec):
+                flush_metrics()
+
+        t8 = threading.Thread(target=_metrics_flush_loop, name="metrics_flush", daemon=True)
+        t8.start()
+        app.state.metrics_flush_thread = t8
+        # polls only bots switched to polling in their settings
+        t5 = threading.Thread(target=run_polling_supervisor, args=(stop_event,), name="telegram_polling", daemon=True)
+        t5.start()
+        app.state.telegram_polling_thread = t5
     yield
     stop_event.set()
+    if inbound_writer is not None:
+        inbound_writer.stop()
+    if http_log_writer is not None:
+        http_log_writer.stop()
+    if usage_recorder is not None:
+        usage_recorder.stop()
+    if kb_query_stats is not None:
+        kb_query_stats.stop()
+    close_telegram_client()
+    close_bitrix_client()
+    shutdown_refresh_pool()
+    flush_metrics()
 
 
 app = FastAPI(
@@ -109,6 +212,7 @@ app.add_middleware(
 )
 
 app.include_router(health.router, tags=["System"])
+app.include_router(metrics.router, tags=["System"])
 app.include_router(admin_auth.router, prefix="/v1/admin/auth", tags=["Admin Auth"])
 app.include_router(admin_portals.router, prefix="/v1/admin/portals", tags=["Admin Portals"])
 app.include_router(admin_dialogs.router, prefix="/v1/admin/dialogs", tags=["Admin Dialogs"])
@@ -1,13 +1,9 @@
-"""Middleware: blackbox logging for POST /v1/bitrix/events only. ASGI: reads body once, logs, replays body to handler."""
+"""Middleware: blackbox logging for POST /v1/bitrix/events only. ASGI: reads body once, enqueues it, replays body to handler."""
 import logging
+from urllib.parse import parse_qs
 
-from apps.backend import database
 from apps.backend.middleware.trace_id import ensure_trace_id
-from apps.backend.services.bitrix_inbound_log import (
-    build_inbound_event_record,
-    run_retention,
-)
-from apps.backend.services.inbound_settings import get_inbound_settings
+from apps.backend.services.inbound_log_writer import InboundEvent, get_inbound_writer
 
 logger = logging.getLogger("uvicorn.error")
 
@@ -46,8 +42,9 @@ def _scope_query_string(scope: dict) -> str | None:
 class BitrixInboundEventsMiddleware:
     """
     ASGI middleware: only for POST /v1/bitrix/events.
-    Reads body from receive() once, saves to bitrix_inbound_events, then passes
-    a new receive() that replays the cached body so the route gets the same body.
+    Reads body from receive() once, hands it to the background inbound log writer
+    (no DB work in the request path), then passes a new receive() that replays
+    the cached body so the route gets the same body.
     """
 
     def __init__(self, app):
@@ -79,34 +76,23 @@ class BitrixInboundEventsMiddleware:
         body_bytes = b"".join(body_chunks)
 
         try:
-            factory = database.get_session_factory()
-            with factory() as db:
-                settings = get_inbound_settings(db)
-                if not settings.get("enabled", True):
-                    pass
-                else:
-                    headers_dict = _scope_headers_to_dict(scope)
-                    query_domain = None
-                    qs = _scope_query_string(scope)
-                    if qs:
-                        from urllib.parse import parse_qs
-                        params = parse_qs(qs)
-                        query_domain = (params.get("DOMAIN") or params.get("domain") or [None])[0]
-                    build_inbound_event_record(
-                        db=db,
-                        trace_id=trace_id,
-                        method=(scope.get("method") or "POST"),
-                        path=(scope.get("path") or "/v1/bitrix/events"),
-                        query_string=qs,
-                        content_type=headers_dict.get("content-type"),
-                        request_headers=headers_dict,
-                        body_bytes=body_bytes,
-                        remote_ip=scope.get("client", (None, None))[0] if scope.get("client") else None,
-                        query_domain=query_domain,
-                        settings=settings,
-                    )
-                    if settings.get("auto_prune_on_write", True):
-                        run_retention(db, settings)
+            qs = _scope_query_string(scope)
+            query_domain = None
+            if qs:
+                params = parse_qs(qs)
+                query_domain = (params.get("DOMAIN") or params.get("domain") or [None])[0]
+            get_inbound_writer().submit(
+                InboundEvent(
+                    trace_id=trace_id,
+                    method=(scope.get("method") or "POST"),
+                    path=(scope.get("path") or "/v1/bitrix/events"),
+                    query_string=qs,
+                    headers=_scope_headers_to_dict(scope),
+                    body=body_bytes,
+                    remote_ip=scope.get("client", (None, None))[0] if scope.get("client") else None,
+                    query_domain=query_domain,
+                )
+            )
         except Exception as e:
             logger.warning("INBOUND_LOG_FAILED trace_id=%s error=%s", trace_id, e)
 
@@ -1,166 +1,110 @@
-"""Middleware: логирование Bitrix запросов."""
-import json
+"""Middleware: логирование Bitrix запросов (pure ASGI, запись в фоне)."""
 import logging
+import random
 import time
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
+from urllib.parse import parse_qsl
 
-from apps.backend.database import get_session_factory
+from apps.backend.config import get_settings
 from apps.backend.middleware.trace_id import ensure_trace_id
-from apps.backend.services.bitrix_logging import log_inbound
+from apps.backend.services.http_log_writer import HttpLogRecord, get_http_log_writer
 
 logger = logging.getLogger("uvicorn.error")
 
+_PREFIXES = ("/v1/bitrix", "/api/v1/bitrix")
+_HEADER_KEYS = frozenset(
+    {b"accept", b"content-type", b"x-requested-with", b"sec-fetch-dest", b"sec-fetch-mode", b"user-agent"}
+)
 
-_MAX_JSON_FIELD_CHARS = 16_000
 
+def _query_keys(query_string: bytes) -> list[str]:
+    if not query_string:
+        return []
+    # decoded the way Starlette's request.query_params decodes them
+    pairs = parse_qsl(query_string.decode("latin-1"), keep_blank_values=True)
+    return list(dict.fromkeys(key for key, _value in pairs if key))
 
-def _mask_payload(value):
-    """Mask sensitive fields recursively for trace-safe diagnostics."""
-    secret_keys = {
-        "access_token",
-        "refresh_token",
-        "token",
-        "auth",
-        "authorization",
-        "password",
-        "client_secret",
-        "secret",
-        "webhook_secret",
-    }
-    if isinstance(value, dict):
-        out = {}
-        for k, v in value.items():
-            kl = str(k).lower()
-            if kl in secret_keys or "token" in kl or "secret" in kl or "password" in kl or "authorization" in kl:
-                out[k] = "[MASKED]" if v else None
-            else:
-                out[k] = _mask_payload(v)
-        return out
-    if isinstance(value, list):
-        return [_mask_payload(v) for v in value]
-    return value
 
+class BitrixLogMiddleware:
+    """
+    ASGI middleware for /v1/bitrix requests.
+    Wraps receive/send to capture at most ``bitrix_http_log_capture_bytes`` of the
+    request and response bodies without buffering the response (streaming is
+    untouched). Errors and slow requests are always logged, successes are
+    sampled by ``bitrix_http_log_sample_rate``. Parsing, masking and the DB
+    insert happen in the background http log writer.
+    """
 
-def _truncate_payload(value):
-    """Bound payload size to keep DB rows compact."""
-    try:
-        raw = json.dumps(value, ensure_ascii=False)
-    except Exception:
-        return value
-    if len(raw) <= _MAX_JSON_FIELD_CHARS:
-        return value
-    clipped = raw[:_MAX_JSON_FIELD_CHARS]
-    return {"_truncated": True, "preview": clipped}
+    def __init__(self, app):
+        self.app = app
 
+    async def __call__(self, scope, receive, send):
+        if scope.get("type") != "http" or not (scope.get("path") or "").startswith(_PREFIXES):
+            await self.app(scope, receive, send)
+            return
 
-class BitrixLogMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        if not (request.url.path.startswith("/v1/bitrix") or request.url.path.startswith("/api/v1/bitrix")):
-            return await call_next(request)
-        trace_id = ensure_trace_id(request.scope)
-        request.state.trace_id = trace_id
+        trace_id = ensure_trace_id(scope)
+        scope.setdefault("state", {})["trace_id"] = trace_id
+        s = get_settings()
+        limit = max(0, int(s.bitrix_http_log_capture_bytes or 0))
         start = time.perf_counter()
-        response = await call_next(request)
-        latency_ms = int((time.perf_counter() - start) * 1000)
-        query_keys = list(request.query_params.keys())
-        body_keys = []
-        request_json = None
-        response_json = None
-        headers_min = {
-            "accept": (request.headers.get("accept", "") or "")[:256],
-            "content_type": (request.headers.get("content-type", "") or "")[:128],
-            "x_requested_with": (request.headers.get("x-requested-with", "") or "")[:64],
-        }
-        try:
-            ct = (request.headers.get("content-type", "") or "").lower()
-            if "application/json" in ct:
-                body_bytes = await request.body()
-                if body_bytes:
-                    parsed = json.loads(body_bytes.decode("utf-8", errors="replace"))
-                    request_json = _truncate_payload(_mask_payload(parsed))
-        except Exception:
-            request_json = {"_parse_error": True}
-        accept = request.headers.get("accept", "")
-        sec_fetch_dest = request.headers.get("sec-fetch-dest", "")
-        sec_fetch_mode = request.headers.get("sec-fetch-mode", "")
-        x_requested_with = request.headers.get("x-requested-with", "")
-        user_agent = request.headers.get("user-agent", "")
-        response_content_type = response.headers.get("content-type", "") if hasattr(response, "headers") else ""
-        response_length = None
-        response_is_json = None
-        try:
-            if hasattr(response, "body") and response.body is not None:
-                body = response.body
-                if isinstance(body, bytes):
-                    response_length = len(body)
-                    prefix = body[:1].decode(errors="ignore") if body else ""
-                    response_is_json = prefix in ("{", "[")
-                    if response_is_json:
-                        try:
-                            parsed_resp = json.loads(body.decode("utf-8", errors="replace"))
-                            response_json = _truncate_payload(_mask_payload(parsed_resp))
-                        except Exception:
-                            response_json = {"_parse_error": True}
-                else:
-                    text = str(body)
-                    response_length = len(text.encode("utf-8"))
-                    response_is_json = text.lstrip().startswith("{") or text.lstrip().startswith("[")
-                    if response_is_json:
-                        try:
-                            parsed_resp = json.loads(text)
-                            response_json = _truncate_payload(_mask_payload(parsed_resp))
-                        except Exception:
-                            response_json = {"_parse_error": True}
-            else:
-                clen = response.headers.get("content-length", "") if hasattr(response, "headers") else ""
-                response_length = int(clen) if str(clen).isdigit() else None
-                response_is_json = (response_content_type or "").startswith("application/json")
-        except Exception:
-            pass
-        try:
-            factory = get_session_factory()
-            with factory() as db:
-                log_inbound(
-                    db,
-                    trace_id=trace_id,
-                    method=request.method,
-                    path=request.url.path,
-                    query_keys=query_keys,
-                    body_keys=body_keys,
-                    status_code=response.status_code,
-                    latency_ms=latency_ms,
-                    portal_id=None,
-                    accept=accept,
-                    sec_fetch_dest=sec_fetch_dest,
-                    sec_fetch_mode=sec_fetch_mode,
-                    user_agent=user_agent,
-                    response_content_type=response_content_type,
-                    response_length=response_length,
-                    response_is_json=response_is_json,
-                    request_json=request_json,
-                    response_json=response_json,
-                    headers_min=headers_min,
-                )
-        except Exception:
-            pass
+        headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope.get("headers") or [] if k in _HEADER_KEYS}
+        req_parts: list[bytes] = []
+        resp_parts: list[bytes] = []
+        state = {"req_len": 0, "resp_len": 0, "status": 500, "ctype": "", "clen": None}
+
+        async def receive_wrapper():
+            message = await receive()
+            if message.get("type") == "http.request":
+                body = message.get("body") or b""
+                room = limit - state["req_len"]
+                if room > 0 and body:
+                    req_parts.append(body[:room])
+                state["req_len"] += len(body)
+            return message
+
+        async def send_wrapper(message):
+            mtype = message.get("type")
+            if mtype == "http.response.start":
+                state["status"] = int(message.get("status") or 500)
+                for k, v in message.get("headers") or []:
+                    if k == b"content-type":
+                        state["ctype"] = v.decode("latin-1")
+                    elif k == b"content-length" and v.isdigit():
+                        state["clen"] = int(v)
+            elif mtype == "http.response.body":
+                body = message.get("body") or b""
+                room = limit - state["resp_len"]
+                if room > 0 and body:
+                    resp_parts.append(body[:room])
+                state["resp_len"] += len(body)
+            await send(message)
+
         try:
-            probe = {
-                "type": "bitrix_iframe_probe",
-                "trace_id": trace_id,
-                "method": request.method,
-                "path": request.url.path,
-                "query_keys": query_keys,
-                "status": response.status_code,
-                "response_content_type": response_content_type,
-                "response_length": response_length,
-                "accept": (accept or "")[:256],
-                "sec_fetch_dest": (sec_fetch_dest or "")[:64],
-                "sec_fetch_mode": (sec_fetch_mode or "")[:64],
-                "x_requested_with": (x_requested_with or "")[:64],
-                "user_agent": (user_agent or "")[:128],
-            }
-            logger.info(json.dumps(probe, ensure_ascii=False))
-        except Exception:
-            pass
-        return response
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            latency_ms = int((time.perf_counter() - start) * 1000)
+            status = state["status"]
+            force = status >= 400 or latency_ms >= int(s.bitrix_http_log_slow_ms or 0)
+            rate = float(s.bitrix_http_log_sample_rate)
+            if force or rate >= 1.0 or random.random() < rate:
+                try:
+                    get_http_log_writer().submit(
+                        HttpLogRecord(
+                            trace_id=trace_id,
+                            method=scope.get("method") or "GET",
+                            path=scope.get("path") or "",
+                            query_keys=_query_keys(scope.get("query_string") or b""),
+                            headers=headers,
+                            status_code=status,
+                            latency_ms=latency_ms,
+                            request_body=b"".join(req_parts),
+                            request_truncated=state["req_len"] > limit,
+                            response_content_type=state["ctype"],
+                            response_length=state["clen"] if state["clen"] is not None else state["resp_len"],
+                            response_body=b"".join(resp_parts),
+                            response_truncated=state["resp_len"] > limit,
+                        ),
+                        force=force,
+                    )
+                except Exception as e:
+                    logger.warning("BITRIX_HTTP_LOG_ENQUEUE_FAILED trace_id=%s error=%s", trace_id, e)
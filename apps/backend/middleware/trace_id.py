@@ -1,14 +1,23 @@
 """Single source for request trace_id. Use scope for ASGI, request.scope for Starlette."""
 import uuid
+from contextvars import ContextVar
 
 SCOPE_KEY = "trace_id"
 
+# Same id for code that has no scope at hand (model defaults, services); unset outside requests.
+_current: ContextVar[str | None] = ContextVar("trace_id", default=None)
+
 
 def ensure_trace_id(scope: dict) -> str:
     """Get or set trace_id on ASGI scope. Returns the same trace_id for the request lifecycle."""
     tid = scope.get(SCOPE_KEY)
-    if tid and isinstance(tid, str):
-        return tid
-    tid = str(uuid.uuid4())[:16]
-    scope[SCOPE_KEY] = tid
+    if not (tid and isinstance(tid, str)):
+        tid = str(uuid.uuid4())[:16]
+        scope[SCOPE_KEY] = tid
+    _current.set(tid)
     return tid
+
+
+def current_trace_id() -> str | None:
+    """trace_id of the request being handled, if any (column default for outbox / kb_jobs)."""
+    return _current.get()
@@ -1,5 +1,5 @@
 """Модели SQLAlchemy."""
-from apps.backend.models.portal import Portal, PortalToken, PortalUsersAccess
+from apps.backend.models.portal import Portal, PortalToken, PortalUsersAccess, PortalUserSync, WelcomeFanout
 from apps.backend.models.dialog import Dialog, Message
 from apps.backend.models.dialog_rag_cache import DialogRagCache
 from apps.backend.models.dialog_state import DialogState
@@ -11,18 +11,24 @@ from apps.backend.models.billing import (
     UsageCounter,
     PortalUsageLimit,
     BillingUsage,
+    BillingUsageCounter,
+    BillingUsageDaily,
     AccountSubscription,
     AccountPlanOverride,
+    BillingAccountSnapshot,
+    BillingAccountSnapshotCohort,
 )
 from apps.backend.models.admin import AdminUser
 from apps.backend.models.bitrix_log import BitrixHttpLog
 from apps.backend.models.bitrix_inbound_event import BitrixInboundEvent
+from apps.backend.models.error_rollup import ApiErrorRollup
 from apps.backend.models.app_setting import AppSetting
 from apps.backend.models.kb import (
     KBFile,
     KBChunk,
     KBEmbedding,
     KBSource,
+    KBSourcePage,
     KBJob,
     KBCollection,
     KBCollectionFile,
@@ -30,6 +36,13 @@ from apps.backend.models.kb import (
     KBFolder,
     KBFolderAccess,
     KBFileAccess,
+    KBFileAccessMap,
+    KBFileProfile,
+    KBFileTopic,
+    KBFileTerm,
+    KBPortalTermDF,
+    KBChunkCitation,
+    KBCatalogVersion,
 )
 from apps.backend.models.portal_kb_setting import PortalKBSetting
 from apps.backend.models.account_kb_setting import AccountKBSetting
@@ -57,6 +70,8 @@ __all__ = [
     "Portal",
     "PortalToken",
     "PortalUsersAccess",
+    "PortalUserSync",
+    "WelcomeFanout",
     "Dialog",
     "Message",
     "DialogRagCache",
@@ -68,11 +83,16 @@ __all__ = [
     "UsageCounter",
     "PortalUsageLimit",
     "BillingUsage",
+    "BillingUsageCounter",
+    "BillingUsageDaily",
     "AccountSubscription",
     "AccountPlanOverride",
+    "BillingAccountSnapshot",
+    "BillingAccountSnapshotCohort",
     "AdminUser",
     "BitrixHttpLog",
     "BitrixInboundEvent",
+    "ApiErrorRollup",
     "AppSetting",
     "PortalKBSetting",
     "AccountKBSetting",
@@ -82,6 +102,7 @@ __all__ = [
     "KBChunk",
     "KBEmbedding",
     "KBSource",
+    "KBSourcePage",
     "KBJob",
     "KBCollection",
     "KBCollectionFile",
@@ -89,6 +110,13 @@ __all__ = [
     "KBFolder",
     "KBFolderAccess",
     "KBFileAccess",
+    "KBFileAccessMap",
+    "KBFileProfile",
+    "KBFileTopic",
+    "KBFileTerm",
+    "KBPortalTermDF",
+    "KBChunkCitation",
+    "KBCatalogVersion",
     "PortalTopicSummary",
     "AccountTopicSummary",
     "WebUser",
@@ -12,7 +12,7 @@ class ActivityEvent(Base):
     portal_id = Column(Integer, ForeignKey("portals.id"), nullable=True, index=True)
     web_user_id = Column(Integer, ForeignKey("web_users.id"), nullable=True, index=True)
     kind = Column(String(32), nullable=False, index=True)  # web|iframe|ai
-    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)  # partition key (057)
 
     __table_args__ = (
         Index("ix_activity_events_kind_time", "kind", "created_at"),
@@ -1,7 +1,7 @@
 """Billing models."""
 from datetime import datetime
 
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, Numeric, String, Text
+from sqlalchemy import BigInteger, Boolean, Column, Date, DateTime, ForeignKey, Integer, Numeric, String, Text
 from sqlalchemy.dialects.postgresql import JSONB
 
 from apps.backend.database import Base
@@ -67,7 +67,39 @@ class BillingUsage(Base):
     cost_rub = Column(Numeric(12, 6), nullable=True)
     status = Column(String(32), nullable=False, default="ok")
     error_code = Column(Text, nullable=True)
-    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)  # partition key (057)
+
+
+class BillingUsageCounter(Base):
+    """Monthly billing_usage rollup per portal or account; limit checks read it by PK (059)."""
+
+    __tablename__ = "billing_usage_counters"
+
+    scope = Column(String(16), primary_key=True)  # portal|account
+    scope_id = Column(Integer, primary_key=True)
+    period_start = Column(Date, primary_key=True)
+    kind = Column(String(32), primary_key=True)
+    requests_ok = Column(Integer, nullable=False, default=0)
+    events = Column(Integer, nullable=False, default=0)
+    tokens_total = Column(BigInteger, nullable=False, default=0)
+    cost_rub = Column(Numeric(14, 6), nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class BillingUsageDaily(Base):
+    """Daily billing_usage rollup per portal for history charts (059)."""
+
+    __tablename__ = "billing_usage_daily"
+
+    portal_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    kind = Column(String(32), primary_key=True)
+    account_id = Column(Integer, nullable=True, index=True)
+    requests_ok = Column(Integer, nullable=False, default=0)
+    events = Column(Integer, nullable=False, default=0)
+    tokens_total = Column(BigInteger, nullable=False, default=0)
+    cost_rub = Column(Numeric(14, 6), nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
 
 
 class AccountSubscription(Base):
@@ -178,6 +210,38 @@ class BillingAccountAdjustment(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
 
 
+class BillingAccountSnapshot(Base):
+    """Materialized effective policy and revenue fields per account for the admin list (060).
+
+    ``stale_since`` is set when an input changes (services.revenue_snapshots);
+    a row is also stale once ``valid_until`` (next validity-window boundary) passes.
+    """
+
+    __tablename__ = "billing_account_snapshots"
+
+    account_id = Column(Integer, ForeignKey("accounts.id", ondelete="CASCADE"), primary_key=True)
+    plan_id = Column(Integer, nullable=True)
+    plan_code = Column(String(32), nullable=True, index=True)
+    plan_version_id = Column(Integer, nullable=True)
+    subscription_status = Column(String(32), nullable=True, index=True)
+    final_price_month = Column(Numeric(12, 2), nullable=True)
+    currency = Column(String(16), nullable=True)
+    adjustments_count = Column(Integer, nullable=False, default=0)
+    runtime_source = Column(String(32), nullable=True)
+    error = Column(String(64), nullable=True)
+    valid_until = Column(DateTime, nullable=True)
+    stale_since = Column(DateTime, nullable=True, index=True)
+    computed_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class BillingAccountSnapshotCohort(Base):
+    __tablename__ = "billing_account_snapshot_cohorts"
+
+    account_id = Column(Integer, ForeignKey("accounts.id", ondelete="CASCADE"), primary_key=True)
+    cohort_id = Column(Integer, ForeignKey("billing_cohorts.id", ondelete="CASCADE"), primary_key=True, index=True)
+    source = Column(String(16), nullable=False, default="auto")
+
+
 class BillingPaymentAttempt(Base):
     __tablename__ = "billing_payment_attempts"
 
@@ -11,7 +11,7 @@ class BitrixInboundEvent(Base):
     __tablename__ = "bitrix_inbound_events"
 
     id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
-    created_at = Column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
+    created_at = Column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)  # partition key (057)
     trace_id = Column(String(64), index=True)
     portal_id = Column(Integer, ForeignKey("portals.id"), index=True)
     domain = Column(Text)
@@ -18,4 +18,4 @@ class BitrixHttpLog(Base):
     summary_json = Column(Text)
     status_code = Column(Integer)
     latency_ms = Column(Integer)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)  # partition key (057)
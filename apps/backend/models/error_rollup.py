@@ -0,0 +1,26 @@
+"""Minute/hour rollups of API errors for the admin errors dashboard."""
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, String
+from sqlalchemy.dialects.postgresql import JSONB
+
+from apps.backend.database import Base
+
+
+class ApiErrorRollup(Base):
+    """Aggregates of bitrix_http_logs (all requests) and inbound errors per bucket (061).
+
+    ``code`` is empty for successful requests; ``latency_hist`` holds counts per
+    services.error_analytics.LATENCY_BOUNDS bucket (last slot: above the top bound).
+    """
+
+    __tablename__ = "api_error_rollups"
+
+    grain = Column(String(8), primary_key=True)  # minute|hour
+    bucket_start = Column(DateTime, primary_key=True)
+    channel = Column(String(16), primary_key=True)  # bitrix_http|inbound
+    portal_id = Column(Integer, primary_key=True)  # 0 = unknown portal
+    code = Column(String(128), primary_key=True)
+    requests = Column(Integer, nullable=False, default=0)
+    latency_hist = Column(JSONB, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
@@ -1,10 +1,11 @@
 """KB models: files, chunks, embeddings, sources, jobs."""
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Index
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, ForeignKey, Text, Index
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 
 from apps.backend.database import Base
+from apps.backend.middleware.trace_id import current_trace_id
 
 
 class KBSource(Base):
@@ -18,11 +19,43 @@ class KBSource(Base):
     url = Column(Text, nullable=True)
     title = Column(String(256), nullable=True)
     status = Column(String(32), nullable=False, default="new")
+    max_pages = Column(Integer, nullable=False, default=1)  # web: pages to crawl under the start URL
+    last_crawled_at = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
 
     files = relationship("KBFile", back_populates="source")
     chunks = relationship("KBChunk", back_populates="source")
+    pages = relationship("KBSourcePage", back_populates="source")
+
+
+class KBSourcePage(Base):
+    __tablename__ = "kb_source_pages"
+
+    id = Column(Integer, primary_key=True, index=True)
+    source_id = Column(Integer, ForeignKey("kb_sources.id", ondelete="CASCADE"), nullable=False, index=True)
+    portal_id = Column(Integer, ForeignKey("portals.id"), nullable=False, index=True)
+    file_id = Column(Integer, ForeignKey("kb_files.id", ondelete="SET NULL"), nullable=True, index=True)
+    url = Column(Text, nullable=False)
+    url_hash = Column(String(64), nullable=False)
+    etag = Column(String(256), nullable=True)
+    last_modified = Column(String(64), nullable=True)
+    content_sha256 = Column(String(64), nullable=True)
+    links_json = Column(JSONB, nullable=True)
+    title = Column(String(256), nullable=True)
+    http_status = Column(Integer, nullable=True)
+    status = Column(String(32), nullable=False, default="new")  # new|changed|unchanged|gone|error
+    error_message = Column(Text, nullable=True)
+    fetched_at = Column(DateTime, nullable=True)
+    changed_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+    source = relationship("KBSource", back_populates="pages")
+
+    __table_args__ = (
+        Index("ix_kb_source_pages_source_url", "source_id", "url_hash", unique=True),
+    )
 
 
 class KBFile(Base):
@@ -112,7 +145,7 @@ class KBJob(Base):
     status = Column(String(32), nullable=False, default="queued")
     payload_json = Column(JSONB, nullable=True)
     error_message = Column(Text, nullable=True)
-    trace_id = Column(String(64), nullable=True, index=True)
+    trace_id = Column(String(64), nullable=True, index=True, default=current_trace_id)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
 
@@ -207,3 +240,89 @@ class KBFileAccess(Base):
     __table_args__ = (
         Index("ix_kb_file_access_file_principal", "file_id", "principal_type", "principal_id"),
     )
+
+
+class KBFileProfile(Base):
+    """Per-file text profile built at ingest (services.kb_file_profiles, 063)."""
+
+    __tablename__ = "kb_file_profiles"
+
+    file_id = Column(Integer, ForeignKey("kb_files.id", ondelete="CASCADE"), primary_key=True)
+    portal_id = Column(Integer, nullable=False, index=True)
+    summary = Column(Text, nullable=True)
+    top_terms = Column(JSONB, nullable=True)  # [[lemma, tf], ...] by tf desc
+    chunk_count = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class KBFileTopic(Base):
+    __tablename__ = "kb_file_topics"
+
+    file_id = Column(Integer, ForeignKey("kb_files.id", ondelete="CASCADE"), primary_key=True)
+    topic_id = Column(String(64), primary_key=True)  # services.kb_file_profiles.KB_TOPICS id
+
+    __table_args__ = (
+        Index("ix_kb_file_topics_topic_file", "topic_id", "file_id"),
+    )
+
+
+class KBFileTerm(Base):
+    __tablename__ = "kb_file_terms"
+
+    file_id = Column(Integer, ForeignKey("kb_files.id", ondelete="CASCADE"), primary_key=True)
+    term = Column(String(40), primary_key=True)  # lemma
+    tf = Column(Integer, nullable=False, default=1)
+
+    __table_args__ = (
+        Index("ix_kb_file_terms_term_file", "term", "file_id"),
+    )
+
+
+class KBPortalTermDF(Base):
+    """Number of profiled files of a portal containing ``term``; kept incrementally."""
+
+    __tablename__ = "kb_portal_term_df"
+
+    portal_id = Column(Integer, primary_key=True)
+    term = Column(String(40), primary_key=True)
+    df = Column(Integer, nullable=False, default=0)
+
+
+class KBFileAccessMap(Base):
+    """Materialized effective KB access per file and principal (services.kb_access_map, 064).
+
+    Rows hold the level granted by the rule set that governs the file; the
+    marker row ``("*", "file" | "folder" | "default")`` names that set.
+    """
+
+    __tablename__ = "kb_file_access_map"
+
+    file_id = Column(Integer, ForeignKey("kb_files.id", ondelete="CASCADE"), primary_key=True)
+    principal_type = Column(String(32), primary_key=True)
+    principal_id = Column(String(128), primary_key=True)
+    access_level = Column(String(16), nullable=False, default="read")
+
+    __table_args__ = (
+        Index("ix_kb_file_access_map_principal", "principal_type", "principal_id", "file_id"),
+    )
+
+
+class KBChunkCitation(Base):
+    """How often a chunk was cited in answers; flushed by services.kb_query_stats (065)."""
+
+    __tablename__ = "kb_chunk_citations"
+
+    chunk_id = Column(Integer, ForeignKey("kb_chunks.id", ondelete="CASCADE"), primary_key=True)
+    file_id = Column(Integer, nullable=True, index=True)
+    citations = Column(Integer, nullable=False, default=0)
+    last_cited_at = Column(DateTime, nullable=True)
+
+
+class KBCatalogVersion(Base):
+    """Per-portal KB change counter behind the file listing ETag (services.kb_catalog, 066)."""
+
+    __tablename__ = "kb_catalog_versions"
+
+    portal_id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
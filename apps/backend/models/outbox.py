@@ -1,8 +1,23 @@
 """Модель исходящих сообщений (outbox)."""
+import json
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Index
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Index, text
 
 from apps.backend.database import Base
+from apps.backend.middleware.trace_id import current_trace_id
+
+
+def _default_trace_id(context) -> str | None:
+    """trace_id from payload_json when the writer put one there, else the current request's."""
+    raw = context.get_current_parameters().get("payload_json")
+    if raw and '"trace_id"' in raw:
+        try:
+            tid = json.loads(raw).get("trace_id")
+        except Exception:
+            tid = None
+        if tid:
+            return str(tid)[:64]
+    return current_trace_id()
 
 
 class Outbox(Base):
@@ -11,9 +26,20 @@ class Outbox(Base):
     id = Column(Integer, primary_key=True, index=True)
     portal_id = Column(Integer, ForeignKey("portals.id"), nullable=False, index=True)
     message_id = Column(Integer, ForeignKey("messages.id"), index=True)
-    status = Column(String(32), default="created")  # created, sent, error
+    status = Column(String(32), default="created")  # created, sending, sent, error
+    trace_id = Column(String(64), index=True, default=_default_trace_id)  # 062
     retry_count = Column(Integer, default=0)
     payload_json = Column(Text)
     error_message = Column(Text)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)  # partition key (057)
     sent_at = Column(DateTime)
+    claimed_at = Column(DateTime)  # status=sending: when a dispatcher took the row (070)
+
+    __table_args__ = (
+        # pending rows for the dispatcher claim; sent/error rows stay out of it
+        Index(
+            "ix_outbox_pending",
+            "id",
+            postgresql_where=text("status IN ('created', 'sending')"),
+        ),
+    )
@@ -37,7 +37,9 @@ class PortalToken(Base):
     portal_id = Column(Integer, ForeignKey("portals.id"), nullable=False, index=True)
     access_token = Column(Text)
     refresh_token = Column(Text)
-    expires_at = Column(DateTime)
+    expires_at = Column(DateTime, index=True)  # refresh scheduler orders by it (058)
+    refresh_failures = Column(Integer, nullable=False, default=0, server_default="0")  # consecutive (071)
+    refresh_retry_at = Column(DateTime)  # scheduler skips the row until then (071)
     scope = Column(String(512))
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -66,3 +68,51 @@ class PortalUsersAccess(Base):
         UniqueConstraint("portal_id", "telegram_username", name="uq_portal_users_access_telegram_username"),
     )
 
+
+
+class PortalUserSync(Base):
+    """Progress and cursor of the Bitrix user directory sync (one row per portal)."""
+
+    __tablename__ = "portal_user_syncs"
+
+    portal_id = Column(Integer, ForeignKey("portals.id", ondelete="CASCADE"), primary_key=True)
+    status = Column(String(16), nullable=False, default="idle")  # idle|queued|running|done|error
+    mode = Column(String(16), nullable=True)  # full|incremental
+    total = Column(Integer, nullable=False, default=0)
+    fetched = Column(Integer, nullable=False, default=0)
+    linked = Column(Integer, nullable=False, default=0)
+    memberships_created = Column(Integer, nullable=False, default=0)
+    skipped = Column(Integer, nullable=False, default=0)
+    http_calls = Column(Integer, nullable=False, default=0)
+    error = Column(String(255), nullable=True)
+    result_json = Column(Text, nullable=True)  # last run's identity_linking summary
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    # Start of the last successful run; the next incremental run asks Bitrix for
+    # users modified after it.
+    synced_at = Column(DateTime, nullable=True)
+
+
+class WelcomeFanout(Base):
+    """One welcome-message fan-out run (install/provision): progress and outcome."""
+
+    __tablename__ = "welcome_fanouts"
+
+    id = Column(Integer, primary_key=True, index=True)
+    portal_id = Column(Integer, ForeignKey("portals.id", ondelete="CASCADE"), nullable=False, index=True)
+    trace_id = Column(String(64), nullable=False, index=True)
+    bot_id = Column(Integer, nullable=False)
+    status = Column(String(16), nullable=False, default="queued")  # queued|running|ok|partial_fail|error
+    message = Column(Text, nullable=False)
+    welcome_hash = Column(String(64), nullable=False)
+    recipients_json = Column(Text, nullable=False)  # [bitrix user_id, ...]
+    total = Column(Integer, nullable=False, default=0)
+    sent = Column(Integer, nullable=False, default=0)
+    skipped = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    http_calls = Column(Integer, nullable=False, default=0)
+    failed_json = Column(Text, nullable=True)  # failed recipients (step_provision_chats shape)
+    error = Column(String(255), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
@@ -14,4 +14,5 @@ class PortalBotFlow(Base):
     kind = Column(String(16), primary_key=True, default="client")  # client|staff
     draft_json = Column(JSONB, nullable=True)
     published_json = Column(JSONB, nullable=True)
+    published_version = Column(Integer, nullable=False, default=0, server_default="0")  # bumped on publish
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
@@ -14,9 +14,11 @@ class PortalTelegramSetting(Base):
     staff_bot_secret = Column(String(64), nullable=True)
     staff_bot_enabled = Column(Boolean, nullable=False, default=False)
     staff_allow_uploads = Column(Boolean, nullable=False, default=False)
+    staff_bot_polling = Column(Boolean, nullable=False, default=False)  # getUpdates instead of the webhook
     client_bot_token_enc = Column(Text, nullable=True)
     client_bot_secret = Column(String(64), nullable=True)
     client_bot_enabled = Column(Boolean, nullable=False, default=False)
     client_allow_uploads = Column(Boolean, nullable=False, default=False)
+    client_bot_polling = Column(Boolean, nullable=False, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -10,6 +10,7 @@ from sqlalchemy.orm import Session
 from apps.backend.auth import get_current_admin
 from apps.backend.deps import get_db
 from apps.backend.models.billing import BillingUsage
+from apps.backend.services.usage_rollup import reconcile_usage_counters
 from apps.backend.services.billing import (
     create_account_plan_override,
     create_billing_plan,
@@ -308,3 +309,18 @@ def billing_usage_list(
             for r in items
         ]
     }
+
+
+@router.post('/usage/reconcile')
+def billing_usage_reconcile(
+    period: str | None = Body(None, embed=True),
+    fix: bool = Body(False, embed=True),
+    db: Session = Depends(get_db),
+    _: dict = Depends(get_current_admin),
+):
+    """Compare usage counters with billing_usage for a month (YYYY-MM); fix=true repairs drift."""
+    try:
+        period_start = datetime.strptime(period, "%Y-%m").date() if period else None
+    except ValueError as exc:
+        _bad_request(exc)
+    return reconcile_usage_counters(db, period_start, fix=fix)
@@ -8,6 +8,7 @@ from apps.backend.auth import get_current_admin
 from apps.backend.deps import get_db
 from apps.backend.models.bitrix_inbound_event import BitrixInboundEvent
 from apps.backend.services.bitrix_inbound_log import get_usage, run_prune
+from apps.backend.services.inbound_log_writer import get_inbound_writer
 from apps.backend.services.inbound_settings import get_inbound_settings
 
 router = APIRouter(dependencies=[Depends(get_current_admin)])
@@ -15,9 +16,11 @@ router = APIRouter(dependencies=[Depends(get_current_admin)])
 
 @router.get("/inbound-events/usage")
 def get_inbound_events_usage(db: Session = Depends(get_db)):
-    """Storage usage: used_mb, target_budget_mb, percent, approx_rows, oldest_at, newest_at."""
+    """Storage usage: used_mb, target_budget_mb, percent, approx_rows, oldest_at, newest_at, writer counters."""
     settings = get_inbound_settings(db)
-    return get_usage(db, settings)
+    usage = get_usage(db, settings)
+    usage["writer"] = get_inbound_writer().stats()
+    return usage
 
 
 class PruneBody(BaseModel):
@@ -327,10 +327,27 @@ def revenue_unassign_account_from_cohort(
 @router.get("/accounts")
 def revenue_list_accounts(
     limit: int = Query(200, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+    q: str | None = Query(None),
+    plan: str | None = Query(None),
+    subscription_status: str | None = Query(None),
+    status: str | None = Query(None),
+    cohort_id: int | None = Query(None),
+    sort: str = Query("account_no"),
     db: Session = Depends(get_db),
     _: dict = Depends(get_current_admin),
 ):
-    return {"items": list_revenue_accounts_v2(db, limit=limit)}
+    return list_revenue_accounts_v2(
+        db,
+        limit=limit,
+        offset=offset,
+        q=q,
+        plan_code=plan,
+        subscription_status=subscription_status,
+        status=status,
+        cohort_id=cohort_id,
+        sort=sort,
+    )
 
 
 @router.get("/accounts/{account_id}")
@@ -74,6 +74,29 @@ def system_health(_: dict = Depends(get_current_admin)):
     return status
 
 
+@router.get("/writers")
+def system_writers(_: dict = Depends(get_current_admin)):
+    """Очереди фоновых писателей этого процесса: глубина, потери, латентность flush."""
+    from apps.backend.services.http_log_writer import get_http_log_writer
+    from apps.backend.services.inbound_log_writer import get_inbound_writer
+    from apps.backend.services.kb_query_stats import get_kb_query_stats
+    from apps.backend.services.usage_recorder import get_usage_recorder
+
+    return {w.name: w.stats() for w in (get_inbound_writer(), get_http_log_writer(), get_usage_recorder(), get_kb_query_stats())}
+
+
+@router.get("/startup")
+def system_startup(refresh: bool = False, top: int = 25, _: dict = Depends(get_current_admin)):
+    """Профиль импорта API (python -X importtime в отдельном процессе) и тяжёлые модули этого процесса."""
+    from apps.backend.services.startup import import_profile, startup_report
+
+    try:
+        profile = import_profile(top=max(1, min(int(top), 200)), refresh=refresh)
+    except Exception as e:
+        profile = {"error": str(e)}
+    return {"process": startup_report(), "import_profile": profile}
+
+
 @router.get("/queue")
 def system_queue(_: dict = Depends(get_current_admin)):
     s = get_settings()
@@ -85,6 +108,8 @@ def system_queue(_: dict = Depends(get_current_admin)):
         for name in (
             s.rq_ingest_queue_name or "ingest",
             s.rq_outbox_queue_name or "outbox",
+            s.rq_preview_queue_name or "preview",
+            s.rq_welcome_queue_name or "welcome",
             "default",
         ):
             if name not in queue_names:
@@ -1,5 +1,8 @@
 """Admin: Bitrix HTTP traces."""
+import heapq
 import json
+from datetime import datetime, timezone
+
 from fastapi import APIRouter, Depends, Query, HTTPException
 from sqlalchemy.orm import Session
 from sqlalchemy import select, desc
@@ -8,22 +11,32 @@ from apps.backend.auth import get_current_admin
 from apps.backend.deps import get_db
 from apps.backend.models.bitrix_log import BitrixHttpLog
 from apps.backend.models.bitrix_inbound_event import BitrixInboundEvent
+from apps.backend.models.kb import KBJob
 from apps.backend.models.outbox import Outbox
 
 router = APIRouter(dependencies=[Depends(get_current_admin)])
 
 
+def _sort_ts(value: datetime | None) -> datetime:
+    if value is None:
+        return datetime.min
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
 @router.get("/{trace_id}/timeline")
 def get_trace_timeline(trace_id: str, db: Session = Depends(get_db)):
-    items: list[dict] = []
+    """Every source is an indexed trace_id lookup; the sorted streams are merged by time."""
+    streams: list[list[tuple[datetime, dict]]] = []
 
     log_rows = db.execute(
         select(BitrixHttpLog)
         .where(BitrixHttpLog.trace_id == trace_id)
         .order_by(BitrixHttpLog.created_at)
     ).scalars().all()
-    for r in log_rows:
-        items.append({
+    streams.append([
+        (_sort_ts(r.created_at), {
             "source": "bitrix_http",
             "id": r.id,
             "created_at": r.created_at.isoformat() if r.created_at else None,
@@ -32,14 +45,16 @@ def get_trace_timeline(trace_id: str, db: Session = Depends(get_db)):
             "status": r.status_code,
             "summary": r.path or "",
         })
+        for r in log_rows
+    ])
 
     inbound_rows = db.execute(
         select(BitrixInboundEvent)
         .where(BitrixInboundEvent.trace_id == trace_id)
         .order_by(BitrixInboundEvent.created_at)
     ).scalars().all()
-    for r in inbound_rows:
-        items.append({
+    streams.append([
+        (_sort_ts(r.created_at), {
             "source": "inbound",
             "id": int(r.id),
             "created_at": r.created_at.isoformat() if r.created_at else None,
@@ -48,8 +63,13 @@ def get_trace_timeline(trace_id: str, db: Session = Depends(get_db)):
             "status": r.status_hint,
             "summary": r.path or "",
         })
+        for r in inbound_rows
+    ])
 
-    outbox_rows = db.execute(select(Outbox).order_by(Outbox.created_at.desc()).limit(1000)).scalars().all()
+    outbox_rows = db.execute(
+        select(Outbox).where(Outbox.trace_id == trace_id).order_by(Outbox.created_at)
+    ).scalars().all()
+    outbox_items = []
     for r in outbox_rows:
         payload = {}
         if r.payload_json:
@@ -57,9 +77,7 @@ def get_trace_timeline(trace_id: str, db: Session = Depends(get_db)):
                 payload = json.loads(r.payload_json) if isinstance(r.payload_json, str) else (r.payload_json or {})
             except Exception:
                 payload = {}
-        if str(payload.get("trace_id") or "") != trace_id:
-            continue
-        items.append({
+        outbox_items.append((_sort_ts(r.created_at), {
             "source": "outbox",
             "id": r.id,
             "created_at": r.created_at.isoformat() if r.created_at else None,
@@ -67,15 +85,28 @@ def get_trace_timeline(trace_id: str, db: Session = Depends(get_db)):
             "kind": payload.get("kind") or "outbox",
             "status": r.status,
             "summary": (r.error_message or "")[:200],
+        }))
+    streams.append(outbox_items)
+
+    job_rows = db.execute(
+        select(KBJob).where(KBJob.trace_id == trace_id).order_by(KBJob.created_at)
+    ).scalars().all()
+    streams.append([
+        (_sort_ts(r.created_at), {
+            "source": "kb_job",
+            "id": r.id,
+            "created_at": r.created_at.isoformat() if r.created_at else None,
+            "portal_id": r.portal_id,
+            "kind": r.job_type,
+            "status": r.status,
+            "summary": (r.error_message or "")[:200],
         })
+        for r in job_rows
+    ])
 
+    items = [item for _ts, item in heapq.merge(*streams, key=lambda x: x[0])]
     if not items:
         raise HTTPException(status_code=404, detail="Трейс не найден")
-
-    def _sort_key(x: dict):
-        return x.get("created_at") or ""
-
-    items.sort(key=_sort_key)
     return {"trace_id": trace_id, "items": items}
 
 
@@ -19,7 +19,7 @@ from typing import Any
 logger = logging.getLogger(__name__)
 
 from fastapi import APIRouter, Request, Depends, UploadFile, File, HTTPException, Form
-from fastapi.responses import RedirectResponse, JSONResponse, HTMLResponse, PlainTextResponse, FileResponse
+from fastapi.responses import RedirectResponse, JSONResponse, HTMLResponse, PlainTextResponse, FileResponse, Response
 
 from pydantic import BaseModel, EmailStr
 
@@ -57,6 +57,7 @@ from apps.backend.services.bitrix_events import process_imbot_message
 from apps.backend.services.portal_tokens import save_tokens, get_valid_access_token, BitrixAuthError, refresh_portal_tokens
 from apps.backend.services.token_crypto import encrypt_token
 from apps.backend.services.kb_storage import ensure_portal_dir, save_upload
+from apps.backend.services.kb_preview import cached_preview_path, request_preview
 from apps.backend.services.billing import (
     get_account_bitrix_portal_count,
     get_account_effective_policy,
@@ -84,12 +85,21 @@ from apps.backend.services.kb_acl import (
     resolve_kb_acl_access,
 )
 from apps.backend.services.kb_rag import answer_from_kb
+from apps.backend.services.kb_access_map import access_rows, effective_level, readable_file_ids
+from apps.backend.services.kb_catalog import catalog_etag, catalog_page, describe_files
+from apps.backend.services.kb_file_profiles import (
+    KB_TOPICS,
+    auto_topic_candidates,
+    drop_file_profile,
+    topic_file_ids,
+    topic_memberships,
+)
 from apps.backend.services.gigachat_client import list_models, DEFAULT_API_BASE
 from apps.backend.services.kb_settings import get_valid_gigachat_access_token
 from apps.backend.services.portal_tokens import get_access_token
 from apps.backend.services.bot_provisioning import ensure_bot_registered
-from apps.backend.services.finalize_install import step_provision_chats, _now_trace_id
-from apps.backend.services.finalize_install import finalize_install, step_provision_chats
+from apps.backend.services.finalize_install import finalize_install, _now_trace_id
+from apps.backend.services.welcome_fanout import DEFAULT_WELCOME, create_fanout, enqueue_fanout, fanout_status
 from apps.backend.services.bot_provisioning import ensure_bot_registered
 from apps.backend.clients.bitrix import imbot_bot_list, BOT_CODE_DEFAULT
 from apps.backend.utils.bitrix_request import parse_bitrix_body
@@ -117,7 +127,10 @@ from apps.backend.clients.telegram import telegram_get_me, telegram_set_webhook
 from apps.backend.services.web_email import create_email_token, send_registration_email
 from apps.backend.services.rbac_service import ensure_account_member, ensure_rbac_for_web_user
 from apps.backend.services.account_workspace import build_unique_account_slug
-from apps.backend.services.transcript_utils import merge_transcript_items
+from apps.backend.services.transcript_store import (
+    load_meta as load_transcript_meta,
+    read_window as read_transcript_window,
+)
 from apps.backend.utils.api_errors import error_envelope
 from apps.backend.utils.api_schema import is_schema_v2
 
@@ -1166,7 +1179,7 @@ async def bitrix_app_provision(request: Request, body: AppStatusBody, db: Sessio
         select(PortalUsersAccess.user_id).where(PortalUsersAccess.portal_id == portal.id)
     ).scalars().all()
     user_ids = []
-    for (uid,) in allowlist_rows:
+    for uid in allowlist_rows:
         try:
             user_ids.append(int(uid))
         except (TypeError, ValueError):
@@ -1174,14 +1187,16 @@ async def bitrix_app_provision(request: Request, body: AppStatusBody, db: Sessio
     if not user_ids:
         return JSONResponse({"status": "ok", "ok_count": 0, "failed_count": 0, "trace_id": _trace_id(request)})
     trace_id = _trace_id(request)
-    welcome_msg = (getattr(portal, "welcome_message", None) or "").strip() or "Привет! Я Teachbase AI. Напишите «ping» — отвечу «pong»."
-    res = step_provision_chats(db, portal.id, domain_full, access_token, bot_id, user_ids, trace_id, welcome_message=welcome_msg)
+    welcome_msg = (getattr(portal, "welcome_message", None) or "").strip() or DEFAULT_WELCOME
+    fanout = create_fanout(db, portal_id=portal.id, bot_id=bot_id, user_ids=user_ids, trace_id=trace_id, welcome_message=welcome_msg)
+    handle = enqueue_fanout(db, fanout, domain=domain_full, access_token=access_token)
     return JSONResponse({
-        "status": res.get("status"),
-        "ok_count": res.get("ok", 0),
-        "failed_count": len(res.get("failed", [])),
+        "status": handle["status"],
+        "ok_count": handle["sent"] + handle["skipped"],
+        "failed_count": handle["failed_count"],
         "trace_id": trace_id,
-        "failed": res.get("failed", []),
+        "failed": handle["failed"],
+        "fanout": handle,
     })
 
 
@@ -1512,6 +1527,7 @@ class TelegramBotSettingsBody(BaseModel):
     enabled: bool | None = None
     clear_token: bool = False
     allow_uploads: bool | None = None
+    polling: bool | None = None  # receive updates by getUpdates (bot behind NAT) instead of the webhook
 
 
 class WebAccessUserBody(BaseModel):
@@ -1678,73 +1694,6 @@ def _resolve_uploader(db: Session, portal_id: int, request: Request) -> tuple[st
     return "bitrix", str(uid), f"Bitrix user {uid}"
 
 
-_KB_TOPICS = [
-    {
-        "id": "product",
-        "name": "\u041f\u0440\u043e\u0434\u0443\u043a\u0442 \u0438 \u0444\u0443\u043d\u043a\u0446\u0438\u043e\u043d\u0430\u043b\u044c\u043d\u043e\u0441\u0442\u044c",
-        "keywords": [
-            "\u0444\u0443\u043d\u043a\u0446\u0438\u0438", "\u0444\u0443\u043d\u043a\u0446\u0438\u043e\u043d\u0430\u043b", "feature", "\u0432\u043e\u0437\u043c\u043e\u0436\u043d\u043e\u0441\u0442\u0438", "\u043f\u043b\u0430\u0442\u0444\u043e\u0440\u043c\u0430",
-            "rag", "\u0431\u0430\u0437\u0430 \u0437\u043d\u0430\u043d\u0438\u0439", "\u043c\u043e\u0434\u0435\u043b\u0438", "\u0438\u043d\u0442\u0435\u0440\u0444\u0435\u0439\u0441",
-            "\u043a\u043e\u043d\u0441\u0442\u0440\u0443\u043a\u0442\u043e\u0440", "\u0441\u0446\u0435\u043d\u0430\u0440\u0438\u0439", "\u0447\u0430\u0442-\u0431\u043e\u0442",
-        ],
-    },
-    {
-        "id": "pricing",
-        "name": "\u0422\u0430\u0440\u0438\u0444\u044b \u0438 \u0446\u0435\u043d\u044b",
-        "keywords": [
-            "\u0442\u0430\u0440\u0438\u0444", "\u0446\u0435\u043d\u0430", "\u0441\u0442\u043e\u0438\u043c\u043e\u0441\u0442\u044c", "\u043e\u043f\u043b\u0430\u0442\u0430", "\u043f\u043e\u0434\u043f\u0438\u0441\u043a\u0430", "billing",
-            "\u0441\u0447\u0435\u0442", "\u043f\u0440\u0430\u0439\u0441", "invoice",
-        ],
-    },
-    {
-        "id": "integrations",
-        "name": "\u0418\u043d\u0442\u0435\u0433\u0440\u0430\u0446\u0438\u0438 \u0438 \u043f\u0440\u043e\u0446\u0435\u0441\u0441\u044b",
-        "keywords": [
-            "\u0438\u043d\u0442\u0435\u0433\u0440\u0430\u0446\u0438\u044f", "\u0438\u043d\u0442\u0435\u0433\u0440\u0430\u0446\u0438\u0438", "crm", "bitrix", "\u0431\u0438\u0442\u0440\u0438\u043a\u0441", "amo",
-            "webhook", "api", "oauth", "telegram",
-        ],
-    },
-    {
-        "id": "sales",
-        "name": "\u041f\u0440\u043e\u0434\u0430\u0436\u0438 \u0438 \u043a\u0432\u0430\u043b\u0438\u0444\u0438\u043a\u0430\u0446\u0438\u044f",
-        "keywords": [
-            "\u043f\u0440\u043e\u0434\u0430\u0436", "\u043b\u0438\u0434", "\u0432\u043e\u0440\u043e\u043d\u043a\u0430", "\u0441\u0434\u0435\u043b\u043a", "\u043a\u043e\u043d\u0432\u0435\u0440\u0441\u0438\u044f",
-            "qualification", "offer", "objection", "cta",
-        ],
-    },
-    {
-        "id": "support",
-        "name": "\u041f\u043e\u0434\u0434\u0435\u0440\u0436\u043a\u0430 \u0438 \u0441\u0435\u0440\u0432\u0438\u0441",
-        "keywords": [
-            "\u043f\u043e\u0434\u0434\u0435\u0440\u0436\u043a", "\u0438\u043d\u0446\u0438\u0434\u0435\u043d\u0442", "\u043e\u0448\u0438\u0431\u043a", "\u0442\u0438\u043a\u0435\u0442",
-            "sla", "support", "\u0441\u0435\u0440\u0432\u0438\u0441", "\u043f\u043e\u043c\u043e\u0449",
-        ],
-    },
-    {
-        "id": "hr",
-        "name": "HR \u0438 \u043a\u043e\u043c\u0430\u043d\u0434\u0430",
-        "keywords": [
-            "\u0441\u043e\u0442\u0440\u0443\u0434\u043d\u0438\u043a", "\u043a\u043e\u043c\u0430\u043d\u0434", "\u043d\u0430\u0439\u043c", "\u0432\u0430\u043a\u0430\u043d\u0441", "hr",
-            "\u043e\u043d\u0431\u043e\u0440\u0434\u0438\u043d\u0433", "\u043e\u0431\u0443\u0447\u0435\u043d\u0438\u0435",
-        ],
-    },
-    {
-        "id": "analytics",
-        "name": "\u0410\u043d\u0430\u043b\u0438\u0442\u0438\u043a\u0430 \u0438 \u043c\u0435\u0442\u0440\u0438\u043a\u0438",
-        "keywords": [
-            "\u0430\u043d\u0430\u043b\u0438\u0442\u0438\u043a", "\u043e\u0442\u0447\u0435\u0442", "\u043c\u0435\u0442\u0440\u0438\u043a", "retention",
-            "ret3", "dashboard", "\u043a\u043e\u0433\u043e\u0440\u0442", "\u0441\u0442\u0430\u0442\u0438\u0441\u0442\u0438\u043a",
-        ],
-    },
-]
-
-def _topic_matches(text: str, keywords: list[str]) -> bool:
-    t = (text or "").lower()
-    if not t:
-        return False
-    return any(k in t for k in keywords)
-
-
 def _make_chunk_anchor(
     chunk_index: int | None,
     page_num: int | None,
@@ -1890,58 +1839,10 @@ def _resolve_scope_file_ids(
             if topic:
                 topic_keys.add(topic.lower())
         if topic_keys:
-            trows = db.execute(
-                select(KBFile.id, KBFile.filename, KBChunk.text)
-                .join(KBChunk, KBChunk.file_id == KBFile.id)
-                .where(file_scope_predicate, KBFile.audience == audience)
-                .limit(8000)
-            ).all()
-            hit_ids: set[int] = set()
-            for fid, fname, txt in trows:
-                hay = f"{fname or ''} {txt or ''}".lower()
-                matched = False
-                for t in _KB_TOPICS:
-                    k = str(t["id"]).lower()
-                    n = str(t["name"]).lower()
-                    if k in topic_keys or n in topic_keys:
-                        if _topic_matches(hay, t["keywords"]):
-                            matched = True
-                            break
-                if not matched:
-                    for key in topic_keys:
-                        if key and key in hay:
-                            matched = True
-                            break
-                if matched:
-                    hit_ids.add(int(fid))
-            scopes.append(hit_ids)
+            scopes.append(topic_file_ids(db, topic_keys, file_scope_predicate, KBFile.audience == audience))
     tids = [str(x).strip().lower() for x in (topic_ids or []) if str(x).strip()]
     if tids:
-        trows = db.execute(
-            select(KBFile.id, KBFile.filename, KBChunk.text)
-            .join(KBChunk, KBChunk.file_id == KBFile.id)
-            .where(file_scope_predicate, KBFile.audience == audience)
-            .limit(8000)
-        ).all()
-        hit_ids: set[int] = set()
-        for fid, fname, txt in trows:
-            hay = f"{fname or ''} {txt or ''}".lower()
-            matched = False
-            for t in _KB_TOPICS:
-                k = str(t["id"]).lower()
-                n = str(t["name"]).lower()
-                if k in tids or n in tids:
-                    if _topic_matches(hay, t["keywords"]):
-                        matched = True
-                        break
-            if not matched:
-                for key in tids:
-                    if key and key in hay:
-                        matched = True
-                        break
-            if matched:
-                hit_ids.add(int(fid))
-        scopes.append(hit_ids)
+        scopes.append(topic_file_ids(db, tids, file_scope_predicate, KBFile.audience == audience))
     if not scopes:
         return None
     out = scopes[0].copy()
@@ -1989,50 +1890,14 @@ def _filter_file_ids_by_kb_acl(
     role: str | None,
     audience: str | None,
 ) -> set[int]:
-    if not file_ids:
-        return set()
-    rows = db.execute(
-        select(KBFile.id, KBFile.folder_id).where(KBFile.id.in_(sorted(file_ids)))
-    ).all()
-    folder_ids = sorted({int(folder_id) for _fid, folder_id in rows if folder_id is not None})
-    file_acl_rows = db.execute(
-        select(KBFileAccess.file_id, KBFileAccess.principal_type, KBFileAccess.principal_id, KBFileAccess.access_level)
-        .where(KBFileAccess.file_id.in_(sorted(file_ids)))
-    ).all()
-    folder_acl_rows = []
-    if folder_ids:
-        folder_acl_rows = db.execute(
-            select(KBFolderAccess.folder_id, KBFolderAccess.principal_type, KBFolderAccess.principal_id, KBFolderAccess.access_level)
-            .where(KBFolderAccess.folder_id.in_(folder_ids))
-        ).all()
-    principals = kb_acl_principals_for_membership(membership_id, role, audience, group_ids)
-    file_acl_map: dict[int, list[tuple[str, str, str]]] = {}
-    for file_id, principal_type, principal_id, access_level in file_acl_rows:
-        file_acl_map.setdefault(int(file_id), []).append(
-            (str(principal_type), str(principal_id), str(access_level))
-        )
-    folder_acl_map: dict[int, list[tuple[str, str, str]]] = {}
-    for folder_id, principal_type, principal_id, access_level in folder_acl_rows:
-        folder_acl_map.setdefault(int(folder_id), []).append(
-            (str(principal_type), str(principal_id), str(access_level))
-        )
-    allowed: set[int] = set()
-    for file_id, folder_id in rows:
-        inherited = default_kb_access_for_role(role)
-        if folder_id is not None:
-            inherited = resolve_kb_acl_access(
-                folder_acl_map.get(int(folder_id), []),
-                principals,
-                inherited,
-            )
-        effective = resolve_kb_acl_access(
-            file_acl_map.get(int(file_id), []),
-            principals,
-            inherited,
-        )
-        if kb_access_allows_read(effective):
-            allowed.add(int(file_id))
-    return allowed
+    return readable_file_ids(
+        db,
+        file_ids,
+        membership_id=membership_id,
+        group_ids=group_ids,
+        role=role,
+        audience=audience,
+    )
 
 
 def _file_has_kb_acl_access(
@@ -2176,58 +2041,19 @@ def _kb_client_access_summary(db: Session, portal_id: int, folder_id: int | None
     }
 
 
-def _kb_file_access_badges(db: Session, file_rec: KBFile) -> dict[str, str]:
-    folder_access_rows = []
-    if file_rec.folder_id:
-        folder_access_rows = db.execute(
-            select(KBFolderAccess.principal_type, KBFolderAccess.principal_id, KBFolderAccess.access_level)
-            .where(KBFolderAccess.folder_id == int(file_rec.folder_id))
-        ).all()
-    file_access_rows = db.execute(
-        select(KBFileAccess.principal_type, KBFileAccess.principal_id, KBFileAccess.access_level)
-        .where(KBFileAccess.file_id == int(file_rec.id))
-    ).all()
-    folder_rules = [(str(pt), str(pid), str(level or "none")) for pt, pid, level in folder_access_rows]
-    file_rules = [(str(pt), str(pid), str(level or "none")) for pt, pid, level in file_access_rows]
-
+def _kb_file_access_badges(db: Session, file_ids: list[int]) -> dict[int, dict[str, str]]:
     staff_principals = kb_acl_principals_for_membership(None, "member", "staff", [])
     client_principals = kb_acl_principals_for_membership(None, "client", "client", [])
-    staff_base = default_kb_access_for_role("member")
-    client_base = default_kb_access_for_role("client")
-    if file_rec.folder_id:
-        staff_base = resolve_kb_acl_access(folder_rules, staff_principals, staff_base)
-        client_base = resolve_kb_acl_access(folder_rules, client_principals, client_base)
-    staff_effective = resolve_kb_acl_access(file_rules, staff_principals, staff_base)
-    client_effective = resolve_kb_acl_access(file_rules, client_principals, client_base)
-
-    client_group_only = False
-    if not kb_access_allows_read(client_effective):
-        has_client_group_rule = any(
-            principal_type == "group" and kb_access_allows_read(access_level)
-            for principal_type, _principal_id, access_level in (folder_rules + file_rules)
+    out: dict[int, dict[str, str]] = {}
+    for file_id, rows in access_rows(db, file_ids).items():
+        staff_effective = effective_level(rows, staff_principals, "member")
+        client_effective = effective_level(rows, client_principals, "client")
+        client_group_only = (
+            not kb_access_allows_read(client_effective)
+            and any(principal_type == "group" and kb_access_allows_read(access_level) for principal_type, _pid, access_level in rows)
         )
-        if has_client_group_rule:
-            client_group_only = True
-
-    if kb_access_allows_manage(staff_effective):
-        staff_badge = "staff_manage"
-    elif kb_access_allows_edit(staff_effective):
-        staff_badge = "staff_edit"
-    elif kb_access_allows_upload(staff_effective):
-        staff_badge = "staff_upload"
-    elif staff_effective == "read":
-        staff_badge = "staff_read"
-    else:
-        staff_badge = "staff_none"
-
-    if kb_access_allows_read(client_effective):
-        client_badge = "client_all"
-    elif client_group_only:
-        client_badge = "client_groups"
-    else:
-        client_badge = "client_none"
-
-    return {"staff": staff_badge, "client": client_badge}
+        out[file_id] = _kb_access_badges(staff_effective, client_effective, client_group_only)
+    return out
 
 
 def _kb_folder_access_badges(db: Session, folder_id: int) -> dict[str, str]:
@@ -2244,6 +2070,10 @@ def _kb_folder_access_badges(db: Session, folder_id: int) -> dict[str, str]:
         not kb_access_allows_read(client_effective)
         and any(principal_type == "group" and kb_access_allows_read(access_level) for principal_type, _pid, access_level in rules)
     )
+    return _kb_access_badges(staff_effective, client_effective, client_group_only)
+
+
+def _kb_access_badges(staff_effective: str, client_effective: str, client_group_only: bool) -> dict[str, str]:
     if kb_access_allows_manage(staff_effective):
         staff_badge = "staff_manage"
     elif kb_access_allows_edit(staff_effective):
@@ -2297,54 +2127,6 @@ def _is_two_part_topic_name(name: str) -> bool:
     return re.search(r"\b[^\W\d_]+\b\s+и\s+\b[^\W\d_]+\b", n, flags=re.IGNORECASE) is not None
 
 
-_AUTO_TOPIC_STOPWORDS = {
-    "\u0447\u0442\u043e", "\u043a\u0430\u043a", "\u044d\u0442\u043e", "\u0434\u043b\u044f", "\u0438\u043b\u0438", "\u043a\u043e\u0433\u0434\u0430", "\u0433\u0434\u0435", "\u0447\u0442\u043e\u0431\u044b", "\u0435\u0441\u043b\u0438", "\u043f\u0440\u0438",
-    "\u0435\u0441\u0442\u044c", "\u043d\u0435\u0442", "\u0431\u044b\u0442\u044c", "\u0431\u0443\u0434\u0435\u0442", "\u043f\u043e\u0441\u043b\u0435", "\u043f\u0435\u0440\u0435\u0434", "\u043c\u0435\u0436\u0434\u0443", "\u043d\u0430\u0434", "\u043f\u043e\u0434",
-    "\u043f\u0440\u043e", "also", "with", "from", "into", "your", "ours", "they", "them",
-    "\u043a\u043e\u0442\u043e\u0440\u044b\u0439", "\u043a\u043e\u0442\u043e\u0440\u0430\u044f", "\u043a\u043e\u0442\u043e\u0440\u044b\u0435", "\u043a\u043e\u0442\u043e\u0440\u044b\u0445", "\u044d\u0442\u043e\u0442", "\u044d\u0442\u0430", "\u044d\u0442\u0438", "\u0442\u043e\u0433\u043e",
-    "\u0432\u0441\u0435\u0433\u043e", "\u0432\u0441\u0435\u0445", "\u043c\u043e\u0436\u043d\u043e", "\u043d\u0443\u0436\u043d\u043e", "\u043e\u0447\u0435\u043d\u044c", "\u0431\u043e\u043b\u0435\u0435", "\u043c\u0435\u043d\u0435\u0435", "\u0442\u0430\u043a\u0436\u0435",
-}
-
-
-def _auto_topic_candidates(
-    file_texts: list[tuple[int, str]],
-    threshold: int,
-    excluded_tokens: set[str],
-    limit: int = 8,
-) -> list[dict[str, Any]]:
-    if not file_texts:
-        return []
-    token_to_files: dict[str, set[int]] = {}
-    for file_id, text in file_texts:
-        tokens = set(re.findall(r"[a-zA-Zа-яА-ЯёЁ0-9]{4,}", (text or "").lower()))
-        for token in tokens:
-            if token in _AUTO_TOPIC_STOPWORDS:
-                continue
-            if token.isdigit():
-                continue
-            if token in excluded_tokens:
-                continue
-            if len(token) > 40:
-                continue
-            token_to_files.setdefault(token, set()).add(int(file_id))
-    ranked = sorted(
-        ((tok, ids) for tok, ids in token_to_files.items() if len(ids) >= threshold),
-        key=lambda x: (-len(x[1]), x[0]),
-    )
-    out: list[dict[str, Any]] = []
-    for tok, ids in ranked[: max(1, limit)]:
-        out.append(
-            {
-                "id": f"auto:{tok}",
-                "name": tok.capitalize(),
-                "count": len(ids),
-                "file_ids": sorted(ids),
-                "auto": True,
-            }
-        )
-    return out
-
-
 @router.post("/portals/{portal_id}/web/register")
 async def register_web_from_bitrix(
     request: Request,
@@ -2694,6 +2476,13 @@ async def get_portal_access_users(
 async def get_portal_kb_files(
     portal_id: int,
     request: Request,
+    limit: int = 200,
+    cursor: str | None = None,
+    sort: str = "created",
+    folder_id: int | None = None,
+    status: str | None = None,
+    audience: str | None = None,
+    q: str | None = None,
     db: Session = Depends(get_db),
     pid: int = Depends(require_portal_access),
 ):
@@ -2701,33 +2490,84 @@ async def get_portal_kb_files(
         return _err(request, "forbidden", "Forbidden", 403)
     _require_portal_admin(db, portal_id, request)
     portal = db.get(Portal, int(portal_id))
-    q = select(KBFile, KBSource.source_type, KBSource.url).join(KBSource, KBSource.id == KBFile.source_id, isouter=True)
+    scope_portal_ids = _account_scope_portal_ids(db, portal_id)
     if portal and portal.account_id:
-        q = q.where(
+        conditions = [
             sa.or_(
                 KBFile.account_id == int(portal.account_id),
-                sa.and_(KBFile.account_id.is_(None), KBFile.portal_id.in_(_account_scope_portal_ids(db, portal_id))),
+                sa.and_(KBFile.account_id.is_(None), KBFile.portal_id.in_(scope_portal_ids)),
             )
-        )
+        ]
+        folder_conditions = [
+            sa.or_(
+                KBFolder.account_id == int(portal.account_id),
+                sa.and_(KBFolder.account_id.is_(None), KBFolder.portal_id.in_(scope_portal_ids)),
+            )
+        ]
     else:
-        q = q.where(KBFile.portal_id.in_(_account_scope_portal_ids(db, portal_id)))
-    q = q.order_by(KBFile.id.desc()).limit(200)
-    rows = db.execute(q).all()
-    # show only the latest entry per filename to hide stale errors
-    seen: set[str] = set()
+        conditions = [KBFile.portal_id.in_(scope_portal_ids)]
+        folder_conditions = [KBFolder.portal_id.in_(scope_portal_ids)]
+    if folder_id is not None:
+        conditions.append(KBFile.folder_id == int(folder_id))
+    if status:
+        conditions.append(KBFile.status == str(status).strip().lower())
+    if audience:
+        conditions.append(KBFile.audience == str(audience).strip().lower())
+    if q and q.strip():
+        conditions.append(KBFile.filename.ilike(f"%{q.strip()}%"))
+    lim = max(1, min(int(limit or 200), 500))
+
+    acl_by_audience = {
+        aud: _portal_acl_subject_ctx(db, portal_id=portal_id, request=request, audience=aud)
+        for aud in ("staff", "client")
+    }
+    etag = catalog_etag(
+        db,
+        scope_portal_ids,
+        sorted((aud, ctx.get("membership_id"), sorted(ctx.get("group_ids") or []), ctx.get("role")) for aud, ctx in acl_by_audience.items()),
+        lim,
+        cursor,
+        sort,
+        folder_id,
+        status,
+        audience,
+        q,
+    )
+    if (request.headers.get("if-none-match") or "").strip() == etag:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
+    def _readable(files: list[KBFile]) -> set[int]:
+        by_audience: dict[str, set[int]] = {}
+        for f in files:
+            by_audience.setdefault(str(f.audience or "staff"), set()).add(int(f.id))
+        allowed: set[int] = set()
+        for aud, ids in by_audience.items():
+            acl_ctx = acl_by_audience.get(aud) or _portal_acl_subject_ctx(db, portal_id=portal_id, request=request, audience=aud)
+            allowed |= _filter_file_ids_by_kb_acl(
+                db,
+                file_ids=ids,
+                membership_id=acl_ctx.get("membership_id"),
+                group_ids=acl_ctx.get("group_ids"),
+                role=acl_ctx.get("role"),
+                audience=acl_ctx.get("audience"),
+            )
+        return allowed
+
+    # only the latest readable entry per filename is listed, to hide stale errors
+    rows, next_cursor = catalog_page(db, conditions, readable=_readable, sort=sort, cursor=cursor, limit=lim)
+    files = [f for f, _source_type, _source_url in rows]
+    badges_by_file = _kb_file_access_badges(db, [int(f.id) for f in files])
+    details = describe_files(db, files, folder_conditions)
     items = []
     for f, source_type, source_url in rows:
-        if not _acl_guard_file(db, file_rec=f, portal_id=portal_id, request=request):
-            continue
-        key = (f.filename or f.storage_path or str(f.id)).lower()
-        if key in seen:
-            continue
-        seen.add(key)
-        badges = _kb_file_access_badges(db, f)
+        badges = badges_by_file.get(int(f.id), {"staff": "staff_none", "client": "client_none"})
         items.append({
             "id": f.id,
             "filename": f.filename,
             "folder_id": f.folder_id,
+            "folder_path": details["folder_path"].get(int(f.id)),
+            "collection_ids": details["collection_ids"].get(int(f.id), []),
+            "chunk_count": details["chunk_count"].get(int(f.id), 0),
             "mime_type": f.mime_type,
             "source_type": source_type,
             "source_url": source_url,
@@ -2744,7 +2584,10 @@ async def get_portal_kb_files(
             "access_badges": badges,
             "created_at": f.created_at.isoformat() if f.created_at else None,
         })
-    return JSONResponse({"items": items})
+    resp = JSONResponse({"items": items, "next_cursor": next_cursor})
+    resp.headers["ETag"] = etag
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
 
 
 @router.get("/portals/{portal_id}/kb/access-summary")
@@ -3235,6 +3078,7 @@ async def delete_kb_file(
     if chunk_ids:
         db.execute(delete(KBEmbedding).where(KBEmbedding.chunk_id.in_(chunk_ids)))
         db.execute(delete(KBChunk).where(KBChunk.id.in_(chunk_ids)))
+    drop_file_profile(db, int(rec.id))
     # remove file from disk
     try:
         if rec.storage_path and os.path.exists(rec.storage_path):
@@ -3297,17 +3141,17 @@ async def get_kb_file_signed_url(
     if rend not in ("original", "preview_pdf"):
         rend = "original"
     if rend == "preview_pdf":
-        candidate = f"{rec.storage_path}.preview.pdf" if rec.storage_path else ""
-        if (not candidate or not os.path.exists(candidate)) and rec.storage_path and os.path.exists(rec.storage_path):
-            # Best-effort on-demand rendition for already indexed files.
-            try:
-                from apps.backend.services.kb_ingest import _generate_preview_pdf  # type: ignore
-                _generate_preview_pdf(rec.storage_path)
-            except Exception:
-                pass
-        if not candidate or not os.path.exists(candidate):
-            return _err(request, "preview_missing", "preview_missing", 404)
-        _backfill_chunk_pages_from_preview(db, rec, candidate)
+        preview = request_preview(db, rec)
+        if preview["status"] == "pending":
+            # Rendering runs on the preview queue; the client polls this endpoint.
+            return JSONResponse(
+                {"status": "pending", "retry_after_ms": 1500},
+                status_code=202,
+                headers={"Retry-After": "2"},
+            )
+        if preview["status"] != "ready":
+            return _err(request, "preview_missing", "preview_missing", 404, detail=preview["status"])
+        _backfill_chunk_pages_from_preview(db, rec, preview["path"])
     sig = _make_file_sig(portal_id, file_id, exp, inl, rend)
     url = f"/api/v1/bitrix/portals/{portal_id}/kb/files/{file_id}/content?exp={exp}&inline={inl}&rendition={rend}&sig={sig}"
     return JSONResponse({"url": url, "expires_at": exp})
@@ -3340,17 +3184,9 @@ async def get_kb_file_content(
     filename = rec.filename or (os.path.basename(rec.storage_path) if rec.storage_path else "file")
     media_type = rec.mime_type or "application/octet-stream"
     if rend == "preview_pdf":
-        candidate = f"{rec.storage_path}.preview.pdf" if rec.storage_path else ""
-        if (not candidate or not os.path.exists(candidate)) and rec.storage_path and os.path.exists(rec.storage_path):
-            # Best-effort on-demand rendition for already indexed files.
-            try:
-                from apps.backend.services.kb_ingest import _generate_preview_pdf  # type: ignore
-                _generate_preview_pdf(rec.storage_path)
-            except Exception:
-                pass
-        if not candidate or not os.path.exists(candidate):
+        candidate = cached_preview_path(rec)
+        if not candidate:
             return _err(request, "preview_missing", "preview_missing", 404)
-        _backfill_chunk_pages_from_preview(db, rec, candidate)
         storage_path = candidate
         stem = os.path.splitext(filename or "file")[0]
         filename = f"{stem}.preview.pdf"
@@ -3511,6 +3347,9 @@ async def get_kb_file_transcript(
     request: Request,
     limit: int = 2000,
     mode: str = "merged",
+    cursor: int = 0,
+    from_ms: int | None = None,
+    to_ms: int | None = None,
     db: Session = Depends(get_db),
     pid: int = Depends(require_portal_access),
 ):
@@ -3525,58 +3364,45 @@ async def get_kb_file_transcript(
     if not is_media_transcription_enabled(db, portal_id):
         return _err(request, "feature_not_enabled", "feature_not_enabled", 403)
     lim = max(1, min(int(limit or 2000), 5000))
-    # Preferred source for transcript panel: raw transcript segments from ingest file.
-    # This avoids showing RAG chunks as if they were transcript turns.
-    transcript_jsonl_path = (rec.storage_path or "") + ".transcript.jsonl"
-    items = []
-    if transcript_jsonl_path and os.path.exists(transcript_jsonl_path):
-        try:
-            with open(transcript_jsonl_path, "r", encoding="utf-8", errors="ignore") as f:
-                for idx, line in enumerate(f):
-                    if idx >= lim:
-                        break
-                    line = (line or "").strip()
-                    if not line:
-                        continue
-                    try:
-                        row = json.loads(line)
-                    except Exception:
-                        continue
-                    text = str(row.get("text") or "").strip()
-                    if not text:
-                        continue
-                    items.append(
-                        {
-                            "id": -1 - idx,  # synthetic id for transcript rows
-                            "chunk_index": idx,
-                            "speaker": (str(row.get("speaker") or "").strip() or "Спикер A"),
-                            "text": text,
-                            "start_ms": int(row.get("start_ms") or 0),
-                            "end_ms": int(row.get("end_ms") or 0),
-                        }
-                    )
-        except Exception:
-            items = []
-
-    raw_items = items
     is_raw_mode = (mode or "merged").strip().lower() == "raw"
-    if not is_raw_mode:
-        items = merge_transcript_items(items)
-
+    mode_name = "raw" if is_raw_mode else "merged"
+    # Transcript panel reads the merged/indexed store written at ingest end
+    # (rebuilt lazily for legacy files), never RAG chunks.
+    meta = load_transcript_meta(rec.storage_path or "") if rec.storage_path else None
     status = (rec.transcript_status or "").strip().lower() or "ready"
-    if not items and status == "ready":
+    etag = None
+    if meta:
+        etag = f'W/"{meta.get("etag")}:{mode_name}:{int(cursor or 0)}:{lim}:{from_ms}:{to_ms}:{status}"'
+        if (request.headers.get("if-none-match") or "").strip() == etag:
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+    window = read_transcript_window(
+        rec.storage_path or "",
+        mode=mode_name,
+        cursor=int(cursor or 0),
+        limit=lim,
+        from_ms=from_ms,
+        to_ms=to_ms,
+        meta=meta,
+    ) if meta else {"items": [], "next_cursor": None}
+    items = window["items"]
+    if not items and status == "ready" and not int((meta or {}).get("raw_count") or 0):
         status = "missing"
 
-    merged_count = len(merge_transcript_items(raw_items)) if raw_items else 0
-    return JSONResponse(
+    resp = JSONResponse(
         {
             "items": items,
             "status": status,
-            "mode": "raw" if is_raw_mode else "merged",
-            "raw_count": len(raw_items),
-            "merged_count": merged_count,
+            "mode": mode_name,
+            "raw_count": int((meta or {}).get("raw_count") or 0),
+            "merged_count": int((meta or {}).get("merged_count") or 0),
+            "duration_ms": int((meta or {}).get("duration_ms") or 0),
+            "next_cursor": window.get("next_cursor"),
         }
     )
+    if etag:
+        resp.headers["ETag"] = etag
+        resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
 
 
 @router.get("/portals/{portal_id}/kb/collections")
@@ -4237,19 +4063,8 @@ async def get_kb_topics(
         audience=acl_ctx.get("audience"),
     )
     files = [(file_id, filename) for file_id, filename in files if int(file_id) in file_ids_allowed]
-    topic_hits: dict[str, list[int]] = {t["id"]: [] for t in _KB_TOPICS}
-    file_texts: list[tuple[int, str]] = []
-    for file_id, filename in files:
-        chunks = db.execute(
-            select(KBChunk.text)
-            .where(KBChunk.file_id == file_id)
-            .limit(20)
-        ).scalars().all()
-        text = (filename or "") + " " + " ".join(chunks)
-        file_texts.append((int(file_id), text))
-        for t in _KB_TOPICS:
-            if _topic_matches(text, t["keywords"]):
-                topic_hits[t["id"]].append(int(file_id))
+    file_ids_desc = [int(file_id) for file_id, _filename in files]
+    topic_hits = topic_memberships(db, file_ids_desc)
     settings = get_portal_kb_settings(db, portal_id)
     threshold = int(settings.get("smart_folder_threshold") or 5)
     if portal and portal.account_id:
@@ -4284,7 +4099,7 @@ async def get_kb_topics(
     topics_out = []
     suggestions = []
     min_count = max(1, threshold)
-    for t in _KB_TOPICS:
+    for t in KB_TOPICS:
         ids = topic_hits.get(t["id"], [])
         topics_out.append({
             "id": t["id"],
@@ -4299,12 +4114,7 @@ async def get_kb_topics(
             and str(t["name"]).strip().lower() not in existing_name_set
         ):
             suggestions.append({"id": t["id"], "name": t["name"], "count": len(ids)})
-    excluded = set()
-    for t in _KB_TOPICS:
-        for kw in t.get("keywords", []):
-            for tok in re.findall(r"[a-zA-Zа-яА-ЯёЁ0-9]{4,}", str(kw).lower()):
-                excluded.add(tok)
-    auto_topics = _auto_topic_candidates(file_texts, threshold=threshold, excluded_tokens=excluded, limit=8)
+    auto_topics = auto_topic_candidates(db, file_ids_desc, threshold=threshold, limit=8)
     for at in auto_topics:
         topics_out.append(
             {
@@ -4426,6 +4236,7 @@ class PortalKBSourceBody(BaseModel):
     url: str
     title: str | None = None
     audience: str | None = None
+    max_pages: int | None = None
 
 
 @router.post("/portals/{portal_id}/kb/settings")
@@ -4533,15 +4344,17 @@ async def set_portal_telegram_staff_settings(
         enabled=body.enabled,
         clear_token=bool(body.clear_token),
         allow_uploads=body.allow_uploads,
+        polling=body.polling,
     )
     secret = get_portal_telegram_secret(db, portal_id, "staff") or ""
     webhook_url = _telegram_webhook_url("staff", portal_id, secret) if secret else None
     webhook_ok = None
     webhook_error = None
     bot_info = None
-    if settings.get("staff", {}).get("enabled") and not webhook_url:
+    polling = bool(settings.get("staff", {}).get("polling"))
+    if settings.get("staff", {}).get("enabled") and not polling and not webhook_url:
         webhook_error = "missing_public_base_url"
-    if webhook_url and settings.get("staff", {}).get("has_token") and settings.get("staff", {}).get("enabled"):
+    if webhook_url and not polling and settings.get("staff", {}).get("has_token") and settings.get("staff", {}).get("enabled"):
         token_plain = body.bot_token or (get_portal_telegram_token_plain(db, portal_id, "staff") or "")
         if token_plain:
             bot_info, _ = telegram_get_me(token_plain)
@@ -4608,15 +4421,17 @@ async def set_portal_telegram_client_settings(
         enabled=body.enabled,
         clear_token=bool(body.clear_token),
         allow_uploads=body.allow_uploads,
+        polling=body.polling,
     )
     secret = get_portal_telegram_secret(db, portal_id, "client") or ""
     webhook_url = _telegram_webhook_url("client", portal_id, secret) if secret else None
     webhook_ok = None
     webhook_error = None
     bot_info = None
-    if settings.get("client", {}).get("enabled") and not webhook_url:
+    polling = bool(settings.get("client", {}).get("polling"))
+    if settings.get("client", {}).get("enabled") and not polling and not webhook_url:
         webhook_error = "missing_public_base_url"
-    if webhook_url and settings.get("client", {}).get("has_token") and settings.get("client", {}).get("enabled"):
+    if webhook_url and not polling and settings.get("client", {}).get("has_token") and settings.get("client", {}).get("enabled"):
         token_plain = body.bot_token or (get_portal_telegram_token_plain(db, portal_id, "client") or "")
         if token_plain:
             bot_info, _ = telegram_get_me(token_plain)
@@ -4722,7 +4537,9 @@ async def add_portal_kb_url_source(
     aud = (body.audience or "staff").strip().lower()
     if aud not in ("staff", "client"):
         aud = "staff"
-    result = create_url_source(db, owner_portal_id, body.url, body.title, audience=aud)
+    result = create_url_source(
+        db, owner_portal_id, body.url, body.title, audience=aud, max_pages=body.max_pages
+    )
     if not result.get("ok"):
         err = str(result.get("error") or "source_create_failed")
         return _err(request, err, err, 400)
@@ -4784,12 +4601,57 @@ async def list_portal_kb_sources(
             "source_type": s.source_type,
             "audience": s.audience or "staff",
             "status": s.status,
+            "max_pages": s.max_pages,
+            "last_crawled_at": s.last_crawled_at.isoformat() if s.last_crawled_at else None,
             "created_at": s.created_at.isoformat() if s.created_at else None,
             "updated_at": s.updated_at.isoformat() if s.updated_at else None,
         })
     return JSONResponse({"items": items})
 
 
+@router.post("/portals/{portal_id}/kb/sources/{source_id}/refresh")
+async def refresh_portal_kb_source(
+    portal_id: int,
+    source_id: int,
+    request: Request,
+    db: Session = Depends(get_db),
+    pid: int = Depends(require_portal_access),
+):
+    """Re-crawl a source: unchanged pages are answered with 304 and are not re-ingested."""
+    if pid != portal_id:
+        return _err(request, "forbidden", "Forbidden", 403)
+    _require_portal_admin(db, portal_id, request)
+    src = db.get(KBSource, int(source_id))
+    if not src or int(src.portal_id) not in _account_scope_portal_ids(db, portal_id):
+        return _err(request, "not_found", "Source not found", 404)
+    if src.status == "processing":
+        return _err(request, "source_busy", "Source is being processed", 409)
+    job = KBJob(
+        account_id=src.account_id,
+        portal_id=src.portal_id,
+        job_type="source",
+        status="queued",
+        payload_json={"source_id": src.id},
+    )
+    db.add(job)
+    db.commit()
+    try:
+        from redis import Redis
+        from rq import Queue
+        s = get_settings()
+        r = Redis(host=s.redis_host, port=s.redis_port)
+        q = Queue(s.rq_ingest_queue_name or "ingest", connection=r)
+        q.enqueue(
+            "apps.worker.jobs.process_kb_job",
+            job.id,
+            job_id=f"kbjob:{job.id}",
+            job_timeout=max(300, int(s.kb_job_timeout_seconds or 3600)),
+        )
+    except Exception:
+        pass
+    return JSONResponse({"ok": True, "source_id": src.id, "job_id": job.id})
+
+
 @router.put("/portals/{portal_id}/access/users")
 async def put_portal_access_users(
     portal_id: int,
@@ -4835,6 +4697,7 @@ async def put_portal_access_users(
     added = sorted(list(new_set - prev_set))
     welcome_status = "skipped"
     welcome_error = None
+    welcome_fanout_id = None
     if added:
         portal = db.execute(select(Portal).where(Portal.id == portal_id)).scalar_one_or_none()
         if portal and portal.domain:
@@ -4854,17 +4717,17 @@ async def put_portal_access_users(
                     try:
                         added_ids = [int(u) for u in added if str(u).isdigit()]
                         if added_ids:
-                            res = step_provision_chats(
+                            fanout = create_fanout(
                                 db,
-                                portal_id,
-                                portal.domain,
-                                access_token,
-                                bot_id,
-                                added_ids,
-                                trace_id,
-                                welcome_message=(getattr(portal, "welcome_message", None) or "").strip() or None,
+                                portal_id=portal_id,
+                                bot_id=bot_id,
+                                user_ids=added_ids,
+                                trace_id=trace_id,
+                                welcome_message=getattr(portal, "welcome_message", None),
                             )
-                            welcome_status = res.get("status", "error")
+                            handle = enqueue_fanout(db, fanout, domain=portal.domain, access_token=access_token)
+                            welcome_status = handle["status"]
+                            welcome_fanout_id = handle["id"]
                         else:
                             welcome_status = "skipped"
                     except Exception as e:
@@ -4883,10 +4746,24 @@ async def put_portal_access_users(
     return JSONResponse({
         "status": "ok",
         "count": len(user_ids_str),
-        "welcome": {"status": welcome_status, "error": welcome_error, "added": added},
+        "welcome": {"status": welcome_status, "error": welcome_error, "added": added, "fanout_id": welcome_fanout_id},
     })
 
 
+@router.get("/portals/{portal_id}/welcome/{fanout_id}")
+async def get_portal_welcome_fanout(
+    portal_id: int,
+    fanout_id: int,
+    db: Session = Depends(get_db),
+    pid: int = Depends(require_portal_access),
+):
+    """Прогресс рассылки welcome-сообщений (handle из install/provision)."""
+    status = fanout_status(db, fanout_id)
+    if status.get("portal_id") != portal_id:
+        return JSONResponse({"error": "not_found"}, status_code=404)
+    return JSONResponse(status)
+
+
 @router.post("/portals/{portal_id}/access/web-users")
 async def add_portal_web_user(
     portal_id: int,
@@ -7,7 +7,7 @@ from apps.backend.deps import get_db
 from apps.backend.models import PortalBotFlow
 from apps.backend.routers.bitrix import _require_portal_admin, require_portal_access
 from apps.backend.services.billing import get_portal_effective_policy
-from apps.backend.services.bot_flow_engine import execute_client_flow_preview
+from apps.backend.services.bot_flow_engine import execute_client_flow_preview, flow_stamp, publish_compiled_flow
 from apps.backend.utils.api_errors import error_envelope
 from apps.backend.utils.api_schema import is_schema_v2
 
@@ -117,8 +117,10 @@ async def publish_portal_botflow_client(
     if not row or not row.draft_json:
         return _err(request, "missing_draft", "missing_draft", 400)
     row.published_json = row.draft_json
+    row.published_version = PortalBotFlow.published_version + 1
     db.commit()
-    return JSONResponse({"status": "ok"})
+    publish_compiled_flow(portal_id, "client", flow_stamp(row), row.published_json)
+    return JSONResponse({"status": "ok", "version": row.published_version})
 
 
 @router.post("/portals/{portal_id}/botflow/client/test")
@@ -0,0 +1,23 @@
+"""Prometheus metrics of the API, RQ workers and the DB pool."""
+import hmac
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+
+from apps.backend.config import get_settings
+from apps.backend.services.metrics import render
+
+router = APIRouter()
+
+
+@router.get("/metrics", include_in_schema=False)
+def metrics(request: Request):
+    token = (get_settings().metrics_token or "").strip()
+    if not token:
+        # served only to a scraper that holds METRICS_TOKEN
+        raise HTTPException(status_code=404, detail="Not Found")
+    auth = request.headers.get("authorization") or ""
+    supplied = auth[7:].strip() if auth.lower().startswith("bearer ") else ""
+    if not hmac.compare_digest(supplied, token):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -5,17 +5,16 @@ import logging
 
 from fastapi import APIRouter, Request, Depends
 from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 
 from apps.backend.deps import get_db
 from apps.backend.utils.api_errors import error_envelope
 from apps.backend.services.telegram_settings import (
     get_portal_telegram_secret,
-    get_portal_telegram_token_plain,
     get_portal_telegram_settings,
 )
-from apps.backend.services.telegram_events import process_telegram_update
-from apps.backend.clients.telegram import telegram_send_message
+from apps.backend.services.telegram_events import dispatch_telegram_update
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -57,11 +56,8 @@ async def _handle_update(request: Request, portal_id: int, kind: str, secret: st
     if kind == "client" and not settings.get("client", {}).get("enabled"):
         return JSONResponse({"ok": True, "disabled": True})
     update = await request.json()
-    result = process_telegram_update(db, portal_id, kind, update)
-    if result.get("status") == "blocked" and result.get("reply") and result.get("chat_id"):
-        token = get_portal_telegram_token_plain(db, portal_id, kind)
-        if token:
-            telegram_send_message(token, result.get("chat_id"), result.get("reply"))
+    # Processing is blocking (DB, RAG, media download): keep it off the event loop.
+    await run_in_threadpool(dispatch_telegram_update, db, portal_id, kind, update)
     return JSONResponse({"ok": True})
 
 
@@ -23,7 +23,6 @@ from apps.backend.models.web_user import WebUser, WebSession
 from apps.backend.models.account import AppSession, AppUserWebCredential, AccountMembership, Account, AccountIntegration
 from apps.backend.services.activity import log_activity
 from apps.backend.services.portal_tokens import get_valid_access_token, BitrixAuthError
-from apps.backend.clients.bitrix import user_get
 from apps.backend.services.telegram_settings import (
     normalize_telegram_username,
     get_portal_telegram_settings,
@@ -41,8 +40,14 @@ from apps.backend.services.web_email import (
     get_valid_email_token,
     send_password_reset_email,
 )
-from apps.backend.services.identity_linking import link_or_create_app_user
-from apps.backend.services.rbac_service import ensure_rbac_for_web_user, get_account_id_by_portal_id, ensure_account_member
+from apps.backend.services.rbac_service import ensure_rbac_for_web_user, get_account_id_by_portal_id
+from apps.backend.services.bitrix_user_sync import (
+    MODES as SYNC_MODES,
+    UserSyncError,
+    enqueue_sync,
+    sync_portal_users,
+    sync_status,
+)
 from apps.backend.services.billing import get_portal_effective_policy
 
 router = APIRouter()
@@ -642,6 +647,7 @@ class TelegramBotSettingsBody(BaseModel):
     enabled: bool | None = None
     clear_token: bool = False
     allow_uploads: bool | None = None
+    polling: bool | None = None  # receive updates by getUpdates (bot behind NAT) instead of the webhook
 
 
 @router.get("/portals/{portal_id}/users")
@@ -763,6 +769,8 @@ def update_portal_access_users(
 @router.post("/portals/{portal_id}/bitrix/users/sync")
 def sync_bitrix_users(
     portal_id: int,
+    mode: str = "full",
+    background: bool = False,
     user: WebUser = Depends(_get_current_web_user),
     db: Session = Depends(get_db),
 ):
@@ -805,92 +813,46 @@ def sync_bitrix_users(
         )
         db.add(integ)
         db.flush()
-    domain_full = f"https://{portal.domain}"
-    users_list, err = user_get(domain_full, access_token, start=0, limit=200)
-    if err == "missing_scope_user":
-        raise HTTPException(status_code=403, detail="missing_scope_user")
-    if err:
-        raise HTTPException(status_code=502, detail=err)
-    existing = db.execute(
-        select(PortalUsersAccess).where(
-            PortalUsersAccess.portal_id == portal_id,
-            PortalUsersAccess.kind == "bitrix",
-        )
-    ).scalars().all()
-    existing_map = {r.user_id: r for r in existing}
-    linked_count = 0
-    membership_created_count = 0
-    skipped_count = 0
-    skipped_examples: list[dict[str, str]] = []
-    for u in users_list:
-        uid = str(u.get("ID"))
-        if not uid or uid == "None":
-            continue
-        name = (u.get("NAME") or "") + " " + (u.get("LAST_NAME") or "")
-        name = name.strip() or (u.get("EMAIL") or "")
-        email = (str(u.get("EMAIL") or "").strip().lower() or None)
-        if uid in existing_map:
-            row = existing_map[uid]
-            if name:
-                row.display_name = name
-            db.add(row)
-        else:
-            db.add(PortalUsersAccess(
+    mode = (mode or "full").strip().lower()
+    if mode not in SYNC_MODES:
+        raise HTTPException(status_code=400, detail="invalid_mode")
+    if background:
+        try:
+            queued = enqueue_sync(
+                db,
                 portal_id=portal_id,
-                user_id=uid,
-                display_name=name,
-                kind="bitrix",
-            ))
-        link_result = link_or_create_app_user(
+                account_id=int(account_id),
+                integration_id=int(integ.id),
+                mode=mode,
+            )
+        except UserSyncError as e:
+            raise HTTPException(status_code=503, detail=e.code)
+        return {"status": "queued" if queued else "already_running", "sync": sync_status(db, portal_id)}
+    try:
+        return sync_portal_users(
             db,
-            provider="bitrix",
+            portal_id=portal_id,
+            domain=portal.domain,
+            access_token=access_token,
+            account_id=int(account_id),
             integration_id=int(integ.id),
-            external_id=uid,
-            display_value=name or email or f"Bitrix user {uid}",
-            email=email,
-            auto_create_user=True,
-            meta_json={
-                "email": email,
-                "name": (u.get("NAME") or None),
-                "last_name": (u.get("LAST_NAME") or None),
-                "portal_id": int(portal_id),
-            },
+            mode=mode,
         )
-        if link_result.user_id:
-            _membership, created = ensure_account_member(
-                db,
-                account_id=int(account_id),
-                user_id=int(link_result.user_id),
-                role="member",
-                status="active",
-                kb_access="none",
-                can_invite_users=False,
-                can_manage_settings=False,
-                can_view_finance=False,
-            )
-            linked_count += 1
-            membership_created_count += 1 if created else 0
-        else:
-            skipped_count += 1
-            if len(skipped_examples) < 10:
-                skipped_examples.append(
-                    {
-                        "external_id": uid,
-                        "email": email or "",
-                        "reason": link_result.reason or link_result.status,
-                    }
-                )
-    db.commit()
-    return {
-        "status": "ok",
-        "count": len(users_list),
-        "identity_linking": {
-            "linked": linked_count,
-            "memberships_created": membership_created_count,
-            "skipped": skipped_count,
-            "examples": skipped_examples,
-        },
-    }
+    except UserSyncError as e:
+        if e.code == "missing_scope_user":
+            raise HTTPException(status_code=403, detail="missing_scope_user")
+        raise HTTPException(status_code=502, detail=e.code)
+
+
+@router.get("/portals/{portal_id}/bitrix/users/sync")
+def get_bitrix_users_sync_status(
+    portal_id: int,
+    user: WebUser = Depends(_get_current_web_user),
+    db: Session = Depends(get_db),
+):
+    if int(user.portal_id or 0) != portal_id:
+        raise HTTPException(status_code=403, detail="forbidden")
+    return sync_status(db, portal_id)
 
 
 @router.get("/portals/{portal_id}/telegram/staff")
@@ -926,15 +888,17 @@ def set_web_telegram_staff_settings(
         enabled=body.enabled,
         clear_token=bool(body.clear_token),
         allow_uploads=body.allow_uploads,
+        polling=body.polling,
     )
     secret = get_portal_telegram_secret(db, portal_id, "staff") or ""
     webhook_url = _telegram_webhook_url("staff", portal_id, secret) if secret else None
     webhook_ok = None
     webhook_error = None
     bot_info = None
-    if settings.get("staff", {}).get("enabled") and not webhook_url:
+    polling = bool(settings.get("staff", {}).get("polling"))
+    if settings.get("staff", {}).get("enabled") and not polling and not webhook_url:
         webhook_error = "missing_public_base_url"
-    if webhook_url and settings.get("staff", {}).get("has_token") and settings.get("staff", {}).get("enabled"):
+    if webhook_url and not polling and settings.get("staff", {}).get("has_token") and settings.get("staff", {}).get("enabled"):
         token_plain = body.bot_token or (get_portal_telegram_token_plain(db, portal_id, "staff") or "")
         if token_plain:
             bot_info, _ = telegram_get_me(token_plain)
@@ -986,15 +950,17 @@ def set_web_telegram_client_settings(
         enabled=body.enabled,
         clear_token=bool(body.clear_token),
         allow_uploads=body.allow_uploads,
+        polling=body.polling,
     )
     secret = get_portal_telegram_secret(db, portal_id, "client") or ""
     webhook_url = _telegram_webhook_url("client", portal_id, secret) if secret else None
     webhook_ok = None
     webhook_error = None
     bot_info = None
-    if settings.get("client", {}).get("enabled") and not webhook_url:
+    polling = bool(settings.get("client", {}).get("polling"))
+    if settings.get("client", {}).get("enabled") and not polling and not webhook_url:
         webhook_error = "missing_public_base_url"
-    if webhook_url and settings.get("client", {}).get("has_token") and settings.get("client", {}).get("enabled"):
+    if webhook_url and not polling and settings.get("client", {}).get("has_token") and settings.get("client", {}).get("enabled"):
         token_plain = body.bot_token or (get_portal_telegram_token_plain(db, portal_id, "client") or "")
         if token_plain:
             bot_info, _ = telegram_get_me(token_plain)
@@ -0,0 +1,45 @@
+"""Backfill and verify the materialized KB access map (kb_file_access_map)."""
+from __future__ import annotations
+
+import argparse
+import json
+
+from sqlalchemy.orm import Session
+
+from apps.backend.database import get_session_factory
+from apps.backend.services.kb_access_map import backfill_access_map, verify_access_map
+
+
+def run(db: Session, *, backfill: bool, limit: int = 50) -> dict:
+    try:
+        written = backfill_access_map(db) if backfill else 0
+        problems = verify_access_map(db)
+        kinds: dict[str, int] = {}
+        for problem in problems:
+            kinds[problem["kind"]] = kinds.get(problem["kind"], 0) + 1
+        return {
+            "ok": not problems,
+            "backfilled_files": written,
+            "problems_total": len(problems),
+            "problems_by_kind": kinds,
+            "problems": problems[:limit],
+        }
+    finally:
+        db.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Backfill and verify the KB access map")
+    parser.add_argument("--backfill", action="store_true", help="Store map rows for files that have none before verifying")
+    parser.add_argument("--limit", type=int, default=50, help="How many problems to print")
+    args = parser.parse_args()
+
+    session_factory = get_session_factory()
+    db = session_factory()
+    result = run(db, backfill=args.backfill, limit=args.limit)
+    print(json.dumps(result, ensure_ascii=False, default=str))
+    return 0 if result["ok"] else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
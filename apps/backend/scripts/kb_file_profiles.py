@@ -0,0 +1,41 @@
+"""Backfill KB file topic profiles for files chunked before migration 063."""
+from __future__ import annotations
+
+import argparse
+import json
+
+from sqlalchemy.orm import Session
+
+from apps.backend.database import get_session_factory
+from apps.backend.models.kb import KBFile
+from apps.backend.services.kb_file_profiles import BACKFILL_LIMIT, ensure_file_profiles
+
+
+def run(db: Session, *, portal_id: int | None = None, batch: int = BACKFILL_LIMIT) -> dict:
+    conditions = [KBFile.portal_id == int(portal_id)] if portal_id else []
+    total = 0
+    try:
+        while True:
+            written = ensure_file_profiles(db, *conditions, limit=max(1, batch))
+            total += written
+            if written == 0:
+                break
+        return {"ok": True, "profiled_files": total}
+    finally:
+        db.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Profile KB files that have chunks but no topic profile")
+    parser.add_argument("--portal-id", type=int, default=None, help="Only this portal")
+    parser.add_argument("--batch", type=int, default=BACKFILL_LIMIT, help="Files per transaction")
+    args = parser.parse_args()
+
+    session_factory = get_session_factory()
+    result = run(session_factory(), portal_id=args.portal_id, batch=args.batch)
+    print(json.dumps(result, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,10 +1,9 @@
 """Activity logging helpers."""
 from __future__ import annotations
 
-from datetime import datetime
 from sqlalchemy.orm import Session
 
-from apps.backend.models.activity_event import ActivityEvent
+from apps.backend.services.usage_recorder import UsageRecord, record
 
 
 def log_activity(
@@ -13,12 +12,14 @@ def log_activity(
     kind: str,
     portal_id: int | None = None,
     web_user_id: int | None = None,
+    transactional: bool = False,
 ) -> None:
-    row = ActivityEvent(
-        kind=kind,
-        portal_id=portal_id,
-        web_user_id=web_user_id,
-        created_at=datetime.utcnow(),
+    """Record an activity event; buffered when the usage recorder is active.
+
+    ``transactional=True`` adds the row to the caller's transaction instead.
+    """
+    record(
+        db,
+        [UsageRecord("activity", {"kind": kind, "portal_id": portal_id, "web_user_id": web_user_id})],
+        transactional=transactional,
     )
-    db.add(row)
-    db.commit()
@@ -0,0 +1,160 @@
+"""Bounded in-process queue drained by one background thread in batches."""
+from __future__ import annotations
+
+import abc
+import logging
+import queue
+import threading
+import time
+from typing import Any, Generic, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class BatchWriter(abc.ABC, Generic[T]):
+    """Request path calls ``submit``; a daemon thread hands batches to ``write_batch``.
+
+    Overload policy: above ``sample_watermark`` of the queue capacity only every
+    ``sample_every``-th item is kept; when the queue (by count or bytes) is full
+    new items are dropped. ``submit(item, force=True)`` skips sampling (errors)
+    but still respects the hard bounds. Counters, queue depth and flush latency
+    are exposed via ``stats()``.
+    """
+
+    name = "batch_writer"
+
+    def __init__(
+        self,
+        max_events: int = 10000,
+        max_bytes: int = 64 * 1024 * 1024,
+        batch_size: int = 200,
+        flush_interval: float = 0.5,
+        sample_watermark: float = 0.8,
+        sample_every: int = 10,
+    ):
+        self.max_events = max(1, int(max_events))
+        self.max_bytes = max(1, int(max_bytes))
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = max(0.01, float(flush_interval))
+        self.sample_watermark = min(1.0, max(0.0, float(sample_watermark)))
+        self.sample_every = max(1, int(sample_every))
+        self._q: queue.Queue[T] = queue.Queue(maxsize=self.max_events)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._pending_bytes = 0
+        self._seq = 0
+        self._stats = {"accepted": 0, "sampled_out": 0, "dropped": 0, "written": 0, "failed": 0, "flushes": 0}
+        self._last_flush_ms = 0.0
+        self._max_flush_ms = 0.0
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def item_size(self, item: T) -> int:
+        return 0
+
+    @abc.abstractmethod
+    def write_batch(self, batch: list[T]) -> int:
+        """Persist ``batch``; returns the number of items written."""
+
+    def submit(self, item: T, force: bool = False) -> bool:
+        size = self.item_size(item)
+        with self._lock:
+            depth = self._q.qsize()
+            if depth + 1 > self.max_events or self._pending_bytes + size > self.max_bytes:
+                self._stats["dropped"] += 1
+                return False
+            if not force and depth >= self.max_events * self.sample_watermark:
+                self._seq += 1
+                if self._seq % self.sample_every:
+                    self._stats["sampled_out"] += 1
+                    return False
+            try:
+                self._q.put_nowait(item)
+            except queue.Full:
+                self._stats["dropped"] += 1
+                return False
+            self._pending_bytes += size
+            self._stats["accepted"] += 1
+        return True
+
+    def _take_batch(self, timeout: float | None) -> list[T]:
+        batch: list[T] = []
+        try:
+            batch.append(self._q.get(timeout=timeout) if timeout else self._q.get_nowait())
+        except queue.Empty:
+            return batch
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._q.get_nowait())
+            except queue.Empty:
+                break
+        with self._lock:
+            self._pending_bytes -= sum(self.item_size(it) for it in batch)
+        return batch
+
+    def _write(self, batch: list[T]) -> int:
+        if not batch:
+            return 0
+        started = time.perf_counter()
+        try:
+            written = self.write_batch(batch)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self._stats["written"] += written
+                self._stats["flushes"] += 1
+                self._last_flush_ms = elapsed_ms
+                self._max_flush_ms = max(self._max_flush_ms, elapsed_ms)
+            return written
+        except Exception as e:
+            with self._lock:
+                self._stats["failed"] += len(batch)
+            logger.warning("%s batch failed size=%s error=%s", self.name, len(batch), e)
+            return 0
+
+    def flush(self) -> int:
+        """Drain everything queued so far in the calling thread."""
+        written = 0
+        with self._write_lock:
+            while True:
+                batch = self._take_batch(timeout=None)
+                if not batch:
+                    return written
+                written += self._write(batch)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            batch = self._take_batch(timeout=self.flush_interval)
+            if not batch:
+                continue
+            # Give a burst a moment to fill the batch instead of writing 1-row inserts.
+            if len(batch) < self.batch_size and self._q.qsize() == 0:
+                time.sleep(min(0.05, self.flush_interval))
+                batch.extend(self._take_batch(timeout=None))
+            with self._write_lock:
+                self._write(batch)
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            out = dict(self._stats)
+            out["queued"] = self._q.qsize()
+            out["queued_bytes"] = self._pending_bytes
+            out["last_flush_ms"] = round(self._last_flush_ms, 2)
+            out["max_flush_ms"] = round(self._max_flush_ms, 2)
+        out["running"] = bool(self._thread and self._thread.is_alive())
+        return out
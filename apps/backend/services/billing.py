@@ -24,7 +24,9 @@ from apps.backend.models.billing import (
 )
 from apps.backend.models.kb import KBChunk, KBFile
 from apps.backend.models.portal import Portal
-from apps.backend.services.activity import log_activity
+from apps.backend.services.revenue_snapshots import list_account_snapshots, refresh_account_snapshots, snapshot_cohorts
+from apps.backend.services.usage_recorder import UsageRecord, record as record_rows
+from apps.backend.services.usage_rollup import get_requests_used, get_usage_totals
 
 PRICING_KEY = "gigachat_pricing"
 
@@ -238,20 +240,44 @@ def list_billing_accounts(db: Session, *, limit: int = 200) -> list[dict[str, An
     return items
 
 
-def list_revenue_accounts_v2(db: Session, *, limit: int = 200) -> list[dict[str, Any]]:
+def list_revenue_accounts_v2(
+    db: Session,
+    *,
+    limit: int = 200,
+    offset: int = 0,
+    q: str | None = None,
+    plan_code: str | None = None,
+    subscription_status: str | None = None,
+    status: str | None = None,
+    cohort_id: int | None = None,
+    sort: str = "account_no",
+) -> dict[str, Any]:
+    """Admin revenue list served from billing_account_snapshots (see services.revenue_snapshots)."""
     ensure_base_plans(db)
-    rows = db.execute(
-        select(Account, AppUserWebCredential.email)
-        .join(AppUserWebCredential, AppUserWebCredential.user_id == Account.owner_user_id, isouter=True)
-        .order_by(Account.account_no.asc().nullslast(), Account.id.asc())
-        .limit(limit)
-    ).all()
+    refresh_account_snapshots(db)
+    rows, total = list_account_snapshots(
+        db,
+        limit=limit,
+        offset=offset,
+        q=q,
+        plan_code=plan_code,
+        subscription_status=subscription_status,
+        status=status,
+        cohort_id=cohort_id,
+        sort=sort,
+    )
+    plan_ids = {int(snap.plan_id) for _, _, snap in rows if snap.plan_id}
+    version_ids = {int(snap.plan_version_id) for _, _, snap in rows if snap.plan_version_id}
+    plans = {int(p.id): p for p in db.execute(select(BillingPlan).where(BillingPlan.id.in_(plan_ids))).scalars()} if plan_ids else {}
+    versions = (
+        {int(v.id): v for v in db.execute(select(BillingPlanVersion).where(BillingPlanVersion.id.in_(version_ids))).scalars()}
+        if version_ids
+        else {}
+    )
+    cohorts = snapshot_cohorts(db, [int(account.id) for account, _, _ in rows])
     items: list[dict[str, Any]] = []
-    for account, owner_email in rows:
-        runtime = get_account_effective_runtime_policy_v2(db, int(account.id))
-        commercial = get_account_effective_commercial_policy_v2(db, int(account.id))
-        active_cohorts = resolve_account_active_cohorts(db, int(account.id))
-        adjustments = resolve_account_active_adjustments(db, int(account.id))
+    for account, owner_email, snap in rows:
+        plan = plans.get(int(snap.plan_id)) if snap.plan_id else None
         items.append(
             {
                 "id": int(account.id),
@@ -260,25 +286,18 @@ def list_revenue_accounts_v2(db: Session, *, limit: int = 200) -> list[dict[str,
                 "slug": account.slug,
                 "status": account.status,
                 "owner_email": owner_email,
-                "plan": commercial.get("plan"),
-                "plan_version": commercial.get("plan_version"),
-                "subscription_status": commercial.get("subscription_status"),
-                "cohorts": [
-                    {
-                        "id": int(item["cohort"].id),
-                        "code": item["cohort"].code,
-                        "name": item["cohort"].name,
-                        "source": item["source"],
-                    }
-                    for item in active_cohorts
-                ],
-                "final_price_month": commercial.get("final_price_month"),
-                "currency": commercial.get("currency"),
-                "adjustments_count": len(adjustments),
-                "runtime_source": runtime.get("source"),
+                "plan": _plan_payload(plan) if plan else None,
+                "plan_version": _plan_version_payload(versions.get(int(snap.plan_version_id)) if snap.plan_version_id else None),
+                "subscription_status": snap.subscription_status,
+                "cohorts": cohorts.get(int(account.id), []),
+                "final_price_month": float(snap.final_price_month) if snap.final_price_month is not None else None,
+                "currency": snap.currency,
+                "adjustments_count": int(snap.adjustments_count or 0),
+                "runtime_source": snap.runtime_source,
+                "policy_error": snap.error,
             }
         )
-    return items
+    return {"items": items, "total": total, "limit": limit, "offset": offset}
 
 
 def get_account_revenue_detail_v2(db: Session, account_id: int) -> dict[str, Any]:
@@ -840,14 +859,10 @@ def _resolve_account_channel(db: Session, account_id: int) -> str | None:
     return str(provider) if provider else None
 
 
-def _match_cohort_rule(db: Session, account: Account | None, cohort: BillingCohort) -> bool:
-    if not account:
-        return False
-    rule = dict(cohort.rule_json or {})
+def _cohort_rule_matches(rule: dict[str, Any], created_at: datetime | None, channel: str | None) -> bool:
     unknown = sorted(set(rule) - ALLOWED_COHORT_RULE_KEYS)
     if unknown:
         return False
-    created_at = getattr(account, "created_at", None)
     if "account_created_before" in rule:
         if created_at is None:
             return False
@@ -859,7 +874,6 @@ def _match_cohort_rule(db: Session, account: Account | None, cohort: BillingCoho
         if created_at <= datetime.fromisoformat(str(rule["account_created_after"]).replace("Z", "+00:00")).replace(tzinfo=None):
             return False
     if "channel" in rule:
-        channel = _resolve_account_channel(db, int(account.id))
         if channel != str(rule["channel"]):
             return False
     if "manual_tag" in rule:
@@ -867,6 +881,14 @@ def _match_cohort_rule(db: Session, account: Account | None, cohort: BillingCoho
     return True
 
 
+def _match_cohort_rule(db: Session, account: Account | None, cohort: BillingCohort) -> bool:
+    if not account:
+        return False
+    rule = dict(cohort.rule_json or {})
+    channel = _resolve_account_channel(db, int(account.id)) if "channel" in rule else None
+    return _cohort_rule_matches(rule, getattr(account, "created_at", None), channel)
+
+
 def resolve_account_active_cohorts(db: Session, account_id: int, now: datetime | None = None) -> list[dict[str, Any]]:
     now = now or datetime.utcnow()
     account = db.get(Account, account_id)
@@ -969,13 +991,22 @@ def _merge_runtime_features(base: dict[str, bool], patch: dict[str, Any] | None)
     return result
 
 
-def get_account_effective_runtime_policy_v2(db: Session, account_id: int, now: datetime | None = None) -> dict[str, Any]:
-    now = now or datetime.utcnow()
-    resolved = resolve_account_plan_version(db, account_id)
-    plan = resolved.get("plan")
-    version = resolved.get("plan_version")
-    sub = resolved.get("subscription")
+def _single_cohort_policy(active_cohorts: list[dict[str, Any]]) -> BillingCohortPolicy | None:
+    policies = [policy for item in active_cohorts for policy in item["policies"]]
+    if len(policies) > 1:
+        raise ValueError("multiple_active_cohort_policies")
+    return policies[0] if policies else None
 
+
+def _compose_runtime_policy(
+    *,
+    plan: BillingPlan | None,
+    version: BillingPlanVersion | None,
+    cohort_policy: BillingCohortPolicy | None,
+    legacy_override: AccountPlanOverride | None,
+    adjustments: list[BillingAccountAdjustment],
+) -> tuple[dict[str, int], dict[str, bool], list[dict[str, Any]]]:
+    """Merge runtime layers (plan -> cohort -> override -> adjustments) into limits, features, explain."""
     limits = dict(DEFAULT_LIMITS)
     features = dict(DEFAULT_FEATURES)
     explain: list[dict[str, Any]] = []
@@ -1000,23 +1031,17 @@ def get_account_effective_runtime_policy_v2(db: Session, account_id: int, now: d
             }
         )
 
-    active_cohorts = resolve_account_active_cohorts(db, account_id, now=now)
-    active_cohort_policies = [policy for item in active_cohorts for policy in item["policies"]]
-    if len(active_cohort_policies) > 1:
-        raise ValueError("multiple_active_cohort_policies")
-    if active_cohort_policies:
-        policy = active_cohort_policies[0]
-        limits = _merge_runtime_limits(limits, policy.limit_adjustments_json or {})
-        features = _merge_runtime_features(features, policy.feature_adjustments_json or {})
+    if cohort_policy:
+        limits = _merge_runtime_limits(limits, cohort_policy.limit_adjustments_json or {})
+        features = _merge_runtime_features(features, cohort_policy.feature_adjustments_json or {})
         explain.append(
             {
                 "layer": "cohort_policy",
-                "ref": int(policy.id),
-                "cohort_id": int(policy.cohort_id),
+                "ref": int(cohort_policy.id),
+                "cohort_id": int(cohort_policy.cohort_id),
             }
         )
 
-    legacy_override = _get_active_override(db, account_id, now=now)
     if legacy_override:
         limits = _merge_runtime_limits(limits, legacy_override.limits_json or {})
         features = _merge_runtime_features(features, legacy_override.features_json or {})
@@ -1027,7 +1052,6 @@ def get_account_effective_runtime_policy_v2(db: Session, account_id: int, now: d
             }
         )
 
-    adjustments = resolve_account_active_adjustments(db, account_id, now=now)
     for item in adjustments:
         if item.kind not in ADJUSTMENT_KINDS_RUNTIME:
             continue
@@ -1047,6 +1071,25 @@ def get_account_effective_runtime_policy_v2(db: Session, account_id: int, now: d
                 "target_key": item.target_key,
             }
         )
+    return limits, features, explain
+
+
+def get_account_effective_runtime_policy_v2(db: Session, account_id: int, now: datetime | None = None) -> dict[str, Any]:
+    now = now or datetime.utcnow()
+    resolved = resolve_account_plan_version(db, account_id)
+    plan = resolved.get("plan")
+    version = resolved.get("plan_version")
+    sub = resolved.get("subscription")
+
+    cohort_policy = _single_cohort_policy(resolve_account_active_cohorts(db, account_id, now=now))
+    legacy_override = _get_active_override(db, account_id, now=now)
+    limits, features, explain = _compose_runtime_policy(
+        plan=plan,
+        version=version,
+        cohort_policy=cohort_policy,
+        legacy_override=legacy_override,
+        adjustments=resolve_account_active_adjustments(db, account_id, now=now),
+    )
 
     return {
         "account_id": int(account_id),
@@ -1067,13 +1110,14 @@ def get_account_effective_runtime_policy_v2(db: Session, account_id: int, now: d
     }
 
 
-def get_account_effective_commercial_policy_v2(db: Session, account_id: int, now: datetime | None = None) -> dict[str, Any]:
-    now = now or datetime.utcnow()
-    resolved = resolve_account_plan_version(db, account_id)
-    plan = resolved.get("plan")
-    version = resolved.get("plan_version")
-    sub = resolved.get("subscription")
-
+def _compose_commercial_policy(
+    *,
+    plan: BillingPlan | None,
+    version: BillingPlanVersion | None,
+    cohort_policy: BillingCohortPolicy | None,
+    adjustments: list[BillingAccountAdjustment],
+) -> dict[str, Any]:
+    """Price after cohort discount and account adjustments; raises ValueError on a negative price."""
     if version:
         base_price = Decimal(str(version.price_month or 0))
         currency = version.currency or "RUB"
@@ -1096,12 +1140,8 @@ def get_account_effective_commercial_policy_v2(db: Session, account_id: int, now
 
     final_price = base_price
 
-    active_cohorts = resolve_account_active_cohorts(db, account_id, now=now)
-    active_cohort_policies = [policy for item in active_cohorts for policy in item["policies"]]
-    if len(active_cohort_policies) > 1:
-        raise ValueError("multiple_active_cohort_policies")
-    if active_cohort_policies:
-        policy = active_cohort_policies[0]
+    if cohort_policy:
+        policy = cohort_policy
         dtype = (policy.discount_type or "none").strip().lower()
         dvalue = Decimal(str(policy.discount_value or 0))
         if dtype == "percent" and dvalue > 0:
@@ -1112,7 +1152,6 @@ def get_account_effective_commercial_policy_v2(db: Session, account_id: int, now
             discounts.append({"source": "cohort", "type": "fixed", "value": float(dvalue), "ref": int(policy.id)})
         explain.append({"layer": "cohort_policy", "ref": int(policy.id), "discount_type": dtype})
 
-    adjustments = resolve_account_active_adjustments(db, account_id, now=now)
     custom_price_applied = None
     for item in adjustments:
         if item.kind not in ADJUSTMENT_KINDS_COMMERCIAL:
@@ -1140,18 +1179,42 @@ def get_account_effective_commercial_policy_v2(db: Session, account_id: int, now
     if final_price < 0:
         raise ValueError("negative_final_price")
 
+    return {
+        "plan_version_code": version_code,
+        "base_price_month": base_price,
+        "currency": currency,
+        "discounts": discounts,
+        "final_price_month": final_price,
+        "explain": explain,
+    }
+
+
+def get_account_effective_commercial_policy_v2(db: Session, account_id: int, now: datetime | None = None) -> dict[str, Any]:
+    now = now or datetime.utcnow()
+    resolved = resolve_account_plan_version(db, account_id)
+    plan = resolved.get("plan")
+    version = resolved.get("plan_version")
+    sub = resolved.get("subscription")
+
+    commercial = _compose_commercial_policy(
+        plan=plan,
+        version=version,
+        cohort_policy=_single_cohort_policy(resolve_account_active_cohorts(db, account_id, now=now)),
+        adjustments=resolve_account_active_adjustments(db, account_id, now=now),
+    )
+
     return {
         "account_id": int(account_id),
         "plan_code": plan.code if plan else "default",
         "plan": _plan_payload(plan) if plan else None,
         "plan_version": _plan_version_payload(version),
-        "plan_version_code": version_code,
+        "plan_version_code": commercial["plan_version_code"],
         "subscription_status": sub.status if sub else None,
-        "base_price_month": float(base_price),
-        "currency": currency,
-        "discounts": discounts,
-        "final_price_month": float(final_price),
-        "explain": explain,
+        "base_price_month": float(commercial["base_price_month"]),
+        "currency": commercial["currency"],
+        "discounts": commercial["discounts"],
+        "final_price_month": float(commercial["final_price_month"]),
+        "explain": commercial["explain"],
     }
 
 
@@ -1238,15 +1301,7 @@ def set_portal_limit(db: Session, portal_id: int, monthly_request_limit: int | N
 
 
 def get_portal_usage_count(db: Session, portal_id: int) -> int:
-    start, end = _month_range()
-    q = select(func.count(BillingUsage.id)).where(
-        BillingUsage.portal_id == portal_id,
-        BillingUsage.kind == "chat",
-        BillingUsage.status == "ok",
-        BillingUsage.created_at >= start,
-        BillingUsage.created_at < end,
-    )
-    return int(db.execute(q).scalar() or 0)
+    return get_requests_used(db, "portal", portal_id)
 
 
 def _account_portal_ids(db: Session, account_id: int) -> list[int]:
@@ -1267,24 +1322,10 @@ def get_account_usage_summary(db: Session, account_id: int) -> dict[str, Any]:
     media_minutes_used = 0
 
     if portal_ids:
-        q_requests = select(func.count(BillingUsage.id)).where(
-            BillingUsage.portal_id.in_(portal_ids),
-            BillingUsage.kind == "chat",
-            BillingUsage.status == "ok",
-            BillingUsage.created_at >= start,
-            BillingUsage.created_at < end,
-        )
-        requests_used = int(db.execute(q_requests).scalar() or 0)
-        q_usage = select(
-            func.coalesce(func.sum(BillingUsage.tokens_total), 0),
-            func.coalesce(func.sum(BillingUsage.cost_rub), 0),
-        ).where(
-            BillingUsage.portal_id.in_(portal_ids),
-            BillingUsage.created_at >= start,
-            BillingUsage.created_at < end,
-        )
-        tokens_total, cost_sum = db.execute(q_usage).one()
-        cost_rub = float(cost_sum or 0.0)
+        totals = get_usage_totals(db, "account", account_id)
+        requests_used = totals["requests_used"]
+        tokens_total = totals["tokens_total"]
+        cost_rub = totals["cost_rub"]
         q_storage = select(func.coalesce(func.sum(KBFile.size_bytes), 0)).where(
             KBFile.portal_id.in_(portal_ids),
             KBFile.status != "error",
@@ -1408,29 +1449,32 @@ def record_usage(
     cost_rub: Decimal | None,
     status: str = "ok",
     error_code: str | None = None,
-) -> BillingUsage:
-    row = BillingUsage(
-        portal_id=portal_id,
-        user_id=user_id,
-        request_id=request_id,
-        kind=kind,
-        model=model,
-        tokens_prompt=tokens_prompt,
-        tokens_completion=tokens_completion,
-        tokens_total=tokens_total,
-        cost_rub=cost_rub,
-        status=status,
-        error_code=error_code,
-        created_at=datetime.utcnow(),
+    transactional: bool = False,
+) -> None:
+    """Record an AI call: the billing_usage row, its counters and an "ai" activity event.
+
+    Goes through the usage recorder (one group commit per flush) when it is
+    active, otherwise commits once; ``transactional=True`` leaves the rows in
+    the caller's transaction.
+    """
+    usage = UsageRecord(
+        "usage",
+        {
+            "portal_id": portal_id,
+            "user_id": user_id,
+            "request_id": request_id,
+            "kind": kind,
+            "model": model,
+            "tokens_prompt": tokens_prompt,
+            "tokens_completion": tokens_completion,
+            "tokens_total": tokens_total,
+            "cost_rub": cost_rub,
+            "status": status,
+            "error_code": error_code,
+        },
     )
-    db.add(row)
-    db.commit()
-    db.refresh(row)
-    try:
-        log_activity(db, kind="ai", portal_id=portal_id, web_user_id=None)
-    except Exception:
-        pass
-    return row
+    activity = UsageRecord("activity", {"kind": "ai", "portal_id": portal_id, "web_user_id": None}, usage.created_at)
+    record_rows(db, [usage, activity], transactional=transactional)
 
 
 def get_portal_usage_summary(db: Session, portal_id: int) -> dict[str, Any]:
@@ -1447,23 +1491,15 @@ def get_portal_usage_summary(db: Session, portal_id: int) -> dict[str, Any]:
     percent = 0
     if limit and limit > 0:
         percent = min(100, int((used / limit) * 100))
-    q = select(
-        func.coalesce(func.sum(BillingUsage.tokens_total), 0),
-        func.coalesce(func.sum(BillingUsage.cost_rub), 0),
-    ).where(
-        BillingUsage.portal_id == portal_id,
-        BillingUsage.created_at >= start,
-        BillingUsage.created_at < end,
-    )
-    tokens_sum, cost_sum = db.execute(q).one()
+    totals = get_usage_totals(db, "portal", portal_id)
     return {
         "period_start": start.isoformat(),
         "period_end": end.isoformat(),
         "limit_requests": limit,
         "used_requests": used,
         "percent": percent,
-        "tokens_total": int(tokens_sum or 0),
-        "cost_rub": float(cost_sum or 0),
+        "tokens_total": int(totals["tokens_total"]),
+        "cost_rub": float(totals["cost_rub"]),
     }
 
 
@@ -1475,11 +1511,11 @@ def is_limit_exceeded(db: Session, portal_id: int) -> bool:
     account_id = db.execute(select(Portal.account_id).where(Portal.id == portal_id)).scalar()
     if not account_id:
         return False
-    usage = get_account_usage_summary(db, int(account_id))
-    limit = int(usage.get("requests_limit") or 0)
+    policy = get_account_effective_policy(db, int(account_id))
+    limit = int((policy.get("limits") or {}).get("requests_per_month") or 0)
     if limit <= 0:
         return False
-    return int(usage.get("requests_used") or 0) >= limit
+    return get_requests_used(db, "account", int(account_id)) >= limit
 
 
 def _normalize_limits_payload(payload: dict[str, Any] | None) -> dict[str, int]:
@@ -11,6 +11,7 @@ from apps.backend.models.portal import Portal, PortalToken, PortalUsersAccess
 from apps.backend.models.dialog import Dialog, Message
 from apps.backend.models.event import Event
 from apps.backend.models.outbox import Outbox
+from apps.backend.middleware.trace_id import current_trace_id
 from apps.backend.services.kb_rag import answer_from_kb
 from apps.backend.services.billing import (
     is_limit_exceeded,
@@ -271,11 +272,12 @@ def process_imbot_message(db: Session, data: dict, auth: dict) -> dict:
     db.commit()
     db.refresh(msg_tx)
     import uuid
-    trace_id = str(uuid.uuid4())[:16]
+    trace_id = current_trace_id() or str(uuid.uuid4())[:16]
     outbox = Outbox(
         portal_id=portal.id,
         message_id=msg_tx.id,
         status="created",
+        trace_id=trace_id,
         payload_json=json.dumps({
             "dialog_id": dialog_id_norm,
             "sender_user_id": sender_user_id,
@@ -2,18 +2,22 @@
 import hashlib
 import json
 import logging
+from datetime import datetime
 from urllib.parse import parse_qs
 from typing import Any
 
 from sqlalchemy.orm import Session
-from sqlalchemy import select, delete, func, text
+from sqlalchemy import select, delete, func, insert, text
 
 from apps.backend.models.bitrix_inbound_event import BitrixInboundEvent
 from apps.backend.models.portal import Portal
+from apps.backend.services import partitions
 from apps.backend.services.inbound_settings import get_inbound_settings, DEFAULTS
 
 logger = logging.getLogger(__name__)
 
+_TABLE = BitrixInboundEvent.__tablename__
+
 BODY_MAX_BYTES_DEFAULT = 131072  # 128KB fallback
 
 SAFE_HEADER_KEYS = frozenset(
@@ -269,8 +273,7 @@ def _resolve_portal(
     return None, None, None
 
 
-def build_inbound_event_record(
-    db: Session,
+def prepare_inbound_event(
     trace_id: str | None,
     method: str,
     path: str,
@@ -281,10 +284,10 @@ def build_inbound_event_record(
     remote_ip: str | None,
     query_domain: str | None = None,
     settings: dict[str, Any] | None = None,
-) -> BitrixInboundEvent | None:
-    """Build and save one inbound event record. Does NOT run retention (caller may do it)."""
-    if settings is None:
-        settings = get_inbound_settings(db)
+    received_at: datetime | None = None,
+) -> dict[str, Any]:
+    """Parse, redact and hash one request without touching the DB. Portal is resolved on write."""
+    settings = settings or DEFAULTS
     max_body_bytes = (settings.get("max_body_kb") or DEFAULTS["max_body_kb"]) * 1024
     body_sha256 = hashlib.sha256(body_bytes).hexdigest()
     body_preview_str, body_truncated = _body_preview(body_bytes, max_body_bytes)
@@ -303,58 +306,121 @@ def build_inbound_event_record(
             domain_from_payload = (auth.get("domain") or auth.get("DOMAIN") or "").strip() or None
     if not domain_from_payload and query_domain:
         domain_from_payload = (query_domain or "").strip() or None
-    referer = request_headers.get("referer") or request_headers.get("Referer")
-    origin = request_headers.get("origin") or request_headers.get("Origin")
     member_id = hints.get("member_id") if hints else None
     application_token = hints.get("application_token") if hints else None
-    domain, portal_id, member_id_resolved = _resolve_portal(
-        db,
-        member_id=str(member_id) if member_id is not None else None,
-        application_token=str(application_token) if application_token is not None else None,
-        domain=domain_from_payload,
-        referer=referer,
-        origin=origin,
-    )
     headers_safe = _safe_headers(request_headers)
     try:
         headers_json = json.loads(json.dumps(headers_safe, ensure_ascii=False))
     except Exception:
         headers_json = dict(headers_safe)
-    rec = BitrixInboundEvent(
+    values = {
+        "created_at": received_at or datetime.utcnow(),
+        "trace_id": trace_id,
+        "dialog_id": str(hints.get("dialog_id"))[:128] if hints and hints.get("dialog_id") is not None else None,
+        "user_id": str(hints.get("user_id"))[:64] if hints and hints.get("user_id") is not None else None,
+        "event_name": str(hints.get("event_name"))[:128] if hints and hints.get("event_name") is not None else None,
+        "remote_ip": remote_ip,
+        "method": method,
+        "path": path,
+        "query": query_string[:2048] if query_string else None,
+        "content_type": content_type[:256] if content_type else None,
+        "headers_json": headers_json,
+        "body_preview": body_preview_str,
+        "body_truncated": body_truncated,
+        "body_sha256": body_sha256,
+        "parsed_redacted_json": parsed_redacted,
+        "hints_json": hints,
+        "status_hint": "ok_logged",
+    }
+    resolve = {
+        "member_id": str(member_id) if member_id is not None else None,
+        "application_token": str(application_token) if application_token is not None else None,
+        "domain": domain_from_payload,
+        "referer": request_headers.get("referer") or request_headers.get("Referer"),
+        "origin": request_headers.get("origin") or request_headers.get("Origin"),
+    }
+    return {"values": values, "resolve": resolve}
+
+
+def _resolved_values(db: Session, prepared: dict[str, Any], cache: dict | None = None) -> dict[str, Any]:
+    """Column values with portal fields filled; cache dedups lookups within a batch."""
+    resolve = prepared["resolve"]
+    key = (resolve["member_id"], resolve["application_token"], resolve["domain"], resolve["referer"], resolve["origin"])
+    if cache is not None and key in cache:
+        resolved = cache[key]
+    else:
+        resolved = _resolve_portal(db, **resolve)
+        if cache is not None:
+            cache[key] = resolved
+    domain, portal_id, member_id_resolved = resolved
+    values = dict(prepared["values"])
+    values.update({"domain": domain, "portal_id": portal_id, "member_id": member_id_resolved})
+    return values
+
+
+def build_inbound_event_record(
+    db: Session,
+    trace_id: str | None,
+    method: str,
+    path: str,
+    query_string: str | None,
+    content_type: str | None,
+    request_headers: dict,
+    body_bytes: bytes,
+    remote_ip: str | None,
+    query_domain: str | None = None,
+    settings: dict[str, Any] | None = None,
+) -> BitrixInboundEvent | None:
+    """Build and save one inbound event record. Does NOT run retention (caller may do it)."""
+    if settings is None:
+        settings = get_inbound_settings(db)
+    prepared = prepare_inbound_event(
         trace_id=trace_id,
-        portal_id=portal_id,
-        domain=domain,
-        member_id=member_id_resolved,
-        dialog_id=str(hints.get("dialog_id"))[:128] if hints and hints.get("dialog_id") is not None else None,
-        user_id=str(hints.get("user_id"))[:64] if hints and hints.get("user_id") is not None else None,
-        event_name=str(hints.get("event_name"))[:128] if hints and hints.get("event_name") is not None else None,
-        remote_ip=remote_ip,
         method=method,
         path=path,
-        query=query_string[:2048] if query_string else None,
-        content_type=content_type[:256] if content_type else None,
-        headers_json=headers_json,
-        body_preview=body_preview_str,
-        body_truncated=body_truncated,
-        body_sha256=body_sha256,
-        parsed_redacted_json=parsed_redacted,
-        hints_json=hints,
-        status_hint="ok_logged",
+        query_string=query_string,
+        content_type=content_type,
+        request_headers=request_headers,
+        body_bytes=body_bytes,
+        remote_ip=remote_ip,
+        query_domain=query_domain,
+        settings=settings,
     )
+    rec = BitrixInboundEvent(**_resolved_values(db, prepared))
     db.add(rec)
     db.commit()
     db.refresh(rec)
     return rec
 
 
+def write_inbound_events(db: Session, prepared: list[dict[str, Any]]) -> int:
+    """Insert a batch of prepared events with one multi-row INSERT."""
+    if not prepared:
+        return 0
+    cache: dict = {}
+    rows = [_resolved_values(db, p, cache) for p in prepared]
+    db.execute(insert(BitrixInboundEvent), rows)
+    db.commit()
+    return len(rows)
+
+
 def run_retention(db: Session, settings: dict[str, Any] | None = None) -> None:
     """Delete old records: TTL retention_days and cap global max_rows (from DB settings)."""
-    from datetime import datetime, timedelta
+    from datetime import timedelta
     if settings is None:
         settings = get_inbound_settings(db)
     retention_days = settings.get("retention_days") or DEFAULTS["retention_days"]
     max_rows = settings.get("max_rows") or DEFAULTS["max_rows"]
     cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    if partitions.is_partitioned(db, _TABLE):
+        # Whole-day partitions: retention is DETACH + DROP, no row-level DELETE.
+        try:
+            partitions.drop_partitions_before(db, _TABLE, cutoff)
+            partitions.drop_oldest_over_rows(db, _TABLE, max_rows)
+        except Exception as e:
+            logger.warning("bitrix_inbound_events partition retention failed: %s", e)
+            db.rollback()
+        return
     try:
         db.execute(delete(BitrixInboundEvent).where(BitrixInboundEvent.created_at < cutoff))
         db.commit()
@@ -380,19 +446,13 @@ def get_usage(db: Session, settings: dict[str, Any] | None = None) -> dict[str,
         settings = get_inbound_settings(db)
     target_mb = settings.get("target_budget_mb") or DEFAULTS["target_budget_mb"]
     try:
-        size_row = db.execute(text("SELECT pg_total_relation_size('bitrix_inbound_events') AS bytes")).fetchone()
-        bytes_used = size_row[0] if size_row and size_row[0] is not None else 0
+        size = partitions.relation_size(db, _TABLE)
     except Exception:
-        bytes_used = 0
-    used_mb = round(bytes_used / (1024 * 1024), 2)
+        db.rollback()
+        size = {"bytes": 0, "approx_rows": 0, "partitions": 0}
+    used_mb = round(size["bytes"] / (1024 * 1024), 2)
     percent = min(100, round(used_mb / target_mb * 100)) if target_mb else 0
-    try:
-        approx_row = db.execute(text(
-            "SELECT reltuples::bigint FROM pg_class WHERE relname = 'bitrix_inbound_events'"
-        )).fetchone()
-        approx_rows = int(approx_row[0]) if approx_row and approx_row[0] is not None else 0
-    except Exception:
-        approx_rows = 0
+    approx_rows = size["approx_rows"]
     try:
         minmax = db.execute(
             select(func.min(BitrixInboundEvent.created_at), func.max(BitrixInboundEvent.created_at))
@@ -408,6 +468,7 @@ def get_usage(db: Session, settings: dict[str, Any] | None = None) -> dict[str,
         "approx_rows": approx_rows,
         "oldest_at": oldest_at,
         "newest_at": newest_at,
+        "partitions": size["partitions"],
     }
 
 
@@ -418,10 +479,12 @@ def run_prune(
     settings: dict[str, Any] | None = None,
 ) -> dict[str, Any]:
     """Prune: auto (retention+max_rows), all (delete all), older_than_days. Returns deleted_rows, remaining_rows, used_mb_after."""
-    from datetime import datetime, timedelta
+    from datetime import timedelta
     if settings is None:
         settings = get_inbound_settings(db)
     target_mb = settings.get("target_budget_mb") or DEFAULTS["target_budget_mb"]
+    if partitions.is_partitioned(db, _TABLE):
+        return _run_prune_partitioned(db, mode, older_than_days, settings)
     deleted = 0
     if mode == "all":
         try:
@@ -468,3 +531,66 @@ def run_prune(
         "remaining_rows": remaining,
         "used_mb_after": usage["used_mb"],
     }
+
+
+def _run_prune_partitioned(
+    db: Session,
+    mode: str,
+    older_than_days: int | None,
+    settings: dict[str, Any],
+) -> dict[str, Any]:
+    """Prune via TRUNCATE / DROP PARTITION; row counts are planner estimates."""
+    from datetime import timedelta
+    before = partitions.relation_size(db, _TABLE)["approx_rows"]
+    try:
+        if mode == "all":
+            db.execute(text(f'TRUNCATE TABLE "{_TABLE}"'))
+            db.commit()
+        elif mode == "older_than_days" and older_than_days is not None and older_than_days >= 1:
+            cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+            partitions.drop_partitions_before(db, _TABLE, cutoff)
+            # Only the partition straddling the cutoff is scanned (partition pruning).
+            db.execute(delete(BitrixInboundEvent).where(BitrixInboundEvent.created_at < cutoff))
+            db.commit()
+        elif mode == "auto":
+            run_retention(db, settings)
+    except Exception as e:
+        logger.warning("bitrix_inbound_events prune %s failed: %s", mode, e)
+        db.rollback()
+    usage = get_usage(db, settings)
+    return {
+        "deleted_rows": max(0, before - usage["approx_rows"]),
+        "remaining_rows": usage["approx_rows"],
+        "used_mb_after": usage["used_mb"],
+    }
+
+
+_RETENTION_LOCK_KEY = "inbound_events:retention:lock"
+
+
+def run_retention_cycle() -> dict[str, Any]:
+    """Periodic retention (replaces prune-on-write): one instance at a time via Redis lock."""
+    from apps.backend import database
+    from apps.backend.config import get_settings
+
+    s = get_settings()
+    try:
+        from redis import Redis
+
+        r = Redis(host=s.redis_host, port=s.redis_port)
+        lock_ttl = max(30, int((s.inbound_log_retention_interval_seconds or 300) * 0.9))
+        if not r.set(_RETENTION_LOCK_KEY, "1", nx=True, ex=lock_ttl):
+            return {"skipped": "lock_not_acquired"}
+    except Exception:
+        logger.exception("inbound_retention_lock_unavailable")
+    try:
+        factory = database.get_session_factory()
+        with factory() as db:
+            settings = get_inbound_settings(db)
+            if not settings.get("auto_prune_on_write", True):
+                return {"skipped": "auto_prune_disabled"}
+            run_retention(db, settings)
+        return {"ok": True}
+    except Exception:
+        logger.exception("inbound_retention_cycle_failed")
+        return {"error": "retention_failed"}
@@ -3,8 +3,10 @@ import json
 import logging
 import time
 import uuid
+from datetime import datetime
 from typing import Any
 
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 
 from apps.backend.models.bitrix_log import BitrixHttpLog
@@ -26,8 +28,7 @@ def _mask_secrets(obj: dict) -> dict:
     return out
 
 
-def log_inbound(
-    db: Session,
+def build_inbound_log_row(
     trace_id: str,
     method: str,
     path: str,
@@ -46,7 +47,9 @@ def log_inbound(
     request_json: dict | list | None = None,
     response_json: dict | list | None = None,
     headers_min: dict | None = None,
-) -> None:
+    created_at: datetime | None = None,
+) -> dict[str, Any]:
+    """Column values for one inbound request row (no DB access)."""
     summary = {
         "query_keys": query_keys,
         "body_keys": body_keys,
@@ -64,26 +67,63 @@ def log_inbound(
         summary["response_json"] = response_json
     if headers_min is not None:
         summary["headers_min"] = headers_min
-    row = BitrixHttpLog(
-        trace_id=trace_id,
-        portal_id=portal_id,
-        direction="inbound",
-        kind="request",
-        method=method,
-        path=path,
-        summary_json=json.dumps(summary),
-        status_code=status_code,
-        latency_ms=latency_ms,
-    )
-    db.add(row)
+    return {
+        "trace_id": trace_id,
+        "portal_id": portal_id,
+        "direction": "inbound",
+        "kind": "request",
+        "method": method,
+        "path": path,
+        "summary_json": json.dumps(summary),
+        "status_code": status_code,
+        "latency_ms": latency_ms,
+        "created_at": created_at or datetime.utcnow(),
+    }
+
+
+def write_http_logs(db: Session, rows: list[dict[str, Any]]) -> int:
+    """Insert prepared bitrix_http_logs rows with one multi-row INSERT."""
+    if not rows:
+        return 0
+    db.execute(insert(BitrixHttpLog), rows)
+    db.commit()
+    return len(rows)
+
+
+def log_inbound(db: Session, **fields: Any) -> None:
+    row = build_inbound_log_row(**fields)
+    db.add(BitrixHttpLog(**row))
     db.commit()
     logger.info(
         "bitrix_inbound trace_id=%s method=%s path=%s status=%d latency_ms=%d content_type=%s",
-        trace_id, method, path, status_code, latency_ms,
-        response_content_type or "-",
+        row["trace_id"], row["method"], row["path"], row["status_code"], row["latency_ms"],
+        fields.get("response_content_type") or "-",
     )
 
 
+def build_outbound_row(
+    trace_id: str,
+    portal_id: int | None,
+    method: str,
+    rest_method: str,
+    status_code: int,
+    latency_ms: int,
+    retry_count: int = 0,
+) -> dict[str, Any]:
+    """Строка bitrix_http_logs для исходящего REST-вызова (kind=rest_call)."""
+    return {
+        "trace_id": trace_id,
+        "portal_id": portal_id,
+        "direction": "outbound",
+        "kind": "rest_call",
+        "method": method,
+        "path": rest_method,
+        "summary_json": json.dumps({"rest_method": rest_method, "retry_count": retry_count}),
+        "status_code": status_code,
+        "latency_ms": latency_ms,
+    }
+
+
 def log_outbound(
     db: Session,
     trace_id: str,
@@ -94,19 +134,7 @@ def log_outbound(
     latency_ms: int,
     retry_count: int = 0,
 ) -> None:
-    summary = {"rest_method": rest_method, "retry_count": retry_count}
-    row = BitrixHttpLog(
-        trace_id=trace_id,
-        portal_id=portal_id,
-        direction="outbound",
-        kind="rest_call",
-        method=method,
-        path=rest_method,
-        summary_json=json.dumps(summary),
-        status_code=status_code,
-        latency_ms=latency_ms,
-    )
-    db.add(row)
+    db.add(BitrixHttpLog(**build_outbound_row(trace_id, portal_id, method, rest_method, status_code, latency_ms, retry_count)))
     db.commit()
     logger.info(
         "bitrix_outbound trace_id=%s rest_method=%s status=%d latency_ms=%d",
@@ -335,8 +363,7 @@ def log_outbound_imbot_chat_add(
     )
 
 
-def log_outbound_imbot_message_add(
-    db: Session,
+def build_imbot_message_add_row(
     trace_id: str,
     portal_id: int,
     target_user_id: int | None,
@@ -346,8 +373,8 @@ def log_outbound_imbot_message_add(
     bitrix_error_code: str | None = None,
     bitrix_error_desc: str | None = None,
     sent_keys: list[str] | None = None,
-) -> None:
-    """Лог вызова imbot.message.add (без токенов). kind=imbot_message_add."""
+) -> dict[str, Any]:
+    """Строка bitrix_http_logs для imbot.message.add (без токенов). kind=imbot_message_add."""
     summary: dict[str, Any] = {
         "rest_method": "imbot.message.add",
         "target_user_id": target_user_id,
@@ -361,18 +388,43 @@ def log_outbound_imbot_message_add(
         summary["bitrix_error_desc"] = (bitrix_error_desc or "")[:200]
     if sent_keys is not None:
         summary["sent_keys"] = sent_keys
-    row = BitrixHttpLog(
-        trace_id=trace_id,
-        portal_id=portal_id,
-        direction="outbound",
-        kind="imbot_message_add",
-        method="POST",
-        path="imbot.message.add",
-        summary_json=json.dumps(summary),
-        status_code=status_code,
-        latency_ms=latency_ms,
-    )
-    db.add(row)
+    return {
+        "trace_id": trace_id,
+        "portal_id": portal_id,
+        "direction": "outbound",
+        "kind": "imbot_message_add",
+        "method": "POST",
+        "path": "imbot.message.add",
+        "summary_json": json.dumps(summary),
+        "status_code": status_code,
+        "latency_ms": latency_ms,
+    }
+
+
+def log_outbound_imbot_message_add(
+    db: Session,
+    trace_id: str,
+    portal_id: int,
+    target_user_id: int | None,
+    dialog_id: str,
+    status_code: int,
+    latency_ms: int,
+    bitrix_error_code: str | None = None,
+    bitrix_error_desc: str | None = None,
+    sent_keys: list[str] | None = None,
+) -> None:
+    """Лог вызова imbot.message.add (без токенов). kind=imbot_message_add."""
+    db.add(BitrixHttpLog(**build_imbot_message_add_row(
+        trace_id,
+        portal_id,
+        target_user_id,
+        dialog_id,
+        status_code,
+        latency_ms,
+        bitrix_error_code=bitrix_error_code,
+        bitrix_error_desc=bitrix_error_desc,
+        sent_keys=sent_keys,
+    )))
     db.commit()
     logger.info(
         "bitrix_outbound_imbot_message_add trace_id=%s portal_id=%s dialog_id=%s status=%s err=%s",
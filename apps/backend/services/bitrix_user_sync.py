@@ -0,0 +1,327 @@
+"""Bitrix user directory sync: every page through ``batch``, set-based writes.
+
+user.get returns 50 users per page. The first call reads page one and the
+total; the remaining pages are requested ``BITRIX_BATCH_MAX_COMMANDS`` at a
+time through ``batch``, so a 10k-user portal takes 5 HTTP calls instead of
+200. Each round is written as one upsert into portal_users_access plus bulk
+identity linking and memberships, and committed together with the progress
+row (portal_user_syncs), so a status poll sees the run advance.
+
+Incremental runs ask only for users modified (TIMESTAMP_X) since the start of
+the last successful run, minus ``INCREMENTAL_OVERLAP``: the filter is
+evaluated in the portal's time zone, and the writes are idempotent, so
+re-reading a day of changes costs nothing but a few rows.
+
+Large runs go to the ingest queue (``enqueue_sync`` ->
+``apps.worker.jobs.sync_bitrix_users``).
+"""
+from __future__ import annotations
+
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Iterator
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from apps.backend.clients.bitrix import (
+    BITRIX_BATCH_MAX_COMMANDS,
+    BITRIX_PAGE_SIZE,
+    _user_scope_error,
+    rest_batch,
+    user_get_page,
+    user_get_query,
+)
+from apps.backend.config import get_settings
+from apps.backend.models.portal import PortalUserSync, PortalUsersAccess
+from apps.backend.services.identity_linking import IdentityLinkInput, link_or_create_app_users
+from apps.backend.services.rbac_service import ensure_account_members
+
+logger = logging.getLogger(__name__)
+
+MODES = ("full", "incremental")
+INCREMENTAL_OVERLAP = timedelta(days=1)
+# A queued/running row older than this is treated as abandoned (worker died).
+STALE_AFTER = timedelta(minutes=30)
+_UPSERT_CHUNK = 1000
+_MAX_SKIPPED_EXAMPLES = 10
+
+
+class UserSyncError(Exception):
+    def __init__(self, code: str) -> None:
+        super().__init__(code)
+        self.code = code
+
+
+def _insert(db: Session):
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert
+
+
+def iter_user_rounds(
+    domain: str,
+    access_token: str,
+    filter: dict | None = None,
+) -> Iterator[tuple[list[dict], int]]:
+    """Yields ``(users, total)`` per HTTP call: page one, then one batch of pages per round."""
+    users, total, err = user_get_page(domain, access_token, start=0, filter=filter)
+    if err:
+        raise UserSyncError(err)
+    yield users, total
+    offsets = list(range(BITRIX_PAGE_SIZE, total, BITRIX_PAGE_SIZE))
+    for i in range(0, len(offsets), BITRIX_BATCH_MAX_COMMANDS):
+        commands = {f"p{start}": user_get_query(start, filter) for start in offsets[i:i + BITRIX_BATCH_MAX_COMMANDS]}
+        results, errors, err, _desc = rest_batch(domain, access_token, commands)
+        if err:
+            raise UserSyncError(err)
+        if errors:
+            first = next(iter(errors.values()))
+            first = first if isinstance(first, dict) else {}
+            raise UserSyncError(
+                _user_scope_error(str(first.get("error") or "batch_command_failed"), first.get("error_description"))
+            )
+        round_users: list[dict] = []
+        for key in commands:
+            page = results.get(key)
+            round_users.extend(page if isinstance(page, list) else [])
+        yield round_users, total
+
+
+def _user_fields(u: dict) -> tuple[str, str, str | None] | None:
+    uid = str(u.get("ID"))
+    if not uid or uid == "None":
+        return None
+    name = (u.get("NAME") or "") + " " + (u.get("LAST_NAME") or "")
+    name = name.strip() or (u.get("EMAIL") or "")
+    email = (str(u.get("EMAIL") or "").strip().lower() or None)
+    return uid, name, email
+
+
+def apply_users(
+    db: Session,
+    *,
+    portal_id: int,
+    account_id: int,
+    integration_id: int,
+    users: list[dict],
+    summary: dict[str, Any],
+) -> None:
+    """Upsert one round of users into access rows, identities and memberships (no commit)."""
+    rows: dict[str, dict[str, Any]] = {}
+    links: list[IdentityLinkInput] = []
+    now = datetime.utcnow()
+    for u in users:
+        fields = _user_fields(u)
+        if not fields:
+            continue
+        uid, name, email = fields
+        rows[uid] = {
+            "portal_id": int(portal_id),
+            "user_id": uid,
+            "display_name": name[:128] or None,
+            "kind": "bitrix",
+            "created_at": now,
+        }
+        links.append(
+            IdentityLinkInput(
+                external_id=uid,
+                display_value=name or email or f"Bitrix user {uid}",
+                email=email,
+                meta_json={
+                    "email": email,
+                    "name": (u.get("NAME") or None),
+                    "last_name": (u.get("LAST_NAME") or None),
+                    "portal_id": int(portal_id),
+                },
+            )
+        )
+    if not rows:
+        return
+    insert = _insert(db)
+    values = list(rows.values())
+    for i in range(0, len(values), _UPSERT_CHUNK):
+        stmt = insert(PortalUsersAccess).values(values[i:i + _UPSERT_CHUNK])
+        db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[PortalUsersAccess.portal_id, PortalUsersAccess.user_id],
+                # an empty name never wipes the stored one; non-bitrix rows are left alone
+                set_={"display_name": func.coalesce(stmt.excluded.display_name, PortalUsersAccess.display_name)},
+                where=PortalUsersAccess.kind == "bitrix",
+            )
+        )
+
+    results = link_or_create_app_users(db, provider="bitrix", integration_id=int(integration_id), items=links)
+    user_ids: set[int] = set()
+    for link in links:
+        result = results[link.external_id]
+        if result.user_id:
+            user_ids.add(int(result.user_id))
+            summary["linked"] += 1
+            continue
+        summary["skipped"] += 1
+        if len(summary["examples"]) < _MAX_SKIPPED_EXAMPLES:
+            summary["examples"].append(
+                {
+                    "external_id": link.external_id,
+                    "email": link.email or "",
+                    "reason": result.reason or result.status,
+                }
+            )
+    created = ensure_account_members(
+        db,
+        account_id=int(account_id),
+        user_ids=user_ids,
+        role="member",
+        status="active",
+        kb_access="none",
+    )
+    summary["memberships_created"] += len(created)
+
+
+def _state(db: Session, portal_id: int) -> PortalUserSync:
+    state = db.get(PortalUserSync, int(portal_id))
+    if state is None:
+        state = PortalUserSync(portal_id=int(portal_id), status="idle")
+        db.add(state)
+    return state
+
+
+def sync_portal_users(
+    db: Session,
+    *,
+    portal_id: int,
+    domain: str,
+    access_token: str,
+    account_id: int,
+    integration_id: int,
+    mode: str = "full",
+) -> dict[str, Any]:
+    """Run a sync, committing after every round; raises UserSyncError (recorded on the state row)."""
+    state = _state(db, portal_id)
+    user_filter: dict[str, str] = {"ACTIVE": "true"}
+    if mode == "incremental" and state.synced_at:
+        since = state.synced_at - INCREMENTAL_OVERLAP
+        user_filter[">TIMESTAMP_X"] = since.strftime("%Y-%m-%dT%H:%M:%S")
+    else:
+        mode = "full"
+    started = datetime.utcnow()
+    state.status = "running"
+    state.mode = mode
+    state.total = state.fetched = state.linked = state.memberships_created = state.skipped = state.http_calls = 0
+    state.error = None
+    state.started_at = started
+    state.finished_at = None
+    db.commit()
+
+    summary: dict[str, Any] = {"linked": 0, "memberships_created": 0, "skipped": 0, "examples": []}
+    domain_full = domain if domain.startswith("http") else f"https://{domain}"
+    try:
+        for users, total in iter_user_rounds(domain_full, access_token, filter=user_filter):
+            apply_users(
+                db,
+                portal_id=portal_id,
+                account_id=account_id,
+                integration_id=integration_id,
+                users=users,
+                summary=summary,
+            )
+            state.total = total
+            state.fetched += len(users)
+            state.http_calls += 1
+            state.linked = summary["linked"]
+            state.memberships_created = summary["memberships_created"]
+            state.skipped = summary["skipped"]
+            db.commit()
+    except UserSyncError as e:
+        db.rollback()
+        state = _state(db, portal_id)
+        state.status = "error"
+        state.error = e.code[:255]
+        state.finished_at = datetime.utcnow()
+        db.commit()
+        logger.warning("bitrix user sync failed portal_id=%s mode=%s error=%s", portal_id, mode, e.code)
+        raise
+    state.status = "done"
+    state.finished_at = datetime.utcnow()
+    state.synced_at = started
+    state.result_json = json.dumps(summary, ensure_ascii=False)
+    db.commit()
+    logger.info(
+        "bitrix user sync done portal_id=%s mode=%s users=%s http_calls=%s ms=%s",
+        portal_id,
+        mode,
+        state.fetched,
+        state.http_calls,
+        int((state.finished_at - started).total_seconds() * 1000),
+    )
+    return {
+        "status": "ok",
+        "mode": mode,
+        "count": int(state.fetched),
+        "total": int(state.total),
+        "http_calls": int(state.http_calls),
+        "identity_linking": summary,
+    }
+
+
+def sync_status(db: Session, portal_id: int) -> dict[str, Any]:
+    state = db.get(PortalUserSync, int(portal_id))
+    if state is None:
+        return {"status": "idle"}
+    return {
+        "status": state.status,
+        "mode": state.mode,
+        "total": int(state.total or 0),
+        "fetched": int(state.fetched or 0),
+        "http_calls": int(state.http_calls or 0),
+        "identity_linking": {
+            "linked": int(state.linked or 0),
+            "memberships_created": int(state.memberships_created or 0),
+            "skipped": int(state.skipped or 0),
+            "examples": (json.loads(state.result_json).get("examples") or []) if state.result_json else [],
+        },
+        "error": state.error,
+        "started_at": state.started_at.isoformat() if state.started_at else None,
+        "finished_at": state.finished_at.isoformat() if state.finished_at else None,
+        "synced_at": state.synced_at.isoformat() if state.synced_at else None,
+    }
+
+
+def enqueue_sync(db: Session, *, portal_id: int, account_id: int, integration_id: int, mode: str) -> bool:
+    """Queue a background run; False if one is already queued or running (and not stale)."""
+    state = _state(db, portal_id)
+    now = datetime.utcnow()
+    if state.status in ("queued", "running") and state.started_at and now - state.started_at < STALE_AFTER:
+        return False
+    state.status = "queued"
+    state.mode = mode
+    state.error = None
+    state.started_at = now
+    state.finished_at = None
+    db.commit()
+    try:
+        from redis import Redis
+        from rq import Queue
+
+        s = get_settings()
+        q = Queue(s.rq_ingest_queue_name or "ingest", connection=Redis(host=s.redis_host, port=s.redis_port))
+        q.enqueue(
+            "apps.worker.jobs.sync_bitrix_users",
+            int(portal_id),
+            int(account_id),
+            int(integration_id),
+            mode,
+            job_timeout=int(STALE_AFTER.total_seconds()),
+        )
+    except Exception:
+        logger.exception("bitrix user sync enqueue failed portal_id=%s", portal_id)
+        state.status = "error"
+        state.error = "enqueue_failed"
+        state.finished_at = datetime.utcnow()
+        db.commit()
+        raise UserSyncError("enqueue_failed")
+    return True
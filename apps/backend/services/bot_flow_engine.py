@@ -1,9 +1,13 @@
 ﻿"""Bot flow execution for client bot."""
 from __future__ import annotations
 
+import copy
 import json
 import logging
 import re
+import threading
+from dataclasses import dataclass, field
+from functools import lru_cache
 from typing import Any
 
 import httpx
@@ -11,10 +15,10 @@ from sqlalchemy.orm import Session
 from sqlalchemy import select
 
 from apps.backend.models.portal_bot_flow import PortalBotFlow
-from apps.backend.models.dialog_state import DialogState
 from apps.backend.models.portal import Portal
 from apps.backend.services.billing import get_portal_effective_policy
-from apps.backend.services.kb_rag import answer_from_kb
+from apps.backend.services.dialog_context import load_state, save_state
+from apps.backend.services.kb_rag import _normalize_ru_token, answer_from_kb
 from apps.backend.services.bitrix_auth import rest_call_with_refresh
 
 logger = logging.getLogger(__name__)
@@ -45,41 +49,177 @@ def _get_flow(db: Session, portal_id: int, kind: str = "client") -> dict[str, An
     return row.published_json or _default_flow()
 
 
-def _get_state(db: Session, dialog_id: int) -> dict[str, Any]:
-    row = db.get(DialogState, dialog_id)
-    if not row or not row.state_json:
-        return {"vars": {}, "pending": None}
-    return row.state_json or {"vars": {}, "pending": None}
+# --- compiled flows --------------------------------------------------------
+
+_PLACEHOLDER_RE = re.compile(r"\{\{(.*?)\}\}", flags=re.DOTALL)
+_PHRASE_TOKEN_RE = re.compile(r"[a-zа-яё0-9]+", flags=re.IGNORECASE)
+
+
+def _compile_template(text: str) -> tuple[str, ...]:
+    """Literal and placeholder parts: odd positions are variable names."""
+    return tuple(_PLACEHOLDER_RE.split(text or ""))
+
+
+def _render_compiled(parts: tuple[str, ...], vars_map: dict[str, Any]) -> str:
+    if len(parts) == 1:
+        return parts[0]
+    out: list[str] = []
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            out.append(part)
+        elif part in vars_map:
+            out.append(str(vars_map[part]))
+        else:
+            out.append("{{" + part + "}}")
+    return "".join(out)
+
+
+def _lemmas(text: str) -> tuple[str, ...]:
+    return tuple(_normalize_ru_token(tok) for tok in _PHRASE_TOKEN_RE.findall((text or "").lower()))
+
+
+@dataclass
+class MeaningIndex:
+    """Intent phrases of one branch node, lowered and lemmatized once.
+
+    A phrase matches when it occurs in the message as a substring (as typed,
+    so stems keep working) or as a run of lemmas (so inflected forms match).
+    Lemma runs are found through ``by_first_lemma`` in one pass over the
+    message tokens.
+    """
+
+    meanings: list[tuple[str, str, float, tuple[str, ...]]]  # id, title, threshold, lowered phrases
+    by_first_lemma: dict[str, list[tuple[int, int, tuple[str, ...]]]] = field(default_factory=dict)
+
+    @classmethod
+    def build(cls, raw_meanings: list[dict[str, Any]]) -> "MeaningIndex":
+        index = cls(meanings=[])
+        for idx, m in enumerate(raw_meanings or []):
+            phrases = tuple(p.lower() for p in _parse_phrases(m.get("phrases") or m.get("core") or []))
+            try:
+                threshold = float(m.get("sensitivity") or 0.5)
+            except Exception:
+                threshold = 0.5
+            meaning_id = str(m.get("id") or m.get("key") or m.get("title") or f"meaning_{idx}")
+            index.meanings.append((meaning_id, str(m.get("title") or meaning_id), threshold, phrases))
+            for p_idx, phrase in enumerate(phrases):
+                lemmas = _lemmas(phrase)
+                if lemmas:
+                    index.by_first_lemma.setdefault(lemmas[0], []).append((idx, p_idx, lemmas))
+        return index
+
+    def select(self, text: str) -> tuple[str | None, float, str | None]:
+        if not self.meanings:
+            return None, 0.0, None
+        low = (text or "").lower()
+        tokens = _lemmas(low)
+        matched: set[tuple[int, int]] = set()
+        for pos, lemma in enumerate(tokens):
+            for m_idx, p_idx, lemmas in self.by_first_lemma.get(lemma, ()):
+                if tokens[pos:pos + len(lemmas)] == lemmas:
+                    matched.add((m_idx, p_idx))
+        best_id = None
+        best_score = 0.0
+        best_title = None
+        for m_idx, (meaning_id, title, threshold, phrases) in enumerate(self.meanings):
+            hits = sum(1 for p_idx, p in enumerate(phrases) if low and ((m_idx, p_idx) in matched or p in low))
+            score = hits / max(1, len(phrases))
+            if score >= threshold and score >= best_score:
+                best_score = score
+                best_id = meaning_id
+                best_title = title
+        return best_id, best_score, best_title
+
+
+@dataclass
+class CompiledFlow:
+    """Published flow as an indexed graph: node map, adjacency list, templates, meaning indexes."""
+
+    settings: dict[str, Any]
+    nodes: dict[str, dict[str, Any]]
+    out_edges: dict[str, list[tuple[str | None, dict[str, Any] | None, bool]]]  # (to, condition, conditional)
+    templates: dict[tuple[str, str], tuple[str, ...]]
+    meanings: dict[str, MeaningIndex]
+    json_configs: dict[tuple[str, str], Any]
+
+
+def _parse_json_config(value: Any) -> Any:
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except Exception:
+            return {}
+    return value or {}
+
+
+def compile_flow(flow: dict[str, Any]) -> CompiledFlow:
+    nodes: dict[str, dict[str, Any]] = {}
+    for n in flow.get("nodes") or []:
+        node_id = n.get("id")
+        if node_id is not None and node_id not in nodes:  # first node wins, as with a linear scan
+            nodes[node_id] = n
+    out_edges: dict[str, list[tuple[str | None, dict[str, Any] | None, bool]]] = {}
+    for e in flow.get("edges") or []:
+        cond = e.get("condition")
+        out_edges.setdefault(e.get("from"), []).append((e.get("to"), cond, _has_meaningful_condition(cond)))
+    templates: dict[tuple[str, str], tuple[str, ...]] = {}
+    meanings: dict[str, MeaningIndex] = {}
+    json_configs: dict[tuple[str, str], Any] = {}
+    for node_id, node in nodes.items():
+        ntype = (node.get("type") or "").lower()
+        config = node.get("config") or {}
+        for key in ("text", "question"):
+            templates[(node_id, key)] = _compile_template(config.get(key) or "")
+        if ntype == "handoff":
+            templates[(node_id, "text")] = _compile_template(config.get("text") or "Передаю менеджеру.")
+        if ntype == "branch":
+            meanings[node_id] = MeaningIndex.build(config.get("meanings") or [])
+        if ntype == "webhook":
+            json_configs[(node_id, "payload")] = _parse_json_config(config.get("payload"))
+        if ntype in ("bitrix_lead", "bitrix_deal"):
+            fields = _parse_json_config(config.get("fields"))
+            json_configs[(node_id, "fields")] = {
+                k: _compile_template(str(v)) for k, v in (fields.items() if isinstance(fields, dict) else [])
+            }
+    return CompiledFlow(
+        settings=flow.get("settings") or {},
+        nodes=nodes,
+        out_edges=out_edges,
+        templates=templates,
+        meanings=meanings,
+        json_configs=json_configs,
+    )
 
 
-def _save_state(db: Session, dialog_id: int, state: dict[str, Any]) -> None:
-    row = db.get(DialogState, dialog_id)
-    if not row:
-        row = DialogState(dialog_id=dialog_id, state_json=state)
-        db.add(row)
-    else:
-        row.state_json = state
-    db.commit()
+_compiled_flows: dict[tuple[int, str], tuple[Any, CompiledFlow]] = {}
+_compiled_lock = threading.Lock()
 
 
-def _find_node(nodes: list[dict[str, Any]], node_id: str) -> dict[str, Any] | None:
-    for n in nodes:
-        if n.get("id") == node_id:
-            return n
-    return None
+def publish_compiled_flow(portal_id: int, kind: str, stamp: Any, flow: dict[str, Any] | None) -> CompiledFlow:
+    """Compile a flow and cache it under ``stamp`` (``(published_version, updated_at)`` of its row)."""
+    compiled = compile_flow(flow or _default_flow())
+    with _compiled_lock:
+        _compiled_flows[(int(portal_id), kind)] = (stamp, compiled)
+    return compiled
 
 
-def _out_edges(edges: list[dict[str, Any]], node_id: str) -> list[dict[str, Any]]:
-    return [e for e in edges if e.get("from") == node_id]
+def flow_stamp(row: PortalBotFlow | None) -> Any:
+    return (int(row.published_version or 0), row.updated_at) if row else None
 
 
-def _render_template(text: str, vars_map: dict[str, Any]) -> str:
-    if not text:
-        return text
-    out = text
-    for k, v in vars_map.items():
-        out = out.replace("{{" + k + "}}", str(v))
-    return out
+def get_compiled_flow(db: Session, portal_id: int, kind: str = "client") -> CompiledFlow:
+    """Compiled published flow; only the version columns are read while the cache is current."""
+    found = db.execute(
+        select(PortalBotFlow.published_version, PortalBotFlow.updated_at).where(
+            PortalBotFlow.portal_id == int(portal_id),
+            PortalBotFlow.kind == kind,
+        )
+    ).first()
+    stamp = (int(found[0] or 0), found[1]) if found else None
+    cached = _compiled_flows.get((int(portal_id), kind))
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    return publish_compiled_flow(portal_id, kind, stamp, _get_flow(db, portal_id, kind))
 
 
 def _parse_phrases(raw: Any) -> list[str]:
@@ -92,37 +232,6 @@ def _parse_phrases(raw: Any) -> list[str]:
     return [p.strip() for p in parts if p.strip()]
 
 
-def _meaning_score(text: str, phrases: list[str]) -> float:
-    if not text or not phrases:
-        return 0.0
-    t = text.lower()
-    hits = 0
-    for p in phrases:
-        if p.lower() in t:
-            hits += 1
-    return hits / max(1, len(phrases))
-
-
-def _select_meaning(text: str, meanings: list[dict[str, Any]]) -> tuple[str | None, float, str | None]:
-    if not meanings:
-        return None, 0.0, None
-    best_id = None
-    best_score = 0.0
-    best_title = None
-    for idx, m in enumerate(meanings):
-        phrases = _parse_phrases(m.get("phrases") or m.get("core") or [])
-        score = _meaning_score(text, phrases)
-        try:
-            threshold = float(m.get("sensitivity") or 0.5)
-        except Exception:
-            threshold = 0.5
-        if score >= threshold and score >= best_score:
-            best_score = score
-            best_id = str(m.get("id") or m.get("key") or m.get("title") or f"meaning_{idx}")
-            best_title = str(m.get("title") or best_id)
-    return best_id, best_score, best_title
-
-
 def _match_condition(cond: dict[str, Any], text: str, vars_map: dict[str, Any]) -> bool:
     if not cond:
         return True
@@ -148,13 +257,19 @@ def _match_condition(cond: dict[str, Any], text: str, vars_map: dict[str, Any])
     if op == "equals":
         return text_val.strip().lower() == str(value).strip().lower()
     if op == "regex":
-        try:
-            return re.search(str(value), text_val, flags=re.IGNORECASE) is not None
-        except re.error:
-            return False
+        pattern = _condition_regex(str(value))
+        return pattern is not None and pattern.search(text_val) is not None
     return str(value).strip().lower() in text_val.strip().lower()
 
 
+@lru_cache(maxsize=1024)
+def _condition_regex(value: str) -> re.Pattern[str] | None:
+    try:
+        return re.compile(value, flags=re.IGNORECASE)
+    except re.error:
+        return None
+
+
 def _has_meaningful_condition(cond: dict[str, Any] | None) -> bool:
     if not cond:
         return False
@@ -167,16 +282,15 @@ def _has_meaningful_condition(cond: dict[str, Any] | None) -> bool:
     return bool(cond.get("op") or cond.get("value") or cond.get("src"))
 
 
-def _select_next(edges: list[dict[str, Any]], text: str, vars_map: dict[str, Any]) -> str | None:
+def _select_next(edges: list[tuple[str | None, dict[str, Any] | None, bool]], text: str, vars_map: dict[str, Any]) -> str | None:
     # first match with condition
-    for e in edges:
-        cond = e.get("condition")
-        if _has_meaningful_condition(cond) and _match_condition(cond, text, vars_map):
-            return e.get("to")
+    for to, cond, conditional in edges:
+        if conditional and _match_condition(cond, text, vars_map):
+            return to
     # default edge (no condition)
-    for e in edges:
-        if not _has_meaningful_condition(e.get("condition")):
-            return e.get("to")
+    for to, _cond, conditional in edges:
+        if not conditional:
+            return to
     return None
 
 
@@ -186,18 +300,17 @@ def _execute_flow(
     dialog_id: int,
     user_text: str,
     *,
-    flow: dict[str, Any],
+    flow: dict[str, Any] | CompiledFlow,
     preview: bool = False,
     state_override: dict[str, Any] | None = None,
     collect_trace: bool = False,
     file_ids_filter: list[int] | None = None,
 ) -> tuple[str, dict[str, Any], list[dict[str, Any]]]:
-    nodes = flow.get("nodes") or []
-    edges = flow.get("edges") or []
-    settings = flow.get("settings") or {}
+    compiled = flow if isinstance(flow, CompiledFlow) else compile_flow(flow)
+    settings = compiled.settings
     features = dict((get_portal_effective_policy(db, portal_id) or {}).get("features") or {})
     vars_map = {}
-    state = state_override if state_override is not None else ({"vars": {}, "pending": None} if preview else _get_state(db, dialog_id))
+    state = state_override if state_override is not None else ({"vars": {}, "pending": None} if preview else load_state(db, dialog_id))
     vars_map.update(state.get("vars") or {})
     pending = state.get("pending")
     trace: list[dict[str, Any]] = []
@@ -229,7 +342,7 @@ def _execute_flow(
     visited: dict[str, int] = {}
     while steps < 20 and current_id:
         steps += 1
-        node = _find_node(nodes, current_id)
+        node = compiled.nodes.get(current_id)
         if not node:
             break
         ntype = (node.get("type") or "").lower()
@@ -241,23 +354,23 @@ def _execute_flow(
             break
 
         if ntype == "start":
-            nxt = _select_next(_out_edges(edges, current_id), user_text, vars_map)
+            nxt = _select_next(compiled.out_edges.get(current_id, ()), user_text, vars_map)
             _trace("edge", node, {"to": nxt})
             current_id = nxt
             continue
 
         if ntype == "message":
-            text = _render_template(config.get("text") or "", vars_map)
+            text = _render_compiled(compiled.templates[(current_id, "text")], vars_map)
             if text:
                 responses.append(text)
-            current_id = _select_next(_out_edges(edges, current_id), user_text, vars_map)
+            current_id = _select_next(compiled.out_edges.get(current_id, ()), user_text, vars_map)
             _trace("edge", node, {"to": current_id})
             continue
 
         if ntype == "ask":
-            question = _render_template(config.get("question") or "", vars_map)
+            question = _render_compiled(compiled.templates[(current_id, "question")], vars_map)
             var_name = (config.get("var") or "answer").strip()
-            nxt = _select_next(_out_edges(edges, current_id), user_text, vars_map)
+            nxt = _select_next(compiled.out_edges.get(current_id, ()), user_text, vars_map)
             state["pending"] = {"var": var_name, "next": nxt}
             _trace("ask", node, {"var": var_name, "next": nxt})
             if question:
@@ -265,8 +378,7 @@ def _execute_flow(
             break
 
         if ntype == "branch":
-            meanings = config.get("meanings") or []
-            meaning_id, meaning_score, meaning_title = _select_meaning(user_text, meanings)
+            meaning_id, meaning_score, meaning_title = compiled.meanings[current_id].select(user_text)
             if meaning_id:
                 vars_map["_meaning"] = meaning_id
                 vars_map["_meaning_score"] = meaning_score
@@ -276,7 +388,7 @@ def _execute_flow(
                 vars_map.pop("_meaning", None)
                 vars_map.pop("_meaning_score", None)
                 vars_map.pop("_meaning_title", None)
-            nxt = _select_next(_out_edges(edges, current_id), user_text, vars_map)
+            nxt = _select_next(compiled.out_edges.get(current_id, ()), user_text, vars_map)
             _trace("edge", node, {"to": nxt})
             current_id = nxt
             continue
@@ -289,7 +401,7 @@ def _execute_flow(
             vars_map["_custom_prompt"] = custom
             if config.get("pre_prompt"):
                 vars_map["_pre_prompt"] = str(config.get("pre_prompt") or "").strip()
-            current_id = _select_next(_out_edges(edges, current_id), user_text, vars_map)
+            current_id = _select_next(compiled.out_edges.get(current_id, ()), user_text, vars_map)
             _trace("edge", node, {"to": current_id})
             continue
 
@@ -327,24 +439,19 @@ def _execute_flow(
                     responses.append(answer)
             else:
                 responses.append("Извините, я пока не могу ответить на этот вопрос.")
-            current_id = _select_next(_out_edges(edges, current_id), user_text, vars_map)
+            current_id = _select_next(compiled.out_edges.get(current_id, ()), user_text, vars_map)
             _trace("edge", node, {"to": current_id})
             continue
 
         if ntype == "webhook":
             if not bool(features.get("allow_webhooks", True)):
                 _trace("webhook_blocked", node)
-                current_id = _select_next(_out_edges(edges, current_id), user_text, vars_map)
+                current_id = _select_next(compiled.out_edges.get(current_id, ()), user_text, vars_map)
                 _trace("edge", node, {"to": current_id})
                 continue
             url = (config.get("url") or "").strip()
-            payload = config.get("payload") or {}
-            if isinstance(payload, str):
-                try:
-                    payload = json.loads(payload)
-                except Exception:
-                    payload = {}
-            payload_rendered = json.loads(json.dumps(payload)) if payload else {}
+            payload = compiled.json_configs[(current_id, "payload")]
+            payload_rendered = copy.deepcopy(payload) if payload else {}
             payload_rendered["text"] = user_text
             payload_rendered["portal_id"] = portal_id
             payload_rendered["vars"] = vars_map
@@ -353,7 +460,7 @@ def _execute_flow(
                     httpx.post(url, json=payload_rendered, timeout=10)
                 except Exception as e:
                     logger.warning("webhook failed: %s", e)
-            current_id = _select_next(_out_edges(edges, current_id), user_text, vars_map)
+            current_id = _select_next(compiled.out_edges.get(current_id, ()), user_text, vars_map)
             _trace("edge", node, {"to": current_id})
             continue
 
@@ -361,37 +468,31 @@ def _execute_flow(
             portal = db.get(Portal, portal_id)
             if portal and portal.domain:
                 method = "crm.lead.add" if ntype == "bitrix_lead" else "crm.deal.add"
-                fields = config.get("fields") or {}
-                if isinstance(fields, str):
-                    try:
-                        fields = json.loads(fields)
-                    except Exception:
-                        fields = {}
-                rendered = {}
-                for k, v in fields.items():
-                    rendered[k] = _render_template(str(v), vars_map)
+                fields = compiled.json_configs[(current_id, "fields")]
+                rendered = {k: _render_compiled(parts, vars_map) for k, parts in fields.items()}
                 try:
                     rest_call_with_refresh(
                         db, portal_id, method, {"fields": rendered}, trace_id="flow"
                     )
                 except Exception as e:
                     logger.warning("bitrix crm add failed: %s", e)
-            current_id = _select_next(_out_edges(edges, current_id), user_text, vars_map)
+            current_id = _select_next(compiled.out_edges.get(current_id, ()), user_text, vars_map)
             _trace("edge", node, {"to": current_id})
             continue
 
         if ntype == "handoff":
-            text = _render_template(config.get("text") or "Передаю менеджеру.", vars_map)
+            text = _render_compiled(compiled.templates[(current_id, "text")], vars_map)
             responses.append(text)
             current_id = None
             continue
 
         # unknown node
-        current_id = _select_next(_out_edges(edges, current_id), user_text, vars_map)
+        current_id = _select_next(compiled.out_edges.get(current_id, ()), user_text, vars_map)
 
     state["vars"] = vars_map
     if not preview and state_override is None:
-        _save_state(db, dialog_id, state)
+        save_state(db, dialog_id, state)
+        db.commit()
     return "\n\n".join([r for r in responses if r]) or "Готов помочь. Задайте вопрос.", state, trace
 
 
@@ -403,7 +504,7 @@ def execute_client_flow(
     *,
     file_ids_filter: list[int] | None = None,
 ) -> str:
-    flow = _get_flow(db, portal_id, "client")
+    flow = get_compiled_flow(db, portal_id, "client")
     text, _state, _trace = _execute_flow(
         db,
         portal_id,
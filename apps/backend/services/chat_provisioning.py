@@ -2,19 +2,15 @@
 from __future__ import annotations
 
 import json
-import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Any
 
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 
-from apps.backend.models.event import Event
 from apps.backend.models.portal import Portal
 from apps.backend.services.portal_tokens import ensure_fresh_access_token, BitrixAuthError
-from apps.backend.clients import bitrix as bitrix_client
+from apps.backend.services.welcome_fanout import create_fanout, run_fanout
 
-PROVISION_MAX_WORKERS = 3
 PROVISION_TIME_BUDGET_SEC = 10
 
 
@@ -37,7 +33,8 @@ def provision_welcome_chats(
     """
     Бот пишет первым каждому user_id (DIALOG_ID=user{id}), создаётся личный чат.
     Возвращает {ok_count, fail_count, results: [{user_id, ok, error_code}]}.
-    Welcome-текст берётся из portal.welcome_message.
+    Welcome-текст берётся из portal.welcome_message. Синхронно, batch-вызовами
+    в пределах PROVISION_TIME_BUDGET_SEC (services/welcome_fanout.py).
     """
     portal = db.execute(select(Portal).where(Portal.id == portal_id)).scalar_one_or_none()
     if not portal:
@@ -57,38 +54,20 @@ def provision_welcome_chats(
     except BitrixAuthError as e:
         return {"ok_count": 0, "fail_count": len(bitrix_user_ids), "results": [{"user_id": uid, "ok": False, "error_code": e.code} for uid in bitrix_user_ids]}
 
-    welcome_message = (getattr(portal, "welcome_message", None) or "").strip() or "Привет! Я Teachbase AI. Напишите «ping» — отвечу «pong»."
-
-    start = time.monotonic()
-    results: list[dict[str, Any]] = []
-
-    def _send(uid: int) -> dict[str, Any]:
-        dialog_id = str(uid)
-        ok, err, _ = bitrix_client.imbot_message_add(
-            domain,
-            access_token,
-            int(bot_id),
-            dialog_id,
-            welcome_message,
-        )
-        return {"user_id": uid, "ok": bool(ok), "error_code": "ok" if ok else (err or "send_failed")}
-
-    with ThreadPoolExecutor(max_workers=PROVISION_MAX_WORKERS) as ex:
-        futures = {ex.submit(_send, uid): uid for uid in bitrix_user_ids}
-        for fut in as_completed(futures):
-            if time.monotonic() - start > PROVISION_TIME_BUDGET_SEC:
-                break
-            try:
-                results.append(fut.result())
-            except Exception:
-                uid = futures.get(fut, 0)
-                results.append({"user_id": uid, "ok": False, "error_code": "exception"})
-
-    done_ids = {r["user_id"] for r in results}
-    for uid in bitrix_user_ids:
-        if uid not in done_ids:
-            results.append({"user_id": uid, "ok": False, "error_code": "timeout"})
-
+    fanout = create_fanout(
+        db,
+        portal_id=portal_id,
+        bot_id=int(bot_id),
+        user_ids=bitrix_user_ids,
+        trace_id=trace_id,
+        welcome_message=getattr(portal, "welcome_message", None),
+    )
+    run = run_fanout(db, fanout.id, domain=domain, access_token=access_token, time_budget_sec=PROVISION_TIME_BUDGET_SEC)
+    failed = {f["user_id"]: f["code"] for f in run["failed"]}
+    results = [
+        {"user_id": uid, "ok": uid not in failed, "error_code": failed.get(uid, "ok")}
+        for uid in bitrix_user_ids
+    ]
     ok_count = sum(1 for r in results if r["ok"])
     fail_count = len(results) - ok_count
     return {"ok_count": ok_count, "fail_count": fail_count, "results": results}
@@ -0,0 +1,476 @@
+"""Conversation context store: bot flow state, RAG follow-up cache and recent history per dialog.
+
+Every bot turn used to read ``dialog_states``, ``dialog_rag_cache`` and the
+last messages separately, then save state and RAG cache with a
+select-then-insert/update and a commit each. Now the three are loaded
+together into one cached context per dialog:
+
+* reads come from the cache; a miss loads the whole context from the
+  database once and stores it;
+* every cached context carries a stamp (``dialog_states.updated_at``, the
+  newest message id and the newest ``dialog_rag_cache.updated_at``) that is
+  checked against the database with one indexed query, once per
+  transaction. An entry that lost a race, missed a write-through during a
+  Redis outage, or was changed by code outside this module reads as a miss;
+* writes are native ``INSERT ... ON CONFLICT`` upserts executed on the
+  caller's session and committed by the turn's single commit; the cache is
+  updated from the session's ``after_commit`` hook (write-through), so a
+  rolled-back turn never reaches it;
+* messages flushed through the ORM are appended to cached histories the same
+  way, so the history stays current without re-reading ``messages``.
+
+The cache is Redis (shared by API processes and workers) when it is
+reachable, otherwise a bounded in-process LRU per engine
+(``dialog_context_cache_size`` dialogs). Entries expire after
+``dialog_context_ttl_seconds``; a missing or stale entry only costs a
+reload.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any
+
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+
+from apps.backend.config import get_settings
+from apps.backend.models.dialog import Message
+from apps.backend.models.dialog_rag_cache import DialogRagCache
+from apps.backend.models.dialog_state import DialogState
+
+logger = logging.getLogger(__name__)
+
+HISTORY_SIZE = 20  # messages kept per cached dialog; larger history windows read the table
+RAG_CHUNK_IDS = 10
+RAG_KEYWORDS = 20
+
+_PENDING_KEY = "dialog_context_pending"
+_CHECKED_KEY = "dialog_context_checked"  # dialogs whose cached stamp matched in this transaction
+_REDIS_KEY = "dialog_ctx:{id}"
+_REDIS_HISTORY_KEY = "dialog_ctx:{id}:h"
+_REDIS_RETRY_SECONDS = 30.0
+
+
+def _testing() -> bool:
+    return os.environ.get("TESTING") == "1" or bool(os.environ.get("PYTEST_CURRENT_TEST"))
+
+
+# --- cache backends --------------------------------------------------------
+# A context is {"state": dict | None, "rag": {model: [chunk_ids, keywords]},
+# "history": [[message_id, direction, body], ...] (oldest first),
+# "stamp": {"state_at": iso | None, "msg_id": int, "rag_at": iso | None}}.
+
+
+class _LocalCache:
+    """Bounded LRU of JSON-encoded contexts (decoding hands callers a private copy)."""
+
+    def __init__(self, size: int, ttl: float):
+        self.size = max(1, int(size))
+        self.ttl = float(ttl)
+        self._items: OrderedDict[int, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, dialog_id: int) -> dict[str, Any] | None:
+        with self._lock:
+            item = self._items.get(dialog_id)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._items[dialog_id]
+                return None
+            self._items.move_to_end(dialog_id)
+        return json.loads(item[1])
+
+    def put(self, dialog_id: int, ctx: dict[str, Any]) -> None:
+        raw = json.dumps(ctx, ensure_ascii=False)
+        with self._lock:
+            self._items[dialog_id] = (time.monotonic() + self.ttl, raw)
+            self._items.move_to_end(dialog_id)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def apply(self, dialog_id: int, change: dict[str, Any]) -> None:
+        with self._lock:
+            item = self._items.get(dialog_id)
+            if item is None:
+                return
+            ctx = json.loads(item[1])
+            _merge(ctx, change)
+            self._items[dialog_id] = (item[0], json.dumps(ctx, ensure_ascii=False))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+
+class _RedisCache:
+    """Hash ``dialog_ctx:{id}`` (state, ``rag:{model}``, markers) plus a capped history list."""
+
+    def __init__(self, ttl: float):
+        self.ttl = max(1, int(ttl))
+        self._down_until = 0.0
+
+    def _client(self):
+        if self._down_until > time.monotonic():
+            return None
+        from redis import Redis
+
+        s = get_settings()
+        return Redis(host=s.redis_host, port=s.redis_port, socket_connect_timeout=0.5, socket_timeout=1.0)
+
+    def _failed(self, e: Exception) -> None:
+        self._down_until = time.monotonic() + _REDIS_RETRY_SECONDS
+        logger.warning("dialog_context redis unavailable, using in-process cache: %s", e)
+
+    @property
+    def available(self) -> bool:
+        return self._down_until <= time.monotonic()
+
+    def get(self, dialog_id: int) -> dict[str, Any] | None:
+        r = self._client()
+        if r is None:
+            raise ConnectionError("redis marked down")
+        try:
+            pipe = r.pipeline(transaction=True)
+            pipe.hgetall(_REDIS_KEY.format(id=dialog_id))
+            pipe.lrange(_REDIS_HISTORY_KEY.format(id=dialog_id), 0, -1)
+            fields, history = pipe.execute()
+        except Exception as e:
+            self._failed(e)
+            raise
+        fields = {k.decode(): v for k, v in (fields or {}).items()}
+        if not fields.get("loaded"):
+            return None
+        if int(fields.get("h_len") or 0) and not history:
+            return None  # history list evicted separately
+        return {
+            "state": json.loads(fields["state"]) if fields.get("state") else None,
+            "rag": {k[4:]: json.loads(v) for k, v in fields.items() if k.startswith("rag:")},
+            "history": [json.loads(x) for x in history],
+            "stamp": {
+                "state_at": fields.get("s:state_at") or None,
+                "msg_id": int(fields.get("s:msg_id") or 0),
+                "rag_at": fields.get("s:rag_at") or None,
+            },
+        }
+
+    def put(self, dialog_id: int, ctx: dict[str, Any]) -> None:
+        r = self._client()
+        if r is None:
+            return
+        key = _REDIS_KEY.format(id=dialog_id)
+        hkey = _REDIS_HISTORY_KEY.format(id=dialog_id)
+        mapping = {"loaded": "1", "h_len": str(len(ctx["history"]))}
+        if ctx.get("state") is not None:
+            mapping["state"] = json.dumps(ctx["state"], ensure_ascii=False)
+        for model, value in (ctx.get("rag") or {}).items():
+            mapping[f"rag:{model}"] = json.dumps(value, ensure_ascii=False)
+        mapping.update(_stamp_fields(ctx["stamp"]))
+        try:
+            pipe = r.pipeline(transaction=True)
+            pipe.delete(key, hkey)
+            pipe.hset(key, mapping=mapping)
+            if ctx["history"]:
+                pipe.rpush(hkey, *[json.dumps(m, ensure_ascii=False) for m in ctx["history"]])
+            pipe.expire(key, self.ttl)
+            pipe.expire(hkey, self.ttl)
+            pipe.execute()
+        except Exception as e:
+            self._failed(e)
+
+    def apply(self, dialog_id: int, change: dict[str, Any]) -> None:
+        r = self._client()
+        if r is None:
+            return  # the entry's stamp no longer matches the database; the next read reloads it
+        key = _REDIS_KEY.format(id=dialog_id)
+        hkey = _REDIS_HISTORY_KEY.format(id=dialog_id)
+        mapping = {}
+        if "state" in change:
+            mapping["state"] = json.dumps(change["state"], ensure_ascii=False)
+        for model, value in (change.get("rag") or {}).items():
+            mapping[f"rag:{model}"] = json.dumps(value, ensure_ascii=False)
+        messages = change.get("messages") or []
+        mapping.update(_stamp_fields(_change_stamp(change)))
+        try:
+            # Without the "loaded" marker a partially written hash reads as a miss.
+            pipe = r.pipeline(transaction=True)
+            if mapping:
+                pipe.hset(key, mapping=mapping)
+            if messages:
+                pipe.rpushx(hkey, *[json.dumps(m, ensure_ascii=False) for m in messages])
+                pipe.ltrim(hkey, -HISTORY_SIZE, -1)
+                pipe.hincrby(key, "h_len", len(messages))
+            pipe.expire(key, self.ttl)
+            pipe.expire(hkey, self.ttl)
+            pipe.execute()
+        except Exception as e:
+            self._failed(e)
+
+
+_local: "weakref.WeakKeyDictionary[Any, _LocalCache]" = weakref.WeakKeyDictionary()
+_redis_cache: _RedisCache | None = None
+_cache_lock = threading.Lock()
+
+
+def _local_cache(bind) -> _LocalCache:
+    engine = getattr(bind, "engine", bind)
+    cache = _local.get(engine)
+    if cache is None:
+        with _cache_lock:
+            cache = _local.get(engine)
+            if cache is None:
+                s = get_settings()
+                cache = _LocalCache(s.dialog_context_cache_size, s.dialog_context_ttl_seconds)
+                _local[engine] = cache
+    return cache
+
+
+def _shared_cache() -> _RedisCache | None:
+    """The Redis tier (``None`` in tests); check ``available`` before reading from it."""
+    global _redis_cache
+    if _testing():
+        return None
+    if _redis_cache is None:
+        with _cache_lock:
+            if _redis_cache is None:
+                _redis_cache = _RedisCache(get_settings().dialog_context_ttl_seconds)
+    return _redis_cache
+
+
+def _cache_get(bind, dialog_id: int) -> tuple[dict[str, Any] | None, Any]:
+    shared = _shared_cache()
+    if shared is not None and shared.available:
+        try:
+            return shared.get(dialog_id), shared
+        except Exception:
+            pass
+    local = _local_cache(bind)
+    return local.get(dialog_id), local
+
+
+def _change_stamp(change: dict[str, Any]) -> dict[str, Any]:
+    """The stamp parts a committed change moves forward."""
+    stamp: dict[str, Any] = {}
+    if "state_at" in change:
+        stamp["state_at"] = change["state_at"]
+    if "rag_at" in change:
+        stamp["rag_at"] = change["rag_at"]
+    if change.get("messages"):
+        stamp["msg_id"] = max(m[0] for m in change["messages"])
+    return stamp
+
+
+def _stamp_fields(stamp: dict[str, Any]) -> dict[str, str]:
+    return {f"s:{k}": "" if v is None else str(v) for k, v in stamp.items()}
+
+
+def _merge(ctx: dict[str, Any], change: dict[str, Any]) -> None:
+    ctx.setdefault("stamp", {}).update(_change_stamp(change))
+    if "state" in change:
+        ctx["state"] = change["state"]
+    ctx.setdefault("rag", {}).update(change.get("rag") or {})
+    history = ctx.setdefault("history", [])
+    last_id = history[-1][0] if history else 0
+    history.extend(m for m in change.get("messages") or [] if m[0] > last_id)
+    del history[:-HISTORY_SIZE]
+
+
+# --- loading ---------------------------------------------------------------
+
+
+def _parse_ids(raw: str | None) -> list[int]:
+    try:
+        values = json.loads(raw or "[]")
+    except Exception:
+        return []
+    return [int(x) for x in values if isinstance(x, (int, str)) and str(x).isdigit()]
+
+
+def _parse_keywords(raw: str | None) -> list[str]:
+    try:
+        return [str(x) for x in json.loads(raw or "[]")]
+    except Exception:
+        return []
+
+
+def _iso(value: datetime | None) -> str | None:
+    return value.isoformat() if value is not None else None
+
+
+def _db_stamp(db: Session, dialog_id: int) -> dict[str, Any]:
+    state_at, msg_id, rag_at = db.execute(
+        select(
+            select(DialogState.updated_at).where(DialogState.dialog_id == dialog_id).scalar_subquery(),
+            select(func.max(Message.id)).where(Message.dialog_id == dialog_id).scalar_subquery(),
+            select(func.max(DialogRagCache.updated_at)).where(DialogRagCache.dialog_id == dialog_id).scalar_subquery(),
+        )
+    ).one()
+    return {"state_at": _iso(state_at), "msg_id": int(msg_id or 0), "rag_at": _iso(rag_at)}
+
+
+def _load_from_db(db: Session, dialog_id: int) -> dict[str, Any]:
+    # stamp first: a commit landing between the reads leaves it behind the data, which is only a reload later
+    stamp = _db_stamp(db, dialog_id)
+    state = db.execute(select(DialogState.state_json).where(DialogState.dialog_id == dialog_id)).scalar_one_or_none()
+    rag = {
+        model: [_parse_ids(ids), _parse_keywords(keywords)]
+        for model, ids, keywords in db.execute(
+            select(DialogRagCache.model, DialogRagCache.chunk_ids_json, DialogRagCache.keywords_json).where(
+                DialogRagCache.dialog_id == dialog_id
+            )
+        ).all()
+    }
+    rows = db.execute(
+        select(Message.id, Message.direction, Message.body)
+        .where(Message.dialog_id == dialog_id)
+        .order_by(Message.id.desc())
+        .limit(HISTORY_SIZE)
+    ).all()
+    history = [[int(mid), direction, body] for mid, direction, body in reversed(rows)]
+    return {"state": state, "rag": rag, "history": history, "stamp": stamp}
+
+
+def load_context(db: Session, dialog_id: int) -> dict[str, Any]:
+    """Cached context of ``dialog_id`` with this session's uncommitted writes applied."""
+    ctx, cache = _cache_get(db.get_bind(), dialog_id)
+    pending = (db.info.get(_PENDING_KEY) or {}).get(dialog_id)
+    checked = db.info.setdefault(_CHECKED_KEY, set())
+    if ctx is not None and dialog_id not in checked and ctx.get("stamp") != _db_stamp(db, dialog_id):
+        ctx = None
+    if ctx is None:
+        ctx = _load_from_db(db, dialog_id)
+        if not pending:  # never cache rows this transaction may still roll back
+            cache.put(dialog_id, ctx)
+    checked.add(dialog_id)
+    if pending:
+        _merge(ctx, json.loads(json.dumps(pending, ensure_ascii=False)))
+    return ctx
+
+
+def load_state(db: Session, dialog_id: int) -> dict[str, Any]:
+    return load_context(db, dialog_id).get("state") or {"vars": {}, "pending": None}
+
+
+def load_rag(db: Session, dialog_id: int, model: str) -> tuple[list[int], list[str]]:
+    chunk_ids, keywords = (load_context(db, dialog_id).get("rag") or {}).get(model) or ([], [])
+    return list(chunk_ids), list(keywords)
+
+
+def load_history(db: Session, dialog_id: int, limit: int = 6) -> list[tuple[str, str | None]]:
+    """Last ``limit`` ``(direction, body)`` pairs, oldest first."""
+    if limit <= 0:
+        return []
+    if limit > HISTORY_SIZE:
+        rows = db.execute(
+            select(Message.direction, Message.body)
+            .where(Message.dialog_id == dialog_id)
+            .order_by(Message.id.desc())
+            .limit(limit)
+        ).all()
+        return [(direction, body) for direction, body in reversed(rows)]
+    history = load_context(db, dialog_id).get("history") or []
+    return [(direction, body) for _mid, direction, body in history[-limit:]]
+
+
+# --- writes ----------------------------------------------------------------
+
+
+def _insert(db: Session):
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert
+
+
+def _pending(db: Session, dialog_id: int) -> dict[str, Any]:
+    return db.info.setdefault(_PENDING_KEY, {}).setdefault(int(dialog_id), {})
+
+
+def save_state(db: Session, dialog_id: int, state: dict[str, Any]) -> None:
+    """Upsert the flow state; committed with the turn, cached after the commit."""
+    now = datetime.utcnow()
+    stmt = _insert(db)(DialogState).values(dialog_id=dialog_id, state_json=state, updated_at=now)
+    db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["dialog_id"],
+            set_={"state_json": stmt.excluded.state_json, "updated_at": stmt.excluded.updated_at},
+        )
+    )
+    change = _pending(db, dialog_id)
+    change["state"] = json.loads(json.dumps(state, ensure_ascii=False, default=str))
+    change["state_at"] = _iso(now)
+
+
+def save_rag(db: Session, dialog_id: int, portal_id: int, model: str, chunk_ids: list[int], keywords: list[str]) -> None:
+    """Upsert the follow-up retrieval cache; committed with the turn, cached after the commit."""
+    chunk_ids = [int(x) for x in chunk_ids[:RAG_CHUNK_IDS]]
+    keywords = [str(x) for x in keywords[:RAG_KEYWORDS]]
+    now = datetime.utcnow()
+    stmt = _insert(db)(DialogRagCache).values(
+        dialog_id=dialog_id,
+        portal_id=portal_id,
+        model=model,
+        chunk_ids_json=json.dumps(chunk_ids, ensure_ascii=False),
+        keywords_json=json.dumps(keywords, ensure_ascii=False),
+        created_at=now,
+        updated_at=now,
+    )
+    db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["dialog_id", "model"],
+            set_={
+                "chunk_ids_json": stmt.excluded.chunk_ids_json,
+                "keywords_json": stmt.excluded.keywords_json,
+                "updated_at": stmt.excluded.updated_at,
+            },
+        )
+    )
+    change = _pending(db, dialog_id)
+    change.setdefault("rag", {})[model] = [chunk_ids, keywords]
+    change["rag_at"] = _iso(now)
+
+
+# --- session hooks ---------------------------------------------------------
+
+
+def _collect_messages(session: Session, flush_context) -> None:
+    for obj in session.new:
+        if isinstance(obj, Message) and obj.dialog_id and obj.id:
+            _pending(session, obj.dialog_id).setdefault("messages", []).append([int(obj.id), obj.direction, obj.body])
+
+
+def _write_through(session: Session) -> None:
+    session.info.pop(_CHECKED_KEY, None)
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+    try:
+        bind = session.get_bind()
+        shared = _shared_cache()
+        use_local = shared is None or not shared.available
+        for dialog_id, change in pending.items():
+            if shared is not None:
+                shared.apply(dialog_id, change)
+            if use_local:
+                _local_cache(bind).apply(dialog_id, change)
+    except Exception as e:
+        # The rows are committed; the cache entries just expire or get reloaded.
+        logger.warning("dialog_context write-through failed dialogs=%s error=%s", sorted(pending), e)
+
+
+def _discard_pending(session: Session, previous_transaction=None) -> None:
+    session.info.pop(_PENDING_KEY, None)
+    session.info.pop(_CHECKED_KEY, None)
+
+
+event.listen(Session, "after_flush", _collect_messages)
+event.listen(Session, "after_commit", _write_through)
+event.listen(Session, "after_rollback", _discard_pending)
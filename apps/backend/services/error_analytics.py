@@ -0,0 +1,596 @@
+"""Error analytics for the admin errors dashboard.
+
+* Aggregates are computed in SQL: error codes are extracted from
+  ``summary_json`` and latencies bucketed into ``LATENCY_BOUNDS`` inside the
+  GROUP BY, so only (bucket, portal, code, latency bucket) counts leave the DB.
+* ``rollup_errors`` keeps minute and hour buckets in ``api_error_rollups``.
+  The summary reads hour rows, then minute rows, then raw rows after the
+  minute watermark, so a 30 day window is a few thousand rows.
+* The 1h window is exact: ``percentile_cont`` on PostgreSQL, the same
+  nearest-rank formula as before in Python on sqlite. Longer windows report
+  p95 as the upper bound of the histogram bucket.
+* ``iter_errors`` merges the bitrix_http / inbound / outbox feeds with keyset
+  pagination per source, so the list and the exports stream instead of
+  loading and sorting everything in memory.
+"""
+from __future__ import annotations
+
+import heapq
+import json
+import logging
+import math
+from datetime import datetime, timedelta, timezone
+from typing import Any, Iterator
+
+from sqlalchemy import String, and_, case, cast, delete, desc, func, insert, literal, or_, select
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import Session
+
+from apps.backend.config import get_settings
+from apps.backend.models.app_setting import AppSetting
+from apps.backend.models.bitrix_inbound_event import BitrixInboundEvent
+from apps.backend.models.bitrix_log import BitrixHttpLog
+from apps.backend.models.error_rollup import ApiErrorRollup
+from apps.backend.models.outbox import Outbox
+from apps.backend.models.portal import Portal
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BOUNDS: tuple[int, ...] = (10, 25, 50, 100, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000, 10000, 30000, 60000)
+PERIODS: dict[str, timedelta] = {
+    "1h": timedelta(hours=1),
+    "24h": timedelta(hours=24),
+    "7d": timedelta(days=7),
+    "30d": timedelta(days=30),
+}
+CHANNELS = ("bitrix_http", "inbound", "outbox")  # also the tie-break order of the merged feed
+WATERMARK_KEY = "api_error_rollups"
+
+
+def _is_pg(db: Session) -> bool:
+    return db.get_bind().dialect.name == "postgresql"
+
+
+def _as_naive_utc(value: Any) -> datetime | None:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _floor(ts: datetime, grain: str) -> datetime:
+    ts = ts.replace(second=0, microsecond=0)
+    return ts.replace(minute=0) if grain == "hour" else ts
+
+
+def _bucket(db: Session, column, grain: str):
+    if _is_pg(db):
+        if getattr(column.type, "timezone", False):
+            column = func.timezone("UTC", column)
+        return func.date_trunc(grain, column)
+    return func.strftime("%Y-%m-%d %H:%M:00" if grain == "minute" else "%Y-%m-%d %H:00:00", column)
+
+
+def _json_text(db: Session, column, key: str):
+    if _is_pg(db):
+        return case((column.like("{%"), cast(column, JSONB)[key].astext), else_=None)
+    return case((func.json_valid(column) == 1, func.json_extract(column, f"$.{key}")), else_=None)
+
+
+def _bitrix_code(db: Session):
+    """Same precedence as the feed: bitrix_error_code, error_code, http_<status>; '' for successes."""
+    return case(
+        (
+            BitrixHttpLog.status_code >= 400,
+            func.coalesce(
+                func.nullif(_json_text(db, BitrixHttpLog.summary_json, "bitrix_error_code"), ""),
+                func.nullif(_json_text(db, BitrixHttpLog.summary_json, "error_code"), ""),
+                literal("http_", String) + cast(BitrixHttpLog.status_code, String),
+            ),
+        ),
+        else_=literal("", String),
+    )
+
+
+def _latency_slot(column):
+    return case(
+        (column.is_(None), -1),
+        *[(column < bound, i) for i, bound in enumerate(LATENCY_BOUNDS)],
+        else_=len(LATENCY_BOUNDS),
+    )
+
+
+def _aggregate(db: Session, start: datetime, end: datetime, grain: str | None) -> list[tuple]:
+    """(bucket|None, channel, portal_id, code, latency slot, count) for [start, end), grouped in SQL."""
+    out: list[tuple] = []
+    sources = (
+        (
+            "bitrix_http",
+            BitrixHttpLog.created_at,
+            [
+                func.coalesce(BitrixHttpLog.portal_id, 0).label("portal_id"),
+                _bitrix_code(db).label("code"),
+                _latency_slot(BitrixHttpLog.latency_ms).label("slot"),
+            ],
+            [],
+        ),
+        (
+            "inbound",
+            BitrixInboundEvent.created_at,
+            [
+                func.coalesce(BitrixInboundEvent.portal_id, 0).label("portal_id"),
+                BitrixInboundEvent.status_hint.label("code"),
+                literal(-1).label("slot"),
+            ],
+            [BitrixInboundEvent.status_hint.isnot(None), BitrixInboundEvent.status_hint != "ok"],
+        ),
+    )
+    for channel, created_at, columns, filters in sources:
+        bucket = [_bucket(db, created_at, grain).label("bucket")] if grain else []
+        inner = (
+            select(*bucket, *columns)
+            .where(created_at >= start, created_at < end, *filters)
+            .subquery()
+        )
+        keys = ([inner.c.bucket] if grain else []) + [inner.c.portal_id, inner.c.code, inner.c.slot]
+        for row in db.execute(select(*keys, func.count()).group_by(*keys)).all():
+            if grain:
+                b, portal_id, code, slot, n = row
+                b = _as_naive_utc(b)
+            else:
+                b = None
+                portal_id, code, slot, n = row
+            out.append((b, channel, int(portal_id or 0), str(code or ""), int(slot), int(n)))
+    return out
+
+
+def _fold(rows, acc: dict[tuple, list] | None = None, *, with_bucket: bool = True) -> dict[tuple, list]:
+    """Sum counts into {(bucket?, channel, portal_id, code): [requests, histogram]}."""
+    acc = {} if acc is None else acc
+    for b, channel, portal_id, code, slot, n in rows:
+        key = (b, channel, portal_id, code) if with_bucket else (channel, portal_id, code)
+        entry = acc.get(key)
+        if entry is None:
+            entry = acc[key] = [0, [0] * (len(LATENCY_BOUNDS) + 1)]
+        entry[0] += n
+        if slot >= 0:
+            entry[1][slot] += n
+    return acc
+
+
+# --- rollups ---------------------------------------------------------------
+
+
+def _get_watermarks(db: Session) -> dict[str, datetime]:
+    row = db.get(AppSetting, WATERMARK_KEY)
+    value = dict(row.value_json or {}) if row else {}
+    return {k: datetime.fromisoformat(v) for k, v in value.items() if v}
+
+
+def _set_watermarks(db: Session, marks: dict[str, datetime]) -> None:
+    row = db.get(AppSetting, WATERMARK_KEY)
+    value = {k: v.isoformat() for k, v in marks.items()}
+    if row:
+        row.value_json = value
+    else:
+        db.add(AppSetting(key=WATERMARK_KEY, value_json=value))
+
+
+def _replace_buckets(db: Session, grain: str, start: datetime, end: datetime) -> int:
+    folded = _fold(_aggregate(db, start, end, grain))
+    db.execute(
+        delete(ApiErrorRollup)
+        .where(ApiErrorRollup.grain == grain)
+        .where(ApiErrorRollup.bucket_start >= start, ApiErrorRollup.bucket_start < end)
+    )
+    now = datetime.utcnow()
+    rows = [
+        {
+            "grain": grain,
+            "bucket_start": b,
+            "channel": channel,
+            "portal_id": portal_id,
+            "code": code[:128],
+            "requests": requests,
+            "latency_hist": hist if any(hist) else None,
+            "updated_at": now,
+        }
+        for (b, channel, portal_id, code), (requests, hist) in folded.items()
+    ]
+    if rows:
+        db.execute(insert(ApiErrorRollup), rows)
+    return len(rows)
+
+
+def rollup_errors(db: Session, now: datetime | None = None) -> dict[str, Any]:
+    """Roll up completed minutes and hours since the watermarks; commits per step.
+
+    Buckets are replaced, so a re-run over the same range is harmless. Rows that
+    arrive later than ``error_rollup_lag_seconds`` are not counted in rollups.
+    """
+    s = get_settings()
+    now = now or datetime.utcnow()
+    end = _floor(now - timedelta(seconds=max(0, int(s.error_rollup_lag_seconds or 0))), "minute")
+    minute_keep = timedelta(hours=max(1, int(s.error_rollup_minute_retention_hours or 48)))
+    hour_keep = timedelta(days=max(1, int(s.error_rollup_hour_retention_days or 35)))
+    marks = _get_watermarks(db)
+    stats = {"minute_rows": 0, "hour_rows": 0}
+
+    for grain, step, max_span, keep in (
+        ("minute", timedelta(hours=1), timedelta(hours=6), minute_keep),
+        ("hour", timedelta(days=1), timedelta(days=7), hour_keep),
+    ):
+        stop = _floor(end, grain)
+        cursor = max(marks.get(grain) or _floor(stop - keep, grain), _floor(stop - keep, grain))
+        limit = min(stop, cursor + max_span)
+        while cursor < limit:
+            upper = min(limit, cursor + step)
+            stats[f"{grain}_rows"] += _replace_buckets(db, grain, cursor, upper)
+            cursor = upper
+            marks[grain] = cursor
+            _set_watermarks(db, marks)
+            db.commit()
+        db.execute(
+            delete(ApiErrorRollup)
+            .where(ApiErrorRollup.grain == grain)
+            .where(ApiErrorRollup.bucket_start < _floor(now - keep, grain))
+        )
+        db.commit()
+    stats.update({k: v.isoformat() for k, v in marks.items()})
+    return stats
+
+
+def run_error_rollups() -> dict[str, Any] | None:
+    """Periodic entry point; one replica at a time."""
+    from redis import Redis
+
+    from apps.backend.database import get_session_factory
+
+    s = get_settings()
+    try:
+        r = Redis(host=s.redis_host, port=s.redis_port)
+        if not r.set("api_error_rollups:lock", "1", nx=True, ex=600):
+            return None
+    except Exception:
+        r = None
+    try:
+        with get_session_factory()() as db:
+            return rollup_errors(db)
+    finally:
+        if r is not None:
+            try:
+                r.delete("api_error_rollups:lock")
+            except Exception:
+                pass
+
+
+# --- summary ---------------------------------------------------------------
+
+
+def _rollup_rows(db: Session, grain: str, start: datetime, end: datetime) -> list[tuple]:
+    rows = db.execute(
+        select(
+            ApiErrorRollup.channel,
+            ApiErrorRollup.portal_id,
+            ApiErrorRollup.code,
+            ApiErrorRollup.requests,
+            ApiErrorRollup.latency_hist,
+        )
+        .where(ApiErrorRollup.grain == grain)
+        .where(ApiErrorRollup.bucket_start >= start, ApiErrorRollup.bucket_start < end)
+    ).all()
+    out = []
+    for channel, portal_id, code, requests, hist in rows:
+        hist = list(hist or [])
+        out.append((None, channel, int(portal_id), code or "", -1, int(requests) - sum(hist)))
+        out.extend((None, channel, int(portal_id), code or "", i, int(n)) for i, n in enumerate(hist) if n)
+    return out
+
+
+def _segments(db: Session, since: datetime, now: datetime, long_window: bool) -> list[tuple[str, datetime, datetime]]:
+    """Cover [since, now) with hour rollups, minute rollups and a raw tail."""
+    s = get_settings()
+    marks = _get_watermarks(db)
+    minute_floor = _floor(now - timedelta(hours=max(1, int(s.error_rollup_minute_retention_hours or 48))), "minute")
+    out: list[tuple[str, datetime, datetime]] = []
+    cursor = since
+    hour_mark = marks.get("hour")
+    if long_window and hour_mark and hour_mark > cursor:
+        out.append(("hour", _floor(cursor, "hour"), hour_mark))
+        cursor = hour_mark
+    minute_mark = marks.get("minute")
+    if minute_mark and minute_mark > cursor and cursor >= minute_floor:
+        out.append(("minute", _floor(cursor, "minute"), minute_mark))
+        cursor = minute_mark
+    out.append(("raw", cursor, now))
+    return out
+
+
+def _hist_p95(hist: list[int]) -> int:
+    total = sum(hist)
+    if not total:
+        return 0
+    rank = math.ceil(0.95 * total)
+    seen = 0
+    for i, n in enumerate(hist):
+        seen += n
+        if seen >= rank:
+            return LATENCY_BOUNDS[min(i, len(LATENCY_BOUNDS) - 1)]
+    return LATENCY_BOUNDS[-1]
+
+
+def _exact_p95(db: Session, start: datetime, end: datetime) -> int:
+    where = (
+        BitrixHttpLog.created_at >= start,
+        BitrixHttpLog.created_at < end,
+        BitrixHttpLog.status_code >= 400,
+        BitrixHttpLog.latency_ms.isnot(None),
+    )
+    if _is_pg(db):
+        value = db.execute(
+            select(func.percentile_cont(0.95).within_group(BitrixHttpLog.latency_ms)).where(*where)
+        ).scalar()
+        return int(round(value)) if value is not None else 0
+    vals = sorted(int(v) for v in db.execute(select(BitrixHttpLog.latency_ms).where(*where)).scalars())
+    if not vals:
+        return 0
+    return int(vals[max(0, min(len(vals) - 1, int(round(0.95 * (len(vals) - 1)))))])
+
+
+def error_summary(db: Session, period: str, now: datetime | None = None) -> dict[str, Any]:
+    window = PERIODS.get((period or "24h").strip().lower(), PERIODS["24h"])
+    now = now or datetime.utcnow()
+    since = now - window
+    exact = window <= PERIODS["1h"]
+    segments = [("raw", since, now)] if exact else _segments(db, since, now, window > PERIODS["24h"])
+    folded: dict[tuple, list] = {}
+    for source, start, end in segments:
+        rows = _aggregate(db, start, end, None) if source == "raw" else _rollup_rows(db, source, start, end)
+        _fold(rows, folded, with_bucket=False)
+
+    total = errors = inbound_errors = 0
+    codes: dict[str, int] = {}
+    portals: dict[str, int] = {}
+    hist = [0] * (len(LATENCY_BOUNDS) + 1)
+    for (channel, portal_id, code), (requests, h) in folded.items():
+        if channel == "inbound":
+            inbound_errors += requests
+            continue
+        total += requests
+        if not code:
+            continue
+        errors += requests
+        codes[code] = codes.get(code, 0) + requests
+        portals[str(portal_id)] = portals.get(str(portal_id), 0) + requests
+        hist = [a + b for a, b in zip(hist, h)]
+
+    def _top(d: dict[str, int], n: int = 5):
+        return [{"key": k, "count": c} for k, c in sorted(d.items(), key=lambda x: x[1], reverse=True)[:n]]
+
+    return {
+        "period": period,
+        "since": since.replace(tzinfo=timezone.utc).isoformat(),
+        "error_rate_percent": round(float(errors) / float(total) * 100.0, 2) if total else 0.0,
+        "bitrix_total_requests": int(total),
+        "bitrix_error_requests": int(errors),
+        "inbound_error_events": int(inbound_errors),
+        "p95_latency_ms": _exact_p95(db, since, now) if exact else _hist_p95(hist),
+        "p95_exact": exact,
+        "top_codes": _top(codes),
+        "top_portals": _top(portals),
+        "sources": [source for source, _, _ in segments],
+    }
+
+
+# --- merged feed -------------------------------------------------------------
+
+
+def _safe_json(raw: Any) -> dict[str, Any]:
+    if raw is None:
+        return {}
+    if isinstance(raw, dict):
+        return raw
+    if isinstance(raw, str):
+        try:
+            obj = json.loads(raw)
+            return obj if isinstance(obj, dict) else {}
+        except Exception:
+            return {}
+    return {}
+
+
+def encode_cursor(item: dict[str, Any]) -> str:
+    return f"{item['_ts'].isoformat()}|{item['channel']}|{item['_id']}"
+
+
+def decode_cursor(cursor: str | None) -> tuple[datetime, str, int] | None:
+    if not cursor:
+        return None
+    try:
+        ts, channel, row_id = cursor.split("|", 2)
+        return datetime.fromisoformat(ts), channel, int(row_id)
+    except Exception:
+        return None
+
+
+def _keyset(created_at, row_id, channel: str, before: tuple[datetime, str, int] | None):
+    """Rows strictly after ``before`` in (created_at, channel, id) descending order."""
+    if before is None:
+        return None
+    ts, b_channel, b_id = before
+    rank, b_rank = CHANNELS.index(channel), CHANNELS.index(b_channel) if b_channel in CHANNELS else -1
+    if rank > b_rank:
+        return created_at <= ts
+    if rank == b_rank:
+        return or_(created_at < ts, and_(created_at == ts, row_id < b_id))
+    return created_at < ts
+
+
+def _pages(db: Session, query, created_at, row_id, channel: str, before, page_size: int) -> Iterator[Any]:
+    cursor = before
+    while True:
+        q = query
+        cond = _keyset(created_at, row_id, channel, cursor)
+        if cond is not None:
+            q = q.where(cond)
+        rows = db.execute(q.order_by(desc(created_at), desc(row_id)).limit(page_size)).all()
+        yield from rows
+        if len(rows) < page_size:
+            return
+        last = rows[-1][0]
+        cursor = (_as_naive_utc(last.created_at), channel, int(last.id))
+
+
+def _bitrix_items(db, portal_id, domain_filter, trace_id, code_filter, before, page_size):
+    code_expr = _bitrix_code(db)
+    q = (
+        select(BitrixHttpLog, Portal.domain, code_expr.label("code"))
+        .join(Portal, Portal.id == BitrixHttpLog.portal_id, isouter=True)
+        .where(BitrixHttpLog.status_code >= 400)
+    )
+    if portal_id is not None:
+        q = q.where(BitrixHttpLog.portal_id == portal_id)
+    if domain_filter:
+        q = q.where(func.lower(Portal.domain).like(f"%{domain_filter}%"))
+    if trace_id:
+        q = q.where(BitrixHttpLog.trace_id == trace_id)
+    if code_filter:
+        q = q.where(func.lower(code_expr).like(f"%{code_filter}%"))
+    for r, domain, code in _pages(db, q, BitrixHttpLog.created_at, BitrixHttpLog.id, "bitrix_http", before, page_size):
+        summary = _safe_json(r.summary_json)
+        err_msg = (
+            summary.get("bitrix_error_desc")
+            or summary.get("error_description_safe")
+            or summary.get("safe_err")
+            or ""
+        )
+        yield {
+            "_ts": _as_naive_utc(r.created_at),
+            "_id": int(r.id),
+            "id": f"bitrix_http:{r.id}",
+            "created_at": r.created_at.isoformat() if r.created_at else None,
+            "portal_id": r.portal_id,
+            "portal_domain": (domain or "") if r.portal_id else "",
+            "trace_id": r.trace_id,
+            "channel": "bitrix_http",
+            "endpoint": r.path or "",
+            "method": r.method or "",
+            "code": str(code),
+            "message": str(err_msg),
+            "status_code": r.status_code,
+            "kind": r.kind or "",
+        }
+
+
+def _inbound_items(db, portal_id, domain_filter, trace_id, code_filter, before, page_size):
+    q = (
+        select(BitrixInboundEvent, Portal.domain)
+        .join(Portal, Portal.id == BitrixInboundEvent.portal_id, isouter=True)
+        .where(BitrixInboundEvent.status_hint.isnot(None), BitrixInboundEvent.status_hint != "ok")
+    )
+    if portal_id is not None:
+        q = q.where(BitrixInboundEvent.portal_id == portal_id)
+    if domain_filter:
+        q = q.where(func.lower(Portal.domain).like(f"%{domain_filter}%"))
+    if trace_id:
+        q = q.where(BitrixInboundEvent.trace_id == trace_id)
+    if code_filter:
+        q = q.where(func.lower(BitrixInboundEvent.status_hint).like(f"%{code_filter}%"))
+    for r, domain in _pages(db, q, BitrixInboundEvent.created_at, BitrixInboundEvent.id, "inbound", before, page_size):
+        hints = _safe_json(r.hints_json)
+        yield {
+            "_ts": _as_naive_utc(r.created_at),
+            "_id": int(r.id),
+            "id": f"inbound:{r.id}",
+            "created_at": r.created_at.isoformat() if r.created_at else None,
+            "portal_id": r.portal_id,
+            "portal_domain": (domain or "") if r.portal_id else "",
+            "trace_id": r.trace_id,
+            "channel": "inbound",
+            "endpoint": r.path or "",
+            "method": r.method or "",
+            "code": str(r.status_hint or hints.get("error_code") or "inbound_error"),
+            "message": str(hints.get("error") or hints.get("reason") or ""),
+            "status_code": None,
+            "kind": r.event_name or "",
+        }
+
+
+def _outbox_items(db, portal_id, domain_filter, trace_id, code_filter, before, page_size):
+    q = (
+        select(Outbox, Portal.domain)
+        .join(Portal, Portal.id == Outbox.portal_id, isouter=True)
+        .where(Outbox.status == "error")
+    )
+    if portal_id is not None:
+        q = q.where(Outbox.portal_id == portal_id)
+    if domain_filter:
+        q = q.where(func.lower(Portal.domain).like(f"%{domain_filter}%"))
+    if trace_id:
+        q = q.where(Outbox.trace_id == trace_id)
+    for r, domain in _pages(db, q, Outbox.created_at, Outbox.id, "outbox", before, page_size):
+        payload = _safe_json(r.payload_json)
+        row_trace = r.trace_id or payload.get("trace_id")
+        msg = (r.error_message or "").strip()
+        code = "outbox_error"
+        if "403" in msg:
+            code = "http_403"
+        elif "401" in msg:
+            code = "http_401"
+        elif "timeout" in msg.lower():
+            code = "timeout"
+        if code_filter and code_filter not in code:
+            continue
+        yield {
+            "_ts": _as_naive_utc(r.created_at),
+            "_id": int(r.id),
+            "id": f"outbox:{r.id}",
+            "created_at": r.created_at.isoformat() if r.created_at else None,
+            "portal_id": r.portal_id,
+            "portal_domain": (domain or "") if r.portal_id else "",
+            "trace_id": row_trace,
+            "channel": "outbox",
+            "endpoint": payload.get("method") or "",
+            "method": "POST",
+            "code": code,
+            "message": msg[:500],
+            "status_code": None,
+            "kind": payload.get("kind") or "",
+        }
+
+
+def iter_errors(
+    db: Session,
+    *,
+    portal_id: int | None = None,
+    portal: str | None = None,
+    trace_id: str | None = None,
+    channel: str | None = None,
+    code: str | None = None,
+    cursor: str | None = None,
+    page_size: int = 500,
+) -> Iterator[dict[str, Any]]:
+    """Newest-first error feed across sources; items carry ``_ts``/``_id`` for ``encode_cursor``."""
+    requested = (channel or "").strip().lower()
+    portal_filter = (portal or "").strip().lower()
+    if portal_id is None and portal_filter.isdigit():
+        portal_id = int(portal_filter)
+    domain_filter = portal_filter if portal_filter and not portal_filter.isdigit() else ""
+    code_filter = (code or "").strip().lower()
+    before = decode_cursor(cursor)
+    feeds = []
+    for name, source in (("bitrix_http", _bitrix_items), ("inbound", _inbound_items), ("outbox", _outbox_items)):
+        if requested in ("", name):
+            feeds.append(source(db, portal_id, domain_filter, trace_id, code_filter, before, page_size))
+    yield from heapq.merge(
+        *feeds,
+        key=lambda it: (it["_ts"] or datetime.min, -CHANNELS.index(it["channel"]), it["_id"]),
+        reverse=True,
+    )
+
+
+def public_item(item: dict[str, Any]) -> dict[str, Any]:
+    return {k: v for k, v in item.items() if not k.startswith("_")}
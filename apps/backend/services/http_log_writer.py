@@ -0,0 +1,195 @@
+"""Background batched writer for inbound Bitrix HTTP logs (bitrix_http_logs).
+
+The middleware only captures bounded raw bytes; JSON parsing, masking and the
+``bitrix_iframe_probe`` log line happen here, off the request path.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import re
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from apps.backend import database
+from apps.backend.config import get_settings
+from apps.backend.services.batch_writer import BatchWriter
+from apps.backend.services.bitrix_logging import build_inbound_log_row, write_http_logs
+
+logger = logging.getLogger("uvicorn.error")
+
+_MAX_JSON_FIELD_CHARS = 16_000
+_SECRET_KEYS = {
+    "access_token",
+    "refresh_token",
+    "token",
+    "auth",
+    "authorization",
+    "password",
+    "client_secret",
+    "secret",
+    "webhook_secret",
+}
+# "key": "value" pairs in raw JSON text; the value may be cut off by the capture limit
+_JSON_STRING_PAIR_RE = re.compile(r'"((?:[^"\\]|\\.)*)"(\s*:\s*)"(?:[^"\\]|\\.)*"?')
+
+
+def _is_secret_key(key) -> bool:
+    kl = str(key).lower()
+    return kl in _SECRET_KEYS or "token" in kl or "secret" in kl or "password" in kl or "authorization" in kl
+
+
+def _mask_payload(value):
+    """Mask sensitive fields recursively for trace-safe diagnostics."""
+    if isinstance(value, dict):
+        out = {}
+        for k, v in value.items():
+            if _is_secret_key(k):
+                out[k] = "[MASKED]" if v else None
+            else:
+                out[k] = _mask_payload(v)
+        return out
+    if isinstance(value, list):
+        return [_mask_payload(v) for v in value]
+    return value
+
+
+def _truncate_payload(value):
+    """Bound payload size to keep DB rows compact."""
+    try:
+        raw = json.dumps(value, ensure_ascii=False)
+    except Exception:
+        return value
+    if len(raw) <= _MAX_JSON_FIELD_CHARS:
+        return value
+    clipped = raw[:_MAX_JSON_FIELD_CHARS]
+    return {"_truncated": True, "preview": clipped}
+
+
+def _mask_text(text: str) -> str:
+    """Mask secret string values in JSON text that cannot be parsed (a body cut at the capture limit)."""
+
+    def _sub(m: re.Match) -> str:
+        return f'"{m.group(1)}"{m.group(2)}"[MASKED]"' if _is_secret_key(m.group(1)) else m.group(0)
+
+    return _JSON_STRING_PAIR_RE.sub(_sub, text)
+
+
+def _json_payload(body: bytes, truncated: bool):
+    if not body:
+        return None
+    if truncated:
+        preview = _mask_text(body.decode("utf-8", errors="replace"))
+        return {"_truncated": True, "preview": preview[:_MAX_JSON_FIELD_CHARS]}
+    try:
+        return _truncate_payload(_mask_payload(json.loads(body.decode("utf-8", errors="replace"))))
+    except Exception:
+        return {"_parse_error": True}
+
+
+@dataclass
+class HttpLogRecord:
+    trace_id: str
+    method: str
+    path: str
+    query_keys: list[str]
+    headers: dict[str, str]
+    status_code: int
+    latency_ms: int
+    request_body: bytes = b""
+    request_truncated: bool = False
+    response_content_type: str = ""
+    response_length: int | None = None
+    response_body: bytes = b""
+    response_truncated: bool = False
+    created_at: datetime = field(default_factory=datetime.utcnow)
+
+
+def _row_for(rec: HttpLogRecord) -> dict:
+    h = rec.headers
+    request_json = None
+    if "application/json" in (h.get("content-type") or "").lower():
+        request_json = _json_payload(rec.request_body, rec.request_truncated)
+    response_is_json = (rec.response_content_type or "").startswith("application/json")
+    response_json = _json_payload(rec.response_body, rec.response_truncated) if response_is_json else None
+    return build_inbound_log_row(
+        trace_id=rec.trace_id,
+        method=rec.method,
+        path=rec.path,
+        query_keys=rec.query_keys,
+        body_keys=[],
+        status_code=rec.status_code,
+        latency_ms=rec.latency_ms,
+        accept=h.get("accept"),
+        sec_fetch_dest=h.get("sec-fetch-dest"),
+        sec_fetch_mode=h.get("sec-fetch-mode"),
+        user_agent=h.get("user-agent"),
+        response_content_type=rec.response_content_type,
+        response_length=rec.response_length,
+        response_is_json=response_is_json,
+        request_json=request_json,
+        response_json=response_json,
+        headers_min={
+            "accept": (h.get("accept") or "")[:256],
+            "content_type": (h.get("content-type") or "")[:128],
+            "x_requested_with": (h.get("x-requested-with") or "")[:64],
+        },
+        created_at=rec.created_at,
+    )
+
+
+def _log_probe(rec: HttpLogRecord) -> None:
+    h = rec.headers
+    probe = {
+        "type": "bitrix_iframe_probe",
+        "trace_id": rec.trace_id,
+        "method": rec.method,
+        "path": rec.path,
+        "query_keys": rec.query_keys,
+        "status": rec.status_code,
+        "response_content_type": rec.response_content_type,
+        "response_length": rec.response_length,
+        "accept": (h.get("accept") or "")[:256],
+        "sec_fetch_dest": (h.get("sec-fetch-dest") or "")[:64],
+        "sec_fetch_mode": (h.get("sec-fetch-mode") or "")[:64],
+        "x_requested_with": (h.get("x-requested-with") or "")[:64],
+        "user_agent": (h.get("user-agent") or "")[:128],
+    }
+    logger.info(json.dumps(probe, ensure_ascii=False))
+
+
+class HttpLogWriter(BatchWriter[HttpLogRecord]):
+    name = "http_log_writer"
+
+    def item_size(self, item: HttpLogRecord) -> int:
+        return len(item.request_body) + len(item.response_body)
+
+    def write_batch(self, batch: list[HttpLogRecord]) -> int:
+        rows = [_row_for(rec) for rec in batch]
+        for rec in batch:
+            _log_probe(rec)
+        factory = database.get_session_factory()
+        with factory() as db:
+            return write_http_logs(db, rows)
+
+
+_writer: HttpLogWriter | None = None
+_writer_lock = threading.Lock()
+
+
+def get_http_log_writer() -> HttpLogWriter:
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                s = get_settings()
+                _writer = HttpLogWriter(
+                    max_events=s.bitrix_http_log_queue_max_events,
+                    max_bytes=int(s.bitrix_http_log_queue_max_mb) * 1024 * 1024,
+                    batch_size=s.inbound_log_batch_size,
+                    flush_interval=s.inbound_log_flush_interval_ms / 1000.0,
+                    sample_watermark=s.inbound_log_sample_watermark,
+                    sample_every=s.inbound_log_sample_every,
+                )
+    return _writer
@@ -179,3 +179,142 @@ def link_or_create_app_user(
         identity_id=int(ident.id),
         account_id=account_id,
     )
+
+
+@dataclass
+class IdentityLinkInput:
+    external_id: str
+    display_value: str | None = None
+    email: str | None = None
+    meta_json: dict | None = None
+
+
+_IN_CHUNK = 500
+
+
+def link_or_create_app_users(
+    db: Session,
+    *,
+    provider: str,
+    integration_id: int | None,
+    items: list[IdentityLinkInput],
+    auto_create_user: bool = True,
+) -> dict[str, IdentityLinkResult]:
+    """Bulk ``link_or_create_app_user`` for directory syncs, keyed by external_id.
+
+    Same rules (existing identity, then web credential email, then a new user),
+    but each step is one query for the whole batch and unchanged identities are
+    not written.
+    """
+    provider_norm = (provider or "").strip().lower()
+    integ_id = int(integration_id) if integration_id else None
+    results: dict[str, IdentityLinkResult] = {}
+    wanted: dict[str, IdentityLinkInput] = {}
+    for item in items:
+        external_norm = str(item.external_id or "").strip()
+        if not provider_norm or not external_norm:
+            results[external_norm] = IdentityLinkResult(
+                status="invalid_input",
+                user_id=None,
+                identity_id=None,
+                account_id=None,
+                reason="missing_provider_or_external_id",
+            )
+            continue
+        wanted[external_norm] = item
+    if not wanted:
+        return results
+
+    account_id: int | None = None
+    if integ_id:
+        integ = db.get(AccountIntegration, integ_id)
+        account_id = int(integ.account_id) if integ and integ.account_id else None
+
+    keys = list(wanted)
+    existing: dict[str, AppUserIdentity] = {}
+    for i in range(0, len(keys), _IN_CHUNK):
+        rows = db.execute(
+            select(AppUserIdentity).where(
+                AppUserIdentity.provider == provider_norm,
+                AppUserIdentity.integration_id == integ_id,
+                AppUserIdentity.external_id.in_(keys[i:i + _IN_CHUNK]),
+            )
+        ).scalars()
+        existing.update({row.external_id: row for row in rows})
+
+    for external_norm, ident in existing.items():
+        item = wanted[external_norm]
+        display = (item.display_value or "").strip()
+        if display and (ident.display_value or "").strip() != display:
+            ident.display_value = display
+        if item.meta_json is not None and ident.meta_json != item.meta_json:
+            ident.meta_json = item.meta_json
+        results[external_norm] = IdentityLinkResult(
+            status="existing_identity",
+            user_id=int(ident.user_id),
+            identity_id=int(ident.id),
+            account_id=account_id,
+        )
+
+    missing = [k for k in keys if k not in existing]
+    emails = sorted({e for e in (_normalize_email(wanted[k].email) for k in missing) if e})
+    cred_users: dict[str, int] = {}
+    for i in range(0, len(emails), _IN_CHUNK):
+        rows = db.execute(
+            select(AppUserWebCredential.email, AppUserWebCredential.user_id).where(
+                AppUserWebCredential.email.in_(emails[i:i + _IN_CHUNK])
+            )
+        ).all()
+        cred_users.update({email: int(user_id) for email, user_id in rows})
+
+    now = datetime.utcnow()
+    owners: dict[str, tuple[int | AppUser, str]] = {}
+    for external_norm in missing:
+        item = wanted[external_norm]
+        email_norm = _normalize_email(item.email)
+        if email_norm and email_norm in cred_users:
+            owners[external_norm] = (cred_users[email_norm], "linked_by_email")
+        elif auto_create_user:
+            app_user = AppUser(
+                display_name=(item.display_value or email_norm or f"{provider_norm}:{external_norm}").strip(),
+                status="active",
+                created_at=now,
+                updated_at=now,
+            )
+            db.add(app_user)
+            owners[external_norm] = (app_user, "created_user")
+        else:
+            results[external_norm] = IdentityLinkResult(
+                status="unresolved",
+                user_id=None,
+                identity_id=None,
+                account_id=account_id,
+                reason="no_safe_match",
+            )
+    db.flush()  # writes changed identities, assigns ids to the new users
+
+    created: list[tuple[str, AppUserIdentity, str, int | None]] = []
+    for external_norm, (owner, status) in owners.items():
+        item = wanted[external_norm]
+        user_id = int(owner.id) if isinstance(owner, AppUser) else int(owner)
+        ident = AppUserIdentity(
+            user_id=user_id,
+            provider=provider_norm,
+            integration_id=integ_id,
+            external_id=external_norm,
+            display_value=(item.display_value or "").strip() or None,
+            meta_json=item.meta_json,
+            created_at=now,
+        )
+        db.add(ident)
+        created.append((external_norm, ident, status, user_id if status == "linked_by_email" else None))
+    db.flush()
+    for external_norm, ident, status, matched_user_id in created:
+        results[external_norm] = IdentityLinkResult(
+            status=status,
+            user_id=int(ident.user_id),
+            identity_id=int(ident.id),
+            account_id=account_id,
+            matched_user_id=matched_user_id,
+        )
+    return results
@@ -0,0 +1,79 @@
+"""Background batched writer for bitrix_inbound_events: the request path only enqueues."""
+from __future__ import annotations
+
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from apps.backend import database
+from apps.backend.config import get_settings
+from apps.backend.services.batch_writer import BatchWriter
+from apps.backend.services.bitrix_inbound_log import prepare_inbound_event, write_inbound_events
+from apps.backend.services.inbound_settings import get_inbound_settings
+
+
+@dataclass
+class InboundEvent:
+    trace_id: str | None
+    method: str
+    path: str
+    query_string: str | None
+    headers: dict
+    body: bytes
+    remote_ip: str | None
+    query_domain: str | None = None
+    received_at: datetime = field(default_factory=datetime.utcnow)
+
+
+class InboundEventWriter(BatchWriter[InboundEvent]):
+    """Parses, redacts and inserts inbound events in multi-row INSERTs off the request path."""
+
+    name = "inbound_log_writer"
+
+    def item_size(self, item: InboundEvent) -> int:
+        return len(item.body or b"")
+
+    def write_batch(self, batch: list[InboundEvent]) -> int:
+        factory = database.get_session_factory()
+        with factory() as db:
+            settings = get_inbound_settings(db)
+            if not settings.get("enabled", True):
+                return 0
+            prepared = [
+                prepare_inbound_event(
+                    trace_id=e.trace_id,
+                    method=e.method,
+                    path=e.path,
+                    query_string=e.query_string,
+                    content_type=e.headers.get("content-type"),
+                    request_headers=e.headers,
+                    body_bytes=e.body,
+                    remote_ip=e.remote_ip,
+                    query_domain=e.query_domain,
+                    settings=settings,
+                    received_at=e.received_at,
+                )
+                for e in batch
+            ]
+            return write_inbound_events(db, prepared)
+
+
+_writer: InboundEventWriter | None = None
+_writer_lock = threading.Lock()
+
+
+def get_inbound_writer() -> InboundEventWriter:
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                s = get_settings()
+                _writer = InboundEventWriter(
+                    max_events=s.inbound_log_queue_max_events,
+                    max_bytes=int(s.inbound_log_queue_max_mb) * 1024 * 1024,
+                    batch_size=s.inbound_log_batch_size,
+                    flush_interval=s.inbound_log_flush_interval_ms / 1000.0,
+                    sample_watermark=s.inbound_log_sample_watermark,
+                    sample_every=s.inbound_log_sample_every,
+                )
+    return _writer
@@ -0,0 +1,359 @@
+"""Materialized effective KB access (``kb_file_access_map``).
+
+Under ``resolve_kb_acl_access`` a file is governed by exactly one rule set:
+its own KBFileAccess rows if it has any, else its folder's KBFolderAccess
+rows, else the role default. The map stores, per file, every principal that
+set grants a level above ``none`` plus a marker row ``("*", source)``. A
+caller's level is the best level among rows matching their principals
+(membership, groups, role, audience), or the role default on ``default``
+files, so filtering a set of files is one indexed query.
+
+Principals are matched at read time, so group membership and role changes
+need no recomputation. Session hooks (``after_flush`` and, for bulk
+``delete``/``update`` of ACL rows, ``do_orm_execute``) recompute, in the same
+transaction, the files whose ACL rows, folder ACL rows or folder assignment
+changed. Files created before migration 064 are evaluated in memory until
+``backfill_access_map`` stores them; ``verify_access_map`` compares the map
+with the per-file resolver (``python -m apps.backend.scripts.kb_access_map``).
+"""
+from __future__ import annotations
+
+from itertools import chain
+from typing import Any, Iterable
+
+from sqlalchemy import and_, delete, event, insert, inspect, or_, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from apps.backend.models.kb import KBFile, KBFileAccess, KBFileAccessMap, KBFolderAccess
+from apps.backend.services.kb_acl import (
+    default_kb_access_for_role,
+    kb_access_allows_read,
+    kb_access_rank,
+    kb_acl_principals_for_membership,
+    normalize_kb_access_level,
+    resolve_kb_acl_access,
+)
+
+MARKER = "*"
+
+Rule = tuple[str, str, str]
+
+
+def _rules_by(rows) -> dict[int, list[Rule]]:
+    out: dict[int, list[Rule]] = {}
+    for key, principal_type, principal_id, access_level in rows:
+        out.setdefault(int(key), []).append((str(principal_type), str(principal_id), str(access_level or "none")))
+    return out
+
+
+def _load_inputs(conn: Session | Connection, ids: list[int]) -> tuple[dict[int, int | None], dict[int, list[Rule]], dict[int, list[Rule]]]:
+    files = {
+        int(fid): (int(folder_id) if folder_id is not None else None)
+        for fid, folder_id in conn.execute(select(KBFile.id, KBFile.folder_id).where(KBFile.id.in_(ids))).all()
+    }
+    if not files:
+        return {}, {}, {}
+    file_rules = _rules_by(
+        conn.execute(
+            select(KBFileAccess.file_id, KBFileAccess.principal_type, KBFileAccess.principal_id, KBFileAccess.access_level)
+            .where(KBFileAccess.file_id.in_(sorted(files)))
+        ).all()
+    )
+    folder_ids = sorted({f for f in files.values() if f is not None})
+    folder_rules = _rules_by(
+        conn.execute(
+            select(KBFolderAccess.folder_id, KBFolderAccess.principal_type, KBFolderAccess.principal_id, KBFolderAccess.access_level)
+            .where(KBFolderAccess.folder_id.in_(folder_ids))
+        ).all()
+    ) if folder_ids else {}
+    return files, file_rules, folder_rules
+
+
+def governing_rules(file_rules: list[Rule], folder_id: int | None, folder_rules: list[Rule]) -> tuple[str, list[Rule]]:
+    if file_rules:
+        return "file", file_rules
+    if folder_id is not None and folder_rules:
+        return "folder", folder_rules
+    return "default", []
+
+
+def _map_rows(source: str, rules: list[Rule]) -> list[Rule]:
+    best: dict[tuple[str, str], str] = {}
+    for principal_type, principal_id, access_level in rules:
+        key = (str(principal_type or "").strip().lower(), str(principal_id or "").strip())
+        level = normalize_kb_access_level(access_level)
+        if level == "none" or not key[0] or not key[1]:
+            continue
+        if kb_access_rank(level) > kb_access_rank(best.get(key)):
+            best[key] = level
+    return [(MARKER, source, "none")] + [(pt, pid, level) for (pt, pid), level in sorted(best.items())]
+
+
+def compute_access_rows(conn: Session | Connection, file_ids: Iterable[int]) -> dict[int, list[Rule]]:
+    """Map rows (marker first) for the existing files among ``file_ids``."""
+    ids = sorted({int(x) for x in file_ids})
+    if not ids:
+        return {}
+    files, file_rules, folder_rules = _load_inputs(conn, ids)
+    out: dict[int, list[Rule]] = {}
+    for fid, folder_id in files.items():
+        source, rules = governing_rules(
+            file_rules.get(fid, []), folder_id, folder_rules.get(folder_id, []) if folder_id is not None else []
+        )
+        out[fid] = _map_rows(source, rules)
+    return out
+
+
+def refresh_access_map(conn: Session | Connection, *, file_ids: Iterable[int] = (), folder_ids: Iterable[int] = ()) -> int:
+    """Recompute and store the map rows of ``file_ids`` and of the files in ``folder_ids``."""
+    ids = {int(x) for x in file_ids if x is not None}
+    folders = sorted({int(x) for x in folder_ids if x is not None})
+    if folders:
+        ids.update(int(x) for x in conn.execute(select(KBFile.id).where(KBFile.folder_id.in_(folders))).scalars().all())
+    if not ids:
+        return 0
+    computed = compute_access_rows(conn, ids)
+    conn.execute(delete(KBFileAccessMap).where(KBFileAccessMap.file_id.in_(sorted(ids))))
+    rows = [
+        {"file_id": fid, "principal_type": pt, "principal_id": pid, "access_level": level}
+        for fid, file_rows in computed.items()
+        for pt, pid, level in file_rows
+    ]
+    if rows:
+        conn.execute(insert(KBFileAccessMap), rows)
+    return len(computed)
+
+
+def _acl_inputs_changed(session: Session, flush_context) -> None:
+    file_ids: set[int] = set()
+    folder_ids: set[int] = set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, KBFileAccess):
+            file_ids.add(obj.file_id)
+            file_ids.update(inspect(obj).attrs.file_id.history.deleted or ())
+        elif isinstance(obj, KBFolderAccess):
+            folder_ids.add(obj.folder_id)
+            folder_ids.update(inspect(obj).attrs.folder_id.history.deleted or ())
+        elif isinstance(obj, KBFile):
+            if obj in session.dirty and not inspect(obj).attrs.folder_id.history.has_changes():
+                continue
+            file_ids.add(obj.id)
+    file_ids.discard(None)
+    folder_ids.discard(None)
+    if file_ids or folder_ids:
+        refresh_access_map(session.connection(), file_ids=file_ids, folder_ids=folder_ids)
+
+
+def _acl_rows_bulk_changed(orm_execute_state):
+    """Bulk ``delete``/``update`` of ACL rows skips the flush; recompute around it."""
+    if not (orm_execute_state.is_delete or orm_execute_state.is_update):
+        return None
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or mapper.class_ not in (KBFileAccess, KBFolderAccess):
+        return None
+    key = KBFileAccess.file_id if mapper.class_ is KBFileAccess else KBFolderAccess.folder_id
+    stmt = orm_execute_state.statement
+    conn = orm_execute_state.session.connection()
+    probe = select(key).distinct()
+    if stmt.whereclause is not None:
+        probe = probe.where(stmt.whereclause)
+    keys = set(conn.execute(probe).scalars().all())
+    result = orm_execute_state.invoke_statement()
+    if orm_execute_state.is_update:
+        keys.update(conn.execute(probe).scalars().all())
+    if keys:
+        if mapper.class_ is KBFileAccess:
+            refresh_access_map(conn, file_ids=keys)
+        else:
+            refresh_access_map(conn, folder_ids=keys)
+    return result
+
+
+event.listen(Session, "after_flush", _acl_inputs_changed)
+event.listen(Session, "do_orm_execute", _acl_rows_bulk_changed)
+
+
+# --- reads -----------------------------------------------------------------
+
+
+def access_rows(
+    db: Session,
+    file_ids: Iterable[int],
+    principals: set[tuple[str, str]] | None = None,
+) -> dict[int, list[Rule]]:
+    """Stored map rows per file (all, or only the marker and ``principals``).
+
+    Files without stored rows are computed in memory; missing ids are absent.
+    """
+    ids = sorted({int(x) for x in file_ids})
+    if not ids:
+        return {}
+    stmt = select(
+        KBFileAccessMap.file_id, KBFileAccessMap.principal_type, KBFileAccessMap.principal_id, KBFileAccessMap.access_level
+    ).where(KBFileAccessMap.file_id.in_(ids))
+    if principals is not None:
+        stmt = stmt.where(
+            or_(
+                KBFileAccessMap.principal_type == MARKER,
+                *[and_(KBFileAccessMap.principal_type == pt, KBFileAccessMap.principal_id == pid) for pt, pid in sorted(principals)],
+            )
+        )
+    out = _rules_by(db.execute(stmt).all())
+    missing = [fid for fid in ids if fid not in out]
+    if missing:
+        for fid, rows in compute_access_rows(db, missing).items():
+            out[fid] = rows if principals is None else [r for r in rows if r[0] == MARKER or (r[0], r[1]) in principals]
+    return out
+
+
+def effective_level(rows: list[Rule], principals: set[tuple[str, str]], role: str | None) -> str:
+    best = "none"
+    for principal_type, principal_id, access_level in rows:
+        if principal_type == MARKER:
+            level = default_kb_access_for_role(role) if principal_id == "default" else "none"
+        elif (principal_type, principal_id) in principals:
+            level = access_level
+        else:
+            continue
+        if kb_access_rank(level) > kb_access_rank(best):
+            best = normalize_kb_access_level(level)
+    return best
+
+
+def readable_file_ids(
+    db: Session,
+    file_ids: Iterable[int],
+    *,
+    membership_id: int | None,
+    group_ids: list[int] | None,
+    role: str | None,
+    audience: str | None,
+) -> set[int]:
+    principals = kb_acl_principals_for_membership(membership_id, role, audience, group_ids)
+    return {
+        fid
+        for fid, rows in access_rows(db, file_ids, principals).items()
+        if kb_access_allows_read(effective_level(rows, principals, role))
+    }
+
+
+# --- maintenance -----------------------------------------------------------
+
+
+def resolve_readable_file_ids(
+    db: Session,
+    file_ids: Iterable[int],
+    *,
+    membership_id: int | None,
+    group_ids: list[int] | None,
+    role: str | None,
+    audience: str | None,
+) -> set[int]:
+    """Reference resolver: folder and file rules through resolve_kb_acl_access, file by file."""
+    ids = sorted({int(x) for x in file_ids})
+    if not ids:
+        return set()
+    files, file_rules, folder_rules = _load_inputs(db, ids)
+    principals = kb_acl_principals_for_membership(membership_id, role, audience, group_ids)
+    return {
+        fid
+        for fid, folder_id in files.items()
+        if kb_access_allows_read(_resolve(file_rules.get(fid, []), folder_id, folder_rules, principals, role))
+    }
+
+
+def _resolve(
+    file_rules: list[Rule],
+    folder_id: int | None,
+    folder_rules: dict[int, list[Rule]],
+    principals: set[tuple[str, str]],
+    role: str | None,
+) -> str:
+    inherited = default_kb_access_for_role(role)
+    if folder_id is not None:
+        inherited = resolve_kb_acl_access(folder_rules.get(folder_id, []), principals, inherited)
+    return resolve_kb_acl_access(file_rules, principals, inherited)
+
+
+def backfill_access_map(db: Session, *, batch_size: int = 1000) -> int:
+    """Store map rows for files that have none; returns how many files were written."""
+    written = 0
+    while True:
+        ids = db.execute(
+            select(KBFile.id)
+            .where(~select(KBFileAccessMap.file_id).where(KBFileAccessMap.file_id == KBFile.id).exists())
+            .order_by(KBFile.id)
+            .limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            return written
+        written += refresh_access_map(db, file_ids=ids)
+        db.commit()
+
+
+def verify_access_map(db: Session, file_ids: Iterable[int] | None = None) -> list[dict[str, Any]]:
+    """Differences between the stored map and the resolver.
+
+    ``missing``/``stale``: stored rows absent or different from a recomputation.
+    ``mismatch``: a subject (generic roles and audiences, plus each membership
+    and group named in the file's rules) whose read decision differs.
+    """
+    if file_ids is None:
+        ids = [int(x) for x in db.execute(select(KBFile.id).order_by(KBFile.id)).scalars().all()]
+    else:
+        ids = sorted({int(x) for x in file_ids})
+    problems: list[dict[str, Any]] = []
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        stored = _rules_by(
+            db.execute(
+                select(
+                    KBFileAccessMap.file_id,
+                    KBFileAccessMap.principal_type,
+                    KBFileAccessMap.principal_id,
+                    KBFileAccessMap.access_level,
+                ).where(KBFileAccessMap.file_id.in_(chunk))
+            ).all()
+        )
+        expected = compute_access_rows(db, chunk)
+        files, file_rules, folder_rules = _load_inputs(db, chunk)
+        for fid in sorted(expected):
+            rows = stored.get(fid)
+            if rows is None:
+                problems.append({"file_id": fid, "kind": "missing"})
+                continue
+            if sorted(rows) != sorted(expected[fid]):
+                problems.append({"file_id": fid, "kind": "stale", "stored": sorted(rows), "expected": expected[fid]})
+                continue
+            folder_id = files.get(fid)
+            named = file_rules.get(fid, []) + (folder_rules.get(folder_id, []) if folder_id is not None else [])
+            subjects: list[dict[str, Any]] = [
+                {"membership_id": None, "group_ids": [], "role": role, "audience": audience}
+                for role in ("owner", "admin", "member", "client")
+                for audience in ("staff", "client")
+            ]
+            for principal_type, principal_id, _level in named:
+                if str(principal_id).strip().isdigit() and principal_type in ("membership", "group"):
+                    pid = int(str(principal_id).strip())
+                    for role in ("member", "client"):
+                        subjects.append(
+                            {
+                                "membership_id": pid if principal_type == "membership" else None,
+                                "group_ids": [pid] if principal_type == "group" else [],
+                                "role": role,
+                                "audience": "client" if role == "client" else "staff",
+                            }
+                        )
+            for subject in subjects:
+                principals = kb_acl_principals_for_membership(
+                    subject["membership_id"], subject["role"], subject["audience"], subject["group_ids"]
+                )
+                by_map = kb_access_allows_read(effective_level(rows, principals, subject["role"]))
+                by_resolver = kb_access_allows_read(
+                    _resolve(file_rules.get(fid, []), folder_id, folder_rules, principals, subject["role"])
+                )
+                if by_map != by_resolver:
+                    problems.append({"file_id": fid, "kind": "mismatch", "subject": subject, "map": by_map})
+                    break
+    return problems
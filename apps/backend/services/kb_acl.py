@@ -17,6 +17,10 @@ def normalize_kb_access_level(value: str | None, *, strict: bool = False) -> str
     return "none"
 
 
+def kb_access_rank(value: str | None) -> int:
+    return _KB_ACCESS_RANK.get(normalize_kb_access_level(value), 0)
+
+
 def kb_access_allows_read(value: str | None) -> bool:
     return _KB_ACCESS_RANK.get(normalize_kb_access_level(value), 0) >= _KB_ACCESS_RANK["read"]
 
@@ -0,0 +1,330 @@
+"""KB file catalog: keyset-paginated listing, batched per-file details, change versions.
+
+The library view used to resolve ACL, folder and access badges file by file.
+``catalog_page`` walks the listing in server-side order with a keyset cursor
+and hands each batch to the caller's ACL filter; ``describe_files`` loads
+folder paths, collection memberships and chunk counts for a whole page in
+three queries.
+
+``kb_catalog_versions`` holds a per-portal counter bumped after every commit
+that touched KB files, chunks, folders, collections or ACL rows (session
+hooks below, including bulk ORM ``delete``/``update``). The bump runs in its
+own short transaction after the commit, so readers never see a new version
+with old data and writers do not hold the counter row lock. ``catalog_etag``
+turns the versions of the listed portals plus the caller's view into a weak
+ETag.
+"""
+from __future__ import annotations
+
+import base64
+import hashlib
+import json
+import logging
+from datetime import datetime
+from itertools import chain
+from typing import Any, Callable, Iterable
+
+from sqlalchemy import and_, event, func, or_, select
+from sqlalchemy.orm import Session
+
+from apps.backend.models.kb import (
+    KBCatalogVersion,
+    KBChunk,
+    KBCollection,
+    KBCollectionFile,
+    KBFile,
+    KBFileAccess,
+    KBFolder,
+    KBFolderAccess,
+    KBSource,
+)
+
+logger = logging.getLogger(__name__)
+
+_PENDING_KEY = "kb_catalog_portals"
+
+# sort name -> (key column, descending)
+SORTS: dict[str, tuple[Any, bool]] = {
+    "created": (KBFile.id, True),
+    "name": (func.lower(KBFile.filename), False),
+    "size": (KBFile.size_bytes, True),
+    "queries": (KBFile.query_count, True),
+}
+
+
+# --- change versions -------------------------------------------------------
+
+
+def _portal_probe(model, whereclause=None):
+    """Select of the portal ids touched by rows of ``model`` matching ``whereclause``."""
+    if model is KBFileAccess or model is KBCollectionFile:
+        stmt = select(KBFile.portal_id).join(model, model.file_id == KBFile.id)
+    elif model is KBFolderAccess:
+        stmt = select(KBFolder.portal_id).join(model, model.folder_id == KBFolder.id)
+    else:
+        stmt = select(model.portal_id)
+    if whereclause is not None:
+        stmt = stmt.where(whereclause)
+    return stmt.distinct()
+
+
+_TRACKED = (KBFile, KBChunk, KBFolder, KBCollection, KBSource, KBFileAccess, KBFolderAccess, KBCollectionFile)
+
+
+def mark_catalog_changed(db: Session, portal_ids: Iterable[int]) -> None:
+    """Bump the versions of ``portal_ids`` after the session's next commit."""
+    pending = db.info.setdefault(_PENDING_KEY, set())
+    pending.update(int(x) for x in portal_ids if x is not None)
+
+
+def _collect_flushed(session: Session, flush_context) -> None:
+    portal_ids: set[int] = set()
+    file_ids: set[int] = set()
+    folder_ids: set[int] = set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if not isinstance(obj, _TRACKED):
+            continue
+        if isinstance(obj, (KBFileAccess, KBCollectionFile)):
+            file_ids.add(obj.file_id)
+        elif isinstance(obj, KBFolderAccess):
+            folder_ids.add(obj.folder_id)
+        else:
+            portal_ids.add(obj.portal_id)
+    file_ids.discard(None)
+    folder_ids.discard(None)
+    if file_ids:
+        portal_ids.update(session.connection().execute(select(KBFile.portal_id).where(KBFile.id.in_(sorted(file_ids)))).scalars().all())
+    if folder_ids:
+        portal_ids.update(session.connection().execute(select(KBFolder.portal_id).where(KBFolder.id.in_(sorted(folder_ids)))).scalars().all())
+    if portal_ids:
+        mark_catalog_changed(session, portal_ids)
+
+
+def _collect_bulk(orm_execute_state):
+    if not (orm_execute_state.is_delete or orm_execute_state.is_update):
+        return None
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or mapper.class_ not in _TRACKED:
+        return None
+    probe = _portal_probe(mapper.class_, orm_execute_state.statement.whereclause)
+    conn = orm_execute_state.session.connection()
+    portal_ids = set(conn.execute(probe).scalars().all())
+    result = orm_execute_state.invoke_statement()
+    if orm_execute_state.is_update:
+        portal_ids.update(conn.execute(probe).scalars().all())
+    mark_catalog_changed(orm_execute_state.session, portal_ids)
+    return result
+
+
+def _insert(conn):
+    if conn.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert
+
+
+def bump_catalog_versions(conn, portal_ids: Iterable[int]) -> None:
+    ids = sorted({int(x) for x in portal_ids if x is not None})
+    if not ids:
+        return
+    now = datetime.utcnow()
+    stmt = _insert(conn)(KBCatalogVersion).values([{"portal_id": pid, "version": 1, "updated_at": now} for pid in ids])
+    conn.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["portal_id"],
+            set_={"version": KBCatalogVersion.version + 1, "updated_at": stmt.excluded.updated_at},
+        )
+    )
+
+
+def _bump_after_commit(session: Session) -> None:
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+    bind = session.get_bind()
+    try:
+        with getattr(bind, "engine", bind).begin() as conn:
+            bump_catalog_versions(conn, pending)
+    except Exception as e:
+        # The data is committed; a missed bump only delays listing ETag changes.
+        logger.warning("kb_catalog version bump failed portals=%s error=%s", sorted(pending), e)
+
+
+def _discard_pending(session: Session, previous_transaction=None) -> None:
+    session.info.pop(_PENDING_KEY, None)
+
+
+event.listen(Session, "after_flush", _collect_flushed)
+event.listen(Session, "do_orm_execute", _collect_bulk)
+event.listen(Session, "after_commit", _bump_after_commit)
+event.listen(Session, "after_rollback", _discard_pending)
+
+
+def catalog_versions(db: Session, portal_ids: Iterable[int]) -> dict[int, int]:
+    ids = sorted({int(x) for x in portal_ids})
+    rows = dict(
+        db.execute(select(KBCatalogVersion.portal_id, KBCatalogVersion.version).where(KBCatalogVersion.portal_id.in_(ids))).all()
+    ) if ids else {}
+    return {pid: int(rows.get(pid) or 0) for pid in ids}
+
+
+def catalog_etag(db: Session, portal_ids: Iterable[int], *view: Any) -> str:
+    """Weak ETag of a listing: portal versions plus whatever else shapes the response (caller, filters)."""
+    payload = json.dumps([sorted(catalog_versions(db, portal_ids).items()), list(view)], default=str, separators=(",", ":"))
+    return f'W/"kbc-{hashlib.sha1(payload.encode("utf-8")).hexdigest()[:24]}"'
+
+
+# --- listing ---------------------------------------------------------------
+
+
+def encode_cursor(sort: str, key: Any, file_id: int) -> str:
+    raw = json.dumps([sort, key, int(file_id)], ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str | None, sort: str) -> tuple[Any, int] | None:
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        c_sort, key, file_id = json.loads(raw)
+        if c_sort != sort:
+            return None
+        return key, int(file_id)
+    except Exception:
+        return None
+
+
+def _after(key_col, descending: bool, after: tuple[Any, int] | None):
+    if after is None:
+        return None
+    key, file_id = after
+    if key_col is KBFile.id:
+        return KBFile.id < file_id if descending else KBFile.id > file_id
+    if descending:
+        return or_(key_col < key, and_(key_col == key, KBFile.id < file_id))
+    return or_(key_col > key, and_(key_col == key, KBFile.id > file_id))
+
+
+def _newest_readable(
+    db: Session,
+    conditions: list[Any],
+    readable: Callable[[list[KBFile]], set[int]],
+    files: list[KBFile],
+) -> dict[str, int]:
+    """Lowercased filename -> id of the newest readable file with that name, for the names of ``files``."""
+    if not files:
+        return {}
+    newest: dict[str, int] = {}
+    for f in files:
+        name = f.filename.lower()
+        newest[name] = max(newest.get(name, 0), int(f.id))
+    newer = db.execute(
+        select(KBFile).where(
+            *conditions,
+            func.lower(KBFile.filename).in_(sorted(newest)),
+            KBFile.id > min(newest.values()),
+        )
+    ).scalars().all()
+    newer = [f for f in newer if int(f.id) > newest[f.filename.lower()]]
+    if newer:
+        allowed = readable(newer)
+        for f in newer:
+            if int(f.id) in allowed:
+                name = f.filename.lower()
+                newest[name] = max(newest[name], int(f.id))
+    return newest
+
+
+def catalog_page(
+    db: Session,
+    conditions: list[Any],
+    *,
+    readable: Callable[[list[KBFile]], set[int]],
+    sort: str = "created",
+    cursor: str | None = None,
+    limit: int = 200,
+) -> tuple[list[tuple[KBFile, str | None, str | None]], str | None]:
+    """One page of ``(file, source_type, source_url)`` rows and the next cursor.
+
+    Only the newest file per filename (case-insensitive) among ``conditions``
+    that the caller may read is listed, which hides stale failed uploads
+    without hiding an older readable file behind a newer unreadable one.
+    ``readable`` filters each fetched batch down to the ids the caller may see.
+    """
+    sort = sort if sort in SORTS else "created"
+    key_col, descending = SORTS[sort]
+    base = (
+        select(KBFile, KBSource.source_type, KBSource.url, key_col.label("sort_key"))
+        .join(KBSource, KBSource.id == KBFile.source_id, isouter=True)
+        .where(*conditions)
+        .order_by(key_col.desc() if descending else key_col.asc(), KBFile.id.desc() if descending else KBFile.id.asc())
+    )
+    batch_size = max(50, limit * 2)
+    position = decode_cursor(cursor, sort)
+    page: list[tuple[KBFile, str | None, str | None, Any]] = []
+    while len(page) <= limit:
+        stmt = base
+        after = _after(key_col, descending, position)
+        if after is not None:
+            stmt = stmt.where(after)
+        batch = db.execute(stmt.limit(batch_size)).all()
+        if not batch:
+            break
+        allowed = readable([row[0] for row in batch])
+        visible = [row for row in batch if int(row[0].id) in allowed]
+        newest = _newest_readable(db, conditions, readable, [row[0] for row in visible])
+        page.extend(row for row in visible if newest.get(row[0].filename.lower()) == int(row[0].id))
+        last = batch[-1]
+        position = (last.sort_key, int(last[0].id))
+        if len(batch) < batch_size:
+            break
+    next_cursor = None
+    if len(page) > limit:
+        edge = page[limit - 1]
+        next_cursor = encode_cursor(sort, edge[3], int(edge[0].id))
+    return [(f, source_type, url) for f, source_type, url, _key in page[:limit]], next_cursor
+
+
+def describe_files(db: Session, files: list[KBFile], folder_conditions: list[Any]) -> dict[str, dict[int, Any]]:
+    """Folder paths, collection ids and chunk counts for ``files`` (three queries)."""
+    ids = sorted({int(f.id) for f in files})
+    out: dict[str, dict[int, Any]] = {"folder_path": {}, "collection_ids": {}, "chunk_count": {}}
+    if not ids:
+        return out
+    folders = {
+        int(fid): (int(parent) if parent is not None else None, str(name or ""))
+        for fid, parent, name in db.execute(select(KBFolder.id, KBFolder.parent_id, KBFolder.name).where(*folder_conditions)).all()
+    }
+    paths: dict[int, str] = {}
+
+    def _path(folder_id: int) -> str:
+        if folder_id in paths:
+            return paths[folder_id]
+        names: list[str] = []
+        seen: set[int] = set()
+        current: int | None = folder_id
+        while current is not None and current in folders and current not in seen:
+            seen.add(current)
+            parent, name = folders[current]
+            names.append(name)
+            current = parent
+        paths[folder_id] = "/".join(reversed(names))
+        return paths[folder_id]
+
+    for f in files:
+        out["folder_path"][int(f.id)] = _path(int(f.folder_id)) if f.folder_id is not None else None
+    for fid, collection_id in db.execute(
+        select(KBCollectionFile.file_id, KBCollectionFile.collection_id)
+        .where(KBCollectionFile.file_id.in_(ids))
+        .order_by(KBCollectionFile.collection_id)
+    ).all():
+        out["collection_ids"].setdefault(int(fid), []).append(int(collection_id))
+    out["chunk_count"] = {
+        int(fid): int(n)
+        for fid, n in db.execute(
+            select(KBChunk.file_id, func.count(KBChunk.id)).where(KBChunk.file_id.in_(ids)).group_by(KBChunk.file_id)
+        ).all()
+    }
+    return out
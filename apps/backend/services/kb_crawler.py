@@ -0,0 +1,400 @@
+"""KB web crawler: bounded per-host concurrency, conditional GETs, change detection.
+
+Crawl runs in two phases: an async fetch phase (no DB access) and a DB apply
+phase that upserts ``KBSourcePage`` rows, rewrites changed pages on disk and
+creates ingest jobs. Ingest itself is a separate job on the ingest queue.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from urllib.parse import urldefrag, urljoin, urlsplit
+from urllib.robotparser import RobotFileParser
+
+import httpx
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+from apps.backend.config import get_settings
+from apps.backend.models.kb import KBChunk, KBEmbedding, KBFile, KBJob, KBSource, KBSourcePage
+from apps.backend.services.kb_storage import ensure_portal_dir
+
+logger = logging.getLogger(__name__)
+
+_USER_AGENT = "TeachbaseAI-KB-Crawler/1.0"
+_SKIP_EXTS = (
+    ".pdf", ".zip", ".rar", ".7z", ".gz", ".png", ".jpg", ".jpeg", ".gif", ".webp", ".svg",
+    ".mp3", ".mp4", ".avi", ".mov", ".webm", ".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx",
+    ".css", ".js", ".ico", ".xml", ".json",
+)
+
+
+def url_hash(url: str) -> str:
+    return hashlib.sha256((url or "").encode("utf-8")).hexdigest()
+
+
+def normalize_url(url: str, base: str | None = None) -> str | None:
+    raw = urljoin(base, url) if base else url
+    raw, _frag = urldefrag((raw or "").strip())
+    parts = urlsplit(raw)
+    if parts.scheme not in ("http", "https") or not parts.netloc:
+        return None
+    path = parts.path or "/"
+    norm = f"{parts.scheme}://{parts.netloc.lower()}{path}"
+    if parts.query:
+        norm += f"?{parts.query}"
+    return norm
+
+
+def _crawl_scope(start_url: str) -> tuple[str, str]:
+    """Crawl stays on the start host and under the start URL directory."""
+    parts = urlsplit(start_url)
+    path = parts.path or "/"
+    prefix = path if path.endswith("/") else path.rsplit("/", 1)[0] + "/"
+    return parts.netloc.lower(), prefix
+
+
+def _in_scope(url: str, host: str, prefix: str) -> bool:
+    parts = urlsplit(url)
+    if parts.netloc.lower() != host:
+        return False
+    path = parts.path or "/"
+    if path.lower().endswith(_SKIP_EXTS):
+        return False
+    return path.startswith(prefix)
+
+
+def extract_page(html: str, base_url: str) -> tuple[str, str, list[str]]:
+    """Return (title, text, links) for an HTML page."""
+    from bs4 import BeautifulSoup  # type: ignore
+
+    soup = BeautifulSoup(html or "", "lxml")
+    links: list[str] = []
+    for a in soup.find_all("a", href=True):
+        norm = normalize_url(str(a.get("href") or ""), base_url)
+        if norm and norm not in links:
+            links.append(norm)
+    for tag in soup(["script", "style", "noscript"]):
+        tag.extract()
+    title = soup.title.get_text().strip() if soup.title else ""
+    text = soup.get_text("\n").strip()
+    return title, text, links
+
+
+def sha256_text(text: str) -> str:
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+@dataclass
+class PageState:
+    etag: str | None = None
+    last_modified: str | None = None
+    content_sha256: str | None = None
+    links: list[str] = field(default_factory=list)
+
+
+@dataclass
+class FetchResult:
+    url: str
+    status: str  # changed|unchanged|gone|error
+    http_status: int | None = None
+    etag: str | None = None
+    last_modified: str | None = None
+    title: str = ""
+    text: str = ""
+    content_sha256: str | None = None
+    links: list[str] = field(default_factory=list)
+    error: str | None = None
+
+
+class _HostGate:
+    """Per-host concurrency limit plus a minimum delay between request starts."""
+
+    def __init__(self, concurrency: int, delay_seconds: float):
+        self.sem = asyncio.Semaphore(max(1, concurrency))
+        self.delay = max(0.0, delay_seconds)
+        self.lock = asyncio.Lock()
+        self.next_at = 0.0
+
+    async def __aenter__(self):
+        await self.sem.acquire()
+        async with self.lock:
+            now = time.monotonic()
+            wait = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.delay
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.sem.release()
+
+
+async def _load_robots(client: httpx.AsyncClient, start_url: str) -> RobotFileParser:
+    parts = urlsplit(start_url)
+    rp = RobotFileParser()
+    try:
+        r = await client.get(f"{parts.scheme}://{parts.netloc}/robots.txt")
+        rp.parse(r.text.splitlines() if r.status_code == 200 else [])
+    except Exception:
+        rp.parse([])
+    return rp
+
+
+async def _fetch_one(client: httpx.AsyncClient, gate: _HostGate, url: str, prev: PageState | None) -> FetchResult:
+    headers: dict[str, str] = {}
+    if prev and prev.etag:
+        headers["If-None-Match"] = prev.etag
+    if prev and prev.last_modified:
+        headers["If-Modified-Since"] = prev.last_modified
+    try:
+        async with gate:
+            r = await client.get(url, headers=headers)
+    except Exception as e:
+        return FetchResult(url=url, status="error", error=str(e)[:200])
+    if r.status_code == 304 and prev:
+        return FetchResult(
+            url=url,
+            status="unchanged",
+            http_status=304,
+            etag=prev.etag,
+            last_modified=prev.last_modified,
+            content_sha256=prev.content_sha256,
+            links=list(prev.links),
+        )
+    if r.status_code in (404, 410):
+        return FetchResult(url=url, status="gone", http_status=r.status_code)
+    if r.status_code >= 400:
+        return FetchResult(url=url, status="error", http_status=r.status_code, error=f"http_{r.status_code}")
+    ctype = (r.headers.get("content-type") or "").lower()
+    if ctype and "html" not in ctype and "text/plain" not in ctype:
+        return FetchResult(url=url, status="error", http_status=r.status_code, error="unsupported_content_type")
+    title, text, links = extract_page(r.text or "", str(r.url))
+    digest = sha256_text(text)
+    unchanged = bool(prev and prev.content_sha256 == digest)
+    return FetchResult(
+        url=url,
+        status="unchanged" if unchanged else "changed",
+        http_status=r.status_code,
+        etag=r.headers.get("etag"),
+        last_modified=r.headers.get("last-modified"),
+        title=title,
+        text=text,
+        content_sha256=digest,
+        links=links,
+        error=None if text else "no_text",
+    )
+
+
+async def crawl(
+    start_url: str,
+    known: dict[str, PageState],
+    *,
+    max_pages: int,
+    concurrency: int,
+    delay_seconds: float,
+    timeout_seconds: float = 20.0,
+    transport: httpx.AsyncBaseTransport | None = None,
+) -> list[FetchResult]:
+    """Breadth-first crawl of pages in scope of ``start_url``."""
+    start = normalize_url(start_url)
+    if not start:
+        return []
+    host, prefix = _crawl_scope(start)
+    gate = _HostGate(concurrency, delay_seconds)
+    results: list[FetchResult] = []
+    seen: set[str] = {start}
+    frontier: list[str] = [start]
+    async with httpx.AsyncClient(
+        timeout=timeout_seconds,
+        follow_redirects=True,
+        headers={"User-Agent": _USER_AGENT},
+        limits=httpx.Limits(max_connections=max(1, concurrency), max_keepalive_connections=max(1, concurrency)),
+        transport=transport,
+    ) as client:
+        robots = await _load_robots(client, start)
+        while frontier and len(results) < max_pages:
+            batch = frontier[: max_pages - len(results)]
+            frontier = frontier[len(batch):]
+            batch = [u for u in batch if robots.can_fetch(_USER_AGENT, u)]
+            fetched = await asyncio.gather(*[_fetch_one(client, gate, u, known.get(u)) for u in batch])
+            for res in fetched:
+                results.append(res)
+                for link in res.links:
+                    if link in seen or not _in_scope(link, host, prefix):
+                        continue
+                    seen.add(link)
+                    frontier.append(link)
+    return results
+
+
+def _enqueue_ingest_jobs(job_ids: list[int]) -> None:
+    if not job_ids:
+        return
+    try:
+        from redis import Redis
+        from rq import Queue
+
+        s = get_settings()
+        r = Redis(host=s.redis_host, port=s.redis_port)
+        q = Queue(s.rq_ingest_queue_name or "ingest", connection=r)
+        for job_id in job_ids:
+            q.enqueue(
+                "apps.worker.jobs.process_kb_job",
+                job_id,
+                job_id=f"kbjob:{job_id}",
+                job_timeout=max(300, int(s.kb_job_timeout_seconds or 3600)),
+            )
+    except Exception:
+        logger.exception("kb_crawler_enqueue_failed")
+
+
+def _page_storage_path(portal_dir: str, source_id: int, page_hash: str) -> str:
+    return os.path.join(portal_dir, f"src{int(source_id)}_{page_hash[:16]}.txt")
+
+
+def _apply_changed_page(
+    db: Session,
+    src: KBSource,
+    page: KBSourcePage,
+    res: FetchResult,
+    portal_dir: str,
+) -> KBJob | None:
+    from apps.backend.services.kb_sources import _safe_filename
+
+    if not res.text:
+        return None
+    rec = db.get(KBFile, page.file_id) if page.file_id else None
+    file_path = rec.storage_path if rec else _page_storage_path(portal_dir, src.id, page.url_hash)
+    with open(file_path, "w", encoding="utf-8") as f:
+        f.write(res.text)
+    filename = f"{_safe_filename(res.title or src.title or 'web')}.txt"
+    now = datetime.utcnow()
+    if rec is None:
+        rec = KBFile(
+            account_id=src.account_id,
+            portal_id=src.portal_id,
+            source_id=src.id,
+            filename=filename,
+            audience=src.audience or "staff",
+            mime_type="text/plain",
+            storage_path=file_path,
+            uploaded_by_type="system",
+            uploaded_by_id="source",
+            uploaded_by_name=src.source_type or "source",
+            created_at=now,
+        )
+        db.add(rec)
+        db.flush()
+        page.file_id = rec.id
+    else:
+        # Content changed: drop stale chunks so ingest re-chunks the new text.
+        chunk_ids = db.execute(select(KBChunk.id).where(KBChunk.file_id == rec.id)).scalars().all()
+        if chunk_ids:
+            db.execute(delete(KBEmbedding).where(KBEmbedding.chunk_id.in_(chunk_ids)))
+            db.execute(delete(KBChunk).where(KBChunk.id.in_(chunk_ids)))
+        rec.filename = filename
+    rec.size_bytes = os.path.getsize(file_path)
+    rec.sha256 = res.content_sha256
+    rec.status = "queued"
+    rec.error_message = None
+    rec.updated_at = now
+    db.add(rec)
+    job = KBJob(
+        account_id=src.account_id,
+        portal_id=src.portal_id,
+        job_type="ingest",
+        status="queued",
+        payload_json={"file_id": rec.id, "source_id": src.id},
+    )
+    db.add(job)
+    return job
+
+
+def apply_crawl_results(db: Session, src: KBSource, results: list[FetchResult]) -> dict:
+    """Persist page state; create ingest jobs for changed pages only."""
+    existing = {
+        p.url_hash: p
+        for p in db.execute(select(KBSourcePage).where(KBSourcePage.source_id == src.id)).scalars().all()
+    }
+    portal_dir = ensure_portal_dir(src.portal_id)
+    now = datetime.utcnow()
+    stats = {"fetched": len(results), "changed": 0, "unchanged": 0, "gone": 0, "errors": 0}
+    jobs: list[KBJob] = []
+    for res in results:
+        h = url_hash(res.url)
+        page = existing.get(h)
+        if page is None:
+            page = KBSourcePage(source_id=src.id, portal_id=src.portal_id, url=res.url, url_hash=h, created_at=now)
+            db.add(page)
+            existing[h] = page
+        page.http_status = res.http_status
+        page.fetched_at = now
+        page.error_message = res.error
+        if res.status in ("changed", "unchanged"):
+            page.etag = res.etag
+            page.last_modified = res.last_modified
+            page.links_json = res.links
+        if res.status == "changed" and res.text:
+            job = _apply_changed_page(db, src, page, res, portal_dir)
+            if job is not None:
+                jobs.append(job)
+            page.content_sha256 = res.content_sha256
+            page.title = (res.title or "")[:256] or page.title
+            page.changed_at = now
+            page.status = "changed"
+            stats["changed"] += 1
+        elif res.status == "unchanged" or (res.status == "changed" and not res.text):
+            page.status = "unchanged" if res.status == "unchanged" else "error"
+            stats["unchanged" if res.status == "unchanged" else "errors"] += 1
+        elif res.status == "gone":
+            page.status = "gone"
+            stats["gone"] += 1
+        else:
+            page.status = "error"
+            stats["errors"] += 1
+    db.commit()
+    job_ids = [int(j.id) for j in jobs]
+    stats["jobs"] = job_ids
+    return stats
+
+
+def crawl_source(db: Session, src: KBSource, *, transport: httpx.AsyncBaseTransport | None = None) -> dict:
+    """Crawl a web source, persist page state and enqueue ingest for changed pages."""
+    s = get_settings()
+    max_pages = max(1, min(int(src.max_pages or 1), int(s.kb_crawler_max_pages or 500)))
+    known: dict[str, PageState] = {
+        p.url: PageState(
+            etag=p.etag,
+            last_modified=p.last_modified,
+            content_sha256=p.content_sha256,
+            links=list(p.links_json or []),
+        )
+        for p in db.execute(select(KBSourcePage).where(KBSourcePage.source_id == src.id)).scalars().all()
+    }
+    results = asyncio.run(
+        crawl(
+            src.url or "",
+            known,
+            max_pages=max_pages,
+            concurrency=int(s.kb_crawler_per_host_concurrency or 2),
+            delay_seconds=max(0, int(s.kb_crawler_delay_ms or 0)) / 1000.0,
+            timeout_seconds=float(s.kb_crawler_timeout_seconds or 20),
+            transport=transport,
+        )
+    )
+    stats = apply_crawl_results(db, src, results)
+    if results and not src.title:
+        first = next((r for r in results if r.title), None)
+        if first:
+            src.title = first.title[:256]
+    src.last_crawled_at = datetime.utcnow()
+    db.add(src)
+    db.commit()
+    _enqueue_ingest_jobs(stats["jobs"])
+    return stats
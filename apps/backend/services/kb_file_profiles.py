@@ -0,0 +1,429 @@
+"""Per-file topic profiles built at ingest time.
+
+``refresh_file_profile`` runs in ``ingest_file`` once the chunks exist and
+stores, per file, the built-in topic memberships (``kb_file_topics``), the top
+lemmas with their in-file frequency (``kb_file_terms``) and a compact summary
+(``kb_file_profiles``). ``kb_portal_term_df`` holds per-portal document
+frequencies; it is adjusted by the difference between a file's old and new
+term sets, so re-ingesting or deleting a file never rescans the corpus.
+
+Scoped queries (topic ids, smart folders), the topics panel and RAG file
+summaries read these tables instead of tokenizing chunks per request; they
+never write. Files chunked before profiles existed are profiled by
+``ensure_file_profiles`` from ``python -m apps.backend.scripts.kb_file_profiles``.
+"""
+from __future__ import annotations
+
+import re
+from collections import Counter
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Iterable
+
+from sqlalchemy import delete, exists, func, insert, select, update
+from sqlalchemy.orm import Session
+
+from apps.backend.models.kb import KBChunk, KBFile, KBFileProfile, KBFileTerm, KBFileTopic, KBPortalTermDF
+from apps.backend.services.kb_rag import _normalize_ru_token
+
+TERMS_PER_FILE = 200
+SUMMARY_CHARS = 220
+BACKFILL_LIMIT = 500
+
+KB_TOPICS: list[dict[str, Any]] = [
+    {
+        "id": "product",
+        "name": "\u041f\u0440\u043e\u0434\u0443\u043a\u0442 \u0438 \u0444\u0443\u043d\u043a\u0446\u0438\u043e\u043d\u0430\u043b\u044c\u043d\u043e\u0441\u0442\u044c",
+        "keywords": [
+            "\u0444\u0443\u043d\u043a\u0446\u0438\u0438", "\u0444\u0443\u043d\u043a\u0446\u0438\u043e\u043d\u0430\u043b", "feature", "\u0432\u043e\u0437\u043c\u043e\u0436\u043d\u043e\u0441\u0442\u0438", "\u043f\u043b\u0430\u0442\u0444\u043e\u0440\u043c\u0430",
+            "rag", "\u0431\u0430\u0437\u0430 \u0437\u043d\u0430\u043d\u0438\u0439", "\u043c\u043e\u0434\u0435\u043b\u0438", "\u0438\u043d\u0442\u0435\u0440\u0444\u0435\u0439\u0441",
+            "\u043a\u043e\u043d\u0441\u0442\u0440\u0443\u043a\u0442\u043e\u0440", "\u0441\u0446\u0435\u043d\u0430\u0440\u0438\u0439", "\u0447\u0430\u0442-\u0431\u043e\u0442",
+        ],
+    },
+    {
+        "id": "pricing",
+        "name": "\u0422\u0430\u0440\u0438\u0444\u044b \u0438 \u0446\u0435\u043d\u044b",
+        "keywords": [
+            "\u0442\u0430\u0440\u0438\u0444", "\u0446\u0435\u043d\u0430", "\u0441\u0442\u043e\u0438\u043c\u043e\u0441\u0442\u044c", "\u043e\u043f\u043b\u0430\u0442\u0430", "\u043f\u043e\u0434\u043f\u0438\u0441\u043a\u0430", "billing",
+            "\u0441\u0447\u0435\u0442", "\u043f\u0440\u0430\u0439\u0441", "invoice",
+        ],
+    },
+    {
+        "id": "integrations",
+        "name": "\u0418\u043d\u0442\u0435\u0433\u0440\u0430\u0446\u0438\u0438 \u0438 \u043f\u0440\u043e\u0446\u0435\u0441\u0441\u044b",
+        "keywords": [
+            "\u0438\u043d\u0442\u0435\u0433\u0440\u0430\u0446\u0438\u044f", "\u0438\u043d\u0442\u0435\u0433\u0440\u0430\u0446\u0438\u0438", "crm", "bitrix", "\u0431\u0438\u0442\u0440\u0438\u043a\u0441", "amo",
+            "webhook", "api", "oauth", "telegram",
+        ],
+    },
+    {
+        "id": "sales",
+        "name": "\u041f\u0440\u043e\u0434\u0430\u0436\u0438 \u0438 \u043a\u0432\u0430\u043b\u0438\u0444\u0438\u043a\u0430\u0446\u0438\u044f",
+        "keywords": [
+            "\u043f\u0440\u043e\u0434\u0430\u0436", "\u043b\u0438\u0434", "\u0432\u043e\u0440\u043e\u043d\u043a\u0430", "\u0441\u0434\u0435\u043b\u043a", "\u043a\u043e\u043d\u0432\u0435\u0440\u0441\u0438\u044f",
+            "qualification", "offer", "objection", "cta",
+        ],
+    },
+    {
+        "id": "support",
+        "name": "\u041f\u043e\u0434\u0434\u0435\u0440\u0436\u043a\u0430 \u0438 \u0441\u0435\u0440\u0432\u0438\u0441",
+        "keywords": [
+            "\u043f\u043e\u0434\u0434\u0435\u0440\u0436\u043a", "\u0438\u043d\u0446\u0438\u0434\u0435\u043d\u0442", "\u043e\u0448\u0438\u0431\u043a", "\u0442\u0438\u043a\u0435\u0442",
+            "sla", "support", "\u0441\u0435\u0440\u0432\u0438\u0441", "\u043f\u043e\u043c\u043e\u0449",
+        ],
+    },
+    {
+        "id": "hr",
+        "name": "HR \u0438 \u043a\u043e\u043c\u0430\u043d\u0434\u0430",
+        "keywords": [
+            "\u0441\u043e\u0442\u0440\u0443\u0434\u043d\u0438\u043a", "\u043a\u043e\u043c\u0430\u043d\u0434", "\u043d\u0430\u0439\u043c", "\u0432\u0430\u043a\u0430\u043d\u0441", "hr",
+            "\u043e\u043d\u0431\u043e\u0440\u0434\u0438\u043d\u0433", "\u043e\u0431\u0443\u0447\u0435\u043d\u0438\u0435",
+        ],
+    },
+    {
+        "id": "analytics",
+        "name": "\u0410\u043d\u0430\u043b\u0438\u0442\u0438\u043a\u0430 \u0438 \u043c\u0435\u0442\u0440\u0438\u043a\u0438",
+        "keywords": [
+            "\u0430\u043d\u0430\u043b\u0438\u0442\u0438\u043a", "\u043e\u0442\u0447\u0435\u0442", "\u043c\u0435\u0442\u0440\u0438\u043a", "retention",
+            "ret3", "dashboard", "\u043a\u043e\u0433\u043e\u0440\u0442", "\u0441\u0442\u0430\u0442\u0438\u0441\u0442\u0438\u043a",
+        ],
+    },
+]
+
+AUTO_TOPIC_STOPWORDS = {
+    "\u0447\u0442\u043e", "\u043a\u0430\u043a", "\u044d\u0442\u043e", "\u0434\u043b\u044f", "\u0438\u043b\u0438", "\u043a\u043e\u0433\u0434\u0430", "\u0433\u0434\u0435", "\u0447\u0442\u043e\u0431\u044b", "\u0435\u0441\u043b\u0438", "\u043f\u0440\u0438",
+    "\u0435\u0441\u0442\u044c", "\u043d\u0435\u0442", "\u0431\u044b\u0442\u044c", "\u0431\u0443\u0434\u0435\u0442", "\u043f\u043e\u0441\u043b\u0435", "\u043f\u0435\u0440\u0435\u0434", "\u043c\u0435\u0436\u0434\u0443", "\u043d\u0430\u0434", "\u043f\u043e\u0434",
+    "\u043f\u0440\u043e", "also", "with", "from", "into", "your", "ours", "they", "them",
+    "\u043a\u043e\u0442\u043e\u0440\u044b\u0439", "\u043a\u043e\u0442\u043e\u0440\u0430\u044f", "\u043a\u043e\u0442\u043e\u0440\u044b\u0435", "\u043a\u043e\u0442\u043e\u0440\u044b\u0445", "\u044d\u0442\u043e\u0442", "\u044d\u0442\u0430", "\u044d\u0442\u0438", "\u0442\u043e\u0433\u043e",
+    "\u0432\u0441\u0435\u0433\u043e", "\u0432\u0441\u0435\u0445", "\u043c\u043e\u0436\u043d\u043e", "\u043d\u0443\u0436\u043d\u043e", "\u043e\u0447\u0435\u043d\u044c", "\u0431\u043e\u043b\u0435\u0435", "\u043c\u0435\u043d\u0435\u0435", "\u0442\u0430\u043a\u0436\u0435",
+}
+
+_TERM_RE = re.compile(r"[a-zA-Zа-яА-ЯёЁ0-9]{4,}")
+
+
+def topic_matches(text: str, keywords: list[str]) -> bool:
+    t = (text or "").lower()
+    if not t:
+        return False
+    return any(k in t for k in keywords)
+
+
+def profile_terms(text: str) -> list[str]:
+    """Lemmas of the words (4+ chars) of ``text`` that can become auto topics."""
+    out: list[str] = []
+    for token in _TERM_RE.findall((text or "").lower()):
+        if token in AUTO_TOPIC_STOPWORDS or token.isdigit() or len(token) > 40:
+            continue
+        lemma = _normalize_ru_token(token)
+        if len(lemma) < 3 or len(lemma) > 40 or lemma in AUTO_TOPIC_STOPWORDS:
+            continue
+        out.append(lemma)
+    return out
+
+
+@lru_cache(maxsize=1)
+def _topic_keyword_terms() -> frozenset[str]:
+    # Words of the built-in topic keywords are not offered again as auto topics.
+    out: set[str] = set()
+    for t in KB_TOPICS:
+        for kw in t.get("keywords", []):
+            for tok in _TERM_RE.findall(str(kw).lower()):
+                out.add(tok)
+                out.add(_normalize_ru_token(tok))
+    return frozenset(out)
+
+
+def build_profile(filename: str, texts: Iterable[str]) -> dict[str, Any]:
+    name_low = (filename or "").lower()
+    topics = {t["id"] for t in KB_TOPICS if topic_matches(name_low, t["keywords"])}
+    counts: Counter[str] = Counter(profile_terms(name_low))
+    summary = ""
+    chunk_count = 0
+    for text in texts:
+        chunk_count += 1
+        low = (text or "").lower()
+        if not low:
+            continue
+        if not summary:
+            summary = " ".join(str(text).split())[:SUMMARY_CHARS]
+        for t in KB_TOPICS:
+            if t["id"] not in topics and topic_matches(low, t["keywords"]):
+                topics.add(t["id"])
+        counts.update(profile_terms(low))
+    top = sorted(counts.items(), key=lambda x: (-x[1], x[0]))[:TERMS_PER_FILE]
+    return {"summary": summary or None, "topics": topics, "terms": top, "chunk_count": chunk_count}
+
+
+def _insert(db: Session):
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert
+
+
+def _adjust_df(db: Session, portal_id: int, terms: set[str], delta: int) -> None:
+    if not terms:
+        return
+    if delta > 0:
+        stmt = _insert(db)(KBPortalTermDF).values(
+            [{"portal_id": int(portal_id), "term": t, "df": delta} for t in sorted(terms)]
+        )
+        db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["portal_id", "term"],
+                set_={"df": KBPortalTermDF.df + stmt.excluded.df},
+            )
+        )
+        return
+    scope = (KBPortalTermDF.portal_id == int(portal_id), KBPortalTermDF.term.in_(sorted(terms)))
+    db.execute(update(KBPortalTermDF).where(*scope).values(df=KBPortalTermDF.df + delta))
+    db.execute(delete(KBPortalTermDF).where(*scope, KBPortalTermDF.df <= 0))
+
+
+def _clear(db: Session, file_id: int) -> tuple[int | None, set[str]]:
+    """Delete a file's profile rows; returns the portal and terms they were counted under."""
+    old = db.get(KBFileProfile, int(file_id))
+    old_terms = set(db.execute(select(KBFileTerm.term).where(KBFileTerm.file_id == int(file_id))).scalars().all())
+    db.execute(delete(KBFileTerm).where(KBFileTerm.file_id == int(file_id)))
+    db.execute(delete(KBFileTopic).where(KBFileTopic.file_id == int(file_id)))
+    return (int(old.portal_id) if old else None), old_terms
+
+
+def refresh_file_profile(db: Session, rec: KBFile, texts: Iterable[str] | None = None) -> dict[str, Any]:
+    """(Re)build the profile of ``rec`` from its chunk texts. The caller commits."""
+    if texts is None:
+        texts = db.execute(
+            select(KBChunk.text).where(KBChunk.file_id == rec.id).order_by(KBChunk.chunk_index)
+        ).scalars().all()
+    profile = build_profile(rec.filename or "", texts)
+    old_portal, old_terms = _clear(db, int(rec.id))
+    new_terms = {t for t, _tf in profile["terms"]}
+    if profile["terms"]:
+        db.execute(insert(KBFileTerm), [{"file_id": rec.id, "term": t, "tf": tf} for t, tf in profile["terms"]])
+    if profile["topics"]:
+        db.execute(insert(KBFileTopic), [{"file_id": rec.id, "topic_id": t} for t in sorted(profile["topics"])])
+    if old_portal is not None and old_portal != int(rec.portal_id):
+        _adjust_df(db, old_portal, old_terms, -1)
+        old_terms = set()
+    _adjust_df(db, int(rec.portal_id), old_terms - new_terms, -1)
+    _adjust_df(db, int(rec.portal_id), new_terms - old_terms, +1)
+    row = db.get(KBFileProfile, int(rec.id)) or KBFileProfile(file_id=int(rec.id))
+    row.portal_id = int(rec.portal_id)
+    row.summary = profile["summary"]
+    row.top_terms = [[t, tf] for t, tf in profile["terms"]]
+    row.chunk_count = profile["chunk_count"]
+    row.updated_at = datetime.utcnow()
+    db.add(row)
+    db.flush()
+    return profile
+
+
+def drop_file_profile(db: Session, file_id: int) -> None:
+    """Remove a file's profile and its document-frequency contribution. The caller commits."""
+    old_portal, old_terms = _clear(db, int(file_id))
+    if old_portal is not None:
+        _adjust_df(db, old_portal, old_terms, -1)
+    db.execute(delete(KBFileProfile).where(KBFileProfile.file_id == int(file_id)))
+
+
+def ensure_file_profiles(db: Session, *conditions: Any, limit: int = BACKFILL_LIMIT) -> int:
+    """Profile up to ``limit`` chunked files matching ``conditions`` that have no profile yet (commits).
+
+    Safe next to ingest and other backfills: the profile rows are inserted with
+    ON CONFLICT DO NOTHING first, and only files whose row this call inserted get
+    their terms, topics and document-frequency increments.
+    """
+    missing = db.execute(
+        select(KBFile)
+        .where(
+            *conditions,
+            ~exists().where(KBFileProfile.file_id == KBFile.id),
+            exists().where(KBChunk.file_id == KBFile.id),
+        )
+        .order_by(KBFile.id)
+        .limit(limit)
+    ).scalars().all()
+    if not missing:
+        return 0
+    texts: dict[int, list[str]] = {int(rec.id): [] for rec in missing}
+    for file_id, text in db.execute(
+        select(KBChunk.file_id, KBChunk.text)
+        .where(KBChunk.file_id.in_(sorted(texts)))
+        .order_by(KBChunk.file_id, KBChunk.chunk_index)
+    ).all():
+        texts[int(file_id)].append(text or "")
+    profiles = {int(rec.id): build_profile(rec.filename or "", texts[int(rec.id)]) for rec in missing}
+    now = datetime.utcnow()
+    stmt = _insert(db)(KBFileProfile).values(
+        [
+            {
+                "file_id": int(rec.id),
+                "portal_id": int(rec.portal_id),
+                "summary": profiles[int(rec.id)]["summary"],
+                "top_terms": [[t, tf] for t, tf in profiles[int(rec.id)]["terms"]],
+                "chunk_count": profiles[int(rec.id)]["chunk_count"],
+                "updated_at": now,
+            }
+            for rec in missing
+        ]
+    )
+    claimed = set(
+        db.execute(
+            stmt.on_conflict_do_nothing(index_elements=["file_id"]).returning(KBFileProfile.file_id)
+        ).scalars().all()
+    )
+    terms: list[dict[str, Any]] = []
+    topics: list[dict[str, Any]] = []
+    df: Counter[tuple[int, str]] = Counter()
+    for rec in missing:
+        if int(rec.id) not in claimed:
+            continue  # profiled concurrently (ingest or another backfill)
+        profile = profiles[int(rec.id)]
+        terms.extend({"file_id": int(rec.id), "term": t, "tf": tf} for t, tf in profile["terms"])
+        topics.extend({"file_id": int(rec.id), "topic_id": t} for t in sorted(profile["topics"]))
+        df.update((int(rec.portal_id), t) for t, _tf in profile["terms"])
+    if terms:
+        db.execute(insert(KBFileTerm), terms)
+    if topics:
+        db.execute(insert(KBFileTopic), topics)
+    if df:
+        stmt = _insert(db)(KBPortalTermDF).values(
+            [{"portal_id": portal_id, "term": term, "df": n} for (portal_id, term), n in sorted(df.items())]
+        )
+        db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["portal_id", "term"],
+                set_={"df": KBPortalTermDF.df + stmt.excluded.df},
+            )
+        )
+    db.commit()
+    return len(claimed)
+
+
+# --- reads -----------------------------------------------------------------
+
+
+def _resolve_topic_keys(keys: Iterable[str]) -> tuple[set[str], list[tuple[str, ...]]]:
+    """Built-in topic ids for keys naming a topic (id or name); term groups for the rest."""
+    topic_ids: set[str] = set()
+    term_groups: list[tuple[str, ...]] = []
+    for raw in keys:
+        key = str(raw or "").strip().lower()
+        if not key:
+            continue
+        builtin = next((t["id"] for t in KB_TOPICS if key in (t["id"].lower(), t["name"].lower())), None)
+        if builtin:
+            topic_ids.add(builtin)
+            continue
+        terms = tuple(sorted(set(profile_terms(key[5:] if key.startswith("auto:") else key))))
+        if terms:
+            term_groups.append(terms)
+    return topic_ids, term_groups
+
+
+def topic_file_ids(db: Session, keys: Iterable[str], *conditions: Any) -> set[int]:
+    """Files (restricted by ``conditions`` on KBFile) belonging to any of the topic keys.
+
+    A key naming a built-in topic matches its keyword membership; ``auto:<lemma>``
+    and free-text keys (smart folder names) match files containing all their lemmas.
+    """
+    topic_ids, term_groups = _resolve_topic_keys(keys)
+    out: set[int] = set()
+    if topic_ids:
+        out.update(
+            db.execute(
+                select(KBFileTopic.file_id)
+                .join(KBFile, KBFile.id == KBFileTopic.file_id)
+                .where(KBFileTopic.topic_id.in_(sorted(topic_ids)), *conditions)
+            ).scalars().all()
+        )
+    for terms in term_groups:
+        out.update(
+            db.execute(
+                select(KBFileTerm.file_id)
+                .join(KBFile, KBFile.id == KBFileTerm.file_id)
+                .where(KBFileTerm.term.in_(terms), *conditions)
+                .group_by(KBFileTerm.file_id)
+                .having(func.count() == len(terms))
+            ).scalars().all()
+        )
+    return {int(x) for x in out}
+
+
+def topic_memberships(db: Session, file_ids: Iterable[int]) -> dict[str, list[int]]:
+    """topic id -> member file ids (descending) among ``file_ids``."""
+    ids = sorted({int(x) for x in file_ids})
+    out: dict[str, list[int]] = {t["id"]: [] for t in KB_TOPICS}
+    if not ids:
+        return out
+    rows = db.execute(
+        select(KBFileTopic.topic_id, KBFileTopic.file_id)
+        .where(KBFileTopic.file_id.in_(ids))
+        .order_by(KBFileTopic.file_id.desc())
+    ).all()
+    for topic_id, file_id in rows:
+        out.setdefault(str(topic_id), []).append(int(file_id))
+    return out
+
+
+def _term_df(db: Session, ids: list[int], excluded: list[str], threshold: int, limit: int) -> list[tuple[str, int]]:
+    in_set = dict(
+        db.execute(
+            select(KBFileProfile.portal_id, func.count())
+            .where(KBFileProfile.file_id.in_(ids))
+            .group_by(KBFileProfile.portal_id)
+        ).all()
+    )
+    if not in_set:
+        return []
+    portal_totals = dict(
+        db.execute(
+            select(KBFileProfile.portal_id, func.count())
+            .where(KBFileProfile.portal_id.in_(sorted(in_set)))
+            .group_by(KBFileProfile.portal_id)
+        ).all()
+    )
+    if all(portal_totals.get(p) == n for p, n in in_set.items()):
+        # The set covers whole portals: read the maintained per-portal aggregates.
+        term, df = KBPortalTermDF.term, func.sum(KBPortalTermDF.df)
+        stmt = select(term, df).where(KBPortalTermDF.portal_id.in_(sorted(in_set)))
+    else:
+        term, df = KBFileTerm.term, func.count()
+        stmt = select(term, df).where(KBFileTerm.file_id.in_(ids))
+    rows = db.execute(
+        stmt.where(term.notin_(excluded))
+        .group_by(term)
+        .having(df >= threshold)
+        .order_by(df.desc(), term)
+        .limit(limit)
+    ).all()
+    return [(str(t), int(n)) for t, n in rows]
+
+
+def auto_topic_candidates(db: Session, file_ids: Iterable[int], *, threshold: int, limit: int = 8) -> list[dict[str, Any]]:
+    """Lemmas shared by at least ``threshold`` of ``file_ids``, most frequent first."""
+    ids = sorted({int(x) for x in file_ids})
+    if not ids:
+        return []
+    ranked = _term_df(db, ids, sorted(_topic_keyword_terms()), max(1, int(threshold)), max(1, limit))
+    if not ranked:
+        return []
+    members: dict[str, list[int]] = {term: [] for term, _n in ranked}
+    for term, file_id in db.execute(
+        select(KBFileTerm.term, KBFileTerm.file_id)
+        .where(KBFileTerm.term.in_(sorted(members)), KBFileTerm.file_id.in_(ids))
+        .order_by(KBFileTerm.file_id)
+    ).all():
+        members[str(term)].append(int(file_id))
+    return [
+        {
+            "id": f"auto:{term}",
+            "name": term.capitalize(),
+            "count": len(members[term]),
+            "file_ids": members[term],
+            "auto": True,
+        }
+        for term, _n in ranked
+    ]
+
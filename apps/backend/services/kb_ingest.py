@@ -26,6 +26,11 @@ from apps.backend.services.kb_settings import (
 )
 from apps.backend.services.gigachat_client import create_embeddings
 from apps.backend.services.kb_pgvector import write_vector_column
+from apps.backend.services import kb_access_map, kb_catalog  # noqa: F401  (session hooks for worker jobs)
+from apps.backend.services.kb_file_profiles import refresh_file_profile
+from apps.backend.services.kb_preview import PREVIEW_EXTS, request_preview
+from apps.backend.services.metrics import StageTimer, timed
+from apps.backend.services.transcript_store import build_transcript_store
 from apps.backend.services.billing import get_pricing, calc_cost_rub, record_usage
 
 log = logging.getLogger(__name__)
@@ -300,28 +305,57 @@ def _build_fb2_preview_html(path: str) -> str | None:
     )
 
 
-def _generate_preview_pdf(src_path: str) -> str | None:
+def _limit_memory_preexec(limit_bytes: int | None):
+    if not limit_bytes:
+        return None
+    try:
+        import resource  # type: ignore
+    except Exception:
+        return None
+
+    def _apply() -> None:
+        resource.setrlimit(resource.RLIMIT_AS, (limit_bytes, limit_bytes))
+
+    return _apply
+
+
+def _generate_preview_pdf(
+    src_path: str,
+    out_path: str | None = None,
+    timeout_seconds: int | None = None,
+    memory_limit_bytes: int | None = None,
+) -> str | None:
     """Best-effort conversion to PDF via LibreOffice (soffice)."""
+    target_path = out_path or _preview_pdf_path(src_path)
+
     def _convert_with_soffice(input_path: str) -> str | None:
         with tempfile.TemporaryDirectory() as td:
             cmd = [
                 "soffice",
                 "--headless",
+                # isolated profile: parallel renders must not share a LibreOffice user dir
+                f"-env:UserInstallation=file://{td}/profile",
                 "--convert-to",
                 "pdf:writer_pdf_Export",
                 "--outdir",
                 td,
                 input_path,
             ]
-            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            subprocess.run(
+                cmd,
+                check=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=timeout_seconds,
+                preexec_fn=_limit_memory_preexec(memory_limit_bytes),
+            )
             base = os.path.splitext(os.path.basename(input_path))[0]
             candidate = os.path.join(td, f"{base}.pdf")
             if not os.path.exists(candidate):
                 return None
-            out_path = _preview_pdf_path(src_path)
-            with open(candidate, "rb") as rf, open(out_path, "wb") as wf:
+            with open(candidate, "rb") as rf, open(target_path, "wb") as wf:
                 wf.write(rf.read())
-            return out_path
+            return target_path
 
     def _fallback_book_to_html_pdf() -> str | None:
         ext = os.path.splitext(src_path)[1].lower()
@@ -855,7 +889,9 @@ def _sha256_text(text: str) -> str:
     return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
 
+@timed("kb_ingest_seconds", outcome=lambda r: r.get("error") or r.get("reason"))
 def ingest_file(db: Session, file_id: int, trace_id: str | None = None) -> dict:
+    stages = StageTimer("kb_ingest_stage_seconds")
     rec = db.get(KBFile, file_id)
     if not rec:
         return {"ok": False, "error": "file_not_found"}
@@ -928,12 +964,15 @@ def ingest_file(db: Session, file_id: int, trace_id: str | None = None) -> dict:
                         all_segments.sort(key=lambda s: (int(s.start_ms), int(s.end_ms)))
                         segments = all_segments
                         _write_transcript_segments_jsonl(transcript_jsonl_path, segments)
+                stages.mark("extract")
                 chunks = _chunk_segments(segments, max_chars=max_chars)
                 transcript_path = rec.storage_path + ".transcript.txt"
                 with open(transcript_path, "w", encoding="utf-8") as tf:
                     for seg in segments:
                         sp = f"[{seg.speaker}] " if seg.speaker else ""
                         tf.write(f"[{seg.start_ms}-{seg.end_ms}] {sp}{seg.text}\n")
+                # Merged transcript + offset index for the transcript panel.
+                build_transcript_store(rec.storage_path)
             except Exception as e:
                 rec.status = "error"
                 rec.error_message = ("transcribe_failed:" + str(e))[:200]
@@ -973,6 +1012,7 @@ def ingest_file(db: Session, file_id: int, trace_id: str | None = None) -> dict:
                 db.add(rec)
                 db.commit()
                 return {"ok": False, "error": "extract_failed", "detail": rec.error_message}
+            stages.mark("extract")
             if ext != ".pdf":
                 chunks = chunk_text(text, max_chars=max_chars, overlap=overlap)
 
@@ -1034,14 +1074,24 @@ def ingest_file(db: Session, file_id: int, trace_id: str | None = None) -> dict:
         db.add_all(new_rows)
         db.commit()
         chunk_rows = new_rows
+        stages.mark("chunk")
 
-        # Best-effort paginated preview for office/book-like files.
-        if ext in (".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx", ".rtf", ".epub", ".fb2"):
-            preview_pdf = _generate_preview_pdf(rec.storage_path)
-            if preview_pdf:
-                _assign_chunk_pages_from_preview(chunk_rows, preview_pdf)
-                db.add_all(chunk_rows)
-                db.commit()
+        # Paginated preview for office/book-like files renders on the preview queue;
+        # the render job assigns chunk pages once the PDF is in the cache.
+        if ext in PREVIEW_EXTS:
+            try:
+                request_preview(db, rec)
+            except Exception:
+                log.warning("kb_preview.enqueue_failed file_id=%s", rec.id)
+
+    # Topic memberships, top lemmas and summary for scoped queries and the topics panel.
+    try:
+        refresh_file_profile(db, rec, [c.text for c in chunk_rows])
+        db.commit()
+    except Exception:
+        db.rollback()
+        log.warning("kb_file_profile.refresh_failed file_id=%s", rec.id, exc_info=True)
+    stages.mark("profile")
 
     settings = get_effective_gigachat_settings(db, rec.portal_id)
     model = (settings.get("embedding_model") or settings.get("model") or "").strip()
@@ -1151,6 +1201,7 @@ def ingest_file(db: Session, file_id: int, trace_id: str | None = None) -> dict:
             db.commit()
             return {"ok": False, "error": rec.error_message}
 
+    stages.mark("embed")
     emb_rows: list[KBEmbedding] = []
     for ch, vec in zip(chunk_rows, vectors):
         emb_rows.append(KBEmbedding(
@@ -1166,6 +1217,7 @@ def ingest_file(db: Session, file_id: int, trace_id: str | None = None) -> dict:
         if emb_row.id:
             write_vector_column(db, int(emb_row.id), vec)
     db.commit()
+    stages.mark("persist")
     # record embedding usage (portal-level, no user)
     try:
         pricing = get_pricing(db)
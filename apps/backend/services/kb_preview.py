@@ -0,0 +1,231 @@
+"""KB preview renditions: content-addressed PDF cache rendered by a background queue."""
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import time
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from apps.backend.config import get_settings
+from apps.backend.models.kb import KBChunk, KBFile
+from apps.backend.services.kb_storage import preview_cache_dir
+
+logger = logging.getLogger(__name__)
+
+# Форматы, для которых строится постраничный PDF-превью (совпадает с фронтендом).
+PREVIEW_EXTS = (".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx", ".rtf", ".epub", ".fb2")
+
+_INFLIGHT_KEY = "kb_preview:inflight:{sha}"
+_SLOT_KEY = "kb_preview:slot:{idx}"
+_FAILED_RETRY_SECONDS = 3600
+_SLOT_RETRY_SECONDS = 15
+
+
+def _redis():
+    from redis import Redis
+
+    s = get_settings()
+    return Redis(host=s.redis_host, port=s.redis_port)
+
+
+def is_previewable(filename: str | None) -> bool:
+    ext = os.path.splitext((filename or "").lower())[1]
+    return ext in PREVIEW_EXTS
+
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def ensure_file_sha256(db: Session, rec: KBFile) -> str | None:
+    """Return file sha256, computing and persisting it for legacy rows."""
+    if rec.sha256:
+        return rec.sha256
+    if not rec.storage_path or not os.path.exists(rec.storage_path):
+        return None
+    try:
+        rec.sha256 = _file_sha256(rec.storage_path)
+        db.add(rec)
+        db.commit()
+    except Exception:
+        db.rollback()
+        return None
+    return rec.sha256
+
+
+def preview_path_for_sha(sha256: str) -> str:
+    return os.path.join(preview_cache_dir(sha256), f"{sha256}.pdf")
+
+
+def _failed_marker_path(sha256: str) -> str:
+    return os.path.join(preview_cache_dir(sha256), f"{sha256}.failed")
+
+
+def _legacy_preview_path(rec: KBFile) -> str:
+    return f"{rec.storage_path}.preview.pdf" if rec.storage_path else ""
+
+
+def cached_preview_path(rec: KBFile) -> str | None:
+    """Path of an already rendered preview (cache or legacy sidecar), without any rendering."""
+    if rec.sha256:
+        path = preview_path_for_sha(rec.sha256)
+        if os.path.exists(path):
+            return path
+    legacy = _legacy_preview_path(rec)
+    if legacy and os.path.exists(legacy):
+        return legacy
+    return None
+
+
+def _recently_failed(sha256: str) -> bool:
+    marker = _failed_marker_path(sha256)
+    try:
+        return (time.time() - os.path.getmtime(marker)) < _FAILED_RETRY_SECONDS
+    except OSError:
+        return False
+
+
+def request_preview(db: Session, rec: KBFile) -> dict:
+    """Return preview state and schedule a single-flight render when it is missing.
+
+    Statuses: ready (with path), pending, failed, unsupported, unavailable.
+    """
+    path = cached_preview_path(rec)
+    if path:
+        return {"status": "ready", "path": path}
+    if not is_previewable(rec.filename):
+        return {"status": "unsupported"}
+    if not rec.storage_path or not os.path.exists(rec.storage_path):
+        return {"status": "unavailable"}
+    sha = ensure_file_sha256(db, rec)
+    if not sha:
+        return {"status": "unavailable"}
+    if _recently_failed(sha):
+        return {"status": "failed"}
+    if not enqueue_preview(rec.id, sha):
+        return {"status": "unavailable"}
+    return {"status": "pending"}
+
+
+def enqueue_preview(file_id: int, sha256: str) -> bool:
+    """Enqueue a render unless one is already in flight for the same content."""
+    s = get_settings()
+    try:
+        from rq import Queue
+
+        r = _redis()
+        ttl = max(60, int(s.kb_preview_timeout_seconds or 180) * 3)
+        if not r.set(_INFLIGHT_KEY.format(sha=sha256), str(int(file_id)), nx=True, ex=ttl):
+            return True
+        q = Queue(s.rq_preview_queue_name or "preview", connection=r)
+        q.enqueue(
+            "apps.worker.jobs.render_kb_preview",
+            int(file_id),
+            job_id=f"kbpreview:{sha256}",
+            job_timeout=ttl,
+        )
+        return True
+    except Exception:
+        logger.exception("kb_preview_enqueue_failed file_id=%s", file_id)
+        return False
+
+
+def _acquire_slot(r, ttl: int) -> str | None:
+    s = get_settings()
+    for idx in range(max(1, int(s.kb_preview_max_concurrency or 1))):
+        key = _SLOT_KEY.format(idx=idx)
+        if r.set(key, "1", nx=True, ex=ttl):
+            return key
+    return None
+
+
+def _memory_limit_bytes() -> int | None:
+    mb = int(get_settings().kb_preview_memory_limit_mb or 0)
+    return mb * 1024 * 1024 if mb > 0 else None
+
+
+def _assign_pages(db: Session, sha256: str, preview_path: str) -> None:
+    from apps.backend.services.kb_ingest import _assign_chunk_pages_from_preview
+
+    file_ids = db.execute(select(KBFile.id).where(KBFile.sha256 == sha256)).scalars().all()
+    if not file_ids:
+        return
+    rows = db.execute(
+        select(KBChunk)
+        .where(KBChunk.file_id.in_(file_ids))
+        .order_by(KBChunk.file_id.asc(), KBChunk.chunk_index.asc())
+    ).scalars().all()
+    if not rows or all((r.page_num is not None and int(r.page_num) > 0) for r in rows):
+        return
+    _assign_chunk_pages_from_preview(rows, preview_path)
+    db.add_all(rows)
+    db.commit()
+
+
+def render_preview(db: Session, file_id: int) -> dict:
+    """Render preview for a file into the content-addressed cache (worker side)."""
+    from apps.backend.services.kb_ingest import _generate_preview_pdf
+
+    rec = db.get(KBFile, file_id)
+    if not rec or not rec.storage_path or not os.path.exists(rec.storage_path):
+        return {"ok": False, "error": "file_missing"}
+    sha = ensure_file_sha256(db, rec)
+    if not sha:
+        return {"ok": False, "error": "file_missing"}
+    out_path = preview_path_for_sha(sha)
+    if os.path.exists(out_path):
+        _assign_pages(db, sha, out_path)
+        return {"ok": True, "path": out_path, "cached": True}
+
+    s = get_settings()
+    timeout = max(30, int(s.kb_preview_timeout_seconds or 180))
+    r = _redis()
+    slot = _acquire_slot(r, ttl=timeout + 30)
+    if not slot:
+        return {"ok": False, "error": "busy", "retry_in": _SLOT_RETRY_SECONDS}
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        result = _generate_preview_pdf(
+            rec.storage_path,
+            out_path=tmp_path,
+            timeout_seconds=timeout,
+            memory_limit_bytes=_memory_limit_bytes(),
+        )
+        if not result or not os.path.exists(tmp_path):
+            with open(_failed_marker_path(sha), "w", encoding="utf-8") as f:
+                f.write(str(int(time.time())))
+            return {"ok": False, "error": "render_failed"}
+        os.replace(tmp_path, out_path)
+    finally:
+        # left behind only when the renderer failed or raised
+        if os.path.exists(tmp_path):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        try:
+            r.delete(slot)
+        except Exception:
+            pass
+    _assign_pages(db, sha, out_path)
+    return {"ok": True, "path": out_path, "cached": False}
+
+
+def release_inflight(sha256: str | None) -> None:
+    if not sha256:
+        return
+    try:
+        _redis().delete(_INFLIGHT_KEY.format(sha=sha256))
+    except Exception:
+        pass
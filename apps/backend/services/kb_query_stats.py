@@ -0,0 +1,149 @@
+"""Write-behind KB query statistics.
+
+``answer_from_kb`` used to finish every answer with an ``UPDATE kb_files SET
+query_count = query_count + 1`` and a commit, taking row locks on popular
+documents inside the latency-critical read path. Now it hands the cited file
+and chunk ids to a per-process aggregator; a background thread sums the hits
+and writes them in one transaction per flush: one executemany UPDATE of
+``kb_files.query_count`` (ids sorted, so concurrent flushes lock rows in the
+same order) and one upsert of ``kb_chunk_citations``.
+
+A crash loses at most the hits of one flush interval
+(``kb_query_stats_flush_interval_ms``); when the queue is full new hits are
+dropped rather than written inline. When the thread is not running (tests,
+scripts) hits are written synchronously on the caller's session, as before.
+"""
+from __future__ import annotations
+
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Iterable
+
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.orm import Session
+
+from apps.backend import database
+from apps.backend.config import get_settings
+from apps.backend.models.kb import KBChunk, KBChunkCitation, KBFile
+from apps.backend.services.batch_writer import BatchWriter
+from apps.backend.services.kb_catalog import mark_catalog_changed
+
+
+@dataclass
+class KBCitationHit:
+    """Files and chunks cited by one answer."""
+
+    file_ids: tuple[int, ...]
+    chunk_files: tuple[tuple[int, int | None], ...]  # (chunk_id, file_id)
+    cited_at: datetime = field(default_factory=datetime.utcnow)
+
+
+def _insert(db: Session):
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert
+
+
+def write_citation_hits(db: Session, hits: list[KBCitationHit]) -> int:
+    """Apply aggregated hits; the caller commits. Returns the number of hits applied."""
+    file_hits: Counter[int] = Counter()
+    chunk_hits: Counter[int] = Counter()
+    chunk_file: dict[int, int | None] = {}
+    last_cited: dict[int, datetime] = {}
+    for hit in hits:
+        file_hits.update(hit.file_ids)
+        for chunk_id, file_id in hit.chunk_files:
+            chunk_hits[chunk_id] += 1
+            chunk_file[chunk_id] = file_id
+            last_cited[chunk_id] = max(last_cited.get(chunk_id, hit.cited_at), hit.cited_at)
+    if file_hits:
+        table = KBFile.__table__
+        db.execute(
+            update(table)
+            .where(table.c.id == bindparam("b_id"))
+            .values(query_count=table.c.query_count + bindparam("b_hits")),
+            [{"b_id": fid, "b_hits": n} for fid, n in sorted(file_hits.items())],
+        )
+        mark_catalog_changed(db, db.execute(select(KBFile.portal_id).where(KBFile.id.in_(sorted(file_hits)))).scalars().all())
+    if chunk_hits:
+        # chunks replaced by a re-ingest since the answer would fail the FK
+        live = set(db.execute(select(KBChunk.id).where(KBChunk.id.in_(sorted(chunk_hits)))).scalars().all())
+        chunk_hits = Counter({cid: n for cid, n in chunk_hits.items() if cid in live})
+    if chunk_hits:
+        stmt = _insert(db)(KBChunkCitation).values(
+            [
+                {"chunk_id": cid, "file_id": chunk_file[cid], "citations": n, "last_cited_at": last_cited[cid]}
+                for cid, n in sorted(chunk_hits.items())
+            ]
+        )
+        db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["chunk_id"],
+                set_={
+                    "citations": KBChunkCitation.citations + stmt.excluded.citations,
+                    "last_cited_at": stmt.excluded.last_cited_at,
+                    "file_id": stmt.excluded.file_id,
+                },
+            )
+        )
+    return len(hits)
+
+
+class KBQueryStats(BatchWriter[KBCitationHit]):
+    """Aggregates citation hits off the answer path."""
+
+    name = "kb_query_stats"
+
+    def write_batch(self, batch: list[KBCitationHit]) -> int:
+        with database.get_session_factory()() as db:
+            written = write_citation_hits(db, batch)
+            db.commit()
+        return written
+
+    @property
+    def buffering(self) -> bool:
+        return bool(self._thread and self._thread.is_alive())
+
+
+_stats: KBQueryStats | None = None
+_stats_lock = threading.Lock()
+
+
+def get_kb_query_stats() -> KBQueryStats:
+    global _stats
+    if _stats is None:
+        with _stats_lock:
+            if _stats is None:
+                s = get_settings()
+                _stats = KBQueryStats(
+                    max_events=s.kb_query_stats_queue_max_events,
+                    batch_size=s.kb_query_stats_batch_size,
+                    flush_interval=s.kb_query_stats_flush_interval_ms / 1000.0,
+                    sample_watermark=1.0,
+                )
+    return _stats
+
+
+def record_citations(db: Session, chunks: Iterable[dict[str, Any]]) -> None:
+    """Count one answer citing ``chunks`` (dicts with ``chunk_id``/``file_id``)."""
+    file_ids: set[int] = set()
+    chunk_files: dict[int, int | None] = {}
+    for c in chunks:
+        file_id = int(c["file_id"]) if c.get("file_id") else None
+        if file_id is not None:
+            file_ids.add(file_id)
+        if c.get("chunk_id"):
+            chunk_files[int(c["chunk_id"])] = file_id
+    if not file_ids and not chunk_files:
+        return
+    hit = KBCitationHit(file_ids=tuple(sorted(file_ids)), chunk_files=tuple(sorted(chunk_files.items())))
+    writer = get_kb_query_stats()
+    if writer.buffering:
+        writer.submit(hit)
+        return
+    write_citation_hits(db, [hit])
+    db.commit()
@@ -3,37 +3,54 @@ from __future__ import annotations
 
 import math
 import re
+import threading
 import json
 from functools import lru_cache
 from typing import Iterable, Any
 
-from sqlalchemy import select, update, or_
+from sqlalchemy import select, or_
 from sqlalchemy.orm import Session
 
-from apps.backend.models.kb import KBChunk, KBEmbedding, KBFile, KBSource
-from apps.backend.models.dialog import Message
-from apps.backend.models.dialog_rag_cache import DialogRagCache
+from apps.backend.models.kb import KBChunk, KBEmbedding, KBFile, KBFileProfile, KBSource
+from apps.backend.services.dialog_context import load_history, load_rag, save_rag
 from apps.backend.services.kb_settings import get_effective_gigachat_settings, get_valid_gigachat_access_token
 from apps.backend.services.gigachat_client import create_embeddings, chat_complete
 from apps.backend.services.kb_pgvector import query_top_chunks_by_pgvector
+from apps.backend.services.kb_query_stats import record_citations
+from apps.backend.services.metrics import StageTimer, timed
 
-try:
-    import pymorphy3  # type: ignore
-except Exception:  # pragma: no cover - optional
-    pymorphy3 = None
+_MORPH_UNSET = object()
+_MORPH: Any = _MORPH_UNSET
+_MORPH_LOCK = threading.Lock()
 
-_MORPH = pymorphy3.MorphAnalyzer() if pymorphy3 else None
+
+def _get_morph():
+    """pymorphy3 analyzer, built on first use (workers build it before forking, see services.startup)."""
+    global _MORPH
+    if _MORPH is _MORPH_UNSET:
+        with _MORPH_LOCK:
+            if _MORPH is _MORPH_UNSET:
+                try:
+                    import pymorphy3  # type: ignore
+
+                    _MORPH = pymorphy3.MorphAnalyzer()
+                except Exception:  # pragma: no cover - optional
+                    _MORPH = None
+    return _MORPH
 
 
 @lru_cache(maxsize=20000)
 def _normalize_ru_token(token: str) -> str:
     tok = (token or "").strip().lower()
-    if not tok or not _MORPH:
+    if not tok:
         return tok
     if not re.fullmatch(r"[а-яё\-]+", tok, flags=re.IGNORECASE):
         return tok
+    morph = _get_morph()
+    if not morph:
+        return tok
     try:
-        return _MORPH.parse(tok)[0].normal_form
+        return morph.parse(tok)[0].normal_form
     except Exception:
         return tok
 
@@ -322,8 +339,7 @@ def _extract_keywords(text: str) -> list[str]:
             continue
         if w in _RU_STOPWORDS:
             continue
-        if _MORPH:
-            w = _normalize_ru_token(w)
+        w = _normalize_ru_token(w)
         out.append(w)
     # uniq while preserving order
     seen = set()
@@ -336,30 +352,73 @@ def _extract_keywords(text: str) -> list[str]:
     return uniq
 
 
-def _keyword_hits(text: str, keywords: list[str]) -> int:
-    if not text or not keywords:
-        return 0
+_TOKEN_RE = re.compile(r"[a-zа-яё0-9]+", flags=re.IGNORECASE)
+
+
+@lru_cache(maxsize=4096)
+def _text_profile(text: str) -> tuple[str, frozenset[str]]:
+    """Lowercased text and its tokens plus their lemmas, computed once per distinct text.
+
+    The same candidate texts are probed by the relevance filter, the lexical seed,
+    the reranker and the confidence estimate; they share this profile.
+    """
     low = text.lower()
-    token_set = set(re.findall(r"[a-zа-яё0-9]+", low, flags=re.IGNORECASE))
-    normalized_token_set = set(token_set)
-    if _MORPH:
-        for tok in list(token_set):
-            normalized_token_set.add(_normalize_ru_token(tok))
-    hits = 0
+    tokens = set(_TOKEN_RE.findall(low))
+    tokens.update([_normalize_ru_token(tok) for tok in tokens])
+    return low, frozenset(tokens)
+
+
+@lru_cache(maxsize=1024)
+def _keyword_plan(keywords: tuple[str, ...]) -> tuple[tuple[str, ...], ...]:
+    plan: list[tuple[str, ...]] = []
     for k in keywords:
         kk = (k or "").strip().lower()
         if not kk:
             continue
-        parts = re.findall(r"[a-zа-яё0-9]+", kk, flags=re.IGNORECASE)
-        if not parts:
-            continue
+        parts = tuple(_TOKEN_RE.findall(kk))
+        if parts:
+            plan.append(parts)
+    return tuple(plan)
+
+
+def _keyword_hits(text: str, keywords: list[str]) -> int:
+    if not text or not keywords:
+        return 0
+    low, tokens = _text_profile(text)
+    hits = 0
+    for parts in _keyword_plan(tuple(keywords)):
         if len(parts) == 1:
             p = parts[0]
-            if p in normalized_token_set or p in low:
+            if p in tokens or p in low:
                 hits += 1
-        else:
-            if all(p in normalized_token_set for p in parts):
+        elif all(p in tokens for p in parts):
+            hits += 1
+    return hits
+
+
+def _keyword_hits_joined(texts: Iterable[str], keywords: list[str]) -> int:
+    """``_keyword_hits(" ".join(texts), keywords)`` from the per-text profiles.
+
+    Keyword parts never contain a space, so a hit in the joined text is a hit in
+    one of the parts; filename/summary profiles are shared by all chunks of a file.
+    """
+    profiles = [_text_profile(t) for t in texts if t]
+    if not profiles or not keywords:
+        return 0
+    if len(profiles) == 1:
+        lows = [profiles[0][0]]
+        tokens = profiles[0][1]
+    else:
+        lows = [low for low, _tokens in profiles]
+        tokens = frozenset().union(*(tok for _low, tok in profiles))
+    hits = 0
+    for parts in _keyword_plan(tuple(keywords)):
+        if len(parts) == 1:
+            p = parts[0]
+            if p in tokens or any(p in low for low in lows):
                 hits += 1
+        elif all(p in tokens for p in parts):
+            hits += 1
     return hits
 
 
@@ -2127,20 +2186,23 @@ def _is_numeric_fact_query(query: str) -> bool:
     return any(m in q for m in markers)
 
 
+_NOISE_MARKERS = (
+    "позитивная музыка",
+    "музыка",
+    "подпишись",
+    "ставьте лайк",
+    "промокод",
+    "ссылка в описании",
+    "реклама",
+)
+
+
+def _has_noise_marker(low: str) -> bool:
+    return bool(low) and any(m in low for m in _NOISE_MARKERS)
+
+
 def _is_noise_chunk_text(text: str) -> bool:
-    t = (text or "").lower()
-    if not t:
-        return False
-    markers = (
-        "позитивная музыка",
-        "музыка",
-        "подпишись",
-        "ставьте лайк",
-        "промокод",
-        "ссылка в описании",
-        "реклама",
-    )
-    return any(m in t for m in markers)
+    return _has_noise_marker((text or "").lower())
 
 
 def _append_lexical_recall_rows(
@@ -2192,20 +2254,12 @@ def _append_lexical_recall_rows(
     rows = db.execute(q).all()
     for text, chunk_index, start_ms, end_ms, page_num, chunk_id, file_id, filename, mime_type, source_type, source_url, source_title in rows:
         txt = str(text or "")
-        txt_low = txt.lower()
-        meta_text = " ".join(
-            [
-                str(filename or ""),
-                str(source_title or ""),
-                str(source_url or ""),
-            ]
-        ).lower()
-        hits = _keyword_hits(txt_low, keywords)
-        meta_hits = _keyword_hits(meta_text, keywords)
+        hits = _keyword_hits(txt, keywords)
+        meta_hits = _keyword_hits_joined((str(filename or ""), str(source_title or ""), str(source_url or "")), keywords)
         if (hits + meta_hits) <= 0:
             continue
         score = 0.10 + (hits * 0.08) + (meta_hits * 0.06)
-        if _is_noise_chunk_text(txt_low):
+        if _has_noise_marker(_text_profile(txt)[0] if txt else ""):
             score -= 0.25
         scored.append(
             (
@@ -2267,6 +2321,11 @@ def _render_claim_context(chunks: list[dict[str, Any]]) -> str:
     return "\n\n".join(out)
 
 
+# (semantic, body hits, meta hits, filename hits)
+_RERANK_WEIGHTS = (0.72, 0.16, 0.22, 0.30)
+_RERANK_WEIGHTS_LIST_INTENT = (0.58, 0.24, 0.28, 0.34)
+
+
 def _rerank_candidates(
     query: str,
     candidates: list[dict[str, Any]],
@@ -2284,7 +2343,16 @@ def _rerank_candidates(
     person_tokens = [t.lower() for t in re.findall(r"[a-zа-яё]{2,}", person_phrase or "", flags=re.IGNORECASE)]
     person_tokens = person_tokens[:4]
     person_full = " ".join(person_tokens) if len(person_tokens) >= 2 else ""
-    ranked: list[tuple[float, dict[str, Any]]] = []
+
+    # Feature table: one row per unique chunk. Texts are tokenized/lemmatized once
+    # through _text_profile (shared with the relevance filter and confidence), and
+    # filename/summary profiles are shared by every chunk of the same file.
+    picked: list[dict[str, Any]] = []
+    sem_col: list[float] = []
+    body_col: list[int] = []
+    meta_col: list[int] = []
+    file_col: list[int] = []
+    bonus_col: list[tuple[float, float, float, float, float, float]] = []
     seen_chunk: set[int] = set()
     seen_file_top: set[int] = set()
     for idx, c in enumerate(candidates):
@@ -2293,22 +2361,18 @@ def _rerank_candidates(
             if cid in seen_chunk:
                 continue
             seen_chunk.add(cid)
-        sem = float(c.get("_score") or 0.0)
         text_scope = str(c.get("text") or "")
         file_name = str(c.get("filename") or "")
-        source_title = str(c.get("source_title") or "")
-        source_url = str(c.get("source_url") or "")
-        file_summary = str(c.get("file_summary") or "")
-        meta_scope = " ".join([file_name, source_title, source_url, file_summary])
+        meta_parts = (file_name, str(c.get("source_title") or ""), str(c.get("source_url") or ""), str(c.get("file_summary") or ""))
         body_hits = _keyword_hits(text_scope, qk)
-        meta_hits = _keyword_hits(meta_scope, qk)
+        meta_hits = _keyword_hits_joined(meta_parts, qk)
         file_hits = _keyword_hits(file_name, qk)
-        txt_low = str(c.get("text") or "").lower()
-        meta_low = meta_scope.lower()
-        file_low = file_name.lower()
+        txt_low = _text_profile(text_scope)[0] if text_scope else ""
+        file_low = _text_profile(file_name)[0] if file_name else ""
         entity_bonus = 0.0
         entity_penalty = 0.0
         if person_tokens:
+            meta_low = " ".join(meta_parts).lower()
             token_hits = sum(1 for t in person_tokens if t in txt_low or t in meta_low)
             if person_full and (person_full in txt_low or person_full in meta_low):
                 entity_bonus += 0.28
@@ -2321,8 +2385,13 @@ def _rerank_candidates(
         focus_bonus = (focus_hits_file * 0.22) + (focus_hits_text * 0.08)
         if len(query_low) >= 6 and query_low in file_low:
             focus_bonus += 0.28
+        if list_intent:
+            if body_hits >= 2:
+                focus_bonus += 0.08
+            if meta_hits >= 1 or file_hits >= 1:
+                focus_bonus += 0.06
         no_evidence_penalty = -0.14 if (body_hits + meta_hits) <= 0 else 0.0
-        noise_penalty = -0.18 if _is_noise_chunk_text(txt_low) else 0.0
+        noise_penalty = -0.18 if _has_noise_marker(txt_low) else 0.0
         # prefer unique files in top positions
         file_diversity_bonus = 0.0
         fid = c.get("file_id")
@@ -2334,34 +2403,23 @@ def _rerank_candidates(
                 file_diversity_bonus -= 0.01
         if idx == 0:
             file_diversity_bonus += 0.02
-        sem_weight = 0.72
-        body_weight = 0.16
-        meta_weight = 0.22
-        file_weight = 0.30
-        if list_intent:
-            sem_weight = 0.58
-            body_weight = 0.24
-            meta_weight = 0.28
-            file_weight = 0.34
-            if body_hits >= 2:
-                focus_bonus += 0.08
-            if meta_hits >= 1 or file_hits >= 1:
-                focus_bonus += 0.06
-        final = (
-            (sem * sem_weight)
-            + (body_hits * body_weight)
-            + (meta_hits * meta_weight)
-            + (file_hits * file_weight)
-            + focus_bonus
-            + file_diversity_bonus
-            + entity_bonus
-            + entity_penalty
-            + no_evidence_penalty
-            + noise_penalty
-        )
-        ranked.append((final, c))
-    ranked.sort(key=lambda x: x[0], reverse=True)
-    return [c for _s, c in ranked[: max(1, top_k)]]
+        picked.append(c)
+        sem_col.append(float(c.get("_score") or 0.0))
+        body_col.append(body_hits)
+        meta_col.append(meta_hits)
+        file_col.append(file_hits)
+        bonus_col.append((focus_bonus, file_diversity_bonus, entity_bonus, entity_penalty, no_evidence_penalty, noise_penalty))
+
+    # One weighted pass over the columns (same summation order as the per-chunk formula).
+    sem_weight, body_weight, meta_weight, file_weight = _RERANK_WEIGHTS_LIST_INTENT if list_intent else _RERANK_WEIGHTS
+    scores = [
+        (sem * sem_weight) + (body * body_weight) + (meta * meta_weight) + (fh * file_weight)
+        + focus + diversity + e_bonus + e_penalty + no_evidence + noise
+        for sem, body, meta, fh, (focus, diversity, e_bonus, e_penalty, no_evidence, noise)
+        in zip(sem_col, body_col, meta_col, file_col, bonus_col)
+    ]
+    order = sorted(range(len(picked)), key=scores.__getitem__, reverse=True)
+    return [picked[i] for i in order[: max(1, top_k)]]
 
 
 def _diversify_top_chunks_by_file(
@@ -2433,8 +2491,17 @@ def _diversify_top_chunks_by_file(
     return out[:limit]
 
 
-def _build_file_summaries(scored: list[tuple[float, bool, dict[str, Any]]]) -> dict[int, str]:
+def _build_file_summaries(db: Session, scored: list[tuple[float, bool, dict[str, Any]]]) -> dict[int, str]:
+    # Summaries come from the ingest-time file profiles; files not profiled yet
+    # fall back to the text of their first retrieved chunk.
+    fids = {item.get("file_id") for _score, _is_lex, item in scored[:120]}
+    fids = sorted(f for f in fids if isinstance(f, int))
     out: dict[int, str] = {}
+    if fids:
+        rows = db.execute(
+            select(KBFileProfile.file_id, KBFileProfile.summary).where(KBFileProfile.file_id.in_(fids))
+        ).all()
+        out = {int(fid): str(summary) for fid, summary in rows if summary}
     for _score, _is_lex, item in scored[:120]:
         fid = item.get("file_id")
         if not isinstance(fid, int) or fid in out:
@@ -2733,16 +2800,8 @@ def _is_follow_up(text: str) -> bool:
 
 
 def _load_dialog_history(db: Session, dialog_id: int, limit: int = 6) -> str:
-    rows = db.execute(
-        select(Message.direction, Message.body)
-        .where(Message.dialog_id == dialog_id)
-        .order_by(Message.id.desc())
-        .limit(limit)
-    ).all()
-    if not rows:
-        return ""
     lines = []
-    for direction, body in reversed(rows):
+    for direction, body in load_history(db, dialog_id, limit=limit):
         role = "Пользователь" if direction == "rx" else "Ассистент"
         text = (body or "").strip()
         if not text:
@@ -2751,43 +2810,7 @@ def _load_dialog_history(db: Session, dialog_id: int, limit: int = 6) -> str:
     return "\n".join(lines)
 
 
-def _load_rag_cache(db: Session, dialog_id: int, model: str) -> tuple[list[int], list[str]]:
-    row = db.execute(
-        select(DialogRagCache).where(
-            DialogRagCache.dialog_id == dialog_id,
-            DialogRagCache.model == model,
-        )
-    ).scalar_one_or_none()
-    if not row:
-        return [], []
-    chunk_ids = []
-    keywords = []
-    try:
-        chunk_ids = json.loads(row.chunk_ids_json or "[]")
-    except Exception:
-        chunk_ids = []
-    try:
-        keywords = json.loads(row.keywords_json or "[]")
-    except Exception:
-        keywords = []
-    return [int(x) for x in chunk_ids if isinstance(x, (int, str)) and str(x).isdigit()], [str(x) for x in keywords]
-
-
-def _save_rag_cache(db: Session, dialog_id: int, portal_id: int, model: str, chunk_ids: list[int], keywords: list[str]) -> None:
-    row = db.execute(
-        select(DialogRagCache).where(
-            DialogRagCache.dialog_id == dialog_id,
-            DialogRagCache.model == model,
-        )
-    ).scalar_one_or_none()
-    if not row:
-        row = DialogRagCache(dialog_id=dialog_id, portal_id=portal_id, model=model)
-        db.add(row)
-    row.chunk_ids_json = json.dumps(chunk_ids[:10], ensure_ascii=False)
-    row.keywords_json = json.dumps(keywords[:20], ensure_ascii=False)
-    db.commit()
-
-
+@timed("kb_answer_seconds", outcome=lambda r: r[1])
 def answer_from_kb(
     db: Session,
     portal_id: int,
@@ -2814,6 +2837,7 @@ def answer_from_kb(
             "top_chunks": [],
             "line_refs": {},
         }
+    stages = StageTimer("kb_answer_stage_seconds")
     mode = _trigger_mode(query)
     settings = get_effective_gigachat_settings(db, portal_id)
     preset = (settings.get("prompt_preset") or "").strip().lower()
@@ -2882,7 +2906,7 @@ def answer_from_kb(
     if overrides.get("rag_v2_enabled") is not None:
         rag_v2_enabled = bool(overrides.get("rag_v2_enabled"))
     import logging
-    logging.getLogger(__name__).warning(
+    logging.getLogger(__name__).debug(
         "kb_rag_models portal_id=%s embed=%s chat=%s api_base=%s",
         portal_id,
         embed_model,
@@ -2896,12 +2920,13 @@ def answer_from_kb(
     token, err = get_valid_gigachat_access_token(db)
     if err or not token:
         return None, err or "missing_access_token", None
+    stages.mark("settings")
 
     follow_up = _is_follow_up(query)
     cached_chunk_ids: list[int] = []
     cached_keywords: list[str] = []
     if dialog_id:
-        cached_chunk_ids, cached_keywords = _load_rag_cache(db, dialog_id, embed_model)
+        cached_chunk_ids, cached_keywords = load_rag(db, dialog_id, embed_model)
     query_for_embed = query
     if follow_up and cached_keywords:
         query_for_embed = query + " " + " ".join(cached_keywords[:5])
@@ -2909,6 +2934,7 @@ def answer_from_kb(
     if err or not q_vecs:
         return None, err or "embedding_failed", None
     qv = q_vecs[0]
+    stages.mark("embedding")
 
     aud = audience if audience in ("staff", "client") else "staff"
     scoped_ids = [int(x) for x in (file_ids_filter or []) if int(x) > 0]
@@ -3046,6 +3072,7 @@ def answer_from_kb(
                     "source_title": source_title or "",
                 }
             ))
+    stages.mark("vector_search")
     lexical_seed = 0
     for _s, is_lex, it in scored[: max(16, retrieval_top_k * 3)]:
         if is_lex:
@@ -3072,9 +3099,10 @@ def answer_from_kb(
             limit=max(120, retrieval_top_k * 24),
             file_ids_filter=scoped_ids,
         )
+    stages.mark("lexical_recall")
     if not scored:
         return None, "kb_empty", None
-    file_summaries = _build_file_summaries(scored)
+    file_summaries = _build_file_summaries(db, scored)
     if file_summaries:
         patched: list[tuple[float, bool, dict[str, Any]]] = []
         for s, lx, item in scored:
@@ -3093,14 +3121,12 @@ def answer_from_kb(
     adaptive_min_score = retrieval_min_score
     if keywords:
         for _score, _is_lex, it in scored[:20]:
-            meta_probe = " ".join(
-                [
-                    str(it.get("filename") or ""),
-                    str(it.get("source_title") or ""),
-                    str(it.get("source_url") or ""),
-                ]
+            meta_probe = (
+                str(it.get("filename") or ""),
+                str(it.get("source_title") or ""),
+                str(it.get("source_url") or ""),
             )
-            if _keyword_hits(meta_probe, keywords) > 0:
+            if _keyword_hits_joined(meta_probe, keywords) > 0:
                 adaptive_min_score = min(adaptive_min_score, 0.0)
                 break
     seen_chunk_ids: set[int] = set()
@@ -3110,17 +3136,15 @@ def answer_from_kb(
             if cid in seen_chunk_ids:
                 continue
             seen_chunk_ids.add(cid)
-        hits = _keyword_hits(str(item.get("text") or ""), keywords)
         if score < adaptive_min_score:
             continue
-        meta_hits = _keyword_hits(
-            " ".join(
-                [
-                    str(item.get("filename") or ""),
-                    str(item.get("source_title") or ""),
-                    str(item.get("source_url") or ""),
-                    str(item.get("file_summary") or ""),
-                ]
+        hits = _keyword_hits(str(item.get("text") or ""), keywords)
+        meta_hits = _keyword_hits_joined(
+            (
+                str(item.get("filename") or ""),
+                str(item.get("source_title") or ""),
+                str(item.get("source_url") or ""),
+                str(item.get("file_summary") or ""),
             ),
             keywords,
         )
@@ -3173,6 +3197,7 @@ def answer_from_kb(
     # Keep retrieval diversified so one file does not dominate all evidence slots.
     top_chunks = _diversify_top_chunks_by_file(top_chunks, top_k=top_k, max_per_file=(4 if list_intent else 2))
     context, used_chunks = _build_context(top_chunks, max_chars=max_chars)
+    stages.mark("rerank")
     conf, evidence = _retrieval_confidence(
         top_chunks,
         query_keywords=keywords,
@@ -3256,6 +3281,7 @@ def answer_from_kb(
         answer_profile=answer_profile,
         answer_style=answer_style,
     )
+    stages.mark("prompt")
     messages = [
         {"role": "system", "content": system_text},
         {"role": "user", "content": user_content},
@@ -3285,6 +3311,7 @@ def answer_from_kb(
                 presence_penalty=presence_penalty,
                 frequency_penalty=frequency_penalty,
             )
+    stages.mark("llm")
     if isinstance(usage, dict):
         usage["model"] = chat_model
     if err or not answer:
@@ -3386,13 +3413,7 @@ def answer_from_kb(
         usage["line_refs"] = line_refs
     if dialog_id and use_cache:
         used_ids = [int(c.get("chunk_id")) for c in used_chunks if c.get("chunk_id")]
-        _save_rag_cache(db, dialog_id, portal_id, embed_model, used_ids, keywords)
-    file_ids = {int(c.get("file_id")) for c in used_chunks if c.get("file_id")}
-    if file_ids:
-        db.execute(
-            update(KBFile)
-            .where(KBFile.id.in_(file_ids))
-            .values(query_count=KBFile.query_count + 1)
-        )
-        db.commit()
+        save_rag(db, dialog_id, portal_id, embed_model, used_ids, keywords)
+    record_citations(db, used_chunks)
+    stages.mark("postprocess")
     return out, None, usage
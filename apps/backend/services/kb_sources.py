@@ -1,20 +1,17 @@
-"""KB URL sources: download audio, transcribe, ingest."""
+"""KB URL sources: crawl web pages or download audio, then queue ingest."""
 from __future__ import annotations
 
 import os
 import re
 import subprocess
-import httpx
-from bs4 import BeautifulSoup  # type: ignore
 from datetime import datetime
 
 from sqlalchemy.orm import Session
-from sqlalchemy import select
 
 from apps.backend.models.kb import KBSource, KBFile, KBJob
 from apps.backend.models.portal import Portal
+from apps.backend.services.kb_crawler import _enqueue_ingest_jobs, crawl_source
 from apps.backend.services.kb_storage import ensure_portal_dir
-from apps.backend.services.kb_ingest import ingest_file
 
 
 def _detect_source_type(url: str) -> str:
@@ -43,6 +40,7 @@ def create_url_source(
     title: str | None = None,
     *,
     audience: str = "staff",
+    max_pages: int | None = None,
 ) -> dict:
     url = (url or "").strip()
     if not url:
@@ -59,6 +57,7 @@ def create_url_source(
         url=url,
         title=title,
         status="new",
+        max_pages=max(1, int(max_pages or 1)) if source_type == "web" else 1,
         created_at=datetime.utcnow(),
         updated_at=datetime.utcnow(),
     )
@@ -119,88 +118,65 @@ def process_url_source(db: Session, source_id: int) -> dict:
     db.add(src)
     db.commit()
     try:
-        portal_dir = ensure_portal_dir(src.portal_id)
         if src.source_type == "web":
-            r = httpx.get(src.url or "", timeout=20)
-            if r.status_code >= 400:
-                src.status = "error"
-                src.updated_at = datetime.utcnow()
-                db.commit()
-                return {"ok": False, "error": f"http_{r.status_code}"}
-            html = r.text or ""
-            soup = BeautifulSoup(html, "lxml")
-            for tag in soup(["script", "style", "noscript"]):
-                tag.extract()
-            title = (soup.title.get_text().strip() if soup.title else "") or (src.title or "")
-            text = soup.get_text("\n").strip()
-            if not text:
-                src.status = "error"
-                src.updated_at = datetime.utcnow()
-                db.commit()
-                return {"ok": False, "error": "no_text"}
-            safe_title = _safe_filename(title or "web")
-            filename = f"{safe_title}.txt"
-            file_path = os.path.join(portal_dir, filename)
-            with open(file_path, "w", encoding="utf-8") as f:
-                f.write(text)
-            rec = KBFile(
-                account_id=src.account_id,
-                portal_id=src.portal_id,
-                source_id=src.id,
-                filename=filename,
-                audience=src.audience or "staff",
-                mime_type="text/plain",
-                size_bytes=os.path.getsize(file_path),
-                storage_path=file_path,
-                sha256=None,
-                status="uploaded",
-                uploaded_by_type="system",
-                uploaded_by_id="source",
-                uploaded_by_name=src.source_type or "source",
-                created_at=datetime.utcnow(),
-                updated_at=datetime.utcnow(),
-            )
-        else:
-            file_path, title = _yt_dlp_download_audio(src.url or "", portal_dir)
-            if not file_path:
-                src.status = "error"
-                src.updated_at = datetime.utcnow()
-                db.commit()
-                return {"ok": False, "error": "download_failed"}
-            filename = os.path.basename(file_path)
-            rec = KBFile(
-                account_id=src.account_id,
-                portal_id=src.portal_id,
-                source_id=src.id,
-                filename=filename,
-                audience=src.audience or "staff",
-                mime_type="audio/mpeg",
-                size_bytes=os.path.getsize(file_path),
-                storage_path=file_path,
-                sha256=None,
-                status="uploaded",
-                uploaded_by_type="system",
-                uploaded_by_id="source",
-                uploaded_by_name=src.source_type or "source",
-                created_at=datetime.utcnow(),
-                updated_at=datetime.utcnow(),
-            )
-        db.add(rec)
-        db.commit()
-        db.refresh(rec)
-        # ingest immediately in worker
-        result = ingest_file(db, rec.id, trace_id=None)
-        if not result.get("ok"):
+            stats = crawl_source(db, src)
+            ok = bool(stats.get("changed") or stats.get("unchanged"))
+            src.status = "ready" if ok else "error"
+            src.updated_at = datetime.utcnow()
+            db.commit()
+            if not ok:
+                return {"ok": False, "error": "no_pages"}
+            return {
+                "ok": True,
+                "pages": stats["fetched"],
+                "changed": stats["changed"],
+                "job_ids": stats["jobs"],
+            }
+        portal_dir = ensure_portal_dir(src.portal_id)
+        file_path, title = _yt_dlp_download_audio(src.url or "", portal_dir)
+        if not file_path:
             src.status = "error"
             src.updated_at = datetime.utcnow()
             db.commit()
-            return {"ok": False, "error": result.get("error") or "ingest_failed"}
+            return {"ok": False, "error": "download_failed"}
+        filename = os.path.basename(file_path)
+        rec = KBFile(
+            account_id=src.account_id,
+            portal_id=src.portal_id,
+            source_id=src.id,
+            filename=filename,
+            audience=src.audience or "staff",
+            mime_type="audio/mpeg",
+            size_bytes=os.path.getsize(file_path),
+            storage_path=file_path,
+            sha256=None,
+            status="queued",
+            uploaded_by_type="system",
+            uploaded_by_id="source",
+            uploaded_by_name=src.source_type or "source",
+            created_at=datetime.utcnow(),
+            updated_at=datetime.utcnow(),
+        )
+        db.add(rec)
+        db.commit()
+        db.refresh(rec)
+        # ingest runs as its own job so a long transcription does not hold the source job
+        job = KBJob(
+            account_id=src.account_id,
+            portal_id=src.portal_id,
+            job_type="ingest",
+            status="queued",
+            payload_json={"file_id": rec.id, "source_id": src.id},
+        )
+        db.add(job)
         src.status = "ready"
         src.title = title or src.title
         src.updated_at = datetime.utcnow()
         db.commit()
-        return {"ok": True, "file_id": rec.id}
+        _enqueue_ingest_jobs([int(job.id)])
+        return {"ok": True, "file_id": rec.id, "job_ids": [int(job.id)]}
     except Exception as e:
+        db.rollback()
         src.status = "error"
         src.updated_at = datetime.utcnow()
         db.commit()
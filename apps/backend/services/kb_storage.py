@@ -32,3 +32,8 @@ def save_upload(stream: BinaryIO, dst_path: str) -> tuple[int, str]:
             h.update(chunk)
             size += len(chunk)
     return size, h.hexdigest()
+
+
+def preview_cache_dir(sha256: str) -> str:
+    """Content-addressed directory for rendered previews (sharded by sha prefix)."""
+    return os.path.join(_base_path(), "previews", (sha256 or "00")[:2])
@@ -0,0 +1,362 @@
+"""In-process metrics: counters, histograms and gauges in Prometheus text format.
+
+Recording is a dict update under a lock, so spans can stay on in production.
+Each process keeps cumulative values; ``flush_shared`` adds the delta since the
+previous flush into one Redis hash, which is how RQ work-horses (forked per
+job) and several API processes are aggregated. ``render`` returns the shared
+totals plus this process's unflushed part, and this process's gauges.
+
+A forked child starts with the parent's values as its flushed baseline, so it
+pushes only what it records itself; the parent still flushes its own part.
+"""
+from __future__ import annotations
+
+import functools
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS: tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SHARED_KEY = "metrics:shared"
+_OUTCOME_RE = re.compile(r"[a-z0-9_]{1,40}")
+
+_lock = threading.Lock()
+_counters: dict[tuple[str, tuple], float] = {}
+_hists: dict[tuple[str, tuple], list[float]] = {}  # per-bucket counts (+Inf last), then sum, then count
+_gauges: dict[tuple[str, tuple], float] = {}
+_flushed_counters: dict[tuple[str, tuple], float] = {}
+_flushed_hists: dict[tuple[str, tuple], list[float]] = {}
+_help: dict[str, str] = {}
+
+
+def _labels(labels: dict[str, Any]) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def describe(name: str, text: str) -> None:
+    _help[name] = text
+
+
+def inc(name: str, value: float = 1.0, **labels: Any) -> None:
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0.0) + value
+
+
+def observe(name: str, seconds: float, **labels: Any) -> None:
+    key = (name, _labels(labels))
+    n = len(DEFAULT_BUCKETS)
+    slot = n
+    for i, bound in enumerate(DEFAULT_BUCKETS):
+        if seconds <= bound:
+            slot = i
+            break
+    with _lock:
+        h = _hists.get(key)
+        if h is None:
+            h = _hists[key] = [0.0] * (n + 3)
+        h[slot] += 1
+        h[n + 1] += seconds
+        h[n + 2] += 1
+
+
+def set_gauge(name: str, value: float, **labels: Any) -> None:
+    with _lock:
+        _gauges[(name, _labels(labels))] = float(value)
+
+
+def add_gauge(name: str, delta: float, **labels: Any) -> None:
+    key = (name, _labels(labels))
+    with _lock:
+        _gauges[key] = _gauges.get(key, 0.0) + delta
+
+
+@contextmanager
+def span(name: str, **labels: Any) -> Iterator[None]:
+    """Observe the duration of the block in histogram ``name``."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - t0, **labels)
+
+
+class StageTimer:
+    """Consecutive stages of one call: ``mark(stage)`` records the time since the previous mark."""
+
+    __slots__ = ("name", "labels", "_last")
+
+    def __init__(self, name: str, **labels: Any):
+        self.name = name
+        self.labels = labels
+        self._last = time.perf_counter()
+
+    def mark(self, stage: str) -> None:
+        now = time.perf_counter()
+        observe(self.name, now - self._last, stage=stage, **self.labels)
+        self._last = now
+
+    def skip(self) -> None:
+        """Restart the clock without recording (time spent outside any stage)."""
+        self._last = time.perf_counter()
+
+
+def outcome_label(value: Any) -> str:
+    """Bounded label value for an error code; free-form messages collapse to ``error``."""
+    if not value:
+        return "ok"
+    text = str(value).strip().lower()
+    return text if _OUTCOME_RE.fullmatch(text) else "error"
+
+
+def timed(name: str, *, outcome: Callable[[Any], Any] | None = None, **labels: Any):
+    """Decorator: histogram ``name`` with an ``outcome`` label taken from the result."""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            result_outcome = "exception"
+            try:
+                result = fn(*args, **kwargs)
+                result_outcome = outcome_label(outcome(result)) if outcome else "ok"
+                return result
+            finally:
+                observe(name, time.perf_counter() - t0, outcome=result_outcome, **labels)
+
+        return wrapper
+
+    return decorator
+
+
+def flushes(fn):
+    """RQ job decorator: work-horses exit right after the job, so push metrics when it ends."""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            flush_shared()
+
+    return wrapper
+
+
+# --- aggregation and export ------------------------------------------------
+
+
+def _field(kind: str, key: tuple[str, tuple], suffix: str = "") -> str:
+    name, labels = key
+    return f"{kind}|{name}|{json.dumps(labels, separators=(',', ':'))}|{suffix}"
+
+
+def _redis():
+    from redis import Redis
+
+    from apps.backend.config import get_settings
+
+    s = get_settings()
+    return Redis(host=s.redis_host, port=s.redis_port, socket_connect_timeout=0.5, socket_timeout=1.0)
+
+
+def _deltas() -> tuple[dict, dict, dict, dict]:
+    with _lock:
+        counters = dict(_counters)
+        hists = {k: list(v) for k, v in _hists.items()}
+    dc = {k: v - _flushed_counters.get(k, 0.0) for k, v in counters.items()}
+    dh = {}
+    for k, v in hists.items():
+        prev = _flushed_hists.get(k)
+        dh[k] = [a - b for a, b in zip(v, prev)] if prev else v
+    return counters, hists, dc, dh
+
+
+def flush_shared() -> bool:
+    """Add this process's unflushed deltas to the shared Redis hash."""
+    counters, hists, dc, dh = _deltas()
+    fields: dict[str, float] = {}
+    for key, v in dc.items():
+        if v:
+            fields[_field("c", key)] = v
+    for key, v in dh.items():
+        if not v[-1]:
+            continue
+        for i, n in enumerate(v[:-2]):
+            if n:
+                fields[_field("h", key, str(i))] = n
+        fields[_field("h", key, "sum")] = v[-2]
+        fields[_field("h", key, "count")] = v[-1]
+    if fields:
+        try:
+            pipe = _redis().pipeline(transaction=False)
+            for f, v in fields.items():
+                pipe.hincrbyfloat(SHARED_KEY, f, v)
+            pipe.execute()
+        except Exception as e:
+            logger.debug("metrics flush failed: %s", e)
+            return False
+    _flushed_counters.update(counters)
+    _flushed_hists.update(hists)
+    return True
+
+
+def _shared() -> tuple[dict, dict] | None:
+    try:
+        raw = _redis().hgetall(SHARED_KEY)
+    except Exception:
+        return None
+    n = len(DEFAULT_BUCKETS)
+    counters: dict[tuple[str, tuple], float] = {}
+    hists: dict[tuple[str, tuple], list[float]] = {}
+    for f, v in raw.items():
+        try:
+            kind, name, labels, suffix = f.decode().split("|", 3)
+            key = (name, tuple(tuple(p) for p in json.loads(labels)))
+            value = float(v)
+        except Exception:
+            continue
+        if kind == "c":
+            counters[key] = counters.get(key, 0.0) + value
+        elif kind == "h":
+            h = hists.setdefault(key, [0.0] * (n + 3))
+            idx = n + 1 if suffix == "sum" else n + 2 if suffix == "count" else int(suffix)
+            h[idx] += value
+    return counters, hists
+
+
+def collect(shared: bool = True) -> tuple[dict, dict, dict]:
+    """(counters, histograms, gauges): shared totals plus local unflushed, or local only."""
+    counters, hists, dc, dh = _deltas()
+    merged = _shared() if shared else None
+    if merged is None:
+        with _lock:
+            gauges = dict(_gauges)
+        return counters, hists, gauges
+    out_c, out_h = merged
+    for k, v in dc.items():
+        out_c[k] = out_c.get(k, 0.0) + v
+    for k, v in dh.items():
+        prev = out_h.get(k)
+        out_h[k] = [a + b for a, b in zip(prev, v)] if prev else v
+    with _lock:
+        gauges = dict(_gauges)
+    return out_c, out_h, gauges
+
+
+def _fmt_labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    body = ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in pairs)
+    return "{" + body + "}"
+
+
+def _fmt_value(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+
+def render(shared: bool = True) -> str:
+    counters, hists, gauges = collect(shared)
+    lines: list[str] = []
+
+    def _family(series: dict, kind: str):
+        by_name: dict[str, list] = {}
+        for (name, labels), v in series.items():
+            by_name.setdefault(name, []).append((labels, v))
+        for name in sorted(by_name):
+            if name in _help:
+                lines.append(f"# HELP {name} {_help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, v in sorted(by_name[name]):
+                if kind != "histogram":
+                    lines.append(f"{name}{_fmt_labels(labels)} {_fmt_value(v)}")
+                    continue
+                cumulative = 0.0
+                for bound, n in zip(DEFAULT_BUCKETS, v):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{_fmt_labels(labels, (('le', repr(bound)),))} {_fmt_value(cumulative)}")
+                lines.append(f"{name}_bucket{_fmt_labels(labels, (('le', '+Inf'),))} {_fmt_value(v[-1])}")
+                lines.append(f"{name}_sum{_fmt_labels(labels)} {_fmt_value(v[-2])}")
+                lines.append(f"{name}_count{_fmt_labels(labels)} {_fmt_value(v[-1])}")
+
+    _family(counters, "counter")
+    _family(gauges, "gauge")
+    _family(hists, "histogram")
+    return "\n".join(lines) + "\n"
+
+
+def reset() -> None:
+    with _lock:
+        for d in (_counters, _hists, _gauges, _flushed_counters, _flushed_hists):
+            d.clear()
+
+
+def _after_fork_in_child() -> None:
+    global _lock
+    # the parent's unflushed deltas are the parent's to push, not this child's
+    _flushed_counters.clear()
+    _flushed_counters.update(_counters)
+    _flushed_hists.clear()
+    _flushed_hists.update({k: list(v) for k, v in _hists.items()})
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(
+        before=lambda: _lock.acquire(),
+        after_in_parent=lambda: _lock.release(),
+        after_in_child=_after_fork_in_child,
+    )
+
+
+# --- DB pool ---------------------------------------------------------------
+
+
+def instrument_db_pool() -> None:
+    """Pool events for every engine: checkouts, new connections, connection hold time."""
+    from sqlalchemy import event
+    from sqlalchemy.pool import Pool
+
+    if event.contains(Pool, "checkout", _on_checkout):
+        return
+    event.listen(Pool, "connect", _on_connect)
+    event.listen(Pool, "checkout", _on_checkout)
+    event.listen(Pool, "checkin", _on_checkin)
+    event.listen(Pool, "invalidate", _on_invalidate)
+
+
+def _on_connect(_dbapi_conn, _record) -> None:
+    inc("db_pool_connects_total")
+
+
+def _on_checkout(_dbapi_conn, record, _proxy) -> None:
+    record.info["metrics_checkout_at"] = time.perf_counter()
+    inc("db_pool_checkouts_total")
+    add_gauge("db_pool_checked_out", 1)
+
+
+def _on_checkin(_dbapi_conn, record) -> None:
+    started = record.info.pop("metrics_checkout_at", None)
+    if started is None:
+        return
+    add_gauge("db_pool_checked_out", -1)
+    observe("db_pool_hold_seconds", time.perf_counter() - started)
+
+
+def _on_invalidate(_dbapi_conn, _record, _exc) -> None:
+    inc("db_pool_invalidations_total")
+
+
+describe("kb_answer_seconds", "answer_from_kb wall time by outcome")
+describe("kb_answer_stage_seconds", "answer_from_kb time per stage")
+describe("kb_ingest_seconds", "ingest_file wall time by outcome")
+describe("kb_ingest_stage_seconds", "ingest_file time per stage")
+describe("outbox_send_seconds", "outbox delivery time by provider and outcome")
+describe("db_pool_hold_seconds", "time a pooled DB connection stays checked out")
@@ -0,0 +1,430 @@
+"""Outbox dispatcher: claim pending rows in batches, deliver them per destination.
+
+Producers still enqueue ``apps.worker.jobs.process_outbox(outbox_id)`` once
+per row. A job does not deliver just its own row. It claims up to
+``outbox_claim_batch`` pending rows, oldest first and from any portal
+(status created -> sending). In a burst, the first jobs drain the backlog and
+the rest find nothing to claim, so they return after one query.
+
+Claimed rows are grouped into lanes:
+
+* one lane per Bitrix portal, sent with the newest token any of its rows
+  carries (event payloads bring their own tokens). Every row of the lane
+  goes out through ``batch`` calls of up to 50 commands, with each part of a
+  long message as its own command. Bitrix runs the commands of a batch in
+  order, and the lane keeps id order, so the messages of a dialog keep their
+  order. A batch holding several parts of one message is sent with
+  ``halt=1``, so a failed part stops the parts after it. Calls are paced per portal (``bitrix_portal_rps``) through the
+  limiter shared with welcome fan-outs (``services/portal_pacing.py``);
+* one lane per Telegram chat (bot token + chat_id). Telegram has no batch
+  API, so each lane sends its rows in order. The per-bot limit is handled by
+  the client's rate limiter.
+
+Lanes run in parallel (``outbox_dispatch_concurrency`` threads). The threads
+only make HTTP calls and never touch the session. Statuses are written back
+in bulk: one UPDATE for the sent rows, one executemany for the failed ones,
+and one INSERT for the Bitrix trace rows.
+
+Order across jobs: claims are serialized (a transaction-level advisory lock
+on Postgres), and a portal that still has rows in flight with another job is
+skipped until they are finished, so two workers never deliver one portal's
+rows at the same time. That job claims again after writing back, and keeps
+going until nothing is left or ``outbox_dispatch_budget_seconds`` is used up
+(then ``process_outbox`` queues a follow-up), so skipped rows are never
+stranded.
+
+While lanes are in flight the job refreshes ``claimed_at`` of its rows. Only
+a row whose worker died goes stale and is claimed again after
+``outbox_claim_ttl_seconds``.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any
+from urllib.parse import urlencode
+
+from sqlalchemy import and_, bindparam, func, or_, select, text, update
+from sqlalchemy.orm import Session
+
+from apps.backend.clients import bitrix as bitrix_client
+from apps.backend.clients import telegram as telegram_client
+from apps.backend.config import get_settings
+from apps.backend.models.outbox import Outbox
+from apps.backend.models.portal import Portal
+from apps.backend.services.bitrix_logging import build_outbound_row, write_http_logs
+from apps.backend.services.metrics import describe, inc
+from apps.backend.services.portal_pacing import wait_portal_slot
+from apps.backend.services.portal_tokens import BitrixAuthError, ensure_fresh_access_token
+from apps.backend.services.telegram_settings import get_portal_telegram_token_plain
+
+logger = logging.getLogger(__name__)
+
+BITRIX_PART_LIMIT = 3000
+TELEGRAM_PART_LIMIT = 3500
+# pg_advisory_xact_lock key that serializes claims across workers
+_CLAIM_LOCK_KEY = 50_050_001
+
+describe("outbox_messages_total", "outbox rows finished by the dispatcher by provider and outcome")
+
+
+def split_message(text: str, limit: int = BITRIX_PART_LIMIT) -> list[str]:
+    """Split at paragraph boundaries into parts of at most ``limit`` characters."""
+    t = (text or "").strip()
+    if not t:
+        return []
+    if len(t) <= limit:
+        return [t]
+    parts: list[str] = []
+    buf: list[str] = []
+    size = 0
+    for para in t.split("\n"):
+        chunk = (para.strip() + "\n").strip()
+        if not chunk:
+            continue
+        if size + len(chunk) + 1 > limit and buf:
+            parts.append("\n".join(buf).strip())
+            buf = []
+            size = 0
+        if len(chunk) > limit:
+            for i in range(0, len(chunk), limit):
+                parts.append(chunk[i:i + limit])
+            continue
+        buf.append(chunk)
+        size += len(chunk) + 1
+    if buf:
+        parts.append("\n".join(buf).strip())
+    return parts or [t[:limit]]
+
+
+@dataclass
+class _Delivery:
+    outbox_id: int
+    portal_id: int
+    provider: str
+    target: str  # Bitrix dialog_id / Telegram chat_id
+    parts: list[str]
+    bot_id: int = 0
+    app_token: bool = False
+    trace_id: str = ""
+    error: str | None = None
+    error_desc: str = ""
+    latency_ms: int = 0
+
+    @property
+    def rest_method(self) -> str:
+        return "imbot.message.add" if self.bot_id else "im.message.add"
+
+
+@dataclass
+class _Lane:
+    provider: str
+    portal_id: int
+    endpoint: str  # Bitrix domain_full / Telegram bot token
+    token: str = ""
+    rows: list[_Delivery] = field(default_factory=list)
+
+
+def _claim_ttl() -> timedelta:
+    return timedelta(seconds=int(get_settings().outbox_claim_ttl_seconds or 300))
+
+
+def claim(db: Session, limit: int | None = None) -> list[Outbox]:
+    """Move up to ``limit`` pending rows to ``sending`` and return them in id order (commits).
+
+    Portals with rows in flight elsewhere (``sending`` and not stale) are skipped.
+    """
+    limit = int(limit or get_settings().outbox_claim_batch or 200)
+    now = datetime.utcnow()
+    stale = now - _claim_ttl()
+    t = Outbox.__table__
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _CLAIM_LOCK_KEY})
+    in_flight = select(t.c.portal_id).where(t.c.status == "sending", t.c.claimed_at >= stale)
+    claimable = and_(
+        or_(t.c.status == "created", and_(t.c.status == "sending", t.c.claimed_at < stale)),
+        t.c.portal_id.not_in(in_flight),
+    )
+    ids = (
+        db.execute(
+            select(t.c.id).where(claimable).order_by(t.c.id).limit(limit).with_for_update(skip_locked=True)
+        )
+        .scalars()
+        .all()
+    )
+    if ids:
+        db.execute(update(t).where(t.c.id.in_(ids)).values(status="sending", claimed_at=now))
+    db.commit()
+    if not ids:
+        return []
+    return list(db.execute(select(Outbox).where(Outbox.id.in_(ids)).order_by(Outbox.id)).scalars())
+
+
+def _touch_claims(db: Session, ids: list[int]) -> None:
+    t = Outbox.__table__
+    db.execute(
+        update(t).where(t.c.id.in_(ids), t.c.status == "sending").values(claimed_at=datetime.utcnow())
+    )
+    db.commit()
+
+
+def _resolve(db: Session, rows: list[Outbox]) -> tuple[list[_Lane], list[_Delivery]]:
+    """Group rows into lanes; rows that cannot be sent come back with ``error`` set."""
+    lanes: dict[tuple, _Lane] = {}
+    rejected: list[_Delivery] = []
+    tg_tokens: dict[tuple[int, str], str | None] = {}
+    bx_tokens: dict[int, str | BitrixAuthError | None] = {}
+    domains: dict[int, str | None] = {}
+    for o in rows:
+        try:
+            payload = json.loads(o.payload_json or "{}")
+        except ValueError:
+            payload = {}
+        provider = payload.get("provider") or "bitrix"
+        if provider == "telegram":
+            chat_id = payload.get("chat_id")
+            body = payload.get("body")
+            d = _Delivery(o.id, o.portal_id, "telegram", str(chat_id or ""), split_message(body, TELEGRAM_PART_LIMIT))
+            if not chat_id or not body:
+                d.error = "Missing chat_id or body"
+                rejected.append(d)
+                continue
+            kind = payload.get("kind") or "staff"
+            if (o.portal_id, kind) not in tg_tokens:
+                tg_tokens[(o.portal_id, kind)] = get_portal_telegram_token_plain(db, o.portal_id, kind)
+            token = tg_tokens[(o.portal_id, kind)]
+            if not token:
+                d.error = "Missing telegram token"
+                rejected.append(d)
+                continue
+            key = ("telegram", token, d.target)
+            lanes.setdefault(key, _Lane("telegram", o.portal_id, token)).rows.append(d)
+            continue
+
+        dialog_id = payload.get("dialog_id")
+        body = payload.get("body")
+        app_token = payload.get("app_token")
+        d = _Delivery(
+            o.id,
+            o.portal_id,
+            "bitrix",
+            str(dialog_id or ""),
+            split_message(body, BITRIX_PART_LIMIT),
+            bot_id=int(payload.get("bot_id") or 0),
+            app_token=bool(app_token),
+            trace_id=payload.get("trace_id", "") or "",
+        )
+        if not dialog_id or not body:
+            d.error = "Missing dialog_id or body"
+            rejected.append(d)
+            continue
+        access_token = payload.get("access_token") or app_token
+        if not access_token and o.portal_id:
+            if o.portal_id not in bx_tokens:
+                try:
+                    bx_tokens[o.portal_id] = ensure_fresh_access_token(db, o.portal_id)
+                except BitrixAuthError as e:
+                    bx_tokens[o.portal_id] = e
+            cached = bx_tokens[o.portal_id]
+            if isinstance(cached, BitrixAuthError):
+                d.error = f"auth_error:{cached.code}"
+                rejected.append(d)
+                continue
+            access_token = cached
+        domain = payload.get("domain")
+        if not domain and o.portal_id:
+            if o.portal_id not in domains:
+                p = db.get(Portal, o.portal_id)
+                domains[o.portal_id] = p.domain if p else None
+            domain = domains[o.portal_id]
+        if not access_token or not domain:
+            d.error = "No token or domain"
+            rejected.append(d)
+            continue
+        domain_clean = domain.replace("https://", "").replace("http://", "").rstrip("/")
+        domain_full = f"https://{domain_clean}"
+        # one lane per portal, whatever token each event carried: rows arrive in id
+        # order, so the newest (freshest) token wins and a dialog never spans lanes
+        lane = lanes.setdefault(("bitrix", o.portal_id, domain_full), _Lane("bitrix", o.portal_id, domain_full))
+        lane.token = access_token
+        lane.rows.append(d)
+    return list(lanes.values()), rejected
+
+
+def _deliver_bitrix(lane: _Lane) -> None:
+    commands: list[tuple[_Delivery, str, str]] = []
+    for d in lane.rows:
+        for n, part in enumerate(d.parts):
+            params: dict[str, Any] = {"DIALOG_ID": d.target, "MESSAGE": part}
+            if d.bot_id:
+                params = {"BOT_ID": d.bot_id, **params}
+            commands.append((d, f"o{d.outbox_id}_{n}", f"{d.rest_method}?{urlencode(params)}"))
+    step = bitrix_client.BITRIX_BATCH_MAX_COMMANDS
+    pending = deque(commands)
+    while pending:
+        # once a part failed, the rest of that message is not sent
+        chunk: list[tuple[_Delivery, str, str]] = []
+        while pending and len(chunk) < step:
+            c = pending.popleft()
+            if c[0].error is None:
+                chunk.append(c)
+        if not chunk:
+            continue
+        # halt=1 when the chunk carries several parts of one message: a failed
+        # part must stop the parts after it. Bitrix then skips every later
+        # command of the chunk, so those of other messages go back to pending.
+        halt = len({id(d) for d, _key, _cmd in chunk}) < len(chunk)
+        wait_portal_slot(lane.portal_id)
+        t0 = time.perf_counter()
+        results, errors, err, desc = bitrix_client.rest_batch(
+            lane.endpoint, lane.token, {key: cmd for _d, key, cmd in chunk}, halt=halt
+        )
+        latency_ms = int((time.perf_counter() - t0) * 1000)
+        skipped: list[tuple[_Delivery, str, str]] = []
+        for c in chunk:
+            d, key, _cmd = c
+            d.latency_ms += latency_ms
+            if d.error is not None:
+                continue
+            if err:
+                d.error, d.error_desc = err, desc or ""
+            elif key in errors:
+                e = errors[key] if isinstance(errors[key], dict) else {}
+                d.error = str(e.get("error") or "send_failed")
+                d.error_desc = str(e.get("error_description") or "")
+            elif halt and errors and key not in results:
+                skipped.append(c)
+            elif not results.get(key):
+                d.error = "send_failed"
+        pending.extendleft(reversed(skipped))
+
+
+def _deliver_telegram(lane: _Lane) -> None:
+    for d in lane.rows:
+        for part in d.parts:
+            ok, err = telegram_client.telegram_send_message(lane.endpoint, d.target, part)
+            if not ok:
+                d.error = err or "send_failed"
+                break
+
+
+def _deliver(lane: _Lane) -> None:
+    try:
+        if lane.provider == "telegram":
+            _deliver_telegram(lane)
+        else:
+            _deliver_bitrix(lane)
+    except Exception:
+        logger.exception("outbox lane failed provider=%s portal_id=%s", lane.provider, lane.portal_id)
+        for d in lane.rows:
+            if d.error is None:
+                d.error = "send_failed"
+
+
+def _error_message(d: _Delivery) -> str:
+    if d.provider == "telegram":
+        return d.error[:200]
+    if d.bot_id and d.app_token:
+        msg = f"Bitrix API failed: {d.error or 'unknown'}"
+        if d.error_desc:
+            msg += f" ({d.error_desc})"
+        return msg[:200]
+    return "Bitrix API failed"
+
+
+def _write_back(db: Session, sent: list[_Delivery], failed: list[_Delivery], rejected: list[_Delivery]) -> None:
+    t = Outbox.__table__
+    now = datetime.utcnow()
+    if sent:
+        db.execute(
+            update(t)
+            .where(t.c.id.in_([d.outbox_id for d in sent]))
+            .values(status="sent", sent_at=now, claimed_at=None)
+        )
+    errors = [
+        {"b_id": d.outbox_id, "b_error": _error_message(d), "b_retry": 1} for d in failed
+    ] + [{"b_id": d.outbox_id, "b_error": d.error, "b_retry": 0} for d in rejected]
+    if errors:
+        db.execute(
+            update(t)
+            .where(t.c.id == bindparam("b_id"))
+            .values(
+                status="error",
+                error_message=bindparam("b_error"),
+                retry_count=func.coalesce(t.c.retry_count, 0) + bindparam("b_retry"),
+                claimed_at=None,
+            ),
+            errors,
+        )
+    log_rows = [
+        build_outbound_row(
+            d.trace_id, d.portal_id, "POST", d.rest_method, 200 if d.error is None else 500, d.latency_ms
+        )
+        for d in sent + failed
+        if d.provider == "bitrix" and d.trace_id
+    ]
+    if log_rows:
+        write_http_logs(db, log_rows)  # commits
+    else:
+        db.commit()
+
+
+def _run_lanes(db: Session, lanes: list[_Lane]) -> None:
+    """Deliver lanes in parallel; refresh the claims of unfinished lanes while waiting."""
+    workers = max(1, min(int(get_settings().outbox_dispatch_concurrency or 1), len(lanes)))
+    heartbeat = _claim_ttl().total_seconds() / 3
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="outbox") as pool:
+        pending = {pool.submit(_deliver, lane): lane for lane in lanes}
+        while pending:
+            done, _ = wait(pending, timeout=heartbeat, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.pop(future)
+            if not done:
+                _touch_claims(db, [d.outbox_id for lane in pending.values() for d in lane.rows])
+
+
+def _dispatch_once(db: Session, limit: int | None, totals: dict[str, int]) -> bool:
+    """One claim-deliver-write round; False when nothing was claimed."""
+    rows = claim(db, limit)
+    if not rows:
+        return False
+    lanes, rejected = _resolve(db, rows)
+    if lanes:
+        _run_lanes(db, lanes)
+    delivered = [d for lane in lanes for d in lane.rows]
+    sent = [d for d in delivered if d.error is None]
+    failed = [d for d in delivered if d.error is not None]
+    _write_back(db, sent, failed, rejected)
+    counts = Counter((d.provider, "sent" if d.error is None else "error") for d in delivered + rejected)
+    for (provider, outcome), n in counts.items():
+        inc("outbox_messages_total", n, provider=provider, outcome=outcome)
+    logger.info(
+        "outbox dispatch claimed=%s lanes=%s sent=%s failed=%s",
+        len(rows),
+        len(lanes),
+        len(sent),
+        len(failed) + len(rejected),
+    )
+    totals["claimed"] += len(rows)
+    totals["sent"] += len(sent)
+    totals["failed"] += len(failed) + len(rejected)
+    return True
+
+
+def dispatch(db: Session, limit: int | None = None) -> dict[str, Any]:
+    """Claim, deliver and record batches until nothing is pending or the time budget is spent.
+
+    ``more`` is True when the budget ran out first; the caller should queue another run.
+    """
+    totals: dict[str, Any] = {"claimed": 0, "sent": 0, "failed": 0, "more": False}
+    deadline = time.monotonic() + int(get_settings().outbox_dispatch_budget_seconds or 120)
+    while _dispatch_once(db, limit, totals):
+        if time.monotonic() >= deadline:
+            totals["more"] = True
+            break
+    return totals
@@ -0,0 +1,263 @@
+"""Range partitions (by created_at) for append-only log tables: premake, drop-retention, sizes.
+
+Partitioned layout is created by migration 057; on other dialects (sqlite in tests)
+or before the migration every helper reports the table as not partitioned and callers
+fall back to row-level maintenance.
+"""
+from __future__ import annotations
+
+import logging
+import re
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Callable
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from apps.backend.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+_LOCK_KEY = "partitions:maintenance:lock"
+_BOUND_RE = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+
+@dataclass(frozen=True)
+class PartitionSpec:
+    table: str
+    interval: str  # day|month
+    premake: int
+    retention_days: Callable[[Session], int | None]
+    # SQL predicate: partition is kept while any row matches it (e.g. undelivered outbox rows).
+    keep_if: str | None = None
+
+
+def _inbound_retention(db: Session) -> int | None:
+    from apps.backend.services.inbound_settings import get_inbound_settings
+
+    settings = get_inbound_settings(db)
+    if not settings.get("auto_prune_on_write", True):
+        return None
+    return int(settings.get("retention_days") or 3)
+
+
+def _setting_days(name: str) -> Callable[[Session], int | None]:
+    def _get(_db: Session) -> int | None:
+        days = int(getattr(get_settings(), name, 0) or 0)
+        return days if days > 0 else None
+
+    return _get
+
+
+SPECS: dict[str, PartitionSpec] = {
+    "bitrix_inbound_events": PartitionSpec("bitrix_inbound_events", "day", 3, _inbound_retention),
+    "bitrix_http_logs": PartitionSpec("bitrix_http_logs", "day", 3, _setting_days("bitrix_http_logs_retention_days")),
+    "activity_events": PartitionSpec("activity_events", "month", 2, _setting_days("activity_events_retention_days")),
+    "outbox": PartitionSpec(
+        "outbox", "month", 2, _setting_days("outbox_retention_days"), keep_if="status IN ('created', 'sending', 'error')"
+    ),
+    "billing_usage": PartitionSpec("billing_usage", "month", 2, _setting_days("billing_usage_retention_days")),
+}
+
+
+def period_start(ts: datetime, interval: str) -> datetime:
+    if interval == "month":
+        return datetime(ts.year, ts.month, 1)
+    return datetime(ts.year, ts.month, ts.day)
+
+
+def next_period(start: datetime, interval: str) -> datetime:
+    if interval == "month":
+        return datetime(start.year + (start.month // 12), start.month % 12 + 1, 1)
+    return start + timedelta(days=1)
+
+
+def partition_name(table: str, start: datetime, interval: str) -> str:
+    suffix = start.strftime("%Y%m") if interval == "month" else start.strftime("%Y%m%d")
+    return f"{table}_p{suffix}"
+
+
+def _is_postgres(db: Session) -> bool:
+    return db.get_bind().dialect.name == "postgresql"
+
+
+def is_partitioned(db: Session, table: str) -> bool:
+    if not _is_postgres(db):
+        return False
+    row = db.execute(
+        text(
+            "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+            "WHERE c.relname = :t AND c.relnamespace = 'public'::regnamespace"
+        ),
+        {"t": table},
+    ).first()
+    return row is not None
+
+
+def _parse_bound(raw: str) -> datetime | None:
+    raw = (raw or "").strip().strip("'")
+    if raw.upper() in ("MINVALUE", "MAXVALUE"):
+        return None
+    try:
+        return datetime.fromisoformat(raw[:19])
+    except ValueError:
+        return None
+
+
+def list_partitions(db: Session, table: str) -> list[dict[str, Any]]:
+    """Leaf partitions with bounds (None = open/default), size in bytes and approx rows."""
+    if not is_partitioned(db, table):
+        return []
+    rows = db.execute(
+        text(
+            "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), "
+            "pg_total_relation_size(c.oid), GREATEST(c.reltuples, 0)::bigint "
+            "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = CAST(:t AS regclass) ORDER BY c.relname"
+        ),
+        {"t": table},
+    ).all()
+    out: list[dict[str, Any]] = []
+    for name, bound, size, approx in rows:
+        bound = bound or ""
+        lower = upper = None
+        m = _BOUND_RE.search(bound)
+        if m:
+            lower, upper = _parse_bound(m.group(1)), _parse_bound(m.group(2))
+        out.append({
+            "name": name,
+            "lower": lower,
+            "upper": upper,
+            "is_default": bound.strip().upper() == "DEFAULT",
+            "bytes": int(size or 0),
+            "approx_rows": int(approx or 0),
+        })
+    out.sort(key=lambda p: (p["is_default"], p["lower"] or datetime.min))
+    return out
+
+
+def relation_size(db: Session, table: str) -> dict[str, int]:
+    """Total bytes and approx rows across all partitions (or of the plain table)."""
+    if not _is_postgres(db):
+        return {"bytes": 0, "approx_rows": 0, "partitions": 0}
+    row = db.execute(
+        text(
+            "SELECT COALESCE(SUM(pg_total_relation_size(t.relid)), 0), "
+            "COALESCE(SUM(GREATEST(c.reltuples, 0)) FILTER (WHERE t.isleaf), 0)::bigint, "
+            "COUNT(*) FILTER (WHERE t.isleaf AND t.level > 0) "
+            "FROM pg_partition_tree(CAST(:t AS regclass)) t JOIN pg_class c ON c.oid = t.relid"
+        ),
+        {"t": table},
+    ).first()
+    if not row:
+        return {"bytes": 0, "approx_rows": 0, "partitions": 0}
+    return {"bytes": int(row[0] or 0), "approx_rows": int(row[1] or 0), "partitions": int(row[2] or 0)}
+
+
+def ensure_partitions(db: Session, table: str, now: datetime | None = None) -> list[str]:
+    """Create the current and ``premake`` future partitions. Returns created names."""
+    spec = SPECS[table]
+    if not is_partitioned(db, table):
+        return []
+    existing = list_partitions(db, table)
+    covered_until = max((p["upper"] for p in existing if p["upper"]), default=None)
+    current = period_start(now or datetime.utcnow(), spec.interval)
+    horizon = current
+    for _ in range(spec.premake + 1):
+        horizon = next_period(horizon, spec.interval)
+    # Continue from the last covered period so a missed run leaves no gaps.
+    start = covered_until if covered_until and covered_until < current else current
+    created: list[str] = []
+    while start < horizon:
+        end = next_period(start, spec.interval)
+        if covered_until is None or start >= covered_until:
+            name = partition_name(table, start, spec.interval)
+            db.execute(text(
+                f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{table}" '
+                f"FOR VALUES FROM ('{start:%Y-%m-%d %H:%M:%S}') TO ('{end:%Y-%m-%d %H:%M:%S}')"
+            ))
+            created.append(name)
+        start = end
+    db.commit()
+    return created
+
+
+def _drop_partition(db: Session, table: str, name: str) -> None:
+    db.execute(text(f'ALTER TABLE "{table}" DETACH PARTITION "{name}"'))
+    db.execute(text(f'DROP TABLE "{name}"'))
+
+
+def drop_partitions_before(db: Session, table: str, cutoff: datetime) -> list[dict[str, Any]]:
+    """Drop partitions whose upper bound is <= cutoff. O(partitions), no row-level DELETE."""
+    spec = SPECS[table]
+    dropped: list[dict[str, Any]] = []
+    for part in list_partitions(db, table):
+        if part["is_default"] or part["upper"] is None or part["upper"] > cutoff:
+            continue
+        if spec.keep_if:
+            busy = db.execute(text(f'SELECT 1 FROM "{part["name"]}" WHERE {spec.keep_if} LIMIT 1')).first()
+            if busy:
+                continue
+        _drop_partition(db, table, part["name"])
+        dropped.append(part)
+    db.commit()
+    return dropped
+
+
+def drop_oldest_over_rows(db: Session, table: str, max_rows: int, now: datetime | None = None) -> list[dict[str, Any]]:
+    """Drop oldest closed partitions while the table holds more than ``max_rows`` (approx)."""
+    spec = SPECS[table]
+    current = period_start(now or datetime.utcnow(), spec.interval)
+    parts = list_partitions(db, table)
+    total = sum(p["approx_rows"] for p in parts)
+    dropped: list[dict[str, Any]] = []
+    for part in parts:
+        if total <= max_rows:
+            break
+        if part["is_default"] or part["upper"] is None or part["upper"] > current:
+            continue
+        _drop_partition(db, table, part["name"])
+        dropped.append(part)
+        total -= part["approx_rows"]
+    db.commit()
+    return dropped
+
+
+def maintain_table(db: Session, table: str, now: datetime | None = None) -> dict[str, Any]:
+    spec = SPECS[table]
+    now = now or datetime.utcnow()
+    if not is_partitioned(db, table):
+        return {"partitioned": False}
+    created = ensure_partitions(db, table, now)
+    dropped: list[str] = []
+    days = spec.retention_days(db)
+    if days:
+        dropped = [p["name"] for p in drop_partitions_before(db, table, now - timedelta(days=days))]
+    return {"partitioned": True, "created": created, "dropped": dropped}
+
+
+def run_partition_maintenance() -> dict[str, Any]:
+    """Premake and retention for all partitioned tables; one instance at a time via Redis lock."""
+    from apps.backend import database
+
+    s = get_settings()
+    try:
+        from redis import Redis
+
+        r = Redis(host=s.redis_host, port=s.redis_port)
+        lock_ttl = max(60, int((s.partition_maintenance_interval_seconds or 3600) * 0.9))
+        if not r.set(_LOCK_KEY, "1", nx=True, ex=lock_ttl):
+            return {"skipped": "lock_not_acquired"}
+    except Exception:
+        logger.exception("partition_maintenance_lock_unavailable")
+    result: dict[str, Any] = {}
+    factory = database.get_session_factory()
+    for table in SPECS:
+        try:
+            with factory() as db:
+                result[table] = maintain_table(db, table)
+        except Exception:
+            logger.exception("partition_maintenance_failed table=%s", table)
+            result[table] = {"error": "maintenance_failed"}
+    return result
@@ -0,0 +1,83 @@
+"""Per-portal pacing of Bitrix calls, shared by every process through Redis.
+
+Welcome fan-outs and the outbox dispatcher run in RQ work-horses (one fork
+per job) and, as a fallback, inside API requests, so a limit kept in process
+memory would let each of them send ``bitrix_portal_rps`` on its own. The next
+free slot of a portal lives in Redis instead: a short script reserves it
+atomically (``max(now, next)``, then moves ``next`` on by ``1 / rps``) using
+the Redis clock, and the caller sleeps until its slot.
+
+When Redis is unreachable the slots are reserved in process memory, and
+Redis is tried again after ``_REDIS_RETRY_SEC``.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+
+from apps.backend.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+_KEY_PREFIX = "bitrix:pace:"
+_REDIS_RETRY_SEC = 30.0
+# KEYS[1] = pace key, ARGV[1] = gap in microseconds; returns the wait in microseconds.
+_RESERVE_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000000 + tonumber(t[2])
+local slot = math.max(now, tonumber(redis.call('GET', KEYS[1]) or 0))
+local gap = tonumber(ARGV[1])
+redis.call('SET', KEYS[1], slot + gap, 'PX', math.ceil((slot - now + gap) / 1000) + 1000)
+return slot - now
+"""
+
+_lock = threading.Lock()
+_local_next: dict[int, float] = {}
+_script = None
+_redis_down_until = 0.0
+
+
+def _redis():
+    from redis import Redis
+
+    s = get_settings()
+    return Redis(host=s.redis_host, port=s.redis_port, socket_connect_timeout=0.5, socket_timeout=1.0)
+
+
+def _reserve_shared(portal_id: int, gap: float) -> float | None:
+    """Seconds to wait for the portal's next slot in Redis, or None when Redis is unavailable."""
+    global _script, _redis_down_until
+    if time.monotonic() < _redis_down_until:
+        return None
+    try:
+        if _script is None:
+            _script = _redis().register_script(_RESERVE_LUA)
+        wait_us = _script(keys=[f"{_KEY_PREFIX}{int(portal_id)}"], args=[int(gap * 1_000_000)])
+        return max(0.0, int(wait_us) / 1_000_000)
+    except Exception as e:
+        logger.warning("portal_pacing redis unavailable, pacing in process error=%s", str(e)[:120])
+        _script = None
+        _redis_down_until = time.monotonic() + _REDIS_RETRY_SEC
+        return None
+
+
+def _reserve_local(portal_id: int, gap: float) -> float:
+    with _lock:
+        now = time.monotonic()
+        slot = max(now, _local_next.get(portal_id, 0.0))
+        _local_next[portal_id] = slot + gap
+    return slot - now
+
+
+def wait_portal_slot(portal_id: int) -> None:
+    """Block until this process may make its next Bitrix call to ``portal_id`` (``bitrix_portal_rps``)."""
+    per_second = float(get_settings().bitrix_portal_rps or 0)
+    if per_second <= 0:
+        return
+    gap = 1.0 / per_second
+    delay = _reserve_shared(int(portal_id), gap)
+    if delay is None:
+        delay = _reserve_local(int(portal_id), gap)
+    if delay > 0:
+        time.sleep(delay)
@@ -44,6 +44,8 @@ def save_tokens(
         if rt_enc is not None:
             row.refresh_token = rt_enc
         row.expires_at = expires
+        row.refresh_failures = 0
+        row.refresh_retry_at = None
     else:
         row = PortalToken(
             portal_id=portal_id,
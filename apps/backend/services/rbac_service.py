@@ -382,3 +382,71 @@ def require_kb_write_permission(ctx: MembershipCtx) -> None:
     if kb_access_allows_edit(ctx.kb_access) or is_owner_or_admin(ctx):
         return
     raise HTTPException(status_code=403, detail="forbidden")
+
+
+def ensure_account_members(
+    db: Session,
+    *,
+    account_id: int,
+    user_ids: list[int] | set[int],
+    role: str = "member",
+    status: str = "active",
+    kb_access: str = "none",
+    can_invite_users: bool = False,
+    can_manage_settings: bool = False,
+    can_view_finance: bool = False,
+) -> set[int]:
+    """Bulk ``ensure_account_member``; returns the user ids whose membership was created."""
+    wanted = sorted({int(u) for u in user_ids})
+    memberships: dict[int, int] = {}
+    for i in range(0, len(wanted), 500):
+        rows = db.execute(
+            select(AccountMembership.user_id, AccountMembership.id).where(
+                AccountMembership.account_id == int(account_id),
+                AccountMembership.user_id.in_(wanted[i:i + 500]),
+            )
+        ).all()
+        memberships.update({int(user_id): int(mid) for user_id, mid in rows})
+
+    now = datetime.utcnow()
+    new = [
+        AccountMembership(
+            account_id=int(account_id),
+            user_id=user_id,
+            role=(role or "member").strip().lower() or "member",
+            status=(status or "active").strip().lower() or "active",
+            invited_by_user_id=None,
+            created_at=now,
+            updated_at=now,
+        )
+        for user_id in wanted
+        if user_id not in memberships
+    ]
+    if new:
+        db.add_all(new)
+        db.flush()
+        memberships.update({int(m.user_id): int(m.id) for m in new})
+
+    membership_ids = sorted(memberships.values())
+    with_perm: set[int] = set()
+    for i in range(0, len(membership_ids), 500):
+        with_perm.update(
+            db.execute(
+                select(AccountPermission.membership_id).where(
+                    AccountPermission.membership_id.in_(membership_ids[i:i + 500])
+                )
+            ).scalars()
+        )
+    db.add_all(
+        AccountPermission(
+            membership_id=mid,
+            kb_access=normalize_kb_access_level(kb_access),
+            can_invite_users=bool(can_invite_users),
+            can_manage_settings=bool(can_manage_settings),
+            can_view_finance=bool(can_view_finance),
+            updated_at=now,
+        )
+        for mid in membership_ids
+        if mid not in with_perm
+    )
+    return {int(m.user_id) for m in new}
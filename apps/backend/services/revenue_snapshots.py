@@ -0,0 +1,369 @@
+"""Materialized per-account policy/revenue snapshots for the admin revenue list.
+
+Resolving the effective policy one account at a time costs a dozen queries per
+account. Here the inputs for a whole chunk of accounts are loaded with one
+query per table, cohort rules are evaluated in bulk and the result is stored in
+``billing_account_snapshots`` (+ ``billing_account_snapshot_cohorts``), so the
+list endpoint is a single paged SQL query with filters and sorting.
+
+Freshness: a session ``after_flush`` hook stamps ``stale_since`` on the
+affected accounts when subscriptions, overrides, adjustments, cohort
+assignments or integrations change, and on every snapshot when plans, plan
+versions, cohorts or cohort policies change. A snapshot also goes stale at
+``valid_until``, the next validity-window boundary of its inputs. Stale and
+missing snapshots are recomputed before the list is read. Account fields and
+owner email are joined live and never stale.
+"""
+from __future__ import annotations
+
+from collections import defaultdict
+from datetime import datetime
+from itertools import chain
+from typing import Any
+
+from sqlalchemy import asc, delete, desc, event, func, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from apps.backend.models.account import Account, AccountIntegration, AppUserWebCredential
+from apps.backend.models.billing import (
+    AccountPlanOverride,
+    AccountSubscription,
+    BillingAccountAdjustment,
+    BillingAccountSnapshot,
+    BillingAccountSnapshotCohort,
+    BillingCohort,
+    BillingCohortAssignment,
+    BillingCohortPolicy,
+    BillingPlan,
+    BillingPlanVersion,
+)
+
+_ACCOUNT_INPUTS = (
+    AccountSubscription,
+    AccountPlanOverride,
+    BillingAccountAdjustment,
+    BillingCohortAssignment,
+    AccountIntegration,
+)
+_GLOBAL_INPUTS = (BillingPlan, BillingPlanVersion, BillingCohort, BillingCohortPolicy)
+
+SORT_COLUMNS = {
+    "account_no": Account.account_no,
+    "name": Account.name,
+    "created_at": Account.created_at,
+    "final_price_month": BillingAccountSnapshot.final_price_month,
+    "plan": BillingAccountSnapshot.plan_code,
+}
+
+
+def _snapshot_inputs_changed(session: Session, flush_context) -> None:
+    account_ids: set[int] = set()
+    everything = False
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if obj in session.dirty and not session.is_modified(obj, include_collections=False):
+            continue
+        if isinstance(obj, _GLOBAL_INPUTS):
+            everything = True
+            break
+        if isinstance(obj, _ACCOUNT_INPUTS) and obj.account_id:
+            account_ids.add(int(obj.account_id))
+        elif isinstance(obj, Account) and obj not in session.new and obj.id:
+            account_ids.add(int(obj.id))
+    if not everything and not account_ids:
+        return
+    stmt = update(BillingAccountSnapshot).values(stale_since=datetime.utcnow())
+    if not everything:
+        stmt = stmt.where(BillingAccountSnapshot.account_id.in_(account_ids))
+    session.connection().execute(stmt)
+
+
+event.listen(Session, "after_flush", _snapshot_inputs_changed)
+
+
+def _first_by_account(rows) -> dict[int, Any]:
+    out: dict[int, Any] = {}
+    for row in rows:
+        out.setdefault(int(row.account_id), row)
+    return out
+
+
+def _next_boundary(rows, now: datetime) -> datetime | None:
+    future = [
+        ts
+        for row in rows
+        for ts in (row.valid_from, row.valid_to)
+        if ts is not None and ts > now
+    ]
+    return min(future) if future else None
+
+
+def compute_account_snapshots(db: Session, account_ids: list[int], now: datetime | None = None) -> list[dict[str, Any]]:
+    """Resolve effective policy fields for many accounts with one query per input table."""
+    from apps.backend.services.billing import (
+        _compose_commercial_policy,
+        _compose_runtime_policy,
+        _cohort_rule_matches,
+        _is_active_window,
+        _single_cohort_policy,
+    )
+
+    now = now or datetime.utcnow()
+    if not account_ids:
+        return []
+    accounts = db.execute(select(Account).where(Account.id.in_(account_ids))).scalars().all()
+    subs = _first_by_account(db.execute(
+        select(AccountSubscription)
+        .where(AccountSubscription.account_id.in_(account_ids))
+        .where(AccountSubscription.status.in_(["trial", "active", "paused"]))
+        .order_by(
+            AccountSubscription.account_id,
+            desc(AccountSubscription.started_at),
+            desc(AccountSubscription.created_at),
+            desc(AccountSubscription.id),
+        )
+    ).scalars())
+    plans = {int(p.id): p for p in db.execute(select(BillingPlan)).scalars()}
+    versions = {int(v.id): v for v in db.execute(select(BillingPlanVersion)).scalars()}
+    default_version: dict[int, BillingPlanVersion] = {}
+    for v in sorted(versions.values(), key=lambda v: (bool(v.is_default_for_new_accounts), int(v.id)), reverse=True):
+        if v.is_active:
+            default_version.setdefault(int(v.plan_id), v)
+
+    cohorts = db.execute(
+        select(BillingCohort).where(BillingCohort.is_active.is_(True)).order_by(BillingCohort.id.asc())
+    ).scalars().all()
+    all_policies = db.execute(
+        select(BillingCohortPolicy)
+        .where(BillingCohortPolicy.is_active.is_(True))
+        .order_by(desc(BillingCohortPolicy.created_at), desc(BillingCohortPolicy.id))
+    ).scalars().all()
+    policies_by_cohort: dict[int, list[BillingCohortPolicy]] = defaultdict(list)
+    for policy in all_policies:
+        if _is_active_window(policy.valid_from, policy.valid_to, now):
+            policies_by_cohort[int(policy.cohort_id)].append(policy)
+    policy_boundary = _next_boundary(all_policies, now)
+
+    manual = {
+        (int(a.account_id), int(a.cohort_id))
+        for a in db.execute(
+            select(BillingCohortAssignment).where(BillingCohortAssignment.account_id.in_(account_ids))
+        ).scalars()
+    }
+    channels: dict[int, str | None] = {}
+    for account_id, provider in db.execute(
+        select(AccountIntegration.account_id, AccountIntegration.provider)
+        .where(AccountIntegration.account_id.in_(account_ids))
+        .where(AccountIntegration.status != "deleted")
+        .order_by(AccountIntegration.id.asc())
+    ).all():
+        channels.setdefault(int(account_id), str(provider) if provider else None)
+    overrides: dict[int, list[AccountPlanOverride]] = defaultdict(list)
+    for row in db.execute(
+        select(AccountPlanOverride)
+        .where(AccountPlanOverride.account_id.in_(account_ids))
+        .order_by(desc(AccountPlanOverride.created_at), desc(AccountPlanOverride.id))
+    ).scalars():
+        overrides[int(row.account_id)].append(row)
+    adjustments: dict[int, list[BillingAccountAdjustment]] = defaultdict(list)
+    for row in db.execute(
+        select(BillingAccountAdjustment)
+        .where(BillingAccountAdjustment.account_id.in_(account_ids))
+        .order_by(desc(BillingAccountAdjustment.created_at), desc(BillingAccountAdjustment.id))
+    ).scalars():
+        adjustments[int(row.account_id)].append(row)
+
+    out: list[dict[str, Any]] = []
+    for account in accounts:
+        aid = int(account.id)
+        sub = subs.get(aid)
+        plan = plans.get(int(sub.plan_id)) if sub and sub.plan_id else None
+        version = None
+        if sub:
+            version = versions.get(int(sub.plan_version_id)) if sub.plan_version_id else None
+            if version is None and sub.plan_id:
+                version = default_version.get(int(sub.plan_id))
+        active_cohorts = []
+        for cohort in cohorts:
+            source = "manual" if (aid, int(cohort.id)) in manual else None
+            if source is None and _cohort_rule_matches(dict(cohort.rule_json or {}), account.created_at, channels.get(aid)):
+                source = "auto"
+            if source:
+                active_cohorts.append({"cohort": cohort, "policies": policies_by_cohort.get(int(cohort.id), []), "source": source})
+        active_overrides = [r for r in overrides.get(aid, []) if _is_active_window(r.valid_from, r.valid_to, now)]
+        active_adjustments = [r for r in adjustments.get(aid, []) if _is_active_window(r.valid_from, r.valid_to, now)]
+        boundaries = [
+            b
+            for b in (policy_boundary, _next_boundary(overrides.get(aid, []), now), _next_boundary(adjustments.get(aid, []), now))
+            if b is not None
+        ]
+        row: dict[str, Any] = {
+            "account_id": aid,
+            "plan_id": int(plan.id) if plan else None,
+            "plan_code": plan.code if plan else None,
+            "plan_version_id": int(version.id) if version else None,
+            "subscription_status": sub.status if sub else None,
+            "final_price_month": None,
+            "currency": None,
+            "adjustments_count": len(active_adjustments),
+            "runtime_source": None,
+            "error": None,
+            "valid_until": min(boundaries) if boundaries else None,
+            "stale_since": None,
+            "computed_at": now,
+            "cohorts": [(int(item["cohort"].id), item["source"]) for item in active_cohorts],
+        }
+        try:
+            cohort_policy = _single_cohort_policy(active_cohorts)
+            _limits, _features, explain = _compose_runtime_policy(
+                plan=plan,
+                version=version,
+                cohort_policy=cohort_policy,
+                legacy_override=active_overrides[0] if active_overrides else None,
+                adjustments=active_adjustments,
+            )
+            commercial = _compose_commercial_policy(
+                plan=plan, version=version, cohort_policy=cohort_policy, adjustments=active_adjustments
+            )
+            row["runtime_source"] = explain[-1]["layer"] if explain else "default"
+            row["final_price_month"] = commercial["final_price_month"]
+            row["currency"] = commercial["currency"]
+        except ValueError as e:
+            row["error"] = str(e)[:64]
+        out.append(row)
+    return out
+
+
+def _stale_account_ids(db: Session, now: datetime, limit: int) -> list[int]:
+    return [
+        int(aid)
+        for aid in db.execute(
+            select(Account.id)
+            .join(BillingAccountSnapshot, BillingAccountSnapshot.account_id == Account.id, isouter=True)
+            .where(or_(
+                BillingAccountSnapshot.account_id.is_(None),
+                BillingAccountSnapshot.stale_since.is_not(None),
+                BillingAccountSnapshot.valid_until <= now,
+            ))
+            .order_by(Account.id.asc())
+            .limit(limit)
+        ).scalars()
+    ]
+
+
+def refresh_account_snapshots(db: Session, *, chunk_size: int = 500, max_accounts: int | None = None) -> int:
+    """Recompute missing and stale snapshots in chunks; returns how many were written.
+
+    An account marked stale while its chunk was being computed is skipped and
+    picked up by the next refresh. The check runs under row locks on the
+    snapshots, in the transaction that replaces them.
+    """
+    written = 0
+    done: set[int] = set()
+    while max_accounts is None or written < max_accounts:
+        started = datetime.utcnow()
+        ids = [aid for aid in _stale_account_ids(db, started, chunk_size + len(done)) if aid not in done][:chunk_size]
+        if not ids:
+            break
+        done.update(ids)
+        stamps = select(BillingAccountSnapshot.account_id, BillingAccountSnapshot.stale_since).where(
+            BillingAccountSnapshot.account_id.in_(ids)
+        )
+        seen = dict(db.execute(stamps).all())
+        rows = compute_account_snapshots(db, ids, now=started)
+        try:
+            # Lock the snapshots, then keep only accounts whose stamp did not move while
+            # computing. A stamp that comes later waits for this commit and marks the new row.
+            current = dict(db.execute(stamps.with_for_update()).all())
+            rows = [r for r in rows if current.get(r["account_id"]) == seen.get(r["account_id"])]
+            if not rows:
+                db.rollback()
+                continue
+            keep = [r["account_id"] for r in rows]
+            db.execute(delete(BillingAccountSnapshotCohort).where(BillingAccountSnapshotCohort.account_id.in_(keep)))
+            db.execute(delete(BillingAccountSnapshot).where(BillingAccountSnapshot.account_id.in_(keep)))
+            db.execute(insert(BillingAccountSnapshot), [{k: v for k, v in r.items() if k != "cohorts"} for r in rows])
+            links = [
+                {"account_id": r["account_id"], "cohort_id": cohort_id, "source": source}
+                for r in rows
+                for cohort_id, source in r["cohorts"]
+            ]
+            if links:
+                db.execute(insert(BillingAccountSnapshotCohort), links)
+            db.commit()
+        except IntegrityError:
+            # A concurrent refresh wrote the same accounts first.
+            db.rollback()
+            continue
+        written += len(rows)
+    return written
+
+
+def list_account_snapshots(
+    db: Session,
+    *,
+    limit: int = 200,
+    offset: int = 0,
+    q: str | None = None,
+    plan_code: str | None = None,
+    subscription_status: str | None = None,
+    status: str | None = None,
+    cohort_id: int | None = None,
+    sort: str = "account_no",
+) -> tuple[list[tuple[Account, str | None, BillingAccountSnapshot]], int]:
+    """One page of (account, owner_email, snapshot) with filters and sorting in SQL, plus the total."""
+    filters = []
+    if q:
+        needle = f"%{q.strip().lower()}%"
+        cond = or_(
+            func.lower(Account.name).like(needle),
+            func.lower(Account.slug).like(needle),
+            func.lower(AppUserWebCredential.email).like(needle),
+        )
+        if q.strip().isdigit():
+            cond = or_(cond, Account.account_no == int(q.strip()), Account.id == int(q.strip()))
+        filters.append(cond)
+    if plan_code:
+        filters.append(BillingAccountSnapshot.plan_code == plan_code)
+    if subscription_status == "none":
+        filters.append(BillingAccountSnapshot.subscription_status.is_(None))
+    elif subscription_status:
+        filters.append(BillingAccountSnapshot.subscription_status == subscription_status)
+    if status:
+        filters.append(Account.status == status)
+    if cohort_id:
+        filters.append(
+            select(BillingAccountSnapshotCohort.account_id)
+            .where(BillingAccountSnapshotCohort.account_id == Account.id)
+            .where(BillingAccountSnapshotCohort.cohort_id == cohort_id)
+            .exists()
+        )
+
+    base = (
+        select(Account, AppUserWebCredential.email, BillingAccountSnapshot)
+        .join(BillingAccountSnapshot, BillingAccountSnapshot.account_id == Account.id)
+        .join(AppUserWebCredential, AppUserWebCredential.user_id == Account.owner_user_id, isouter=True)
+        .where(*filters)
+    )
+    total = int(db.execute(select(func.count()).select_from(base.subquery())).scalar() or 0)
+    descending = sort.startswith("-")
+    column = SORT_COLUMNS.get(sort.lstrip("-"), Account.account_no)
+    order = desc(column).nullslast() if descending else asc(column).nullslast()
+    rows = db.execute(base.order_by(order, Account.id.asc()).limit(limit).offset(offset)).all()
+    return [(account, email, snapshot) for account, email, snapshot in rows], total
+
+
+def snapshot_cohorts(db: Session, account_ids: list[int]) -> dict[int, list[dict[str, Any]]]:
+    out: dict[int, list[dict[str, Any]]] = defaultdict(list)
+    if not account_ids:
+        return out
+    for link, cohort in db.execute(
+        select(BillingAccountSnapshotCohort, BillingCohort)
+        .join(BillingCohort, BillingCohort.id == BillingAccountSnapshotCohort.cohort_id)
+        .where(BillingAccountSnapshotCohort.account_id.in_(account_ids))
+        .order_by(BillingCohort.id.asc())
+    ).all():
+        out[int(link.account_id)].append(
+            {"id": int(cohort.id), "code": cohort.code, "name": cohort.name, "source": link.source}
+        )
+    return out
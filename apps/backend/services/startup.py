@@ -0,0 +1,158 @@
+"""Startup cost: worker preload and the import-time profile.
+
+Parser and ML libraries (pypdf, docx, openpyxl, xlrd, bs4, faster-whisper)
+are imported inside the functions that use them, and the pymorphy3 analyzer
+is built on first use (``kb_rag._get_morph``), so the API does not pay for
+them at import.
+
+RQ forks a work horse per job, and the child imports the job module itself,
+so every job used to re-import the application and rebuild the pymorphy3
+dictionaries. ``preload`` imports the job modules and warms the analyzer in
+the worker parent (``apps.worker.worker.PreloadWorker``); children inherit
+them through fork. ``gc.freeze`` moves the preloaded objects out of the
+collector's reach so collections in the child do not touch (and copy) their
+pages.
+
+``import_profile`` runs ``python -X importtime`` on the API entry point in a
+subprocess and reports the most expensive modules
+(``GET /v1/admin/system/startup``).
+"""
+from __future__ import annotations
+
+import gc
+import importlib
+import logging
+import subprocess
+import sys
+import threading
+import time
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+# Modules every job imports in the work horse.
+PRELOAD_MODULES = (
+    "apps.worker.jobs",
+    "apps.backend.database",
+    "apps.backend.models",
+    "apps.backend.services.kb_ingest",
+    "apps.backend.services.kb_sources",
+    "apps.backend.services.kb_preview",
+    "apps.backend.services.kb_rag",
+    "apps.backend.services.portal_tokens",
+    "apps.backend.clients.bitrix",
+    "apps.backend.clients.telegram",
+)
+# Optional parser libraries; missing ones are skipped (the outbox image does not ship them).
+PRELOAD_OPTIONAL = ("pypdf", "docx", "openpyxl", "xlrd", "bs4")
+# Modules whose presence in sys.modules the report shows.
+HEAVY_MODULES = ("pymorphy3", "pypdf", "docx", "openpyxl", "xlrd", "bs4", "faster_whisper", "torch", "pyannote.audio")
+
+_preload_report: dict[str, Any] = {}
+_profile: dict[str, Any] | None = None
+_profile_lock = threading.Lock()
+
+
+def preload(modules: tuple[str, ...] = PRELOAD_MODULES, optional: tuple[str, ...] = PRELOAD_OPTIONAL) -> dict[str, Any]:
+    """Import ``modules`` and warm the lemmatizer; returns per-step milliseconds."""
+    started = time.perf_counter()
+    steps: dict[str, float] = {}
+    skipped: list[str] = []
+    for name in (*modules, *optional):
+        t = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            if name not in optional:
+                logger.warning("preload import failed module=%s error=%s", name, e)
+            skipped.append(name)
+            continue
+        steps[name] = round((time.perf_counter() - t) * 1000, 1)
+    t = time.perf_counter()
+    from apps.backend.services.kb_rag import _get_morph
+
+    morph = _get_morph()
+    if morph is not None:
+        morph.parse("документ")
+    steps["pymorphy3.MorphAnalyzer"] = round((time.perf_counter() - t) * 1000, 1)
+    gc.collect()
+    gc.freeze()
+    _preload_report.clear()
+    _preload_report.update(
+        {
+            "total_ms": round((time.perf_counter() - started) * 1000, 1),
+            "steps_ms": steps,
+            "skipped": skipped,
+            "frozen_objects": gc.get_freeze_count(),
+        }
+    )
+    logger.info("worker preload done total_ms=%s skipped=%s", _preload_report["total_ms"], skipped)
+    return dict(_preload_report)
+
+
+def parse_importtime(stderr: str) -> list[dict[str, Any]]:
+    """Rows of ``-X importtime`` output as ``{"module", "self_us", "cumulative_us", "depth"}``."""
+    rows: list[dict[str, Any]] = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3:
+            continue
+        try:
+            self_us, cumulative_us = int(parts[0]), int(parts[1])
+        except ValueError:
+            continue  # header
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip(" "))) // 2
+        rows.append({"module": name.strip(), "self_us": self_us, "cumulative_us": cumulative_us, "depth": depth})
+    return rows
+
+
+def import_profile(target: str = "apps.backend.main", top: int = 25, refresh: bool = False) -> dict[str, Any]:
+    """Import-time profile of ``target`` in a fresh interpreter (cached per process)."""
+    global _profile
+    with _profile_lock:
+        if _profile is not None and not refresh and _profile.get("target") == target:
+            cached = _profile
+        else:
+            t = time.perf_counter()
+            proc = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", f"import {target}"],
+                capture_output=True,
+                text=True,
+                timeout=120,
+            )
+            rows = parse_importtime(proc.stderr)
+            cached = _profile = {
+                "target": target,
+                "ok": proc.returncode == 0,
+                "wall_ms": round((time.perf_counter() - t) * 1000, 1),
+                "rows": rows,
+                "measured_at": time.time(),
+            }
+    rows = cached["rows"]
+    root = next((r for r in rows if r["module"] == target), None)
+    return {
+        "target": target,
+        "ok": cached["ok"],
+        "wall_ms": cached["wall_ms"],
+        "import_ms": round(root["cumulative_us"] / 1000, 1) if root else None,
+        "measured_at": cached["measured_at"],
+        "top_self": [
+            {"module": r["module"], "self_ms": round(r["self_us"] / 1000, 1), "cumulative_ms": round(r["cumulative_us"] / 1000, 1)}
+            for r in sorted(rows, key=lambda r: r["self_us"], reverse=True)[:top]
+        ],
+        "top_packages": [
+            {"module": r["module"], "cumulative_ms": round(r["cumulative_us"] / 1000, 1)}
+            for r in sorted((r for r in rows if r["depth"] == 1), key=lambda r: r["cumulative_us"], reverse=True)[:top]
+        ],
+    }
+
+
+def startup_report() -> dict[str, Any]:
+    """What this process has loaded: heavy modules and the worker preload result."""
+    return {
+        "loaded_heavy_modules": [name for name in HEAVY_MODULES if name in sys.modules],
+        "preload": dict(_preload_report) or None,
+    }
@@ -13,7 +13,7 @@ from apps.backend.models.dialog import Dialog, Message
 from apps.backend.models.event import Event
 from apps.backend.models.outbox import Outbox
 from apps.backend.models.portal import PortalUsersAccess
-from apps.backend.models.kb import KBFile, KBJob, KBFileAccess, KBFolderAccess
+from apps.backend.models.kb import KBFile, KBJob
 from apps.backend.models.portal import Portal
 from apps.backend.models.account import AccountMembership, AppUserIdentity, AccountUserGroupMember
 from apps.backend.services.kb_rag import answer_from_kb
@@ -30,13 +30,8 @@ from apps.backend.services.telegram_settings import (
     get_portal_telegram_token_plain,
 )
 from apps.backend.services.kb_storage import ensure_portal_dir
-from apps.backend.services.kb_acl import (
-    default_kb_access_for_role,
-    kb_access_allows_read,
-    kb_acl_principals_for_membership,
-    resolve_kb_acl_access,
-)
-from apps.backend.clients.telegram import telegram_get_file, telegram_download_file
+from apps.backend.services.kb_access_map import readable_file_ids
+from apps.backend.clients.telegram import telegram_get_file, telegram_download_file, telegram_send_message
 from apps.backend.config import get_settings
 
 logger = logging.getLogger(__name__)
@@ -173,36 +168,14 @@ def _filter_file_ids_by_kb_acl(
     role: str | None,
     audience: str | None,
 ) -> set[int]:
-    if not file_ids:
-        return set()
-    rows = db.execute(select(KBFile.id, KBFile.folder_id).where(KBFile.id.in_(sorted(file_ids)))).all()
-    folder_ids = sorted({int(folder_id) for _fid, folder_id in rows if folder_id is not None})
-    file_acl_rows = db.execute(
-        select(KBFileAccess.file_id, KBFileAccess.principal_type, KBFileAccess.principal_id, KBFileAccess.access_level)
-        .where(KBFileAccess.file_id.in_(sorted(file_ids)))
-    ).all()
-    folder_acl_rows = []
-    if folder_ids:
-        folder_acl_rows = db.execute(
-            select(KBFolderAccess.folder_id, KBFolderAccess.principal_type, KBFolderAccess.principal_id, KBFolderAccess.access_level)
-            .where(KBFolderAccess.folder_id.in_(folder_ids))
-        ).all()
-    principals = kb_acl_principals_for_membership(membership_id, role, audience, group_ids)
-    file_acl_map: dict[int, list[tuple[str, str, str]]] = {}
-    for file_id, principal_type, principal_id, access_level in file_acl_rows:
-        file_acl_map.setdefault(int(file_id), []).append((str(principal_type), str(principal_id), str(access_level)))
-    folder_acl_map: dict[int, list[tuple[str, str, str]]] = {}
-    for folder_id, principal_type, principal_id, access_level in folder_acl_rows:
-        folder_acl_map.setdefault(int(folder_id), []).append((str(principal_type), str(principal_id), str(access_level)))
-    allowed: set[int] = set()
-    for file_id, folder_id in rows:
-        inherited = default_kb_access_for_role(role)
-        if folder_id is not None:
-            inherited = resolve_kb_acl_access(folder_acl_map.get(int(folder_id), []), principals, inherited)
-        effective = resolve_kb_acl_access(file_acl_map.get(int(file_id), []), principals, inherited)
-        if kb_access_allows_read(effective):
-            allowed.add(int(file_id))
-    return allowed
+    return readable_file_ids(
+        db,
+        file_ids,
+        membership_id=membership_id,
+        group_ids=group_ids,
+        role=role,
+        audience=audience,
+    )
 
 
 def _telegram_client_file_scope(db: Session, portal_id: int, username: str | None) -> tuple[dict[str, object] | None, list[int] | None]:
@@ -589,3 +562,13 @@ def process_telegram_update(
         outbox.error_message = str(e)[:200]
         db.commit()
     return {"status": "ok", "dialog_id": dialog.id, "outbox_id": outbox.id}
+
+
+def dispatch_telegram_update(db: Session, portal_id: int, kind: str, update: dict) -> dict:
+    """Webhook and long-polling entry point: process the update and answer blocked senders."""
+    result = process_telegram_update(db, portal_id, kind, update)
+    if result.get("status") == "blocked" and result.get("reply") and result.get("chat_id"):
+        token = get_portal_telegram_token_plain(db, portal_id, kind)
+        if token:
+            telegram_send_message(token, result.get("chat_id"), result.get("reply"))
+    return result
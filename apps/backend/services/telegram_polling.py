@@ -0,0 +1,172 @@
+"""getUpdates long-polling for Telegram bots that cannot receive webhooks (behind NAT).
+
+Polling is switched on per bot (``polling`` in the bot's Telegram settings);
+other bots keep their webhooks. A supervisor thread keeps one polling thread
+per such bot; each update goes through the same ``dispatch_telegram_update``
+path as the webhook. A Redis lease per bot keeps several API replicas from
+polling the same token. The lease is renewed before every update, together
+with the offset of the updates handled so far, in one compare-and-expire
+script, so a slow batch neither loses the lease nor replays handled updates.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import uuid
+from typing import Callable
+
+from apps.backend import database
+from apps.backend.clients.telegram import telegram_delete_webhook, telegram_get_updates
+from apps.backend.config import get_settings
+from apps.backend.services.telegram_events import dispatch_telegram_update
+from apps.backend.services.telegram_settings import list_polling_telegram_bots
+
+logger = logging.getLogger(__name__)
+
+
+def _redis():
+    from redis import Redis
+
+    s = get_settings()
+    return Redis(host=s.redis_host, port=s.redis_port)
+
+
+# KEYS: lease, offset; ARGV: owner, ttl, offset ('' keeps it). Renews and stores only for the owner.
+_RENEW_LUA = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+  return 0
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+if ARGV[3] ~= '' then
+  redis.call('SET', KEYS[2], ARGV[3])
+end
+return 1
+"""
+
+
+def _renew_lease(renew, lock_key: str, offset_key: str, owner: bytes, ttl: int, offset: int | None = None) -> bool:
+    """Extend the lease and store ``offset`` if this owner still holds it."""
+    return bool(renew(keys=[lock_key, offset_key], args=[owner, ttl, "" if offset is None else int(offset)]))
+
+
+def _hold_lock(r, renew, lock_key: str, offset_key: str, owner: bytes, ttl: int) -> bool:
+    """Renew the lease if this owner holds it, otherwise take it if it is free."""
+    if _renew_lease(renew, lock_key, offset_key, owner, ttl):
+        return True
+    return bool(r.set(lock_key, owner, nx=True, ex=ttl))
+
+
+def poll_bot_once(
+    portal_id: int,
+    kind: str,
+    token: str,
+    offset: int | None,
+    timeout: int,
+    checkpoint: Callable[[int | None], bool] | None = None,
+) -> int | None:
+    """One getUpdates round; returns the offset to confirm on the next call.
+
+    ``checkpoint(offset)`` runs before each update with the offset of the
+    updates handled so far, and once at the end; when it returns False (the
+    lease is lost) the rest of the batch is left to the new holder.
+    """
+    updates, err = telegram_get_updates(token, offset=offset, timeout=timeout)
+    if err:
+        logger.warning("telegram_poll_failed portal_id=%s kind=%s error=%s", portal_id, kind, err)
+        return offset
+    factory = database.get_session_factory()
+    for update in updates or []:
+        if checkpoint is not None and not checkpoint(offset):
+            logger.warning("telegram_poll_lease_lost portal_id=%s kind=%s offset=%s", portal_id, kind, offset)
+            return offset
+        update_id = update.get("update_id")
+        try:
+            with factory() as db:
+                dispatch_telegram_update(db, portal_id, kind, update)
+        except Exception:
+            logger.exception("telegram_poll_update_failed portal_id=%s kind=%s update_id=%s", portal_id, kind, update_id)
+        if isinstance(update_id, int):
+            offset = max(offset or 0, update_id + 1)
+    if checkpoint is not None:
+        checkpoint(offset)
+    return offset
+
+
+def _bot_loop(portal_id: int, kind: str, token: str, stop: threading.Event) -> None:
+    s = get_settings()
+    timeout = max(1, int(s.telegram_polling_timeout_seconds or 50))
+    ttl = timeout + 30
+    lock_key = f"telegram:poll:lock:{portal_id}:{kind}"
+    offset_key = f"telegram:poll:offset:{portal_id}:{kind}"
+    owner = uuid.uuid4().hex.encode()
+    r = renew = None
+    webhook_cleared = False
+    while not stop.is_set():
+        try:
+            if r is None:
+                r = _redis()
+                renew = r.register_script(_RENEW_LUA)
+            if not _hold_lock(r, renew, lock_key, offset_key, owner, ttl):
+                stop.wait(timeout)
+                continue
+            if not webhook_cleared:
+                # getUpdates is rejected while a webhook is set.
+                webhook_cleared, err = telegram_delete_webhook(token)
+                if not webhook_cleared:
+                    logger.warning("telegram_poll_delete_webhook_failed portal_id=%s kind=%s error=%s", portal_id, kind, err)
+                    stop.wait(timeout)
+                    continue
+            raw = r.get(offset_key)
+            offset = int(raw) if raw else None
+            new_offset = poll_bot_once(
+                portal_id,
+                kind,
+                token,
+                offset,
+                timeout,
+                checkpoint=lambda handled: _renew_lease(renew, lock_key, offset_key, owner, ttl, handled),
+            )
+            if new_offset == offset:
+                stop.wait(1)
+        except Exception as e:
+            logger.warning("telegram_poll_loop_error portal_id=%s kind=%s error=%s", portal_id, kind, e)
+            r = renew = None
+            stop.wait(5)
+    try:
+        if r is not None and r.get(lock_key) == owner:
+            r.delete(lock_key)
+    except Exception:
+        pass
+
+
+def run_polling_supervisor(stop_event: threading.Event) -> None:
+    """Start/stop per-bot polling threads as bots are enabled, disabled or re-keyed."""
+    s = get_settings()
+    rescan = max(5, int(s.telegram_polling_rescan_seconds or 60))
+    running: dict[tuple[int, str, str], tuple[threading.Thread, threading.Event]] = {}
+    while not stop_event.is_set():
+        try:
+            with database.get_session_factory()() as db:
+                wanted = set(list_polling_telegram_bots(db))
+        except Exception as e:
+            logger.warning("telegram_poll_scan_failed error=%s", e)
+            wanted = set(running)
+        for key in list(running):
+            thread, stop = running[key]
+            if key not in wanted or not thread.is_alive():
+                stop.set()
+                running.pop(key)
+        for key in wanted - set(running):
+            portal_id, kind, token = key
+            stop = threading.Event()
+            thread = threading.Thread(
+                target=_bot_loop,
+                args=(portal_id, kind, token, stop),
+                name=f"telegram_poll_{portal_id}_{kind}",
+                daemon=True,
+            )
+            thread.start()
+            running[key] = (thread, stop)
+        stop_event.wait(rescan)
+    for _thread, stop in running.values():
+        stop.set()
@@ -42,8 +42,8 @@ def get_portal_telegram_settings(db: Session, portal_id: int) -> dict[str, Any]:
     row = db.get(PortalTelegramSetting, portal_id)
     if not row:
         return {
-            "staff": {"enabled": False, "has_token": False, "token_masked": ""},
-            "client": {"enabled": False, "has_token": False, "token_masked": ""},
+            "staff": {"enabled": False, "has_token": False, "polling": False, "token_masked": ""},
+            "client": {"enabled": False, "has_token": False, "polling": False, "token_masked": ""},
         }
     staff_plain = decrypt_token(row.staff_bot_token_enc or "", _enc_key()) if row.staff_bot_token_enc else ""
     client_plain = decrypt_token(row.client_bot_token_enc or "", _enc_key()) if row.client_bot_token_enc else ""
@@ -52,12 +52,14 @@ def get_portal_telegram_settings(db: Session, portal_id: int) -> dict[str, Any]:
             "enabled": bool(row.staff_bot_enabled),
             "has_token": bool(row.staff_bot_token_enc),
             "allow_uploads": bool(row.staff_allow_uploads),
+            "polling": bool(row.staff_bot_polling),
             "token_masked": mask_token(staff_plain) if staff_plain else "",
         },
         "client": {
             "enabled": bool(row.client_bot_enabled),
             "has_token": bool(row.client_bot_token_enc),
             "allow_uploads": bool(row.client_allow_uploads),
+            "polling": bool(row.client_bot_polling),
             "token_masked": mask_token(client_plain) if client_plain else "",
         },
     }
@@ -95,6 +97,7 @@ def set_portal_telegram_settings(
     enabled: bool | None = None,
     clear_token: bool = False,
     allow_uploads: bool | None = None,
+    polling: bool | None = None,
 ) -> dict[str, Any]:
     row = _get_or_create(db, portal_id)
     enc_key = _enc_key()
@@ -107,6 +110,8 @@ def set_portal_telegram_settings(
             row.staff_bot_enabled = bool(enabled)
         if allow_uploads is not None:
             row.staff_allow_uploads = bool(allow_uploads)
+        if polling is not None:
+            row.staff_bot_polling = bool(polling)
         if (bot_token or row.staff_bot_token_enc) and not row.staff_bot_secret:
             row.staff_bot_secret = secrets.token_hex(16)
     elif kind == "client":
@@ -118,6 +123,8 @@ def set_portal_telegram_settings(
             row.client_bot_enabled = bool(enabled)
         if allow_uploads is not None:
             row.client_allow_uploads = bool(allow_uploads)
+        if polling is not None:
+            row.client_bot_polling = bool(polling)
         if (bot_token or row.client_bot_token_enc) and not row.client_bot_secret:
             row.client_bot_secret = secrets.token_hex(16)
     db.add(row)
@@ -125,5 +132,17 @@ def set_portal_telegram_settings(
     return get_portal_telegram_settings(db, portal_id)
 
 
+def list_polling_telegram_bots(db: Session) -> list[tuple[int, str, str]]:
+    """(portal_id, kind, plain token) for every enabled bot with a token that receives updates by polling."""
+    out: list[tuple[int, str, str]] = []
+    enc = _enc_key()
+    for row in db.query(PortalTelegramSetting).all():
+        if row.staff_bot_enabled and row.staff_bot_polling and row.staff_bot_token_enc:
+            out.append((row.portal_id, "staff", decrypt_token(row.staff_bot_token_enc, enc)))
+        if row.client_bot_enabled and row.client_bot_polling and row.client_bot_token_enc:
+            out.append((row.portal_id, "client", decrypt_token(row.client_bot_token_enc, enc)))
+    return [b for b in out if b[2]]
+
+
 def normalize_telegram_username(username: str | None) -> str | None:
     return _normalize_username(username)
@@ -1,35 +1,218 @@
+"""Background refresh of portal OAuth tokens, ordered by expiry.
+
+Each tick reads only tokens expiring within the refresh window (indexed by
+``portal_tokens.expires_at``), soonest first, and refreshes them in a bounded
+thread pool. Every portal gets a stable jitter inside the window so a burst of
+installs does not expire (and refresh) in lockstep, and a token is refreshed
+once per lifetime rather than on every tick. A Redis lease per portal keeps
+API replicas from refreshing the same portal; the row lock in
+``refresh_portal_tokens`` remains the last line of defence.
+
+Failures back off exponentially (30 s doubling to 15 min). The backoff is
+stored on the token row (``refresh_failures``, ``refresh_retry_at``) and
+filtered in the due query, so portals that keep failing (uninstalled, revoked)
+neither fill the batch ahead of healthy tokens nor lose their backoff on
+restart. Saving new tokens (reinstall) clears it.
+"""
 from __future__ import annotations
 
+import hashlib
 import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
-from sqlalchemy import select
+from sqlalchemy import func, or_, select, update
 
+from apps.backend.config import get_settings
 from apps.backend.database import get_session_factory
-from apps.backend.models.portal import PortalToken
+from apps.backend.models.portal import Portal, PortalToken
 from apps.backend.services.portal_tokens import ensure_fresh_access_token, BitrixAuthError
 
 logger = logging.getLogger(__name__)
 
+_instance_id = uuid.uuid4().hex
+_state_lock = threading.Lock()
+_in_flight: set[int] = set()
+_domain_next: dict[str, float] = {}
+_executor: ThreadPoolExecutor | None = None
+
+
+def _jitter_seconds(portal_id: int, max_jitter: int) -> int:
+    """Stable per-portal offset in [0, max_jitter]."""
+    if max_jitter <= 0:
+        return 0
+    digest = hashlib.sha1(str(portal_id).encode()).digest()
+    return int.from_bytes(digest[:4], "big") % (max_jitter + 1)
+
+
+def refresh_due_at(portal_id: int, expires_at: datetime | None, lead_seconds: int, jitter_seconds: int) -> datetime | None:
+    """When the scheduler should refresh this token (None = immediately)."""
+    if expires_at is None:
+        return None
+    return expires_at - timedelta(seconds=lead_seconds + _jitter_seconds(portal_id, jitter_seconds))
+
+
+def select_due_tokens(db, now: datetime, lead_seconds: int, jitter_seconds: int, limit: int) -> list[tuple[int, str, int]]:
+    """(portal_id, domain, skew seconds) of tokens due for refresh, soonest expiry first."""
+    horizon = now + timedelta(seconds=lead_seconds + jitter_seconds)
+    rows = db.execute(
+        select(PortalToken.portal_id, PortalToken.expires_at, Portal.domain)
+        .join(Portal, Portal.id == PortalToken.portal_id)
+        .where(PortalToken.refresh_token.isnot(None))
+        .where(or_(PortalToken.expires_at.is_(None), PortalToken.expires_at <= horizon))
+        .where(or_(PortalToken.refresh_retry_at.is_(None), PortalToken.refresh_retry_at <= now))
+        .order_by(PortalToken.expires_at.asc().nullsfirst())
+        .limit(limit)
+    ).all()
+    due = []
+    for portal_id, expires_at, domain in rows:
+        at = refresh_due_at(int(portal_id), expires_at, lead_seconds, jitter_seconds)
+        if at is None or at <= now:
+            skew = lead_seconds + _jitter_seconds(int(portal_id), jitter_seconds)
+            due.append((int(portal_id), (domain or "").strip().lower(), skew))
+    return due
+
+
+def _redis():
+    from redis import Redis
+
+    s = get_settings()
+    return Redis(host=s.redis_host, port=s.redis_port)
+
+
+def _acquire_lease(r, portal_id: int, ttl: int) -> bool:
+    if r is None:
+        return True
+    try:
+        return bool(r.set(f"token_refresh:lease:{portal_id}", _instance_id, nx=True, ex=ttl))
+    except Exception:
+        return True
+
+
+def _release_lease(r, portal_id: int) -> None:
+    if r is None:
+        return
+    try:
+        key = f"token_refresh:lease:{portal_id}"
+        if r.get(key) == _instance_id.encode():
+            r.delete(key)
+    except Exception:
+        pass
+
+
+def _wait_domain_slot(domain: str, per_second: float) -> None:
+    if not domain or per_second <= 0:
+        return
+    gap = 1.0 / per_second
+    with _state_lock:
+        now = time.monotonic()
+        slot = max(now, _domain_next.get(domain, 0.0))
+        _domain_next[domain] = slot + gap
+    if slot > now:
+        time.sleep(slot - now)
+
+
+def _record_failure(portal_id: int) -> int:
+    """Bump the failure count on the token row and push its next attempt out; returns attempts."""
+    with get_session_factory()() as db:
+        attempts = int(
+            db.execute(
+                select(func.max(PortalToken.refresh_failures)).where(PortalToken.portal_id == portal_id)
+            ).scalar()
+            or 0
+        ) + 1
+        backoff = min(900, 30 * (2 ** min(attempts - 1, 10)))
+        db.execute(
+            update(PortalToken)
+            .where(PortalToken.portal_id == portal_id)
+            .values(refresh_failures=attempts, refresh_retry_at=datetime.utcnow() + timedelta(seconds=backoff))
+        )
+        db.commit()
+    return attempts
+
+
+def _clear_failures(db, portal_id: int) -> None:
+    db.execute(
+        update(PortalToken)
+        .where(PortalToken.portal_id == portal_id, PortalToken.refresh_failures > 0)
+        .values(refresh_failures=0, refresh_retry_at=None)
+    )
+    db.commit()
+
+
+def _refresh_one(portal_id: int, domain: str, skew_seconds: int, r) -> str:
+    s = get_settings()
+    try:
+        if not _acquire_lease(r, portal_id, max(30, int(s.token_refresh_lease_seconds or 120))):
+            return "leased"
+        try:
+            _wait_domain_slot(domain, float(s.token_refresh_per_domain_rps or 0))
+            with get_session_factory()() as db:
+                # Re-checks expiry on the current row: another replica may have just refreshed it.
+                ensure_fresh_access_token(db, portal_id, skew_seconds=skew_seconds, trace_id="refresh_daemon")
+                _clear_failures(db, portal_id)
+            return "refreshed"
+        finally:
+            _release_lease(r, portal_id)
+    except Exception as e:
+        code = e.code if isinstance(e, BitrixAuthError) else str(e)[:120]
+        try:
+            attempts = _record_failure(portal_id)
+        except Exception:
+            logger.exception("refresh_daemon portal_id=%s backoff not recorded", portal_id)
+            attempts = None
+        logger.warning("refresh_daemon portal_id=%s error=%s attempts=%s", portal_id, code, attempts)
+        return "failed"
+    finally:
+        with _state_lock:
+            _in_flight.discard(portal_id)
+
+
+def _get_executor(workers: int) -> ThreadPoolExecutor:
+    global _executor
+    with _state_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="token_refresh")
+        return _executor
+
+
+def refresh_tokens_once(now: datetime | None = None, wait: bool = False) -> dict[str, int]:
+    """One scheduler tick: submit due tokens to the pool. ``wait`` blocks until they finish."""
+    s = get_settings()
+    now = now or datetime.utcnow()
+    lead = max(0, int(s.token_refresh_lead_seconds or 0))
+    jitter = max(0, int(s.token_refresh_jitter_seconds or 0))
+    with get_session_factory()() as db:
+        due = select_due_tokens(db, now, lead, jitter, max(1, int(s.token_refresh_batch_size or 500)))
+    try:
+        r = _redis()
+        r.ping()
+    except Exception:
+        r = None
+    stats = {"due": len(due), "submitted": 0, "skipped": 0}
+    futures = []
+    executor = _get_executor(int(s.token_refresh_workers or 8))
+    for portal_id, domain, skew in due:
+        with _state_lock:
+            if portal_id in _in_flight:
+                stats["skipped"] += 1
+                continue
+            _in_flight.add(portal_id)
+        futures.append(executor.submit(_refresh_one, portal_id, domain, skew, r))
+        stats["submitted"] += 1
+    if wait:
+        for f in futures:
+            outcome = f.result()
+            stats[outcome] = stats.get(outcome, 0) + 1
+    return stats
+
 
-def refresh_tokens_once(skew_seconds: int = 1800) -> None:
-    factory = get_session_factory()
-    with factory() as db:
-        now = datetime.utcnow()
-        cutoff = now + timedelta(seconds=skew_seconds)
-        rows = db.execute(select(PortalToken.portal_id, PortalToken.expires_at)).all()
-        for portal_id, expires_at in rows:
-            try:
-                if not expires_at or expires_at <= cutoff:
-                    ensure_fresh_access_token(
-                        db,
-                        int(portal_id),
-                        now=now,
-                        skew_seconds=skew_seconds,
-                        trace_id="refresh_daemon",
-                        force=False,
-                    )
-            except BitrixAuthError as e:
-                logger.warning("refresh_daemon portal_id=%s error=%s", portal_id, e.code)
-            except Exception as e:
-                logger.warning("refresh_daemon portal_id=%s error=%s", portal_id, str(e)[:120])
+def shutdown_refresh_pool() -> None:
+    global _executor
+    with _state_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
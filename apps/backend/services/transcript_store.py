@@ -0,0 +1,223 @@
+"""Transcript store: merged transcript + fixed-width offset index for windowed reads.
+
+Layout next to the media file (``<storage_path>`` prefix):
+  .transcript.jsonl         raw segments written by ingest (source of truth)
+  .transcript.merged.jsonl  speaker-merged rows (merge_transcript_items)
+  .transcript.raw.idx       one record per raw row: byte offset, start_ms, end_ms
+  .transcript.merged.idx    same for merged rows
+  .transcript.meta.json     counts, etag and source fingerprint
+
+Index records are fixed-width, so a window read is a binary search plus a seek,
+independent of the recording length.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import struct
+from typing import Any
+
+from apps.backend.services.transcript_utils import merge_transcript_items
+
+STORE_VERSION = 1
+MODES = ("raw", "merged")
+
+_RECORD = struct.Struct("<QII")  # byte offset, start_ms, end_ms
+
+
+def _paths(storage_path: str) -> dict[str, str]:
+    base = storage_path or ""
+    return {
+        "source": base + ".transcript.jsonl",
+        "merged": base + ".transcript.merged.jsonl",
+        "raw_idx": base + ".transcript.raw.idx",
+        "merged_idx": base + ".transcript.merged.idx",
+        "meta": base + ".transcript.meta.json",
+    }
+
+
+def _source_fingerprint(path: str) -> dict[str, int] | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return {"size": int(st.st_size), "mtime_ns": int(st.st_mtime_ns)}
+
+
+def _read_source_rows(path: str) -> list[tuple[int, dict[str, Any]]]:
+    """Return (byte_offset, item) for every non-empty raw row."""
+    out: list[tuple[int, dict[str, Any]]] = []
+    with open(path, "rb") as f:
+        while True:
+            offset = f.tell()
+            line = f.readline()
+            if not line:
+                break
+            try:
+                row = json.loads(line.decode("utf-8", errors="ignore").strip() or "null")
+            except Exception:
+                continue
+            if not isinstance(row, dict):
+                continue
+            text = str(row.get("text") or "").strip()
+            if not text:
+                continue
+            out.append((offset, _raw_item(row, len(out))))
+    return out
+
+
+def _raw_item(row: dict[str, Any], position: int) -> dict[str, Any]:
+    return {
+        "id": -1 - position,  # synthetic id for transcript rows
+        "chunk_index": position,
+        "speaker": (str(row.get("speaker") or "").strip() or "Спикер A"),
+        "text": str(row.get("text") or "").strip(),
+        "start_ms": int(row.get("start_ms") or 0),
+        "end_ms": int(row.get("end_ms") or 0),
+    }
+
+
+def _clamp_ms(value: int) -> int:
+    return max(0, min(int(value or 0), 0xFFFFFFFF))
+
+
+def _write_index(path: str, records: list[tuple[int, int, int]]) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        for offset, start_ms, end_ms in records:
+            f.write(_RECORD.pack(int(offset), _clamp_ms(start_ms), _clamp_ms(end_ms)))
+    os.replace(tmp, path)
+
+
+def build_transcript_store(storage_path: str) -> dict | None:
+    """(Re)build merged transcript and indexes from the raw JSONL. Returns meta."""
+    p = _paths(storage_path)
+    fp = _source_fingerprint(p["source"])
+    if fp is None:
+        return None
+    rows = _read_source_rows(p["source"])
+    raw_records = [(off, it["start_ms"], it["end_ms"]) for off, it in rows]
+    merged = merge_transcript_items([it for _off, it in rows])
+
+    merged_records: list[tuple[int, int, int]] = []
+    tmp_merged = p["merged"] + ".tmp"
+    with open(tmp_merged, "wb") as f:
+        for it in merged:
+            merged_records.append((f.tell(), it["start_ms"], it["end_ms"]))
+            f.write(json.dumps(it, ensure_ascii=False).encode("utf-8") + b"\n")
+    os.replace(tmp_merged, p["merged"])
+    _write_index(p["raw_idx"], raw_records)
+    _write_index(p["merged_idx"], merged_records)
+
+    etag_src = f"{STORE_VERSION}:{fp['size']}:{fp['mtime_ns']}:{len(raw_records)}:{len(merged_records)}"
+    meta = {
+        "version": STORE_VERSION,
+        "raw_count": len(raw_records),
+        "merged_count": len(merged_records),
+        "duration_ms": max((r[2] for r in raw_records), default=0),
+        "etag": hashlib.sha1(etag_src.encode("utf-8")).hexdigest()[:20],
+        "source": fp,
+    }
+    tmp_meta = p["meta"] + ".tmp"
+    with open(tmp_meta, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_meta, p["meta"])
+    return meta
+
+
+def load_meta(storage_path: str, rebuild: bool = True) -> dict | None:
+    """Return store meta, rebuilding when missing or stale against the raw JSONL."""
+    p = _paths(storage_path)
+    meta = None
+    try:
+        with open(p["meta"], "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except Exception:
+        meta = None
+    fp = _source_fingerprint(p["source"])
+    fresh = (
+        isinstance(meta, dict)
+        and meta.get("version") == STORE_VERSION
+        and (fp is None or meta.get("source") == fp)
+    )
+    if fresh:
+        return meta
+    if not rebuild or fp is None:
+        return meta if isinstance(meta, dict) else None
+    return build_transcript_store(storage_path)
+
+
+class _Index:
+    def __init__(self, path: str):
+        self.f = open(path, "rb")
+        self.count = os.fstat(self.f.fileno()).st_size // _RECORD.size
+
+    def close(self) -> None:
+        self.f.close()
+
+    def record(self, i: int) -> tuple[int, int, int]:
+        self.f.seek(i * _RECORD.size)
+        return _RECORD.unpack(self.f.read(_RECORD.size))
+
+    def first_ending_after(self, ms: int) -> int:
+        """Position of the first row whose end_ms >= ms (rows are time-ordered)."""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.record(mid)[2] < ms:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+def read_window(
+    storage_path: str,
+    *,
+    mode: str = "merged",
+    cursor: int = 0,
+    limit: int = 200,
+    from_ms: int | None = None,
+    to_ms: int | None = None,
+    meta: dict | None = None,
+) -> dict:
+    """Read a window of transcript rows by cursor (row number) and/or time range."""
+    mode = mode if mode in MODES else "merged"
+    meta = meta or load_meta(storage_path)
+    if not meta:
+        return {"items": [], "next_cursor": None, "total": 0}
+    p = _paths(storage_path)
+    data_path = p["source"] if mode == "raw" else p["merged"]
+    idx_path = p["raw_idx"] if mode == "raw" else p["merged_idx"]
+    if not os.path.exists(data_path) or not os.path.exists(idx_path):
+        return {"items": [], "next_cursor": None, "total": 0}
+
+    idx = _Index(idx_path)
+    items: list[dict[str, Any]] = []
+    try:
+        pos = max(0, int(cursor or 0))
+        if from_ms is not None:
+            pos = max(pos, idx.first_ending_after(int(from_ms)))
+        end = min(idx.count, pos + max(1, int(limit)))
+        with open(data_path, "rb") as df:
+            while pos < end:
+                offset, start_ms, _end_ms = idx.record(pos)
+                if to_ms is not None and start_ms > int(to_ms):
+                    break
+                df.seek(offset)
+                try:
+                    row = json.loads(df.readline().decode("utf-8", errors="ignore"))
+                except Exception:
+                    row = None
+                if isinstance(row, dict):
+                    items.append(_raw_item(row, pos) if mode == "raw" else row)
+                pos += 1
+        has_more = pos < idx.count and (to_ms is None or idx.record(pos)[1] <= int(to_ms))
+    finally:
+        idx.close()
+    return {
+        "items": items,
+        "next_cursor": pos if has_more else None,
+        "total": int(meta.get(f"{mode}_count") or 0),
+    }
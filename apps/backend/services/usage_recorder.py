@@ -0,0 +1,181 @@
+"""Buffered recording of billing usage and activity rows.
+
+Message handlers used to commit ``billing_usage``, the usage counters and an
+``activity_events`` row separately for every AI call. Now they hand the rows to
+a per-process recorder that writes them in multi-row INSERTs together with
+aggregated counter upserts, in one commit per flush.
+
+Buffering is active while the recorder thread runs (API process) or inside a
+``buffered_recording()`` scope (worker jobs, flushed when the job ends).
+Otherwise, or when the queue is full, rows are written synchronously with a
+single commit. Billing rows are never sampled out.
+
+A failed flush does not drop the batch: it is retried with backoff, then
+written row by row so that only a row the database rejects (logged at error
+level) is lost. Rows that cannot be written because the database is
+unreachable are carried over to the next flush.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Iterator
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.orm import Session
+
+from apps.backend import database
+from apps.backend.config import get_settings
+from apps.backend.models.activity_event import ActivityEvent
+from apps.backend.models.billing import BillingUsage
+from apps.backend.models.portal import Portal
+from apps.backend.services.batch_writer import BatchWriter
+from apps.backend.services.usage_rollup import apply_usage_batch
+
+logger = logging.getLogger(__name__)
+
+# pauses between attempts of a failed batch before it is written row by row
+_RETRY_DELAYS = (0.5, 2.0)
+# the row itself is invalid (e.g. its portal was deleted): another attempt cannot succeed
+_ROW_ERRORS = (IntegrityError, DataError)
+
+
+@dataclass
+class UsageRecord:
+    """One row for ``billing_usage`` (kind="usage") or ``activity_events`` (kind="activity")."""
+
+    kind: str
+    values: dict[str, Any]
+    created_at: datetime = field(default_factory=datetime.utcnow)
+
+
+def write_usage_records(db: Session, records: list[UsageRecord]) -> int:
+    """Insert records and move the usage counters; the caller commits."""
+    usage = [dict(r.values, created_at=r.created_at) for r in records if r.kind == "usage"]
+    activity = [dict(r.values, created_at=r.created_at) for r in records if r.kind == "activity"]
+    if usage:
+        portal_ids = {int(u["portal_id"]) for u in usage}
+        accounts = dict(db.execute(select(Portal.id, Portal.account_id).where(Portal.id.in_(portal_ids))).all())
+        db.execute(insert(BillingUsage), usage)
+        apply_usage_batch(db, [dict(u, account_id=accounts.get(int(u["portal_id"]))) for u in usage])
+    if activity:
+        db.execute(insert(ActivityEvent), activity)
+    return len(usage) + len(activity)
+
+
+class UsageRecorder(BatchWriter[UsageRecord]):
+    """Group-commits usage and activity rows off the request path."""
+
+    name = "usage_recorder"
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._scopes = 0
+        self._carry: list[UsageRecord] = []
+
+    def _commit(self, records: list[UsageRecord]) -> int:
+        with database.get_session_factory()() as db:
+            written = write_usage_records(db, records)
+            db.commit()
+        return written
+
+    def write_batch(self, batch: list[UsageRecord]) -> int:
+        batch, self._carry = self._carry + batch, []
+        for delay in (*_RETRY_DELAYS, None):
+            try:
+                return self._commit(batch)
+            except _ROW_ERRORS:
+                break
+            except Exception as e:
+                if delay is None:
+                    break
+                logger.warning("%s batch failed size=%s error=%s; retrying in %ss", self.name, len(batch), e, delay)
+                time.sleep(delay)
+        return self._write_rows(batch)
+
+    def _write_rows(self, batch: list[UsageRecord]) -> int:
+        written = 0
+        for i, rec in enumerate(batch):
+            try:
+                written += self._commit([rec])
+            except _ROW_ERRORS as e:
+                logger.error("%s row rejected kind=%s values=%s error=%s", self.name, rec.kind, rec.values, e)
+            except Exception as e:
+                # the database is unreachable, not this row: keep the rest for the next flush
+                self._carry = batch[i:]
+                logger.error("%s write failed, %s rows carried over error=%s", self.name, len(self._carry), e)
+                break
+        return written
+
+    def flush(self) -> int:
+        written = super().flush()
+        with self._write_lock:
+            carry, self._carry = self._carry, []
+            written += self._write(carry)
+        return written
+
+    @property
+    def buffering(self) -> bool:
+        return self._scopes > 0 or bool(self._thread and self._thread.is_alive())
+
+    def stats(self) -> dict[str, Any]:
+        out = super().stats()
+        out["scopes"] = self._scopes
+        out["carried"] = len(self._carry)
+        return out
+
+
+_recorder: UsageRecorder | None = None
+_recorder_lock = threading.Lock()
+
+
+def get_usage_recorder() -> UsageRecorder:
+    global _recorder
+    if _recorder is None:
+        with _recorder_lock:
+            if _recorder is None:
+                s = get_settings()
+                _recorder = UsageRecorder(
+                    max_events=s.usage_recorder_queue_max_events,
+                    batch_size=s.usage_recorder_batch_size,
+                    flush_interval=s.usage_recorder_flush_interval_ms / 1000.0,
+                    sample_watermark=1.0,
+                )
+    return _recorder
+
+
+@contextmanager
+def buffered_recording() -> Iterator[UsageRecorder]:
+    """Buffer usage rows for the duration of the block and flush them on exit (worker jobs)."""
+    recorder = get_usage_recorder()
+    with _recorder_lock:
+        recorder._scopes += 1
+    try:
+        yield recorder
+    finally:
+        with _recorder_lock:
+            recorder._scopes -= 1
+        recorder.flush()
+
+
+def record(db: Session, records: list[UsageRecord], *, transactional: bool = False) -> None:
+    """Record rows: in the caller's transaction (``transactional``), through the
+    buffer, or on the caller's session with a single commit."""
+    if not records:
+        return
+    if transactional:
+        write_usage_records(db, records)
+        return
+    recorder = get_usage_recorder()
+    if recorder.buffering:
+        rejected = [r for r in records if not recorder.submit(r, force=True)]
+        if not rejected:
+            return
+        records = rejected
+    write_usage_records(db, records)
+    db.commit()
@@ -0,0 +1,331 @@
+"""Pre-aggregated billing usage: monthly counters and daily rollups.
+
+Usage rows are written together with ``apply_usage_batch`` in one transaction
+(see services.usage_recorder), so counters move atomically with the raw
+``billing_usage`` rows. Limit checks and dashboards read
+counters by primary key. A scope/period without counter rows (usage inserted
+outside ``record_usage``) is seeded from the raw table on first read, and
+``reconcile_usage_counters`` recomputes a month from the raw table and repairs
+any drift.
+"""
+from __future__ import annotations
+
+import logging
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any
+
+from sqlalchemy import case, func, select, text
+from sqlalchemy.orm import Session
+
+from apps.backend.config import get_settings
+from apps.backend.models.billing import BillingUsage, BillingUsageCounter, BillingUsageDaily
+from apps.backend.models.portal import Portal
+
+logger = logging.getLogger(__name__)
+
+_MEASURES = ("requests_ok", "events", "tokens_total", "cost_rub")
+
+
+def period_start(ts: datetime | date | None = None) -> date:
+    ts = ts or datetime.utcnow()
+    return date(ts.year, ts.month, 1)
+
+
+def _period_bounds(start: date) -> tuple[datetime, datetime]:
+    end = date(start.year + (start.month // 12), start.month % 12 + 1, 1)
+    return datetime(start.year, start.month, 1), datetime(end.year, end.month, 1)
+
+
+def _insert(db: Session):
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+
+def _upsert(
+    db: Session,
+    model,
+    keys: dict[str, Any],
+    measures: dict[str, Any],
+    *,
+    add: bool,
+    extra: dict[str, Any] | None = None,
+    only_missing: bool = False,
+) -> None:
+    """INSERT .. ON CONFLICT: add to the stored measures (``add``) or overwrite them."""
+    now = datetime.utcnow()
+    stmt = _insert(db)(model).values(**keys, **measures, **(extra or {}), updated_at=now)
+    if only_missing:
+        db.execute(stmt.on_conflict_do_nothing(index_elements=list(keys)))
+        return
+    if add:
+        update = {c: getattr(model, c) + stmt.excluded[c] for c in measures}
+    else:
+        update = {c: stmt.excluded[c] for c in measures}
+    for c in extra or {}:
+        update[c] = stmt.excluded[c]
+    update["updated_at"] = now
+    db.execute(stmt.on_conflict_do_update(index_elements=list(keys), set_=update))
+
+
+def apply_usage_batch(db: Session, rows: list[dict[str, Any]]) -> None:
+    """Add billing_usage rows (dicts with portal_id, account_id, kind, status,
+    tokens_total, cost_rub, created_at) to the counters, one upsert per key.
+    The caller commits."""
+    counters: dict[tuple, dict[str, Any]] = {}
+    daily: dict[tuple, dict[str, Any]] = {}
+    accounts: dict[tuple, int | None] = {}
+    for row in rows:
+        created_at = row["created_at"]
+        delta = {
+            "requests_ok": 1 if row.get("status") == "ok" else 0,
+            "events": 1,
+            "tokens_total": int(row.get("tokens_total") or 0),
+            "cost_rub": Decimal(str(row.get("cost_rub") or 0)),
+        }
+        period = period_start(created_at)
+        keys = [("portal", int(row["portal_id"]), period, row["kind"])]
+        if row.get("account_id"):
+            keys.append(("account", int(row["account_id"]), period, row["kind"]))
+        for key in keys:
+            acc = counters.setdefault(key, dict.fromkeys(_MEASURES, 0))
+            for c in _MEASURES:
+                acc[c] += delta[c]
+        day_key = (int(row["portal_id"]), created_at.date(), row["kind"])
+        acc = daily.setdefault(day_key, dict.fromkeys(_MEASURES, 0))
+        for c in _MEASURES:
+            acc[c] += delta[c]
+        accounts[day_key] = row.get("account_id")
+    for (scope, scope_id, period, kind), measures in counters.items():
+        _upsert(db, BillingUsageCounter, {"scope": scope, "scope_id": scope_id, "period_start": period, "kind": kind}, measures, add=True)
+    for (portal_id, day, kind), measures in daily.items():
+        _upsert(
+            db,
+            BillingUsageDaily,
+            {"portal_id": portal_id, "day": day, "kind": kind},
+            measures,
+            add=True,
+            extra={"account_id": accounts[(portal_id, day, kind)]},
+        )
+
+
+def apply_usage(
+    db: Session,
+    *,
+    portal_id: int,
+    account_id: int | None,
+    kind: str,
+    status: str,
+    tokens_total: int | None,
+    cost_rub: Decimal | float | None,
+    created_at: datetime,
+) -> None:
+    """Add one billing_usage row to the counters; the caller commits."""
+    apply_usage_batch(db, [{
+        "portal_id": portal_id,
+        "account_id": account_id,
+        "kind": kind,
+        "status": status,
+        "tokens_total": tokens_total,
+        "cost_rub": cost_rub,
+        "created_at": created_at,
+    }])
+
+
+def _raw_measures():
+    return (
+        func.coalesce(func.sum(case((BillingUsage.status == "ok", 1), else_=0)), 0),
+        func.count(BillingUsage.id),
+        func.coalesce(func.sum(BillingUsage.tokens_total), 0),
+        func.coalesce(func.sum(BillingUsage.cost_rub), 0),
+    )
+
+
+def _measure_dict(values) -> dict[str, Any]:
+    requests_ok, events, tokens_total, cost_rub = values
+    return {
+        "requests_ok": int(requests_ok or 0),
+        "events": int(events or 0),
+        "tokens_total": int(tokens_total or 0),
+        "cost_rub": Decimal(str(cost_rub or 0)),
+    }
+
+
+def _seed_scope(db: Session, scope: str, scope_id: int, period: date) -> None:
+    """Build counters for a scope/period that has none yet, from the raw table."""
+    start, end = _period_bounds(period)
+    q = select(BillingUsage.kind, *_raw_measures()).where(
+        BillingUsage.created_at >= start,
+        BillingUsage.created_at < end,
+    )
+    if scope == "account":
+        q = q.join(Portal, Portal.id == BillingUsage.portal_id).where(Portal.account_id == scope_id)
+    else:
+        q = q.where(BillingUsage.portal_id == scope_id)
+    rows = db.execute(q.group_by(BillingUsage.kind)).all()
+    keys = {"scope": scope, "scope_id": scope_id, "period_start": period}
+    if not rows:
+        # Zero "chat" row marks the period as seeded so the next read stays a PK lookup.
+        _upsert(db, BillingUsageCounter, {**keys, "kind": "chat"}, _measure_dict((0, 0, 0, 0)), add=False, only_missing=True)
+    for kind, *values in rows:
+        _upsert(db, BillingUsageCounter, {**keys, "kind": kind}, _measure_dict(values), add=False, only_missing=True)
+    db.commit()
+
+
+def get_usage_counters(db: Session, scope: str, scope_id: int, period: date | None = None) -> dict[str, dict[str, Any]]:
+    """kind -> measures for one scope and month."""
+    period = period or period_start()
+    q = select(BillingUsageCounter).where(
+        BillingUsageCounter.scope == scope,
+        BillingUsageCounter.scope_id == scope_id,
+        BillingUsageCounter.period_start == period,
+    )
+    rows = db.execute(q).scalars().all()
+    if not rows:
+        _seed_scope(db, scope, scope_id, period)
+        rows = db.execute(q).scalars().all()
+    return {r.kind: {c: getattr(r, c) for c in _MEASURES} for r in rows}
+
+
+def get_requests_used(db: Session, scope: str, scope_id: int, period: date | None = None) -> int:
+    """Successful chat requests this month: a single primary-key read."""
+    period = period or period_start()
+    row = db.get(BillingUsageCounter, (scope, scope_id, period, "chat"))
+    if row is None:
+        _seed_scope(db, scope, scope_id, period)
+        row = db.get(BillingUsageCounter, (scope, scope_id, period, "chat"))
+    return int(row.requests_ok or 0) if row else 0
+
+
+def get_usage_totals(db: Session, scope: str, scope_id: int, period: date | None = None) -> dict[str, Any]:
+    counters = get_usage_counters(db, scope, scope_id, period)
+    chat = counters.get("chat") or {}
+    return {
+        "requests_used": int(chat.get("requests_ok") or 0),
+        "tokens_total": sum(int(c.get("tokens_total") or 0) for c in counters.values()),
+        "cost_rub": float(sum(Decimal(str(c.get("cost_rub") or 0)) for c in counters.values())),
+    }
+
+
+def _same(a: dict[str, Any], b: dict[str, Any]) -> bool:
+    for c in _MEASURES:
+        if c == "cost_rub":
+            if round(float(a.get(c) or 0), 6) != round(float(b.get(c) or 0), 6):
+                return False
+        elif int(a.get(c) or 0) != int(b.get(c) or 0):
+            return False
+    return True
+
+
+def reconcile_usage_counters(db: Session, period: date | None = None, *, fix: bool = True) -> dict[str, Any]:
+    """Recompute one month of counters and daily rollups from billing_usage.
+
+    Returns the number of keys checked and every mismatch found. Both sides are
+    read from one snapshot; with ``fix`` the difference is then applied as a
+    delta in a new transaction, so increments made meanwhile are not lost.
+    """
+    period = period or period_start()
+    start, end = _period_bounds(period)
+    db.commit()
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY"))
+    in_period = (BillingUsage.created_at >= start, BillingUsage.created_at < end)
+    day_expr = func.date(BillingUsage.created_at)
+
+    expected: dict[tuple, dict[str, Any]] = {}
+    for portal_id, kind, *values in db.execute(
+        select(BillingUsage.portal_id, BillingUsage.kind, *_raw_measures()).where(*in_period).group_by(BillingUsage.portal_id, BillingUsage.kind)
+    ).all():
+        expected[("counter", "portal", int(portal_id), kind)] = _measure_dict(values)
+    for account_id, kind, *values in db.execute(
+        select(Portal.account_id, BillingUsage.kind, *_raw_measures())
+        .join(Portal, Portal.id == BillingUsage.portal_id)
+        .where(*in_period, Portal.account_id.isnot(None))
+        .group_by(Portal.account_id, BillingUsage.kind)
+    ).all():
+        expected[("counter", "account", int(account_id), kind)] = _measure_dict(values)
+    for portal_id, day, kind, *values in db.execute(
+        select(BillingUsage.portal_id, day_expr, BillingUsage.kind, *_raw_measures()).where(*in_period).group_by(BillingUsage.portal_id, day_expr, BillingUsage.kind)
+    ).all():
+        if isinstance(day, str):
+            day = date.fromisoformat(day)
+        expected[("daily", int(portal_id), day, kind)] = _measure_dict(values)
+
+    actual: dict[tuple, dict[str, Any]] = {}
+    for r in db.execute(select(BillingUsageCounter).where(BillingUsageCounter.period_start == period)).scalars():
+        actual[("counter", r.scope, int(r.scope_id), r.kind)] = {c: getattr(r, c) for c in _MEASURES}
+    for r in db.execute(
+        select(BillingUsageDaily).where(BillingUsageDaily.day >= start.date(), BillingUsageDaily.day < end.date())
+    ).scalars():
+        actual[("daily", int(r.portal_id), r.day, r.kind)] = {c: getattr(r, c) for c in _MEASURES}
+
+    db.commit()
+
+    zero = _measure_dict((0, 0, 0, 0))
+    mismatches = []
+    for key in sorted(set(expected) | set(actual), key=str):
+        want = expected.get(key, zero)
+        have = actual.get(key) or zero
+        if key in actual and _same(want, have):
+            continue
+        mismatches.append({
+            "key": [str(k) for k in key],
+            "expected": {k: str(v) for k, v in want.items()},
+            "actual": {k: str(v) for k, v in actual[key].items()} if key in actual else None,
+        })
+        if not fix:
+            continue
+        delta = {c: Decimal(str(want[c] or 0)) - Decimal(str(have[c] or 0)) for c in _MEASURES}
+        delta = {c: (v if c == "cost_rub" else int(v)) for c, v in delta.items()}
+        if key[0] == "counter":
+            _, scope, scope_id, kind = key
+            _upsert(db, BillingUsageCounter, {"scope": scope, "scope_id": scope_id, "period_start": period, "kind": kind}, delta, add=True)
+        else:
+            _, portal_id, day, kind = key
+            _upsert(db, BillingUsageDaily, {"portal_id": portal_id, "day": day, "kind": kind}, delta, add=True)
+    if fix and mismatches:
+        db.commit()
+    return {
+        "period_start": period.isoformat(),
+        "checked": len(set(expected) | set(actual)),
+        "mismatches": mismatches,
+        "fixed": len(mismatches) if fix else 0,
+    }
+
+
+def run_usage_reconciliation() -> dict[str, Any] | None:
+    """Reconcile the current and the previous month; one replica at a time."""
+    from redis import Redis
+
+    from apps.backend.database import get_session_factory
+
+    s = get_settings()
+    try:
+        r = Redis(host=s.redis_host, port=s.redis_port)
+        if not r.set("billing_usage:reconcile:lock", "1", nx=True, ex=900):
+            return None
+    except Exception:
+        r = None
+    out: dict[str, Any] = {}
+    try:
+        current = period_start()
+        previous = date(current.year - 1, 12, 1) if current.month == 1 else date(current.year, current.month - 1, 1)
+        with get_session_factory()() as db:
+            for period in (previous, current):
+                result = reconcile_usage_counters(db, period)
+                out[period.isoformat()] = {"checked": result["checked"], "fixed": result["fixed"]}
+                if result["mismatches"]:
+                    logger.warning(
+                        "billing_usage_reconcile period=%s mismatches=%s sample=%s",
+                        period.isoformat(), len(result["mismatches"]), result["mismatches"][:3],
+                    )
+        return out
+    finally:
+        if r is not None:
+            try:
+                r.delete("billing_usage:reconcile:lock")
+            except Exception:
+                pass
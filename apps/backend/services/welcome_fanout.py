@@ -0,0 +1,321 @@
+"""Welcome-message fan-out: the bot writes first to allowlisted users.
+
+Recipients go out in Bitrix ``batch`` calls of up to 50 imbot.message.add
+commands, paced per portal across processes (``bitrix_portal_rps``,
+``services/portal_pacing.py``); commands rejected with
+QUERY_LIMIT_EXCEEDED are retried after a pause. After every batch the
+per-recipient log rows are written with one multi-row INSERT and the
+last_welcome_at/hash of delivered users with one UPDATE, together with the
+progress of the run (welcome_fanouts).
+
+Runs are resumable: recipients whose last_welcome_hash matches the current
+text within WELCOME_IDEMPOTENCY_HOURS are skipped, so a retried job or a
+second click sends only to the rest.
+
+Install/provision endpoints create a run and queue it on its own queue
+(``rq_welcome_queue_name``, ``apps.worker.jobs.run_welcome_fanout``) and
+return its progress handle; when the queue is unavailable the run happens
+inline within ``INLINE_TIME_BUDGET_SEC``.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any
+from urllib.parse import urlencode
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+from apps.backend.clients import bitrix as bitrix_client
+from apps.backend.config import get_settings
+from apps.backend.models.portal import Portal, PortalUsersAccess, WelcomeFanout
+from apps.backend.services.bitrix_logging import (
+    build_imbot_message_add_row,
+    log_outbound_prepare_chats,
+    write_http_logs,
+)
+from apps.backend.services.portal_pacing import wait_portal_slot
+from apps.backend.services.portal_tokens import BitrixAuthError, ensure_fresh_access_token
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WELCOME = "Привет! Я Teachbase AI. Напишите «ping» — отвечу «pong»."
+WELCOME_IDEMPOTENCY_HOURS = 24
+# Per-command errors worth another attempt in a later batch.
+_RETRY_ERRORS = {"QUERY_LIMIT_EXCEEDED", bitrix_client.BITRIX_ERR_RATE_LIMITED}
+_MAX_ATTEMPTS = 3
+_RETRY_PAUSE_SEC = 2.0
+# Failed recipients and child trace ids kept on the run and in the prepare_chats log.
+_MAX_KEPT = 500
+_JOB_TIMEOUT_SEC = 1800
+# Inline run inside the request when the queue is down; the rest is reported as ``timeout``.
+INLINE_TIME_BUDGET_SEC = 10
+_SENT_KEYS = ["BOT_ID", "DIALOG_ID", "MESSAGE"]
+
+
+def _welcome_hash(msg: str) -> str:
+    return hashlib.sha256((msg or "").encode("utf-8")).hexdigest()
+
+
+def _child_trace_id(parent_trace_id: str, user_id: int) -> str:
+    return f"{parent_trace_id}-u{user_id}"[:64]
+
+
+def _redis():
+    from redis import Redis
+
+    s = get_settings()
+    return Redis(host=s.redis_host, port=s.redis_port, socket_connect_timeout=0.5, socket_timeout=1.0)
+
+
+def create_fanout(
+    db: Session,
+    *,
+    portal_id: int,
+    bot_id: int,
+    user_ids: list[int],
+    trace_id: str,
+    welcome_message: str | None = None,
+) -> WelcomeFanout:
+    msg = (welcome_message or "").strip() or DEFAULT_WELCOME
+    recipients = list(dict.fromkeys(int(u) for u in user_ids))
+    fanout = WelcomeFanout(
+        portal_id=int(portal_id),
+        trace_id=trace_id,
+        bot_id=int(bot_id),
+        status="queued",
+        message=msg,
+        welcome_hash=_welcome_hash(msg),
+        recipients_json=json.dumps(recipients),
+        total=len(recipients),
+        sent=0,
+        skipped=0,
+        failed=0,
+        http_calls=0,
+    )
+    db.add(fanout)
+    db.commit()
+    return fanout
+
+
+def enqueue_fanout(db: Session, fanout: WelcomeFanout, *, domain: str | None = None, access_token: str | None = None) -> dict[str, Any]:
+    """Queue the run and return its progress handle; runs inline if the queue is unavailable."""
+    try:
+        from rq import Queue
+
+        s = get_settings()
+        q = Queue(s.rq_welcome_queue_name or "welcome", connection=_redis())
+        q.enqueue("apps.worker.jobs.run_welcome_fanout", int(fanout.id), job_timeout=_JOB_TIMEOUT_SEC)
+    except Exception as e:
+        logger.warning("welcome_fanout enqueue failed fanout_id=%s error=%s; running inline", fanout.id, str(e)[:120])
+        run_fanout(db, int(fanout.id), domain=domain, access_token=access_token, time_budget_sec=INLINE_TIME_BUDGET_SEC)
+    return fanout_status(db, int(fanout.id))
+
+
+def _outcome(uid: int, ok: bool, code: str, trace_id_child: str | None, err: str | None = None, desc: str | None = None) -> dict[str, Any]:
+    return {
+        "user_id": uid,
+        "ok": ok,
+        "code": code,
+        "bitrix_error_code": err,
+        "bitrix_error_desc": (desc or "")[:200] if err else None,
+        "trace_id_child": trace_id_child,
+    }
+
+
+def run_fanout(
+    db: Session,
+    fanout_id: int,
+    *,
+    domain: str | None = None,
+    access_token: str | None = None,
+    time_budget_sec: float | None = None,
+) -> dict[str, Any]:
+    """Send the run's pending welcomes; returns ``{status, total, ok, failed, child_trace_ids}``.
+
+    With ``time_budget_sec`` recipients left when the budget runs out are
+    reported with code ``timeout`` (the synchronous admin path and the inline
+    fallback of ``enqueue_fanout``).
+    """
+    fanout = db.get(WelcomeFanout, int(fanout_id))
+    if fanout is None:
+        return {"status": "error", "total": 0, "ok": 0, "failed": [], "child_trace_ids": [], "error": "fanout_not_found"}
+    if fanout.finished_at is not None:
+        return _result(fanout)
+    portal_id = int(fanout.portal_id)
+    recipients = [int(u) for u in json.loads(fanout.recipients_json or "[]")]
+
+    portal = db.get(Portal, portal_id)
+    domain_raw = (domain or (portal.domain if portal else "") or "").strip()
+    error = None
+    if not domain_raw:
+        error = "portal_no_domain"
+    elif not access_token:
+        try:
+            access_token = ensure_fresh_access_token(db, portal_id, trace_id=fanout.trace_id)
+        except BitrixAuthError as e:
+            error = e.code
+    if error:
+        fanout.status = "error"
+        fanout.error = error
+        fanout.failed = len(recipients)
+        fanout.failed_json = json.dumps([_outcome(u, False, error, None) for u in recipients[:_MAX_KEPT]])
+        fanout.finished_at = datetime.utcnow()
+        db.commit()
+        return _result(fanout)
+    domain_full = domain_raw if domain_raw.startswith("http") else f"https://{domain_raw}"
+
+    fanout.status = "running"
+    fanout.started_at = fanout.started_at or datetime.utcnow()
+    db.commit()
+
+    cutoff = datetime.utcnow() - timedelta(hours=WELCOME_IDEMPOTENCY_HOURS)
+    welcomed = set(
+        db.execute(
+            select(PortalUsersAccess.user_id).where(
+                PortalUsersAccess.portal_id == portal_id,
+                PortalUsersAccess.last_welcome_hash == fanout.welcome_hash,
+                PortalUsersAccess.last_welcome_at >= cutoff,
+            )
+        ).scalars()
+    )
+    pending = [u for u in recipients if str(u) not in welcomed]
+    # a resumed run starts over on what is left: earlier deliveries count as skipped
+    fanout.skipped = len(recipients) - len(pending)
+    fanout.sent = fanout.failed = 0
+    failed: list[dict[str, Any]] = []
+    attempts: dict[int, int] = {}
+    started = time.monotonic()
+
+    while pending:
+        if time_budget_sec is not None and time.monotonic() - started > time_budget_sec:
+            failed.extend(_outcome(u, False, "timeout", None) for u in pending)
+            fanout.failed += len(pending)
+            break
+        chunk, pending = pending[:bitrix_client.BITRIX_BATCH_MAX_COMMANDS], pending[bitrix_client.BITRIX_BATCH_MAX_COMMANDS:]
+        commands = {
+            f"u{uid}": "imbot.message.add?" + urlencode({"BOT_ID": fanout.bot_id, "DIALOG_ID": uid, "MESSAGE": fanout.message})
+            for uid in chunk
+        }
+        wait_portal_slot(portal_id)
+        t0 = time.perf_counter()
+        results, errors, batch_err, batch_desc = bitrix_client.rest_batch(domain_full, access_token, commands)
+        latency_ms = int((time.perf_counter() - t0) * 1000)
+        fanout.http_calls += 1
+
+        log_rows: list[dict[str, Any]] = []
+        delivered: list[str] = []
+        retry: list[int] = []
+        for uid in chunk:
+            key = f"u{uid}"
+            child_tid = _child_trace_id(fanout.trace_id, uid)
+            if batch_err:
+                err, desc = batch_err, batch_desc
+            elif key in errors:
+                cmd_err = errors[key] if isinstance(errors[key], dict) else {}
+                err = str(cmd_err.get("error") or "message_add_failed")
+                desc = str(cmd_err.get("error_description") or "")
+            elif results.get(key):
+                err, desc = None, ""
+            else:
+                err, desc = "message_add_failed", ""
+            log_rows.append(
+                build_imbot_message_add_row(
+                    child_tid,
+                    portal_id,
+                    uid,
+                    str(uid),
+                    200 if not err else 400,
+                    latency_ms,
+                    bitrix_error_code=err,
+                    bitrix_error_desc=(desc or None) if err else None,
+                    sent_keys=_SENT_KEYS,
+                )
+            )
+            if not err:
+                delivered.append(str(uid))
+            elif err in _RETRY_ERRORS and attempts.get(uid, 0) + 1 < _MAX_ATTEMPTS:
+                attempts[uid] = attempts.get(uid, 0) + 1
+                retry.append(uid)
+            else:
+                failed.append(_outcome(uid, False, err, child_tid, err, desc))
+                fanout.failed += 1
+
+        if delivered:
+            db.execute(
+                update(PortalUsersAccess)
+                .where(PortalUsersAccess.portal_id == portal_id, PortalUsersAccess.user_id.in_(delivered))
+                .values(last_welcome_at=datetime.utcnow(), last_welcome_hash=fanout.welcome_hash)
+            )
+            fanout.sent += len(delivered)
+        fanout.failed_json = json.dumps(failed[:_MAX_KEPT], ensure_ascii=False)
+        write_http_logs(db, log_rows)  # commits the progress and welcome marks with the log rows
+
+        if batch_err and batch_err not in _RETRY_ERRORS:
+            # auth/transport failure: every remaining recipient would fail the same way
+            failed.extend(_outcome(u, False, batch_err, None, batch_err, batch_desc) for u in pending)
+            fanout.failed += len(pending)
+            pending = []
+        elif retry:
+            time.sleep(_RETRY_PAUSE_SEC)
+            pending.extend(retry)
+
+    fanout.status = "ok" if not fanout.failed else "partial_fail"
+    fanout.failed_json = json.dumps(failed[:_MAX_KEPT], ensure_ascii=False)
+    fanout.finished_at = datetime.utcnow()
+    db.commit()
+    result = _result(fanout)
+    log_outbound_prepare_chats(
+        db,
+        fanout.trace_id,
+        portal_id,
+        status=result["status"],
+        total=result["total"],
+        ok_count=result["ok"],
+        failed=result["failed"],
+        latency_ms=int((time.monotonic() - started) * 1000),
+        child_trace_ids=result["child_trace_ids"],
+    )
+    logger.info(
+        "welcome_fanout done fanout_id=%s portal_id=%s total=%s sent=%s skipped=%s failed=%s http_calls=%s",
+        fanout.id, portal_id, fanout.total, fanout.sent, fanout.skipped, fanout.failed, fanout.http_calls,
+    )
+    return result
+
+
+def _result(fanout: WelcomeFanout) -> dict[str, Any]:
+    recipients = json.loads(fanout.recipients_json or "[]")
+    return {
+        "status": fanout.status,
+        "total": int(fanout.total or 0),
+        "ok": int(fanout.sent or 0) + int(fanout.skipped or 0),
+        "failed": json.loads(fanout.failed_json or "[]"),
+        "child_trace_ids": [_child_trace_id(fanout.trace_id, int(u)) for u in recipients[:_MAX_KEPT]],
+        "fanout_id": int(fanout.id),
+    }
+
+
+def fanout_status(db: Session, fanout_id: int) -> dict[str, Any]:
+    fanout = db.get(WelcomeFanout, int(fanout_id))
+    if fanout is None:
+        return {"id": int(fanout_id), "status": "not_found", "done": True}
+    return {
+        "id": int(fanout.id),
+        "portal_id": int(fanout.portal_id),
+        "trace_id": fanout.trace_id,
+        "status": fanout.status,
+        "done": fanout.finished_at is not None,
+        "total": int(fanout.total or 0),
+        "sent": int(fanout.sent or 0),
+        "skipped": int(fanout.skipped or 0),
+        "failed_count": int(fanout.failed or 0),
+        "http_calls": int(fanout.http_calls or 0),
+        "failed": json.loads(fanout.failed_json or "[]"),
+        "error": fanout.error,
+        "created_at": fanout.created_at.isoformat() if fanout.created_at else None,
+        "finished_at": fanout.finished_at.isoformat() if fanout.finished_at else None,
+    }
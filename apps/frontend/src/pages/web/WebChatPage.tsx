@@ -878,6 +878,7 @@ export function WebChatPage() {
 
   const timelineEndRef = useRef<HTMLDivElement | null>(null);
   const mediaRef = useRef<HTMLVideoElement | HTMLAudioElement | null>(null);
+  const previewPdfPollRef = useRef<number | null>(null);
   const pendingSeekMsRef = useRef<number | null>(null);
   const pendingSeekRetryRef = useRef<number | null>(null);
   const sendQueueRef = useRef<Array<{ threadId: string; query: string }>>([]);
@@ -1078,6 +1079,7 @@ export function WebChatPage() {
   };
 
   const closePreview = () => {
+    previewPdfPollRef.current = null;
     setPreviewSource(null);
     setPreviewUrl(null);
     setPreviewPdfUrl(null);
@@ -1121,7 +1123,25 @@ export function WebChatPage() {
     setQueuedCount(0);
   };
 
+  const pollPreviewPdf = async (pid: number, fileId: number, delayMs: number) => {
+    // PDF rendition renders in the background; poll until it is ready or the preview switches.
+    previewPdfPollRef.current = fileId;
+    for (let attempt = 0; attempt < 40; attempt += 1) {
+      await new Promise((resolve) => window.setTimeout(resolve, Math.max(500, delayMs)));
+      if (previewPdfPollRef.current !== fileId) return;
+      const res = await fetchPortal(`/api/v1/bitrix/portals/${pid}/kb/files/${fileId}/signed-url?inline=1&rendition=preview_pdf`);
+      const data = await res.json().catch(() => null);
+      if (previewPdfPollRef.current !== fileId) return;
+      if (res.ok && data?.url) {
+        setPreviewPdfUrl(String(data.url));
+        return;
+      }
+      if (res.status !== 202) return;
+    }
+  };
+
   const openSourcePreview = async (src: ChatSource, focusText?: string) => {
+    previewPdfPollRef.current = null;
     setPreviewSource(src);
     setPreviewChunks([]);
     const anchorKind = String(src.anchor_kind || "").toLowerCase();
@@ -1165,6 +1185,7 @@ export function WebChatPage() {
       const ppr = await fetchPortal(`/api/v1/bitrix/portals/${portalId}/kb/files/${src.file_id}/signed-url?inline=1&rendition=preview_pdf`);
       const ppd = await ppr.json().catch(() => null);
       if (ppr.ok && ppd?.url) setPreviewPdfUrl(String(ppd.url));
+      else if (ppr.status === 202 && ppd?.status === "pending") void pollPreviewPdf(portalId, Number(src.file_id), Number(ppd.retry_after_ms || 1500));
 
       const dr = await fetchPortal(`/api/v1/bitrix/portals/${portalId}/kb/files/${src.file_id}/signed-url?inline=0`);
       const dd = await dr.json().catch(() => null);
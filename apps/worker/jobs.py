@@ -1,165 +1,52 @@
 """RQ jobs."""
 import json
 import logging
-from datetime import timedelta
+from datetime import datetime, timedelta
 from sqlalchemy import select
 
-logger = logging.getLogger(__name__)
-
+from apps.backend.services.metrics import flushes, timed
 
-def _split_message(text: str, limit: int = 3000) -> list[str]:
-    t = (text or "").strip()
-    if not t:
-        return []
-    if len(t) <= limit:
-        return [t]
-    parts: list[str] = []
-    buf: list[str] = []
-    size = 0
-    for para in t.split("\n"):
-        chunk = (para.strip() + "\n").strip()
-        if not chunk:
-            continue
-        if size + len(chunk) + 1 > limit and buf:
-            parts.append("\n".join(buf).strip())
-            buf = []
-            size = 0
-        if len(chunk) > limit:
-            for i in range(0, len(chunk), limit):
-                parts.append(chunk[i:i + limit])
-            continue
-        buf.append(chunk)
-        size += len(chunk) + 1
-    if buf:
-        parts.append("\n".join(buf).strip())
-    return parts or [t[:limit]]
+logger = logging.getLogger(__name__)
 
 
+@flushes
+@timed("outbox_send_seconds", outcome=lambda ok: None if ok else "failed")
 def process_outbox(outbox_id: int) -> bool:
-    """Отправка сообщения через Bitrix API."""
+    """Отправка outbox: джоба забирает пачку ожидающих строк (не только свою) и рассылает её."""
     from apps.backend.database import get_session_factory
-    from apps.backend.models.outbox import Outbox
-    from apps.backend.clients.bitrix import im_message_add, imbot_message_add
-    from apps.backend.services.portal_tokens import ensure_fresh_access_token, BitrixAuthError
-    from apps.backend.config import get_settings
-    from apps.backend.clients.telegram import telegram_send_message
-    from apps.backend.services.telegram_settings import get_portal_telegram_token_plain
+    from apps.backend.services.outbox_dispatcher import dispatch
 
     factory = get_session_factory()
     with factory() as db:
-        o = db.get(Outbox, outbox_id)
-        if not o or o.status != "created":
-            return False
-        payload = json.loads(o.payload_json or "{}")
-        provider = payload.get("provider") or "bitrix"
-        if provider == "telegram":
-            chat_id = payload.get("chat_id")
-            body = payload.get("body")
-            kind = payload.get("kind") or "staff"
-            if not chat_id or not body:
-                o.status = "error"
-                o.error_message = "Missing chat_id or body"
-                db.commit()
-                return False
-            token = get_portal_telegram_token_plain(db, o.portal_id, kind)
-            if not token:
-                o.status = "error"
-                o.error_message = "Missing telegram token"
-                db.commit()
-                return False
-            parts = _split_message(body, limit=3500)
-            ok = True
-            err = None
-            for part in parts:
-                ok, err = telegram_send_message(token, chat_id, part)
-                if not ok:
-                    break
-            if ok:
-                from datetime import datetime
-                o.status = "sent"
-                o.sent_at = datetime.utcnow()
-            else:
-                o.status = "error"
-                o.error_message = (err or "send_failed")[:200]
-                o.retry_count = (o.retry_count or 0) + 1
-            db.commit()
-            return ok
-        dialog_id = payload.get("dialog_id")
-        body = payload.get("body")
-        domain = payload.get("domain")
-        access_token_payload = payload.get("access_token")
-        app_token = payload.get("app_token")
-        bot_id = payload.get("bot_id", 0)
-        if not dialog_id or not body:
-            o.status = "error"
-            o.error_message = "Missing dialog_id or body"
-            db.commit()
-            return False
-        access_token = access_token_payload or app_token
-        if not access_token and o.portal_id:
-            try:
-                access_token = ensure_fresh_access_token(db, o.portal_id)
-            except BitrixAuthError as e:
-                access_token = None
-                o.status = "error"
-                o.error_message = f"auth_error:{e.code}"
-                db.commit()
-                return False
-        if not domain and o.portal_id:
-            from apps.backend.models.portal import Portal
-            p = db.get(Portal, o.portal_id)
-            if p:
-                domain = p.domain
-        if not access_token or not domain:
-            o.status = "error"
-            o.error_message = "No token or domain"
-            db.commit()
-            return False
-        domain_clean = domain.replace("https://", "").replace("http://", "").rstrip("/")
-        domain_full = f"https://{domain_clean}"
-        import time
-        trace_id = payload.get("trace_id", "")
-        t0 = time.perf_counter()
-        parts = _split_message(body, limit=3000)
-        ok = True
-        err = None
-        err_desc = ""
-        rest_method = "imbot.message.add" if bot_id else "im.message.add"
-        for part in parts:
-            if bot_id and access_token:
-                ok, err, err_desc = imbot_message_add(domain_full, access_token, int(bot_id), dialog_id, part)
-            else:
-                ok = im_message_add(domain_full, access_token, dialog_id, part)
-                err = None if ok else "send_failed"
-                err_desc = ""
-            if not ok:
-                break
-        latency_ms = int((time.perf_counter() - t0) * 1000)
-        if trace_id:
-            try:
-                from apps.backend.services.bitrix_logging import log_outbound
-                log_outbound(db, trace_id, o.portal_id, "POST", rest_method, 200 if ok else 500, latency_ms)
-            except Exception:
-                pass
-        if ok:
-            from datetime import datetime
-            o.status = "sent"
-            o.sent_at = datetime.utcnow()
-        else:
-            o.status = "error"
-            if bot_id and app_token:
-                o.error_message = f"Bitrix API failed: {err or 'unknown'}"
-                if err_desc:
-                    o.error_message = (o.error_message + f" ({err_desc})")[:200]
-            else:
-                o.error_message = "Bitrix API failed"
-            o.retry_count = (o.retry_count or 0) + 1
-        db.commit()
-    return ok
+        result = dispatch(db)
+    if result["claimed"]:
+        logger.info("process_outbox outbox_id=%s %s", outbox_id, result)
+    if result["more"]:
+        # budget spent with rows still pending: their own jobs may already have run
+        try:
+            from redis import Redis
+            from rq import Queue
+            from apps.backend.config import get_settings
+
+            s = get_settings()
+            q = Queue(s.rq_outbox_queue_name or "outbox", connection=Redis(host=s.redis_host, port=s.redis_port))
+            q.enqueue("apps.worker.jobs.process_outbox", outbox_id)
+        except Exception:
+            logger.exception("process_outbox requeue failed outbox_id=%s", outbox_id)
+    return not result["failed"]
 
 
+@flushes
 def process_kb_job(job_id: int) -> bool:
     """Process KB job (ingest/source) with safe lifecycle and dedup."""
+    from apps.backend.services.usage_recorder import buffered_recording
+
+    # Embedding usage rows are group-committed and flushed when the job ends.
+    with buffered_recording():
+        return _process_kb_job(job_id)
+
+
+def _process_kb_job(job_id: int) -> bool:
     from apps.backend.database import get_session_factory
     from apps.backend.models.kb import KBJob
     from apps.backend.models.outbox import Outbox
@@ -313,3 +200,97 @@ def process_kb_job(job_id: int) -> bool:
                 pass
             return False
 
+
+
+@flushes
+def render_kb_preview(file_id: int) -> bool:
+    """Render KB preview PDF into the content-addressed cache (preview queue)."""
+    from apps.backend.database import get_session_factory
+    from apps.backend.models.kb import KBFile
+    from apps.backend.services.kb_preview import release_inflight, render_preview
+
+    factory = get_session_factory()
+    with factory() as db:
+        rec = db.get(KBFile, file_id)
+        sha = rec.sha256 if rec else None
+        try:
+            result = render_preview(db, file_id)
+        except Exception:
+            logger.exception("render_kb_preview_failed file_id=%s", file_id)
+            release_inflight(sha)
+            return False
+        # render_preview may have backfilled sha256 for legacy rows.
+        sha = rec.sha256 if rec else None
+        if result.get("error") == "busy":
+            # All renderer slots are taken: retry later, keep the single-flight marker.
+            try:
+                from redis import Redis
+                from rq import Queue
+                from apps.backend.config import get_settings
+                s = get_settings()
+                r = Redis(host=s.redis_host, port=s.redis_port)
+                q = Queue(s.rq_preview_queue_name or "preview", connection=r)
+                q.enqueue_in(
+                    timedelta(seconds=int(result.get("retry_in") or 15)),
+                    "apps.worker.jobs.render_kb_preview",
+                    file_id,
+                    job_id=f"kbpreview:{sha}",
+                )
+                return False
+            except Exception:
+                pass
+        release_inflight(sha)
+        return bool(result.get("ok"))
+
+
+@flushes
+def sync_bitrix_users(portal_id: int, account_id: int, integration_id: int, mode: str = "full") -> bool:
+    """Bitrix user directory sync in the background (progress in portal_user_syncs)."""
+    from apps.backend.database import get_session_factory
+    from apps.backend.models.portal import Portal
+    from apps.backend.services.bitrix_user_sync import UserSyncError, _state, sync_portal_users
+    from apps.backend.services.portal_tokens import BitrixAuthError, get_valid_access_token
+
+    factory = get_session_factory()
+    with factory() as db:
+        portal = db.get(Portal, portal_id)
+        access_token, error = "", None
+        if not portal or not portal.domain:
+            error = "portal_not_found"
+        else:
+            try:
+                access_token = get_valid_access_token(db, portal_id)
+            except BitrixAuthError as e:
+                error = e.code
+        if error:
+            state = _state(db, portal_id)
+            state.status = "error"
+            state.error = error
+            state.finished_at = datetime.utcnow()
+            db.commit()
+            return False
+        try:
+            sync_portal_users(
+                db,
+                portal_id=portal_id,
+                domain=portal.domain,
+                access_token=access_token,
+                account_id=account_id,
+                integration_id=integration_id,
+                mode=mode,
+            )
+        except UserSyncError:
+            return False
+        return True
+
+
+@flushes
+def run_welcome_fanout(fanout_id: int) -> bool:
+    """Welcome-message fan-out in the background (progress in welcome_fanouts)."""
+    from apps.backend.database import get_session_factory
+    from apps.backend.services.welcome_fanout import run_fanout
+
+    factory = get_session_factory()
+    with factory() as db:
+        result = run_fanout(db, fanout_id)
+        return result.get("status") == "ok"
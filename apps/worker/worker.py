@@ -0,0 +1,13 @@
+"""RQ worker that preloads the application before forking job work horses.
+
+Usage: ``rq worker --worker-class apps.worker.worker.PreloadWorker <queues>``.
+"""
+from rq import Worker
+
+from apps.backend.services.startup import preload
+
+
+class PreloadWorker(Worker):
+    def work(self, *args, **kwargs):
+        preload()
+        return super().work(*args, **kwargs)
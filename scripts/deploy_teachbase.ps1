@@ -119,7 +119,7 @@ if [ "$($FullBuild.IsPresent)" = "True" ]; then
   docker compose -f docker-compose.prod.yml build
 else
   echo "Build mode: fast (skip worker-ingest rebuild)"
-  docker compose -f docker-compose.prod.yml build backend frontend migrator worker-outbox
+  docker compose -f docker-compose.prod.yml build backend frontend migrator worker-outbox worker-welcome
 fi
 docker compose -f docker-compose.prod.yml up -d --scale worker-ingest=$IngestWorkers --scale worker-outbox=$OutboxWorkers
 docker compose -f docker-compose.prod.yml restart nginx
@@ -1,6 +1,9 @@
 """Admin trace timeline endpoint tests."""
 
+import contextvars
 import json
+from datetime import datetime, timedelta
+
 import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy.orm import sessionmaker
@@ -13,6 +16,8 @@ from apps.backend.models.portal import Portal
 from apps.backend.models.bitrix_log import BitrixHttpLog
 from apps.backend.models.bitrix_inbound_event import BitrixInboundEvent
 from apps.backend.models.outbox import Outbox
+from apps.backend.models.kb import KBJob
+from apps.backend.middleware.trace_id import ensure_trace_id
 
 client = TestClient(app)
 
@@ -142,3 +147,48 @@ def test_trace_detail_exposes_request_and_response_json(test_db_session, overrid
     assert data["items"][0]["request_json"]["portal_id"] == 18
     assert data["items"][0]["response_json"]["code"] == "forbidden"
     assert data["items"][0]["headers_min"]["content_type"] == "application/json"
+
+
+@pytest.mark.timeout(10)
+def test_trace_timeline_uses_indexed_trace_columns(test_db_session, override_get_db):
+    portal = Portal(domain="timeline2.bitrix24.ru", status="active")
+    test_db_session.add(portal)
+    test_db_session.commit()
+    trace_id = "trace-timeline-old"
+    old = datetime.utcnow() - timedelta(days=20)
+
+    test_db_session.add(
+        Outbox(
+            portal_id=portal.id,
+            status="sent",
+            payload_json=json.dumps({"trace_id": trace_id, "kind": "bitrix_send"}),
+            created_at=old,
+        )
+    )
+    test_db_session.add_all(
+        [Outbox(portal_id=portal.id, status="sent", payload_json=json.dumps({"trace_id": f"other-{i}"})) for i in range(1100)]
+    )
+
+    def _in_request():
+        ensure_trace_id({"trace_id": trace_id})
+        test_db_session.add(KBJob(portal_id=portal.id, job_type="ingest", status="queued", created_at=old + timedelta(seconds=1)))
+        test_db_session.commit()
+
+    contextvars.copy_context().run(_in_request)
+    outside = KBJob(portal_id=portal.id, job_type="ingest", status="queued")
+    test_db_session.add(outside)
+    test_db_session.commit()
+    assert outside.trace_id is None
+
+    app.dependency_overrides[get_db] = override_get_db
+    try:
+        admin_token = create_access_token({"sub": "admin"})
+        r = client.get(
+            f"/v1/admin/traces/{trace_id}/timeline",
+            headers={"Authorization": f"Bearer {admin_token}"},
+        )
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+
+    assert r.status_code == 200
+    assert [x["source"] for x in r.json()["items"]] == ["outbox", "kb_job"]
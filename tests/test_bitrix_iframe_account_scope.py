@@ -30,6 +30,7 @@ from apps.backend.models.portal_kb_setting import PortalKBSetting
 from apps.backend.models.topic_summary import PortalTopicSummary, AccountTopicSummary
 from apps.backend.routers import bitrix as bitrix_router
 from apps.backend.routers import bitrix_dialogs as bitrix_dialogs_router
+from apps.backend.services.kb_file_profiles import refresh_file_profile
 
 client = TestClient(app)
 
@@ -677,6 +678,8 @@ def test_bitrix_topics_are_account_scoped_from_second_portal(test_db_session):
             created_at=datetime.utcnow(),
         )
     )
+    test_db_session.flush()
+    refresh_file_profile(test_db_session, file_rec)  # as ingest does
     test_db_session.commit()
 
     app.dependency_overrides[get_db] = _override_get_db(test_db_session)
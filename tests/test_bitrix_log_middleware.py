@@ -0,0 +1,170 @@
+"""Pure ASGI Bitrix log middleware: capture, sampling, batched write, overhead."""
+import asyncio
+import json
+import time
+from unittest.mock import patch
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import sessionmaker
+
+from apps.backend.config import get_settings
+from apps.backend.database import Base, get_test_engine
+from apps.backend.middleware.bitrix_log import BitrixLogMiddleware
+from apps.backend.models.bitrix_log import BitrixHttpLog
+from apps.backend.services.http_log_writer import HttpLogRecord, HttpLogWriter, _row_for
+
+
+@pytest.fixture
+def writer(monkeypatch):
+    w = HttpLogWriter(max_events=1000)
+    monkeypatch.setattr("apps.backend.middleware.bitrix_log.get_http_log_writer", lambda: w)
+    return w
+
+
+def _app() -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/v1/bitrix/echo")
+    async def echo(request: Request):
+        body = await request.json()
+        return {"got": body.get("x"), "trace_id": request.state.trace_id, "access_token": "secret-value"}
+
+    @app.get("/v1/bitrix/fail")
+    async def fail():
+        return JSONResponse({"error": "bad"}, status_code=502)
+
+    @app.get("/v1/bitrix/stream")
+    async def stream():
+        async def gen():
+            for i in range(3):
+                yield f"chunk{i};".encode()
+
+        return StreamingResponse(gen(), media_type="text/plain")
+
+    @app.get("/health")
+    async def health():
+        return {"ok": True}
+
+    app.add_middleware(BitrixLogMiddleware)
+    return app
+
+
+def test_request_body_reaches_handler_and_flush_masks(writer, monkeypatch):
+    monkeypatch.setattr(get_settings(), "bitrix_http_log_sample_rate", 1.0)
+    client = TestClient(_app())
+    r = client.post("/v1/bitrix/echo?DOMAIN=a&lang=ru", json={"x": 1, "data": {"refresh_token": "r"}})
+    assert r.status_code == 200
+    assert r.json()["got"] == 1
+    assert r.json()["trace_id"]
+    client.get("/health")
+    assert writer.stats()["queued"] == 1
+
+    engine = get_test_engine()
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine)
+    with patch("apps.backend.database.get_session_factory", return_value=factory):
+        assert writer.flush() == 1
+    db = factory()
+    try:
+        row = db.query(BitrixHttpLog).one()
+        summary = json.loads(row.summary_json)
+        assert row.trace_id == r.json()["trace_id"]
+        assert row.status_code == 200
+        assert summary["query_keys"] == ["DOMAIN", "lang"]
+        assert summary["request_json"]["data"]["refresh_token"] == "[MASKED]"
+        assert summary["response_json"]["access_token"] == "[MASKED]"
+        assert summary["response_json"]["got"] == 1
+    finally:
+        db.close()
+
+
+def test_errors_logged_successes_sampled_out(writer, monkeypatch):
+    monkeypatch.setattr(get_settings(), "bitrix_http_log_sample_rate", 0.0)
+    client = TestClient(_app())
+    for _ in range(5):
+        assert client.post("/v1/bitrix/echo", json={"x": 2}).status_code == 200
+    assert client.get("/v1/bitrix/fail").status_code == 502
+    assert writer.stats()["queued"] == 1
+    rec = writer._q.get_nowait()
+    assert rec.status_code == 502
+    assert rec.path == "/v1/bitrix/fail"
+
+
+def test_streaming_response_passes_through_with_bounded_capture(writer, monkeypatch):
+    monkeypatch.setattr(get_settings(), "bitrix_http_log_sample_rate", 1.0)
+    monkeypatch.setattr(get_settings(), "bitrix_http_log_capture_bytes", 4)
+    r = TestClient(_app()).get("/v1/bitrix/stream")
+    assert r.text == "chunk0;chunk1;chunk2;"
+    rec = writer._q.get_nowait()
+    assert rec.response_length == len(r.content)
+    assert rec.response_body == b"chun"
+    assert rec.response_truncated is True
+
+
+def test_oversized_body_preview_masks_tokens_and_query_keys_are_decoded(monkeypatch):
+    body = json.dumps({"access_token": "SECRET123", "auth": {"refresh_token": "R-456"}, "data": "x" * 70_000}).encode()
+    rec = HttpLogRecord(
+        trace_id="t1",
+        method="POST",
+        path="/v1/bitrix/events",
+        query_keys=[],
+        headers={"content-type": "application/json"},
+        status_code=200,
+        latency_ms=1,
+        request_body=body[:65536],
+        request_truncated=True,
+    )
+    summary = json.loads(_row_for(rec)["summary_json"])
+    preview = summary["request_json"]["preview"]
+    assert summary["request_json"]["_truncated"] is True
+    assert "SECRET123" not in preview and "R-456" not in preview
+    assert preview.startswith('{"access_token": "[MASKED]", "auth": {"refresh_token": "[MASKED]"}')
+
+    client = TestClient(_app())
+    writer = HttpLogWriter(max_events=10)
+    monkeypatch.setattr("apps.backend.middleware.bitrix_log.get_http_log_writer", lambda: writer)
+    monkeypatch.setattr(get_settings(), "bitrix_http_log_sample_rate", 1.0)
+    client.post("/v1/bitrix/echo?auth%5Baccess_token%5D=a&DOMAIN=b", json={"x": 1})
+    assert writer._q.get_nowait().query_keys == ["auth[access_token]", "DOMAIN"]
+
+
+def test_per_request_overhead_under_1ms(writer, monkeypatch):
+    monkeypatch.setattr(get_settings(), "bitrix_http_log_sample_rate", 1.0)
+    payload = json.dumps({"x": "y" * 512}).encode()
+
+    async def inner(scope, receive, send):
+        await receive()
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": b'{"ok": true}'})
+
+    wrapped = BitrixLogMiddleware(inner)
+
+    async def drive(app, n):
+        async def receive():
+            return {"type": "http.request", "body": payload, "more_body": False}
+
+        async def send(message):
+            return None
+
+        started = time.perf_counter()
+        for _ in range(n):
+            scope = {
+                "type": "http",
+                "method": "POST",
+                "path": "/v1/bitrix/events",
+                "query_string": b"DOMAIN=a",
+                "headers": [(b"content-type", b"application/json"), (b"accept", b"*/*")],
+            }
+            await app(scope, receive, send)
+        return time.perf_counter() - started
+
+    n = 2000
+    base = asyncio.run(drive(inner, n))
+    logged = asyncio.run(drive(wrapped, n))
+    overhead_ms = (logged - base) / n * 1000
+    assert overhead_ms < 1.0
+    stats = writer.stats()
+    assert stats["accepted"] + stats["sampled_out"] + stats["dropped"] == n
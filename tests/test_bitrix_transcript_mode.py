@@ -68,6 +68,11 @@ def test_transcript_mode_raw_vs_merged(tmp_path):
     try:
         r_raw = client.get(f"/v1/bitrix/portals/{portal.id}/kb/files/{rec.id}/transcript?mode=raw")
         r_merged = client.get(f"/v1/bitrix/portals/{portal.id}/kb/files/{rec.id}/transcript?mode=merged")
+        r_cached = client.get(
+            f"/v1/bitrix/portals/{portal.id}/kb/files/{rec.id}/transcript?mode=merged",
+            headers={"If-None-Match": r_merged.headers.get("etag") or ""},
+        )
+        r_window = client.get(f"/v1/bitrix/portals/{portal.id}/kb/files/{rec.id}/transcript?mode=raw&limit=1&cursor=1")
     finally:
         app.dependency_overrides.pop(get_db, None)
         app.dependency_overrides.pop(bitrix_router.require_portal_access, None)
@@ -85,3 +90,10 @@ def test_transcript_mode_raw_vs_merged(tmp_path):
     assert int(raw.get("merged_count") or 0) == 2
     assert len(raw.get("items") or []) == 3
     assert len(merged.get("items") or []) == 2
+
+    assert r_merged.headers.get("etag")
+    assert r_cached.status_code == 304
+
+    window = r_window.json()
+    assert [it["text"] for it in window["items"]] == ["как дела"]
+    assert window["next_cursor"] == 2
@@ -0,0 +1,94 @@
+"""Bitrix user directory sync: batch paging, set-based upserts, incremental runs."""
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.orm import sessionmaker
+
+from apps.backend.database import Base, get_test_engine
+from apps.backend.models.account import Account, AccountIntegration, AccountMembership, AccountPermission, AppUserIdentity
+from apps.backend.models.portal import Portal, PortalUserSync, PortalUsersAccess
+from apps.backend.services import bitrix_user_sync
+from apps.backend.services.bitrix_user_sync import UserSyncError, sync_portal_users, sync_status
+
+
+def _users(start: int, count: int) -> list[dict]:
+    return [{"ID": str(i), "NAME": f"User{i}", "LAST_NAME": "", "EMAIL": f"u{i}@example.com"} for i in range(start, start + count)]
+
+
+@pytest.fixture
+def env(monkeypatch):
+    engine = get_test_engine()
+    Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    account = Account(account_no=120001, name="Sync", slug="sync", status="active")
+    db.add(account)
+    db.flush()
+    portal = Portal(domain="sync.bitrix24.ru", status="active", account_id=account.id)
+    db.add(portal)
+    db.flush()
+    integ = AccountIntegration(account_id=account.id, provider="bitrix", status="active", external_key=portal.domain, portal_id=portal.id)
+    db.add(integ)
+    db.add(PortalUsersAccess(portal_id=portal.id, user_id="3", display_name="Manual", kind="web"))
+    db.commit()
+
+    calls: list[tuple[str, object]] = []
+    directory = _users(1, 130)
+
+    def page(domain, token, start=0, filter=None):
+        calls.append(("user.get", dict(filter or {})))
+        matching = [u for u in directory if ">TIMESTAMP_X" not in (filter or {}) or u.get("CHANGED")]
+        return matching[start:start + 50], len(matching), None
+
+    def batch(domain, token, commands, halt=False, timeout_sec=60):
+        calls.append(("batch", sorted(commands)))
+        results = {key: directory[int(key[1:]):int(key[1:]) + 50] for key in commands}
+        return results, {}, None, ""
+
+    monkeypatch.setattr(bitrix_user_sync, "user_get_page", page)
+    monkeypatch.setattr(bitrix_user_sync, "rest_batch", batch)
+    kwargs = {"portal_id": portal.id, "domain": portal.domain, "access_token": "t", "account_id": account.id, "integration_id": integ.id}
+    try:
+        yield db, kwargs, calls, directory
+    finally:
+        db.close()
+
+
+def test_full_sync_pages_through_batch_and_upserts(env):
+    db, kwargs, calls, directory = env
+    result = sync_portal_users(db, **kwargs)
+
+    assert [c[0] for c in calls] == ["user.get", "batch"]
+    assert calls[1][1] == ["p100", "p50"]
+    assert result["count"] == result["total"] == 130 and result["http_calls"] == 2
+    assert result["identity_linking"]["linked"] == 130
+    assert result["identity_linking"]["memberships_created"] == 130
+    bitrix_rows = db.execute(select(func.count()).select_from(PortalUsersAccess).where(PortalUsersAccess.kind == "bitrix")).scalar()
+    assert bitrix_rows == 129  # user 3 already has a non-bitrix row, which is left alone
+    assert db.execute(select(PortalUsersAccess.display_name).where(PortalUsersAccess.user_id == "3")).scalar() == "Manual"
+    assert db.execute(select(func.count()).select_from(AccountPermission)).scalar() == 130
+    assert sync_status(db, kwargs["portal_id"])["status"] == "done"
+
+    # incremental: only changed users are fetched; nothing is duplicated
+    directory[4]["NAME"], directory[4]["CHANGED"] = "Renamed", True
+    calls.clear()
+    result = sync_portal_users(db, mode="incremental", **kwargs)
+    assert result["mode"] == "incremental" and result["count"] == 1 and result["http_calls"] == 1
+    assert ">TIMESTAMP_X" in calls[0][1]
+    assert db.execute(select(PortalUsersAccess.display_name).where(PortalUsersAccess.user_id == "5")).scalar() == "Renamed"
+    assert db.execute(select(AppUserIdentity.display_value).where(AppUserIdentity.external_id == "5")).scalar() == "Renamed"
+    assert db.execute(select(func.count()).select_from(AppUserIdentity)).scalar() == 130
+    assert db.execute(select(func.count()).select_from(AccountMembership)).scalar() == 130
+    assert result["identity_linking"]["memberships_created"] == 0
+
+
+def test_batch_scope_error_is_recorded(env, monkeypatch):
+    db, kwargs, _calls, _directory = env
+    monkeypatch.setattr(
+        bitrix_user_sync,
+        "rest_batch",
+        lambda *a, **k: ({}, {"p50": {"error": "insufficient_scope", "error_description": "scope user"}}, None, ""),
+    )
+    with pytest.raises(UserSyncError) as exc:
+        sync_portal_users(db, **kwargs)
+    assert exc.value.code == "missing_scope_user"
+    state = db.get(PortalUserSync, kwargs["portal_id"])
+    assert (state.status, state.error, state.fetched, state.synced_at) == ("error", "missing_scope_user", 50, None)
@@ -0,0 +1,77 @@
+"""Compiled bot flows: graph indexes, templates, meaning index, per-version cache."""
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from apps.backend.database import Base, get_test_engine
+from apps.backend.models.portal import Portal
+from apps.backend.models.portal_bot_flow import PortalBotFlow
+from apps.backend.services import bot_flow_engine
+from apps.backend.services.bot_flow_engine import _render_compiled, compile_flow, get_compiled_flow
+
+FLOW = {
+    "settings": {"mood": "строгий"},
+    "nodes": [
+        {"id": "start", "type": "start"},
+        {
+            "id": "b",
+            "type": "branch",
+            "config": {"meanings": [{"id": "price", "phrases": "стоимость тарифа, прайс"}, {"id": "help", "phrases": ["помощь"]}]},
+        },
+        {"id": "m", "type": "message", "config": {"text": "Привет, {{name}}! {{missing}}"}},
+        {"id": "h", "type": "handoff"},
+        {"id": "lead", "type": "bitrix_lead", "config": {"fields": '{"TITLE": "Лид {{name}}"}'}},
+    ],
+    "edges": [
+        {"from": "start", "to": "b"},
+        {"from": "b", "to": "h", "condition": {"op": "meaning", "value": "price"}},
+        {"from": "b", "to": "m"},
+    ],
+}
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(bot_flow_engine, "_compiled_flows", {})
+    engine = get_test_engine()
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def test_compile_builds_indexes_once():
+    compiled = compile_flow(FLOW)
+    assert set(compiled.nodes) == {"start", "b", "m", "h", "lead"}
+    assert [(to, conditional) for to, _cond, conditional in compiled.out_edges["b"]] == [("h", True), ("m", False)]
+    assert _render_compiled(compiled.templates[("m", "text")], {"name": "Анна"}) == "Привет, Анна! {{missing}}"
+    assert _render_compiled(compiled.templates[("h", "text")], {}) == "Передаю менеджеру."
+    assert _render_compiled(compiled.json_configs[("lead", "fields")]["TITLE"], {"name": "Анна"}) == "Лид Анна"
+
+    index = compiled.meanings["b"]
+    # inflected forms match through lemmas, plain substrings still match as typed
+    assert index.select("Какова стоимость тарифов и где прайсы?")[:2] == ("price", 1.0)
+    assert index.select("нужна помощь")[0] == "help"
+    assert index.select("добрый день") == (None, 0.0, None)
+
+
+def test_cached_flow_is_recompiled_only_after_publish(db):
+    portal = Portal(domain="flow-cache.bitrix24.ru", status="active")
+    db.add(portal)
+    db.commit()
+    db.add(PortalBotFlow(portal_id=portal.id, kind="client", published_json=FLOW, published_version=1))
+    db.commit()
+
+    first = get_compiled_flow(db, portal.id)
+    assert get_compiled_flow(db, portal.id) is first
+
+    row = db.get(PortalBotFlow, {"portal_id": portal.id, "kind": "client"})
+    row.published_json = {**FLOW, "settings": {"mood": "дружелюбный"}}
+    row.published_version = 2
+    db.commit()
+    second = get_compiled_flow(db, portal.id)
+    assert second is not first and second.settings == {"mood": "дружелюбный"}
+
+    # portals without a flow get the compiled default flow
+    assert set(get_compiled_flow(db, portal.id + 1).nodes) == {"start", "kb"}
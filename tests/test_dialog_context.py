@@ -0,0 +1,95 @@
+"""Dialog context store: cached reads, upserts, write-through after commit, stamp checks."""
+from datetime import datetime
+
+import pytest
+from sqlalchemy import event, select, update
+from sqlalchemy.orm import sessionmaker
+
+from apps.backend.database import Base, get_test_engine
+from apps.backend.models.dialog import Dialog, Message
+from apps.backend.models.dialog_rag_cache import DialogRagCache
+from apps.backend.models.dialog_state import DialogState
+from apps.backend.models.portal import Portal
+from apps.backend.services.dialog_context import load_history, load_rag, load_state, save_rag, save_state
+
+
+@pytest.fixture
+def env():
+    engine = get_test_engine()
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine)
+    db = factory()
+    portal = Portal(domain="ctx.bitrix24.ru", status="active")
+    db.add(portal)
+    db.flush()
+    dialog = Dialog(portal_id=portal.id, provider_dialog_id="chat1")
+    db.add(dialog)
+    db.flush()
+    db.add(Message(dialog_id=dialog.id, direction="rx", body="привет"))
+    db.commit()
+    statements: list[str] = []
+    event.listen(engine, "before_cursor_execute", lambda conn, cur, stmt, *a: statements.append(stmt))
+    try:
+        yield factory, db, portal.id, dialog.id, statements
+    finally:
+        db.close()
+
+
+def test_turn_reads_once_and_writes_through_on_commit(env):
+    factory, db, portal_id, dialog_id, statements = env
+    assert load_state(db, dialog_id) == {"vars": {}, "pending": None}
+    loads = len(statements)
+    assert load_history(db, dialog_id, limit=6) == [("rx", "привет")]
+    assert load_rag(db, dialog_id, "emb") == ([], [])
+    assert len(statements) == loads
+
+    save_state(db, dialog_id, {"vars": {"name": "Анна"}, "pending": None})
+    save_rag(db, dialog_id, portal_id, "emb", list(range(15)), ["тариф"])
+    db.add(Message(dialog_id=dialog_id, direction="tx", body="Здравствуйте"))
+    assert load_state(db, dialog_id)["vars"] == {"name": "Анна"}  # own uncommitted write
+    db.commit()
+    save_rag(db, dialog_id, portal_id, "emb", [3], ["цена"])
+    db.commit()
+
+    other = factory()
+    before = len(statements)
+    assert load_state(other, dialog_id)["vars"] == {"name": "Анна"}
+    assert load_rag(other, dialog_id, "emb") == ([3], ["цена"])
+    assert load_history(other, dialog_id) == [("rx", "привет"), ("tx", "Здравствуйте")]
+    assert len(statements) == before + 1  # the stamp check, once per transaction
+    assert other.execute(select(DialogRagCache.chunk_ids_json)).scalars().all() == ["[3]"]
+    assert other.get(DialogState, dialog_id).state_json["vars"] == {"name": "Анна"}
+    other.close()
+
+
+def test_rolled_back_turn_never_reaches_the_cache(env):
+    _factory, db, _portal_id, dialog_id, _statements = env
+    load_state(db, dialog_id)
+    save_state(db, dialog_id, {"vars": {"x": 1}, "pending": {"var": "x", "next": "m"}})
+    db.add(Message(dialog_id=dialog_id, direction="tx", body="lost"))
+    db.flush()
+    db.rollback()
+    assert load_state(db, dialog_id) == {"vars": {}, "pending": None}
+    assert load_history(db, dialog_id) == [("rx", "привет")]
+
+
+def test_entry_missing_a_write_is_reloaded(env):
+    factory, db, _portal_id, dialog_id, _statements = env
+    save_state(db, dialog_id, {"vars": {}, "pending": {"var": "city", "next": "n2"}})
+    db.commit()
+    assert load_state(db, dialog_id)["pending"] == {"var": "city", "next": "n2"}
+    db.commit()
+
+    # a commit whose write-through never reached the cache (another process, Redis outage)
+    other = factory()
+    other.execute(
+        update(DialogState)
+        .where(DialogState.dialog_id == dialog_id)
+        .values(state_json={"vars": {"city": "Казань"}, "pending": None}, updated_at=datetime.utcnow())
+    )
+    other.add(Message(dialog_id=dialog_id, direction="rx", body="Казань"))
+    other.commit()
+    other.close()
+
+    assert load_state(db, dialog_id) == {"vars": {"city": "Казань"}, "pending": None}
+    assert load_history(db, dialog_id)[-1] == ("rx", "Казань")
@@ -0,0 +1,151 @@
+"""Admin errors analytics: SQL aggregates, minute/hour rollups and the keyset feed."""
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from apps.backend.database import Base, get_test_engine
+from apps.backend.models.bitrix_inbound_event import BitrixInboundEvent
+from apps.backend.models.bitrix_log import BitrixHttpLog
+from apps.backend.models.error_rollup import ApiErrorRollup
+from apps.backend.models.outbox import Outbox
+from apps.backend.models.portal import Portal
+from apps.backend.services.error_analytics import (
+    LATENCY_BOUNDS,
+    encode_cursor,
+    error_summary,
+    iter_errors,
+    rollup_errors,
+)
+
+NOW = datetime(2026, 10, 19, 12, 30, 15)
+
+
+@pytest.fixture
+def db():
+    engine = get_test_engine()
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def _http(db, portal_id, ago, status, latency, code=None):
+    summary = json.dumps({"bitrix_error_code": code}) if code else "not json"
+    db.add(
+        BitrixHttpLog(
+            portal_id=portal_id,
+            direction="out",
+            kind="bitrix_rest",
+            method="POST",
+            path="/rest/im.message.add",
+            status_code=status,
+            latency_ms=latency,
+            summary_json=summary,
+            created_at=NOW - ago,
+        )
+    )
+
+
+def _seed(db):
+    p1 = Portal(domain="alpha.bitrix24.ru", status="active")
+    p2 = Portal(domain="beta.bitrix24.ru", status="active")
+    db.add_all([p1, p2])
+    db.commit()
+    for i in range(30):
+        _http(db, p1.id, timedelta(hours=i * 4, minutes=7), 200, 40 + i)
+    for i in range(6):
+        _http(db, p1.id, timedelta(hours=i * 9, minutes=3), 403, 900, code="ACCESS_DENIED")
+    for i in range(4):
+        _http(db, p2.id, timedelta(minutes=10 + i * 50), 500, 2500)
+    _http(db, p2.id, timedelta(seconds=30), 502, 70)  # still inside the rollup lag
+    db.add(
+        BitrixInboundEvent(
+            portal_id=p2.id,
+            method="POST",
+            path="/v1/bitrix/events",
+            body_truncated=False,
+            body_sha256="x" * 64,
+            status_hint="denied",
+            created_at=NOW - timedelta(hours=5),
+        )
+    )
+    db.commit()
+    return p1, p2
+
+
+def _comparable(summary):
+    return {k: summary[k] for k in ("bitrix_total_requests", "bitrix_error_requests", "inbound_error_events", "top_codes", "top_portals", "error_rate_percent")}
+
+
+def test_rollups_reproduce_raw_summary(db):
+    _seed(db)
+    raw = {p: error_summary(db, p, now=NOW) for p in ("24h", "7d", "30d")}
+    assert raw["7d"]["sources"] == ["raw"]
+    assert raw["7d"]["bitrix_total_requests"] == 41
+    assert raw["7d"]["bitrix_error_requests"] == 11
+    assert raw["7d"]["top_codes"][0] == {"key": "ACCESS_DENIED", "count": 6}
+    assert {"key": "http_500", "count": 4} in raw["7d"]["top_codes"]
+
+    for _ in range(10):  # first runs backfill the hour buckets in chunks
+        rollup_errors(db, now=NOW)
+    assert db.query(ApiErrorRollup).filter(ApiErrorRollup.grain == "hour").count() > 0
+
+    for period in ("24h", "7d", "30d"):
+        rolled = error_summary(db, period, now=NOW)
+        assert rolled["sources"][-1] == "raw" and len(rolled["sources"]) > 1
+        assert _comparable(rolled) == _comparable(raw[period])
+        assert rolled["p95_latency_ms"] in LATENCY_BOUNDS
+        assert rolled["p95_latency_ms"] >= raw[period]["p95_latency_ms"] or raw[period]["p95_latency_ms"] == 0
+
+    rows_before = db.query(ApiErrorRollup).count()
+    rollup_errors(db, now=NOW)
+    assert db.query(ApiErrorRollup).count() == rows_before
+
+
+def test_one_hour_summary_is_exact(db):
+    _seed(db)
+    summary = error_summary(db, "1h", now=NOW)
+    assert summary["p95_exact"] is True
+    assert summary["bitrix_error_requests"] == 4  # ACCESS_DENIED, two http_500 and the 502
+    assert summary["p95_latency_ms"] == 2500
+
+
+def test_feed_pages_with_cursor_across_channels(db):
+    p1, p2 = _seed(db)
+    for i in range(3):
+        db.add(
+            Outbox(
+                portal_id=p1.id,
+                status="error",
+                payload_json=json.dumps({"trace_id": f"tr-{i}"}),
+                error_message="timeout",
+                created_at=NOW - timedelta(minutes=10 + i * 50),  # ties with the http_500 rows
+            )
+        )
+    db.commit()
+    full = list(iter_errors(db))
+    assert len(full) == 11 + 1 + 3
+    keys = [(it["_ts"], it["channel"], it["_id"]) for it in full]
+    assert len(set(keys)) == len(keys)
+
+    paged, cursor = [], None
+    while True:
+        page = []
+        for item in iter_errors(db, cursor=cursor, page_size=2):
+            page.append(item)
+            if len(page) == 4:
+                break
+        paged.extend(page)
+        if len(page) < 4:
+            break
+        cursor = encode_cursor(page[-1])
+    assert [it["id"] for it in paged] == [it["id"] for it in full]
+
+    beta = list(iter_errors(db, portal="beta", code="http_5"))
+    assert {it["portal_domain"] for it in beta} == {"beta.bitrix24.ru"}
+    assert len(beta) == 5
+    assert [it["code"] for it in iter_errors(db, channel="outbox", trace_id="tr-1")] == ["timeout"]
@@ -8,6 +8,7 @@ from apps.backend.main import app
 from apps.backend.database import get_test_engine, Base
 from apps.backend.models.bitrix_inbound_event import BitrixInboundEvent
 from apps.backend.services.bitrix_inbound_log import _safe_headers, _body_preview, BODY_MAX_BYTES_DEFAULT
+from apps.backend.services.inbound_log_writer import get_inbound_writer
 
 client = TestClient(app)
 EVENTS_PATH = "/v1/bitrix/events"
@@ -58,8 +59,14 @@ class TestInboundEventsMiddleware:
         def fake_settings(db):
             return {"enabled": False, "auto_prune_on_write": True, "retention_days": 3,
                     "max_rows": 5000, "max_body_kb": 128, "target_budget_mb": 200}
-        with patch("apps.backend.middleware.bitrix_inbound_events.get_inbound_settings", side_effect=fake_settings):
+        engine = get_test_engine()
+        Base.metadata.create_all(engine)
+        factory = sessionmaker(bind=engine)
+        get_inbound_writer().flush()
+        with patch("apps.backend.services.inbound_log_writer.get_inbound_settings", side_effect=fake_settings), \
+                patch("apps.backend.database.get_session_factory", return_value=factory):
             r = client.post(EVENTS_PATH, json={"event": "PING"})
+            assert get_inbound_writer().flush() == 0
         assert r.status_code == 200
         data = r.json()
         assert data.get("event") == "PING" or data.get("status") == "ok"
@@ -126,6 +133,7 @@ def test_events_trace_id_consistency():
 
     with patch("apps.backend.database.get_session_factory", side_effect=test_session_factory):
         r = client.post(EVENTS_PATH, json={"event": "ONIMBOTMESSAGEADD", "data": {}, "auth": {}})
+        get_inbound_writer().flush()
     assert r.status_code == 200
     data = r.json()
     assert "trace_id" in data
@@ -0,0 +1,69 @@
+"""Batched inbound event writer: multi-row flush and overload policy."""
+import json
+from unittest.mock import patch
+
+from sqlalchemy.orm import sessionmaker
+
+from apps.backend.database import Base, get_test_engine
+from apps.backend.models.bitrix_inbound_event import BitrixInboundEvent
+from apps.backend.models.portal import Portal
+from apps.backend.services.inbound_log_writer import InboundEvent, InboundEventWriter
+
+
+def _event(i: int, body: bytes | None = None) -> InboundEvent:
+    payload = {"event": "ONIMBOTMESSAGEADD", "auth": {"member_id": "m-writer", "domain": "w.example"}, "data": {"USER_ID": i}}
+    return InboundEvent(
+        trace_id=f"t{i}",
+        method="POST",
+        path="/v1/bitrix/events",
+        query_string=None,
+        headers={"content-type": "application/json"},
+        body=body if body is not None else json.dumps(payload).encode(),
+        remote_ip=None,
+    )
+
+
+def test_flush_writes_batch_and_resolves_portal_once():
+    engine = get_test_engine()
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine)
+    writer = InboundEventWriter(max_events=100, batch_size=50)
+    for i in range(1, 6):
+        assert writer.submit(_event(i)) is True
+
+    with patch("apps.backend.database.get_session_factory", return_value=factory):
+        written = writer.flush()
+
+    assert written == 5
+    db = factory()
+    try:
+        rows = db.query(BitrixInboundEvent).order_by(BitrixInboundEvent.id).all()
+        assert [r.trace_id for r in rows] == ["t1", "t2", "t3", "t4", "t5"]
+        assert {r.user_id for r in rows} == {"1", "2", "3", "4", "5"}
+        portals = db.query(Portal).filter(Portal.member_id == "m-writer").all()
+        assert len(portals) == 1
+        assert {r.portal_id for r in rows} == {portals[0].id}
+    finally:
+        db.close()
+    assert writer.stats()["written"] == 5
+    assert writer.stats()["queued"] == 0
+
+
+def test_overload_samples_then_drops():
+    writer = InboundEventWriter(max_events=10, sample_watermark=0.5, sample_every=2)
+    accepted = sum(1 for i in range(30) if writer.submit(_event(i)))
+    stats = writer.stats()
+
+    assert stats["queued"] == 10
+    assert accepted == 10
+    assert stats["sampled_out"] > 0
+    assert stats["dropped"] > 0
+    assert stats["accepted"] + stats["sampled_out"] + stats["dropped"] == 30
+
+
+def test_byte_budget_bounds_queue():
+    writer = InboundEventWriter(max_events=100, max_bytes=1000)
+    assert writer.submit(_event(1, body=b"x" * 600)) is True
+    assert writer.submit(_event(2, body=b"x" * 600)) is False
+    assert writer.stats()["dropped"] == 1
+    assert writer.stats()["queued_bytes"] == 600
@@ -0,0 +1,103 @@
+"""Materialized KB access map: session hook, reads, backfill and verification."""
+import pytest
+from sqlalchemy import delete, select
+from sqlalchemy.orm import sessionmaker
+
+from apps.backend.database import Base, get_test_engine
+from apps.backend.models.kb import KBFile, KBFileAccess, KBFileAccessMap, KBFolder, KBFolderAccess
+from apps.backend.models.portal import Portal
+from apps.backend.services.kb_access_map import (
+    access_rows,
+    backfill_access_map,
+    readable_file_ids,
+    resolve_readable_file_ids,
+    verify_access_map,
+)
+
+
+@pytest.fixture
+def db():
+    engine = get_test_engine()
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def _setup(db):
+    portal = Portal(domain="acl.bitrix24.ru", status="active")
+    db.add(portal)
+    db.flush()
+    folder = KBFolder(portal_id=portal.id, name="Clients")
+    db.add(folder)
+    db.flush()
+    files = [
+        KBFile(portal_id=portal.id, filename=f"f{i}.txt", storage_path=f"/tmp/f{i}.txt", status="ready")
+        for i in range(4)
+    ]
+    files[1].folder_id = folder.id
+    files[2].folder_id = folder.id
+    db.add_all(files)
+    db.flush()
+    db.add(KBFolderAccess(folder_id=folder.id, principal_type="group", principal_id="7", access_level="read"))
+    db.add(KBFileAccess(file_id=files[2].id, principal_type="membership", principal_id="42", access_level="edit"))
+    db.add(KBFileAccess(file_id=files[3].id, principal_type="audience", principal_id="client", access_level="read"))
+    db.commit()
+    return portal, folder, [int(f.id) for f in files]
+
+
+SUBJECTS = [
+    {"membership_id": None, "group_ids": [], "role": "member", "audience": "staff"},
+    {"membership_id": None, "group_ids": [], "role": "client", "audience": "client"},
+    {"membership_id": None, "group_ids": [7], "role": "client", "audience": "client"},
+    {"membership_id": 42, "group_ids": [], "role": "member", "audience": "staff"},
+    {"membership_id": None, "group_ids": [], "role": "owner", "audience": "staff"},
+]
+
+
+def test_map_matches_resolver_and_follows_acl_changes(db):
+    _portal, folder, ids = _setup(db)
+    assert verify_access_map(db) == []
+    for subject in SUBJECTS:
+        assert readable_file_ids(db, ids, **subject) == resolve_readable_file_ids(db, ids, **subject)
+    client = SUBJECTS[1]
+    grouped = SUBJECTS[2]
+    assert readable_file_ids(db, ids, **client) == {ids[3]}
+    assert readable_file_ids(db, ids, **grouped) == {ids[1], ids[3]}
+    assert readable_file_ids(db, ids, **SUBJECTS[0]) == {ids[0]}
+
+    # folder rule change reaches every file governed by the folder rules
+    db.add(KBFolderAccess(folder_id=folder.id, principal_type="audience", principal_id="client", access_level="read"))
+    db.commit()
+    assert readable_file_ids(db, ids, **client) == {ids[1], ids[3]}
+
+    # moving a file out of the folder drops the inherited grant
+    rec = db.get(KBFile, ids[1])
+    rec.folder_id = None
+    db.commit()
+    assert readable_file_ids(db, ids, **grouped) == {ids[3]}
+
+    # bulk deletes skip the flush and are handled around the statement
+    db.execute(delete(KBFileAccess).where(KBFileAccess.file_id == ids[2]))
+    db.commit()
+    assert ids[2] in readable_file_ids(db, ids, **client)
+    assert verify_access_map(db) == []
+
+
+def test_legacy_files_are_computed_until_backfilled(db):
+    _portal, _folder, ids = _setup(db)
+    db.execute(delete(KBFileAccessMap))
+    db.commit()
+    assert {p["kind"] for p in verify_access_map(db)} == {"missing"}
+    assert readable_file_ids(db, ids, **SUBJECTS[2]) == {ids[1], ids[3]}
+    assert db.execute(select(KBFileAccessMap.file_id)).first() is None
+    assert sorted(access_rows(db, [ids[0]])[ids[0]]) == [("*", "default", "none")]
+
+    assert backfill_access_map(db, batch_size=3) == 4
+    assert verify_access_map(db) == []
+
+    db.execute(delete(KBFileAccessMap).where(KBFileAccessMap.principal_type == "group"))
+    db.commit()
+    assert [(p["file_id"], p["kind"]) for p in verify_access_map(db)] == [(ids[1], "stale")]
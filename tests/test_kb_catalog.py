@@ -0,0 +1,140 @@
+"""KB file catalog: change versions, keyset pages over ACL-filtered files, listing ETag."""
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import delete
+from sqlalchemy.orm import sessionmaker
+
+from apps.backend.auth import create_portal_token_with_user
+from apps.backend.database import Base, get_test_engine
+from apps.backend.deps import get_db
+from apps.backend.main import app
+from apps.backend.models.kb import KBChunk, KBCollection, KBCollectionFile, KBFile, KBFileAccess, KBFolder
+from apps.backend.models.portal import Portal
+from apps.backend.services.kb_catalog import catalog_page, catalog_versions, describe_files
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def db():
+    engine = get_test_engine()
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def _portal(db):
+    portal = Portal(domain="catalog.bitrix24.ru", status="active", admin_user_id=1)
+    db.add(portal)
+    db.commit()
+    return portal
+
+
+def _file(db, portal_id, name, **kw):
+    kw.setdefault("status", "ready")
+    rec = KBFile(portal_id=portal_id, filename=name, storage_path=f"/tmp/{name}", **kw)
+    db.add(rec)
+    db.commit()
+    return rec
+
+
+def test_versions_bump_after_commit_only(db):
+    portal = _portal(db)
+    assert catalog_versions(db, [portal.id]) == {portal.id: 0}
+    rec = _file(db, portal.id, "a.txt")
+    assert catalog_versions(db, [portal.id]) == {portal.id: 1}
+
+    db.add(KBFileAccess(file_id=rec.id, principal_type="role", principal_id="member", access_level="read"))
+    db.flush()
+    db.rollback()
+    assert catalog_versions(db, [portal.id]) == {portal.id: 1}
+
+    db.add(KBFileAccess(file_id=rec.id, principal_type="role", principal_id="member", access_level="read"))
+    db.commit()
+    db.execute(delete(KBFileAccess).where(KBFileAccess.file_id == rec.id))
+    db.commit()
+    assert catalog_versions(db, [portal.id]) == {portal.id: 3}
+
+
+def test_keyset_pages_skip_unreadable_and_stale_duplicates(db):
+    portal = _portal(db)
+    root = KBFolder(portal_id=portal.id, name="Docs")
+    db.add(root)
+    db.flush()
+    child = KBFolder(portal_id=portal.id, parent_id=root.id, name="HR")
+    db.add(child)
+    db.commit()
+    _file(db, portal.id, "b.txt", status="error")
+    recs = {name: _file(db, portal.id, name) for name in ["d.txt", "B.txt", "a.txt", "c.txt", "e.txt"]}
+    recs["c.txt"].folder_id = child.id
+    collection = KBCollection(portal_id=portal.id, name="Onboarding")
+    db.add(collection)
+    db.flush()
+    db.add(KBCollectionFile(collection_id=collection.id, file_id=recs["c.txt"].id))
+    db.add_all(KBChunk(portal_id=portal.id, file_id=recs["c.txt"].id, chunk_index=i, text="x") for i in range(3))
+    db.commit()
+    hidden = recs["d.txt"].id
+
+    def readable(files):
+        return {int(f.id) for f in files if int(f.id) != hidden}
+
+    conditions = [KBFile.portal_id == portal.id]
+    names, cursor = [], None
+    while True:
+        rows, cursor = catalog_page(db, conditions, readable=readable, sort="name", cursor=cursor, limit=2)
+        names.append([f.filename for f, _type, _url in rows])
+        if not cursor:
+            break
+    assert names == [["a.txt", "B.txt"], ["c.txt", "e.txt"]]
+
+    rows, cursor = catalog_page(db, conditions, readable=readable, limit=10)
+    assert [f.filename for f, _type, _url in rows] == ["e.txt", "c.txt", "a.txt", "B.txt"] and cursor is None
+
+    details = describe_files(db, [f for f, _type, _url in rows], [KBFolder.portal_id == portal.id])
+    c_id = recs["c.txt"].id
+    assert details["folder_path"][c_id] == "Docs/HR" and details["folder_path"][recs["a.txt"].id] is None
+    assert details["collection_ids"] == {c_id: [collection.id]}
+    assert details["chunk_count"] == {c_id: 3}
+
+
+def test_older_readable_file_is_listed_when_the_newest_namesake_is_hidden(db):
+    portal = _portal(db)
+    older = _file(db, portal.id, "x.txt")
+    hidden = _file(db, portal.id, "X.txt").id
+    _file(db, portal.id, "y.txt")
+
+    def readable(files):
+        return {int(f.id) for f in files if int(f.id) != hidden}
+
+    rows, cursor = catalog_page(db, [KBFile.portal_id == portal.id], readable=readable, sort="name", limit=10)
+    assert [f.id for f, _type, _url in rows] == [older.id, older.id + 2] and cursor is None
+
+
+def test_listing_etag_revalidates_until_kb_changes(db):
+    portal = _portal(db)
+    _file(db, portal.id, "manual.pdf")
+    token = create_portal_token_with_user(portal.id, user_id=1, expires_minutes=10)
+    headers = {"Authorization": f"Bearer {token}"}
+
+    def _get_db():
+        yield db
+
+    app.dependency_overrides[get_db] = _get_db
+    try:
+        first = client.get(f"/v1/bitrix/portals/{portal.id}/kb/files", headers=headers)
+        etag = first.headers["ETag"]
+        again = client.get(f"/v1/bitrix/portals/{portal.id}/kb/files", headers={**headers, "If-None-Match": etag})
+        filtered = client.get(f"/v1/bitrix/portals/{portal.id}/kb/files?q=zzz", headers={**headers, "If-None-Match": etag})
+        _file(db, portal.id, "policy.pdf")
+        changed = client.get(f"/v1/bitrix/portals/{portal.id}/kb/files", headers={**headers, "If-None-Match": etag})
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+
+    assert first.status_code == 200 and [i["filename"] for i in first.json()["items"]] == ["manual.pdf"]
+    assert again.status_code == 304
+    assert filtered.status_code == 200 and filtered.json()["items"] == []
+    assert changed.status_code == 200
+    assert [i["filename"] for i in changed.json()["items"]] == ["policy.pdf", "manual.pdf"]
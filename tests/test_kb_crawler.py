@@ -0,0 +1,148 @@
+"""KB web crawler: scope, conditional re-crawl and change-driven ingest."""
+import httpx
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from apps.backend.config import get_settings
+from apps.backend.database import Base, get_test_engine
+from apps.backend.models.kb import KBChunk, KBFile, KBJob, KBSource, KBSourcePage
+from apps.backend.models.portal import Portal
+from apps.backend.services import kb_crawler
+
+
+class _Site:
+    def __init__(self):
+        self.pages = {
+            "/docs/": '<html><title>Docs</title><a href="a.html">A</a><a href="/docs/b.html#x">B</a>'
+            '<a href="/blog/">Blog</a><a href="https://other.example/docs/">Ext</a>'
+            '<a href="/docs/file.pdf">PDF</a></html>',
+            "/docs/a.html": "<html><title>A</title>Отпуск 28 дней</html>",
+            "/docs/b.html": "<html><title>B</title>Больничный</html>",
+            "/blog/": "<html>blog</html>",
+        }
+        self.requests: list[tuple[str, int]] = []
+
+    def etag(self, path):
+        return '"%x"' % (abs(hash(self.pages[path])) % (1 << 32))
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        if path == "/robots.txt":
+            return httpx.Response(200, text="User-agent: *\nDisallow: /docs/private/\n")
+        if path not in self.pages:
+            self.requests.append((path, 404))
+            return httpx.Response(404)
+        etag = self.etag(path)
+        if request.headers.get("if-none-match") == etag:
+            self.requests.append((path, 304))
+            return httpx.Response(304, headers={"ETag": etag})
+        self.requests.append((path, 200))
+        return httpx.Response(
+            200,
+            headers={"ETag": etag, "Content-Type": "text/html; charset=utf-8"},
+            text=self.pages[path],
+        )
+
+
+@pytest.fixture
+def test_db_session(tmp_path, monkeypatch):
+    monkeypatch.setattr(get_settings(), "kb_storage_path", str(tmp_path / "kb"))
+    monkeypatch.setattr(get_settings(), "kb_crawler_delay_ms", 0)
+    engine = get_test_engine()
+    Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def enqueued(monkeypatch):
+    calls: list[int] = []
+    monkeypatch.setattr(kb_crawler, "_enqueue_ingest_jobs", lambda ids: calls.extend(ids))
+    return calls
+
+
+def _make_source(db, max_pages=10):
+    portal = Portal(domain="crawl.bitrix24.ru", status="active")
+    db.add(portal)
+    db.commit()
+    src = KBSource(
+        portal_id=portal.id,
+        source_type="web",
+        url="https://site.example/docs/",
+        status="new",
+        max_pages=max_pages,
+    )
+    db.add(src)
+    db.commit()
+    return src
+
+
+def test_normalize_and_scope():
+    assert kb_crawler.normalize_url("b.html#top", "https://Site.example/docs/a.html") == "https://site.example/docs/b.html"
+    assert kb_crawler.normalize_url("mailto:hr@site.example") is None
+    host, prefix = kb_crawler._crawl_scope("https://site.example/docs/index.html")
+    assert (host, prefix) == ("site.example", "/docs/")
+    assert kb_crawler._in_scope("https://site.example/docs/x", host, prefix)
+    assert not kb_crawler._in_scope("https://site.example/blog/", host, prefix)
+    assert not kb_crawler._in_scope("https://site.example/docs/x.pdf", host, prefix)
+
+
+def test_first_crawl_creates_files_and_ingest_jobs(test_db_session, enqueued):
+    site = _Site()
+    src = _make_source(test_db_session)
+
+    stats = kb_crawler.crawl_source(test_db_session, src, transport=httpx.MockTransport(site.handler))
+
+    assert stats["fetched"] == 3
+    assert stats["changed"] == 3
+    assert sorted(p for p, _ in site.requests) == ["/docs/", "/docs/a.html", "/docs/b.html"]
+    pages = test_db_session.query(KBSourcePage).filter(KBSourcePage.source_id == src.id).all()
+    assert {p.status for p in pages} == {"changed"}
+    assert all(p.etag and p.file_id for p in pages)
+    files = test_db_session.query(KBFile).filter(KBFile.source_id == src.id).all()
+    assert len(files) == 3 and {f.status for f in files} == {"queued"}
+    jobs = test_db_session.query(KBJob).filter(KBJob.job_type == "ingest").all()
+    assert sorted(enqueued) == sorted(j.id for j in jobs)
+    assert src.last_crawled_at is not None
+
+
+def test_recrawl_uses_conditional_get_and_reingests_only_changed(test_db_session, enqueued):
+    site = _Site()
+    src = _make_source(test_db_session)
+    transport = httpx.MockTransport(site.handler)
+    kb_crawler.crawl_source(test_db_session, src, transport=transport)
+    a_file_id = test_db_session.query(KBSourcePage).filter(KBSourcePage.url.like("%/a.html")).one().file_id
+    test_db_session.add(KBChunk(portal_id=src.portal_id, file_id=a_file_id, chunk_index=0, text="Отпуск 28 дней"))
+    test_db_session.commit()
+    enqueued.clear()
+    site.requests.clear()
+
+    stats = kb_crawler.crawl_source(test_db_session, src, transport=transport)
+    assert stats["changed"] == 0 and stats["unchanged"] == 3
+    assert {code for _, code in site.requests} == {304}
+    assert enqueued == []
+
+    site.pages["/docs/a.html"] = "<html><title>A</title>Отпуск 31 день</html>"
+    stats = kb_crawler.crawl_source(test_db_session, src, transport=transport)
+
+    assert stats["changed"] == 1
+    assert len(enqueued) == 1
+    job = test_db_session.get(KBJob, enqueued[0])
+    assert job.payload_json["file_id"] == a_file_id
+    assert test_db_session.query(KBChunk).filter(KBChunk.file_id == a_file_id).count() == 0
+    rec = test_db_session.get(KBFile, a_file_id)
+    with open(rec.storage_path, encoding="utf-8") as f:
+        assert "31 день" in f.read()
+
+
+def test_crawl_respects_max_pages(test_db_session, enqueued):
+    site = _Site()
+    src = _make_source(test_db_session, max_pages=1)
+
+    stats = kb_crawler.crawl_source(test_db_session, src, transport=httpx.MockTransport(site.handler))
+
+    assert stats["fetched"] == 1
+    assert site.requests == [("/docs/", 200)]
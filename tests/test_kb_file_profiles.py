@@ -0,0 +1,101 @@
+"""KB file profiles: topic memberships, term document frequencies, topic lookups."""
+from datetime import datetime
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+
+from apps.backend.database import Base, get_test_engine
+from apps.backend.models.kb import KBChunk, KBFile, KBFileProfile, KBPortalTermDF
+from apps.backend.models.portal import Portal
+from apps.backend.services.kb_file_profiles import (
+    auto_topic_candidates,
+    drop_file_profile,
+    ensure_file_profiles,
+    refresh_file_profile,
+    topic_file_ids,
+    topic_memberships,
+)
+
+
+@pytest.fixture
+def db():
+    engine = get_test_engine()
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def _file(db, portal_id, name, *texts):
+    rec = KBFile(portal_id=portal_id, filename=name, storage_path=f"/tmp/{name}", status="ready")
+    db.add(rec)
+    db.flush()
+    for i, text in enumerate(texts):
+        db.add(KBChunk(portal_id=portal_id, file_id=rec.id, chunk_index=i, text=text, created_at=datetime.utcnow()))
+    db.commit()
+    return rec
+
+
+def _df(db, portal_id):
+    rows = db.execute(select(KBPortalTermDF.term, KBPortalTermDF.df).where(KBPortalTermDF.portal_id == portal_id)).all()
+    return dict(rows)
+
+
+def test_profiles_keep_document_frequencies_incremental(db):
+    portal = Portal(domain="p.bitrix24.ru", status="active")
+    db.add(portal)
+    db.commit()
+    a = _file(db, portal.id, "tariffs.txt", "Тариф и стоимость подписки. Договоры поставки.")
+    b = _file(db, portal.id, "contracts.txt", "Договор поставки оборудования", "Сотрудник подписывает договор")
+    c = _file(db, portal.id, "empty.txt")
+
+    assert ensure_file_profiles(db, KBFile.portal_id == portal.id) == 2  # files without chunks are skipped
+    assert db.get(KBFileProfile, c.id) is None
+    assert db.get(KBFileProfile, a.id).summary.startswith("Тариф и стоимость")
+    df = _df(db, portal.id)
+    assert df["договор"] == 2 and df["поставка"] == 2 and df["подписка"] == 1
+
+    refresh_file_profile(db, a, ["Поставка оборудования для склада"])
+    db.commit()
+    df = _df(db, portal.id)
+    assert df["договор"] == 1 and "подписка" not in df and df["поставка"] == 2
+
+    members = topic_memberships(db, [a.id, b.id])
+    assert members["hr"] == [b.id] and members["pricing"] == []
+    assert topic_file_ids(db, ["hr"]) == {b.id}
+    assert topic_file_ids(db, ["auto:договор"], KBFile.portal_id == portal.id) == {b.id}
+    assert topic_file_ids(db, ["поставки оборудования"]) == {a.id, b.id}
+
+    whole = auto_topic_candidates(db, [a.id, b.id], threshold=2)
+    subset = auto_topic_candidates(db, [b.id], threshold=1)
+    assert [t["id"] for t in whole] == ["auto:оборудование", "auto:поставка"]
+    assert whole[0]["file_ids"] == [a.id, b.id]
+    assert {t["id"] for t in subset} >= {"auto:договор", "auto:поставка"}
+
+    drop_file_profile(db, b.id)
+    db.commit()
+    df = _df(db, portal.id)
+    assert "договор" not in df and df["поставка"] == 1
+
+
+def test_topic_reads_never_write_and_the_script_backfills(db, monkeypatch):
+    from apps.backend.scripts import kb_file_profiles as script
+
+    portal = Portal(domain="b.bitrix24.ru", status="active")
+    db.add(portal)
+    db.commit()
+    a = _file(db, portal.id, "hr.txt", "Сотрудник проходит онбординг")
+    b = _file(db, portal.id, "team.txt", "Сотрудник команды")
+
+    assert topic_file_ids(db, ["hr"], KBFile.portal_id == portal.id) == set()
+    assert db.execute(select(KBFileProfile)).first() is None
+
+    monkeypatch.setattr(db, "close", lambda: None)
+    assert script.run(db, portal_id=portal.id, batch=1) == {"ok": True, "profiled_files": 2}
+    assert topic_file_ids(db, ["hr"], KBFile.portal_id == portal.id) == {a.id, b.id}
+    assert _df(db, portal.id)["сотрудник"] == 2
+    assert ensure_file_profiles(db, KBFile.portal_id == portal.id) == 0
+    assert _df(db, portal.id)["сотрудник"] == 2
@@ -0,0 +1,168 @@
+"""KB preview cache and single-flight scheduling tests."""
+import hashlib
+import os
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from apps.backend.config import get_settings
+from apps.backend.database import Base, get_test_engine
+from apps.backend.models.kb import KBChunk, KBFile
+from apps.backend.models.portal import Portal
+from apps.backend.services import kb_ingest, kb_preview
+
+
+class _FakeRedis:
+    def __init__(self):
+        self.store: dict[str, str] = {}
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.store:
+            return False
+        self.store[key] = value
+        return True
+
+    def delete(self, key):
+        self.store.pop(key, None)
+
+
+class _FakeQueue:
+    enqueued: list[tuple] = []
+
+    def __init__(self, name, connection=None):
+        self.name = name
+
+    def enqueue(self, func, *args, **kwargs):
+        _FakeQueue.enqueued.append((self.name, func, args, kwargs.get("job_id")))
+
+
+@pytest.fixture
+def test_db_session(tmp_path, monkeypatch):
+    monkeypatch.setattr(get_settings(), "kb_storage_path", str(tmp_path / "kb"))
+    engine = get_test_engine()
+    Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    r = _FakeRedis()
+    monkeypatch.setattr(kb_preview, "_redis", lambda: r)
+    monkeypatch.setattr("rq.Queue", _FakeQueue)
+    _FakeQueue.enqueued = []
+    return r
+
+
+def _make_file(db, tmp_path, filename="policy.docx", content=b"docx-bytes"):
+    portal = Portal(domain="preview.bitrix24.ru", status="active")
+    db.add(portal)
+    db.commit()
+    path = tmp_path / filename
+    path.write_bytes(content)
+    rec = KBFile(
+        portal_id=portal.id,
+        filename=filename,
+        size_bytes=len(content),
+        storage_path=str(path),
+        status="ready",
+    )
+    db.add(rec)
+    db.commit()
+    db.refresh(rec)
+    return rec
+
+
+def test_request_preview_is_single_flight(test_db_session, tmp_path, fake_redis):
+    rec = _make_file(test_db_session, tmp_path)
+
+    first = kb_preview.request_preview(test_db_session, rec)
+    second = kb_preview.request_preview(test_db_session, rec)
+
+    assert first == {"status": "pending"}
+    assert second == {"status": "pending"}
+    assert rec.sha256 == hashlib.sha256(b"docx-bytes").hexdigest()
+    assert len(_FakeQueue.enqueued) == 1
+    queue_name, func, args, job_id = _FakeQueue.enqueued[0]
+    assert queue_name == "preview"
+    assert func == "apps.worker.jobs.render_kb_preview"
+    assert args == (rec.id,)
+    assert job_id == f"kbpreview:{rec.sha256}"
+
+
+def test_request_preview_unsupported_for_media(test_db_session, tmp_path, fake_redis):
+    rec = _make_file(test_db_session, tmp_path, filename="call.mp3")
+    assert kb_preview.request_preview(test_db_session, rec) == {"status": "unsupported"}
+    assert _FakeQueue.enqueued == []
+
+
+def test_render_preview_fills_cache_and_assigns_pages(test_db_session, tmp_path, fake_redis, monkeypatch):
+    rec = _make_file(test_db_session, tmp_path)
+    test_db_session.add(KBChunk(portal_id=rec.portal_id, file_id=rec.id, chunk_index=0, text="Отпуск сотрудников"))
+    test_db_session.commit()
+    calls: list[dict] = []
+
+    def _fake_render(src_path, out_path=None, timeout_seconds=None, memory_limit_bytes=None):
+        calls.append({"timeout": timeout_seconds, "memory": memory_limit_bytes})
+        with open(out_path, "wb") as f:
+            f.write(b"%PDF-1.4")
+        return out_path
+
+    monkeypatch.setattr(kb_ingest, "_generate_preview_pdf", _fake_render)
+    monkeypatch.setattr(kb_ingest, "_read_pdf_pages", lambda _p: [(1, "вводная"), (2, "отпуск сотрудников")])
+
+    result = kb_preview.render_preview(test_db_session, rec.id)
+    again = kb_preview.render_preview(test_db_session, rec.id)
+
+    assert result["ok"] is True and result["cached"] is False
+    assert again["cached"] is True
+    assert len(calls) == 1
+    assert calls[0]["memory"] == 2048 * 1024 * 1024
+    assert result["path"] == kb_preview.preview_path_for_sha(rec.sha256)
+    assert os.path.exists(result["path"])
+    assert not any(k.startswith("kb_preview:slot:") for k in fake_redis.store)
+    chunk = test_db_session.query(KBChunk).filter(KBChunk.file_id == rec.id).one()
+    assert chunk.page_num == 2
+    assert kb_preview.request_preview(test_db_session, rec) == {"status": "ready", "path": result["path"]}
+
+
+def test_render_preview_failure_is_remembered(test_db_session, tmp_path, fake_redis, monkeypatch):
+    rec = _make_file(test_db_session, tmp_path)
+    monkeypatch.setattr(kb_ingest, "_generate_preview_pdf", lambda *a, **kw: None)
+
+    result = kb_preview.render_preview(test_db_session, rec.id)
+
+    assert result == {"ok": False, "error": "render_failed"}
+    assert kb_preview.request_preview(test_db_session, rec) == {"status": "failed"}
+    assert _FakeQueue.enqueued == []
+
+
+def test_render_preview_removes_partial_output_when_renderer_raises(test_db_session, tmp_path, fake_redis, monkeypatch):
+    rec = _make_file(test_db_session, tmp_path)
+
+    def _crash(src_path, out_path=None, timeout_seconds=None, memory_limit_bytes=None):
+        with open(out_path, "wb") as f:
+            f.write(b"%PDF-half")
+        raise RuntimeError("soffice died")
+
+    monkeypatch.setattr(kb_ingest, "_generate_preview_pdf", _crash)
+    with pytest.raises(RuntimeError):
+        kb_preview.render_preview(test_db_session, rec.id)
+
+    out_dir = os.path.dirname(kb_preview.preview_path_for_sha(rec.sha256))
+    assert not [n for n in os.listdir(out_dir) if n.endswith(".tmp")]
+    assert not any(k.startswith("kb_preview:slot:") for k in fake_redis.store)
+
+
+def test_render_preview_busy_when_slots_taken(test_db_session, tmp_path, fake_redis, monkeypatch):
+    rec = _make_file(test_db_session, tmp_path)
+    monkeypatch.setattr(get_settings(), "kb_preview_max_concurrency", 1)
+    fake_redis.store["kb_preview:slot:0"] = "1"
+
+    result = kb_preview.render_preview(test_db_session, rec.id)
+
+    assert result["ok"] is False
+    assert result["error"] == "busy"
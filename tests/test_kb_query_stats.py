@@ -0,0 +1,72 @@
+"""Write-behind KB query statistics: aggregation, flush, unbuffered fallback."""
+import pytest
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+
+from apps.backend import database
+from apps.backend.database import Base, get_test_engine
+from apps.backend.models.kb import KBChunk, KBChunkCitation, KBFile
+from apps.backend.models.portal import Portal
+from apps.backend.services import kb_query_stats
+from apps.backend.services.kb_query_stats import KBQueryStats, record_citations
+
+
+@pytest.fixture
+def env(monkeypatch):
+    engine = get_test_engine()
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine)
+    monkeypatch.setattr(database, "get_session_factory", lambda: factory)
+    writer = KBQueryStats(max_events=100, batch_size=100, flush_interval=1.0, sample_watermark=1.0)
+    monkeypatch.setattr(kb_query_stats, "_stats", writer)
+    db = factory()
+    portal = Portal(domain="stats.example", status="active")
+    db.add(portal)
+    db.flush()
+    files = [KBFile(portal_id=portal.id, filename=f"{i}.txt", storage_path=f"/tmp/{i}.txt", status="ready") for i in range(2)]
+    db.add_all(files)
+    db.flush()
+    chunks = [KBChunk(portal_id=portal.id, file_id=files[i % 2].id, chunk_index=i, text=f"c{i}") for i in range(3)]
+    db.add_all(chunks)
+    db.commit()
+    try:
+        yield db, writer, files, chunks
+    finally:
+        db.close()
+
+
+def _cited(*chunks):
+    return [{"chunk_id": c.id, "file_id": c.file_id} for c in chunks]
+
+
+def _citations(db):
+    return dict(db.execute(select(KBChunkCitation.chunk_id, KBChunkCitation.citations)).all())
+
+
+def test_buffered_hits_are_summed_into_one_flush(env, monkeypatch):
+    db, writer, files, chunks = env
+    monkeypatch.setattr(KBQueryStats, "buffering", property(lambda self: True))
+    record_citations(db, _cited(chunks[0], chunks[2]))
+    record_citations(db, _cited(chunks[0], chunks[1]))
+    record_citations(db, [{"chunk_id": 999, "file_id": files[1].id}])
+    assert writer.stats()["queued"] == 3
+    db.expire_all()
+    assert db.get(KBFile, files[0].id).query_count == 0
+    assert _citations(db) == {}
+
+    assert writer.flush() == 3
+    assert writer.stats()["flushes"] == 1
+    db.expire_all()
+    assert db.get(KBFile, files[0].id).query_count == 2
+    assert db.get(KBFile, files[1].id).query_count == 2
+    assert _citations(db) == {chunks[0].id: 2, chunks[1].id: 1, chunks[2].id: 1}
+
+
+def test_unbuffered_hits_are_written_inline(env):
+    db, writer, files, chunks = env
+    record_citations(db, _cited(chunks[1]))
+    record_citations(db, _cited(chunks[1]))
+    assert writer.stats()["queued"] == 0
+    db.expire_all()
+    assert db.get(KBFile, files[1].id).query_count == 2
+    assert _citations(db) == {chunks[1].id: 2}
@@ -1,4 +1,4 @@
-﻿from apps.backend.services.kb_rag import _rerank_candidates
+﻿from apps.backend.services.kb_rag import _keyword_hits, _keyword_hits_joined, _rerank_candidates
 
 
 def test_rerank_prioritizes_filename_focus_term():
@@ -59,3 +59,11 @@ def test_rerank_penalizes_chunks_without_query_evidence():
     out = _rerank_candidates(query, candidates, top_k=2)
 
     assert out[0]["chunk_id"] == 102
+
+
+def test_joined_keyword_hits_match_hits_on_joined_text():
+    keywords = ["фоллаут", "серии", "убежище рейдеры", "1 сезон", "mp3", "лагутин"]
+    parts = ("Сериал Фоллаут - 1 сезон 6 серия.mp3", "", "https://example.com/fallout", "Убежище и рейдеры.")
+    assert _keyword_hits_joined(parts, keywords) == _keyword_hits(" ".join(parts), keywords)
+    assert _keyword_hits_joined(parts[:1], keywords) == _keyword_hits(parts[0], keywords)
+    assert _keyword_hits_joined(("", ""), keywords) == 0
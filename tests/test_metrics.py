@@ -0,0 +1,113 @@
+"""In-process metrics: Prometheus rendering, stage timers, shared aggregation, /metrics."""
+import pytest
+from fastapi.testclient import TestClient
+
+from apps.backend.config import get_settings
+from apps.backend.main import app
+from apps.backend.services import metrics
+
+
+class _FakeRedis:
+    def __init__(self):
+        self.hash: dict[bytes, float] = {}
+
+    def pipeline(self, transaction=False):
+        return self
+
+    def hincrbyfloat(self, _key, field, value):
+        k = field.encode()
+        self.hash[k] = self.hash.get(k, 0.0) + value
+
+    def execute(self):
+        return []
+
+    def hgetall(self, _key):
+        return {k: str(v).encode() for k, v in self.hash.items()}
+
+
+@pytest.fixture(autouse=True)
+def clean_registry():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_render_counters_histograms_and_stage_timer():
+    metrics.inc("outbox_sent_total", provider="telegram")
+    metrics.inc("outbox_sent_total", 2, provider="telegram")
+    metrics.observe("kb_answer_seconds", 0.03, outcome="ok")
+    metrics.observe("kb_answer_seconds", 7.0, outcome="ok")
+    stages = metrics.StageTimer("kb_answer_stage_seconds")
+    stages.mark("embedding")
+    stages.mark("llm")
+
+    text = metrics.render(shared=False)
+    assert 'outbox_sent_total{provider="telegram"} 3' in text
+    assert "# TYPE kb_answer_seconds histogram" in text
+    assert 'kb_answer_seconds_bucket{outcome="ok",le="0.05"} 1' in text
+    assert 'kb_answer_seconds_bucket{outcome="ok",le="10.0"} 2' in text
+    assert 'kb_answer_seconds_bucket{outcome="ok",le="+Inf"} 2' in text
+    assert 'kb_answer_seconds_count{outcome="ok"} 2' in text
+    assert 'kb_answer_stage_seconds_count{stage="embedding"} 1' in text
+    assert 'kb_answer_stage_seconds_count{stage="llm"} 1' in text
+
+
+def test_timed_keeps_outcome_labels_bounded():
+    @metrics.timed("job_seconds", outcome=lambda r: r[1])
+    def job(err):
+        return None, err
+
+    job(None)
+    job("kb_empty")
+    job("HTTP 500: upstream said something long")
+    with pytest.raises(ValueError):
+        metrics.timed("job_seconds")(lambda: (_ for _ in ()).throw(ValueError()))()
+
+    text = metrics.render(shared=False)
+    for outcome in ("ok", "kb_empty", "error", "exception"):
+        assert f'job_seconds_count{{outcome="{outcome}"}} 1' in text
+
+
+def test_flush_adds_only_deltas_to_shared_totals(monkeypatch):
+    fake = _FakeRedis()
+    monkeypatch.setattr(metrics, "_redis", lambda: fake)
+    metrics.inc("jobs_total", queue="ingest")
+    metrics.observe("kb_ingest_seconds", 0.2, outcome="ok")
+    assert metrics.flush_shared()
+    assert metrics.flush_shared()  # nothing new: no double counting
+    metrics.inc("jobs_total", queue="ingest")
+
+    # another process (an RQ work-horse) flushed into the same hash
+    fake.hincrbyfloat(metrics.SHARED_KEY, 'c|jobs_total|[["queue","ingest"]]|', 5)
+
+    text = metrics.render()
+    assert 'jobs_total{queue="ingest"} 7' in text
+    assert 'kb_ingest_seconds_count{outcome="ok"} 1' in text
+
+
+def test_metrics_endpoint_and_db_pool(monkeypatch):
+    client = TestClient(app)
+    monkeypatch.setattr(metrics, "_redis", lambda: _FakeRedis())
+    client.get("/ready")  # checks out a DB connection
+    monkeypatch.setattr(get_settings(), "metrics_token", "")
+    assert client.get("/metrics").status_code == 404
+
+    monkeypatch.setattr(get_settings(), "metrics_token", "secret")
+    assert client.get("/metrics").status_code == 401
+    r = client.get("/metrics", headers={"Authorization": "Bearer secret"})
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/plain")
+    assert "db_pool_checkouts_total" in r.text
+
+
+def test_forked_child_flushes_only_its_own_values(monkeypatch):
+    fake = _FakeRedis()
+    monkeypatch.setattr(metrics, "_redis", lambda: fake)
+    metrics.inc("jobs_total", 3, queue="ingest")
+    metrics.observe("kb_ingest_seconds", 0.2, outcome="ok")
+
+    metrics._after_fork_in_child()  # what os.register_at_fork runs in a forked work horse
+    metrics.inc("jobs_total", queue="ingest")
+    assert metrics.flush_shared()
+
+    assert fake.hash == {b'c|jobs_total|[["queue","ingest"]]|': 1.0}
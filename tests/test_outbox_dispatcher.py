@@ -0,0 +1,177 @@
+"""Outbox dispatcher: batch claims, per-destination lanes, ordered Bitrix batches, bulk statuses."""
+import json
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+
+from apps.backend.config import get_settings
+from apps.backend.database import Base, get_test_engine
+from apps.backend.models.bitrix_log import BitrixHttpLog
+from apps.backend.models.outbox import Outbox
+from apps.backend.models.portal import Portal
+from apps.backend.services import outbox_dispatcher
+from apps.backend.services.outbox_dispatcher import dispatch
+
+
+@pytest.fixture
+def env(monkeypatch):
+    engine = get_test_engine()
+    Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    portals = [Portal(domain=f"p{i}.bitrix24.ru", status="active") for i in (1, 2)]
+    db.add_all(portals)
+    db.commit()
+
+    batches: list[tuple[str, list[str], str]] = []
+    sent_tg: list[tuple[str, str, str]] = []
+
+    def batch(domain, token, commands, halt=False, timeout_sec=60):
+        batches.append((domain, list(commands.values()), token))
+        results, errors = {}, {}
+        for key, cmd in commands.items():
+            if "DIALOG_ID=broken" in cmd:
+                errors[key] = {"error": "DIALOG_NOT_FOUND", "error_description": "no dialog"}
+            else:
+                results[key] = len(results) + 1
+        return results, errors, None, ""
+
+    def tg_send(token, chat_id, text):
+        sent_tg.append((token, chat_id, text))
+        return True, None
+
+    monkeypatch.setattr(outbox_dispatcher.bitrix_client, "rest_batch", batch)
+    monkeypatch.setattr(outbox_dispatcher.telegram_client, "telegram_send_message", tg_send)
+    monkeypatch.setattr(outbox_dispatcher, "wait_portal_slot", lambda portal_id: None)
+    monkeypatch.setattr(outbox_dispatcher, "get_portal_telegram_token_plain", lambda db, portal_id, kind: f"bot{portal_id}")
+    try:
+        yield db, [p.id for p in portals], batches, sent_tg
+    finally:
+        db.close()
+
+
+def _row(db, portal_id, **payload) -> int:
+    o = Outbox(portal_id=portal_id, status="created", payload_json=json.dumps(payload))
+    db.add(o)
+    db.commit()
+    return o.id
+
+
+def test_dispatch_groups_by_portal_and_keeps_dialog_order(env):
+    db, (p1, p2), batches, sent_tg = env
+    long_body = "\n".join(["абзац " * 100] * 12)  # ~7k chars -> 3 parts
+    ids = [
+        _row(db, p1, dialog_id="chat1", body="first", bot_id=7, app_token="a", access_token="t1", trace_id="tr-1"),
+        _row(db, p2, dialog_id="chat9", body="other portal", access_token="t2"),
+        _row(db, p1, dialog_id="chat1", body=long_body, bot_id=7, app_token="a", access_token="t1"),
+        _row(db, p1, dialog_id="broken", body="x", bot_id=7, app_token="a", access_token="t1"),
+        _row(db, p1, provider="telegram", chat_id="42", body="hi"),
+        _row(db, p1, dialog_id="", body="no dialog", access_token="t1"),
+    ]
+
+    result = dispatch(db)
+    assert result == {"claimed": 6, "sent": 4, "failed": 2, "more": False}
+
+    by_domain = {domain: cmds for domain, cmds, _token in batches}
+    assert len(batches) == 2  # one batch call per portal
+    p1_cmds = by_domain["https://p1.bitrix24.ru"]
+    assert len(p1_cmds) == 5
+    assert p1_cmds[0].startswith("imbot.message.add?BOT_ID=7&DIALOG_ID=chat1&MESSAGE=first")
+    assert all("DIALOG_ID=chat1" in c for c in p1_cmds[1:4])
+    assert by_domain["https://p2.bitrix24.ru"][0].startswith("im.message.add?DIALOG_ID=chat9")
+    assert sent_tg == [(f"bot{p1}", "42", "hi")]
+
+    db.expire_all()
+    rows = {o.id: o for o in db.execute(select(Outbox)).scalars()}
+    assert [rows[i].status for i in ids] == ["sent", "sent", "sent", "error", "sent", "error"]
+    assert rows[ids[3]].error_message == "Bitrix API failed: DIALOG_NOT_FOUND (no dialog)"
+    assert rows[ids[3]].retry_count == 1
+    assert (rows[ids[5]].error_message, rows[ids[5]].retry_count) == ("Missing dialog_id or body", 0)
+    assert all(rows[i].sent_at and rows[i].claimed_at is None for i in (ids[0], ids[1], ids[2], ids[4]))
+    log = db.execute(select(BitrixHttpLog).where(BitrixHttpLog.trace_id == "tr-1")).scalar_one()
+    assert (log.path, log.status_code) == ("imbot.message.add", 200)
+
+    # every row was claimed by the first job: the next ones are no-ops
+    batches.clear()
+    assert dispatch(db) == {"claimed": 0, "sent": 0, "failed": 0, "more": False}
+    assert batches == []
+
+
+def test_rows_with_different_event_tokens_share_one_portal_lane(env):
+    db, (p1, _p2), batches, _sent_tg = env
+    for n, token in enumerate(["ev-a", "ev-b", "ev-c", "ev-b"]):
+        _row(db, p1, dialog_id="chat1", body=f"m{n}", access_token=token)
+
+    assert dispatch(db)["sent"] == 4
+    assert len(batches) == 1
+    _domain, cmds, token = batches[0]
+    assert token == "ev-b"  # the newest row's token
+    assert [c.rsplit("MESSAGE=", 1)[1] for c in cmds] == ["m0", "m1", "m2", "m3"]
+
+
+def test_failed_part_halts_its_message_and_requeues_other_dialogs(env, monkeypatch):
+    db, (p1, _p2), _batches, _sent_tg = env
+    long_body = "\n".join(["абзац " * 100] * 12)  # ~7k chars -> 3 parts
+    long_id = _row(db, p1, dialog_id="chat1", body=long_body, access_token="t1")
+    other_id = _row(db, p1, dialog_id="chat2", body="after", access_token="t1")
+    calls: list[tuple[bool, list[str]]] = []
+
+    def batch(domain, token, commands, halt=False, timeout_sec=60):
+        calls.append((halt, list(commands)))
+        results, errors = {}, {}
+        for key in commands:
+            if key == f"o{long_id}_1":
+                errors[key] = {"error": "ACCESS_DENIED", "error_description": "denied"}
+                if halt:
+                    break
+            else:
+                results[key] = True
+        return results, errors, None, ""
+
+    monkeypatch.setattr(outbox_dispatcher.bitrix_client, "rest_batch", batch)
+
+    assert dispatch(db) == {"claimed": 2, "sent": 1, "failed": 1, "more": False}
+    assert calls == [
+        (True, [f"o{long_id}_0", f"o{long_id}_1", f"o{long_id}_2", f"o{other_id}_0"]),
+        (False, [f"o{other_id}_0"]),
+    ]
+    db.expire_all()
+    assert db.get(Outbox, long_id).status == "error"
+    assert db.get(Outbox, other_id).status == "sent"
+
+
+def test_claim_skips_portals_in_flight_and_takes_over_stale_rows(env):
+    db, (p1, p2), _batches, _sent_tg = env
+    in_flight = _row(db, p1, dialog_id="chat1", body="in flight", access_token="t1")
+    queued = _row(db, p1, dialog_id="chat1", body="after it", access_token="t1")
+    stuck = _row(db, p2, dialog_id="chat9", body="stuck", access_token="t2")
+    db.get(Outbox, in_flight).status = db.get(Outbox, stuck).status = "sending"
+    db.get(Outbox, in_flight).claimed_at = datetime.utcnow()
+    db.get(Outbox, stuck).claimed_at = datetime.utcnow() - timedelta(hours=1)
+    db.commit()
+
+    # another worker still delivers portal 1: its next row must wait, or it could overtake
+    result = dispatch(db)
+    assert (result["claimed"], result["more"]) == (1, False)
+    db.expire_all()
+    assert [db.get(Outbox, i).status for i in (in_flight, queued, stuck)] == ["sending", "created", "sent"]
+
+
+def test_claims_are_refreshed_while_a_lane_is_slow(env, monkeypatch):
+    db, (p1, _p2), _batches, _sent_tg = env
+    monkeypatch.setattr(get_settings(), "outbox_claim_ttl_seconds", 1)
+    touched: list[list[int]] = []
+    touch = outbox_dispatcher._touch_claims
+    monkeypatch.setattr(outbox_dispatcher, "_touch_claims", lambda db, ids: (touched.append(ids), touch(db, ids)))
+
+    def slow_send(token, chat_id, text):
+        time.sleep(0.8)
+        return True, None
+
+    monkeypatch.setattr(outbox_dispatcher.telegram_client, "telegram_send_message", slow_send)
+    oid = _row(db, p1, provider="telegram", chat_id="42", body="slow")
+
+    assert dispatch(db)["sent"] == 1
+    assert touched and touched[0] == [oid]
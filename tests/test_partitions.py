@@ -0,0 +1,87 @@
+"""Partition maintenance helpers (naming, bounds, premake/retention planning)."""
+from datetime import datetime
+
+from sqlalchemy.orm import sessionmaker
+
+from apps.backend.database import Base, get_test_engine
+from apps.backend.services import partitions
+
+
+class _RecordingDB:
+    def __init__(self):
+        self.sql: list[str] = []
+
+    def execute(self, stmt, params=None):
+        self.sql.append(str(stmt))
+
+        class _R:
+            def first(self_inner):
+                return None
+
+        return _R()
+
+    def commit(self):
+        pass
+
+
+def test_period_helpers():
+    ts = datetime(2026, 12, 31, 23, 59)
+    assert partitions.period_start(ts, "day") == datetime(2026, 12, 31)
+    assert partitions.next_period(datetime(2026, 12, 31), "day") == datetime(2027, 1, 1)
+    assert partitions.next_period(datetime(2026, 12, 1), "month") == datetime(2027, 1, 1)
+    assert partitions.partition_name("outbox", datetime(2026, 3, 1), "month") == "outbox_p202603"
+    assert partitions.partition_name("bitrix_http_logs", datetime(2026, 3, 9), "day") == "bitrix_http_logs_p20260309"
+    assert partitions._parse_bound("'2026-10-19 00:00:00+00'") == datetime(2026, 10, 19)
+    assert partitions._parse_bound("MINVALUE") is None
+
+
+def test_sqlite_is_never_partitioned():
+    engine = get_test_engine()
+    Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    try:
+        assert partitions.is_partitioned(db, "bitrix_inbound_events") is False
+        assert partitions.list_partitions(db, "bitrix_inbound_events") == []
+        assert partitions.maintain_table(db, "outbox") == {"partitioned": False}
+        assert partitions.relation_size(db, "outbox")["bytes"] == 0
+    finally:
+        db.close()
+
+
+def test_ensure_partitions_fills_gap_up_to_horizon(monkeypatch):
+    db = _RecordingDB()
+    monkeypatch.setattr(partitions, "is_partitioned", lambda _db, _t: True)
+    monkeypatch.setattr(partitions, "list_partitions", lambda _db, _t: [
+        {"name": "bitrix_http_logs_legacy", "lower": None, "upper": datetime(2026, 10, 17), "is_default": False, "approx_rows": 10},
+        {"name": "bitrix_http_logs_default", "lower": None, "upper": None, "is_default": True, "approx_rows": 0},
+    ])
+
+    created = partitions.ensure_partitions(db, "bitrix_http_logs", now=datetime(2026, 10, 19, 12))
+
+    assert created == [
+        "bitrix_http_logs_p20261017",
+        "bitrix_http_logs_p20261018",
+        "bitrix_http_logs_p20261019",
+        "bitrix_http_logs_p20261020",
+        "bitrix_http_logs_p20261021",
+        "bitrix_http_logs_p20261022",
+    ]
+    assert "FROM ('2026-10-22 00:00:00') TO ('2026-10-23 00:00:00')" in db.sql[-1]
+
+
+def test_drop_partitions_before_skips_open_and_busy(monkeypatch):
+    db = _RecordingDB()
+    parts = [
+        {"name": "outbox_legacy", "lower": None, "upper": datetime(2026, 7, 1), "is_default": False, "approx_rows": 5},
+        {"name": "outbox_p202607", "lower": datetime(2026, 7, 1), "upper": datetime(2026, 8, 1), "is_default": False, "approx_rows": 5},
+        {"name": "outbox_p202610", "lower": datetime(2026, 10, 1), "upper": datetime(2026, 11, 1), "is_default": False, "approx_rows": 5},
+        {"name": "outbox_default", "lower": None, "upper": None, "is_default": True, "approx_rows": 0},
+    ]
+    monkeypatch.setattr(partitions, "list_partitions", lambda _db, _t: parts)
+
+    dropped = partitions.drop_partitions_before(db, "outbox", datetime(2026, 9, 1))
+
+    assert [p["name"] for p in dropped] == ["outbox_legacy", "outbox_p202607"]
+    assert any("status IN ('created', 'sending', 'error')" in q for q in db.sql)
+    assert 'DROP TABLE "outbox_legacy"' in db.sql
+    assert not any("outbox_p202610" in q for q in db.sql)
@@ -0,0 +1,63 @@
+"""Per-portal Bitrix pacing: slots shared through Redis, in-process fallback."""
+import pytest
+
+from apps.backend.config import get_settings
+from apps.backend.services import portal_pacing
+
+
+class _FakeRedis:
+    """Runs the reserve script in Python against one shared dict and a fixed clock."""
+
+    def __init__(self):
+        self.values: dict[str, int] = {}
+        self.now_us = 1_000_000_000
+
+    def register_script(self, _lua):
+        def script(keys, args):
+            slot = max(self.now_us, self.values.get(keys[0], 0))
+            self.values[keys[0]] = slot + int(args[0])
+            return slot - self.now_us
+
+        return script
+
+
+@pytest.fixture
+def paced(monkeypatch):
+    monkeypatch.setattr(get_settings(), "bitrix_portal_rps", 2.0)
+    monkeypatch.setattr(portal_pacing, "_script", None)
+    monkeypatch.setattr(portal_pacing, "_redis_down_until", 0.0)
+    monkeypatch.setattr(portal_pacing, "_local_next", {})
+    sleeps: list[float] = []
+    monkeypatch.setattr(portal_pacing.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def test_processes_share_one_portal_budget(paced, monkeypatch):
+    shared = _FakeRedis()
+    monkeypatch.setattr(portal_pacing, "_redis", lambda: shared)
+
+    portal_pacing.wait_portal_slot(1)
+    # another work horse: its own module state, the same Redis
+    monkeypatch.setattr(portal_pacing, "_script", None)
+    monkeypatch.setattr(portal_pacing, "_local_next", {})
+    portal_pacing.wait_portal_slot(1)
+    portal_pacing.wait_portal_slot(1)
+    portal_pacing.wait_portal_slot(2)
+
+    assert paced == [0.5, 1.0]
+    assert portal_pacing._local_next == {}
+
+
+def test_falls_back_to_process_pacing_without_redis(paced, monkeypatch):
+    connects: list[int] = []
+
+    def down():
+        connects.append(1)
+        raise ConnectionError("redis down")
+
+    monkeypatch.setattr(portal_pacing, "_redis", down)
+    for _ in range(3):
+        portal_pacing.wait_portal_slot(1)
+
+    assert len(paced) == 2 and all(0.4 < s <= 1.0 for s in paced)
+    assert connects == [1]  # not retried on every call
@@ -0,0 +1,184 @@
+"""Admin revenue list served from per-account policy snapshots."""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event, update
+from sqlalchemy.orm import sessionmaker
+
+from apps.backend.database import Base, get_test_engine
+from apps.backend.models.account import Account, AccountIntegration
+from apps.backend.models.billing import BillingAccountAdjustment, BillingAccountSnapshot, BillingPlan, BillingPlanVersion
+from apps.backend.services.billing import (
+    assign_account_to_cohort_v2,
+    create_billing_plan_version,
+    create_revenue_cohort_v2,
+    ensure_base_plans,
+    get_account_effective_commercial_policy_v2,
+    get_account_effective_runtime_policy_v2,
+    list_revenue_accounts_v2,
+    upsert_account_subscription,
+    upsert_revenue_cohort_policy_v2,
+)
+from apps.backend.services import revenue_snapshots
+from apps.backend.services.revenue_snapshots import _stale_account_ids, refresh_account_snapshots
+
+
+@pytest.fixture
+def db():
+    engine = get_test_engine()
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def _plans(db) -> dict[str, BillingPlan]:
+    return {p.code: p for p in ensure_base_plans(db)}
+
+
+def _account(db, name: str, *, plan: BillingPlan | None = None, channel: str | None = None) -> Account:
+    account = Account(name=name, status="active")
+    db.add(account)
+    db.commit()
+    if channel:
+        db.add(AccountIntegration(account_id=account.id, provider=channel, status="active", external_key=f"{channel}:{name}"))
+        db.commit()
+    if plan is not None:
+        upsert_account_subscription(db, account_id=account.id, plan_id=plan.id, status="active")
+    return account
+
+
+def _seed(db):
+    plans = _plans(db)
+    version = create_billing_plan_version(
+        db,
+        plan_id=plans["pro"].id,
+        version_code="pro-2026",
+        name="Pro 2026",
+        price_month=30000,
+        currency="RUB",
+        limits_json={},
+        features_json={},
+        is_default_for_new_accounts=True,
+    )
+    cohort = create_revenue_cohort_v2(db, code="bitrix", name="Bitrix", rule_json={"channel": "bitrix"})
+    upsert_revenue_cohort_policy_v2(
+        db, cohort_id=cohort["id"], plan_version_id=version["id"], discount_type="percent", discount_value=10
+    )
+    a = _account(db, "Alpha", plan=plans["pro"], channel="bitrix")
+    b = _account(db, "Beta", plan=plans["start"])
+    c = _account(db, "Gamma")
+    db.add(BillingAccountAdjustment(account_id=b.id, kind="discount_fixed", value_json={"amount": 900}))
+    db.commit()
+    return plans, cohort, a, b, c
+
+
+def test_snapshot_matches_per_account_resolution(db):
+    _plans_, cohort, a, b, c = _seed(db)
+    page = list_revenue_accounts_v2(db)
+    assert page["total"] == 3
+    by_id = {item["id"]: item for item in page["items"]}
+    for account in (a, b, c):
+        commercial = get_account_effective_commercial_policy_v2(db, account.id)
+        runtime = get_account_effective_runtime_policy_v2(db, account.id)
+        item = by_id[account.id]
+        assert item["final_price_month"] == pytest.approx(commercial["final_price_month"])
+        assert item["runtime_source"] == runtime["source"]
+        assert item["subscription_status"] == commercial["subscription_status"]
+    assert by_id[a.id]["final_price_month"] == pytest.approx(27000)
+    assert [x["id"] for x in by_id[a.id]["cohorts"]] == [cohort["id"]]
+    assert by_id[a.id]["plan_version"]["version_code"] == "pro-2026"
+    assert by_id[b.id]["final_price_month"] == pytest.approx(4000)
+    assert by_id[b.id]["adjustments_count"] == 1
+    assert by_id[c.id]["plan"] is None
+
+
+def test_changes_mark_only_affected_snapshots_stale(db):
+    _plans_, cohort, a, b, c = _seed(db)
+    list_revenue_accounts_v2(db)
+    assert _stale_account_ids(db, datetime.utcnow(), 100) == []
+
+    ensure_base_plans(db)  # rewrites base plans with identical values
+    db.commit()
+    assert _stale_account_ids(db, datetime.utcnow(), 100) == []
+
+    assign_account_to_cohort_v2(db, cohort_id=cohort["id"], account_id=c.id)
+    assert _stale_account_ids(db, datetime.utcnow(), 100) == [c.id]
+    item = next(i for i in list_revenue_accounts_v2(db)["items"] if i["id"] == c.id)
+    assert item["cohorts"][0]["source"] == "manual"
+
+    version = db.query(BillingPlanVersion).filter(BillingPlanVersion.version_code == "pro-2026").one()
+    upsert_revenue_cohort_policy_v2(
+        db, cohort_id=cohort["id"], plan_version_id=version.id, discount_type="percent", discount_value=20
+    )
+    assert set(_stale_account_ids(db, datetime.utcnow(), 100)) == {a.id, b.id, c.id}
+    by_id = {i["id"]: i for i in list_revenue_accounts_v2(db)["items"]}
+    assert by_id[a.id]["final_price_month"] == pytest.approx(24000)
+
+
+def test_future_adjustment_sets_valid_until(db):
+    _plans_, _cohort, a, _b, _c = _seed(db)
+    starts = datetime.utcnow() + timedelta(hours=2)
+    db.add(BillingAccountAdjustment(account_id=a.id, kind="custom_price", value_json={"price_month": 1000}, valid_from=starts))
+    db.commit()
+    list_revenue_accounts_v2(db)
+    snap = db.get(BillingAccountSnapshot, a.id)
+    assert snap.valid_until == starts
+    assert float(snap.final_price_month) == pytest.approx(27000)
+    assert _stale_account_ids(db, starts + timedelta(seconds=1), 100) == [a.id]
+
+
+def test_refresh_keeps_an_account_whose_stamp_moved_while_computing(db, monkeypatch):
+    _plans_, _cohort, a, b, _c = _seed(db)
+    list_revenue_accounts_v2(db)
+    earlier = datetime.utcnow() - timedelta(minutes=5)
+    db.execute(update(BillingAccountSnapshot).values(stale_since=earlier))
+    db.commit()
+    compute = revenue_snapshots.compute_account_snapshots
+
+    def compute_then_restamp(session, ids, now):
+        rows = compute(session, ids, now=now)
+        # a change committed now, stamped with a time from before the refresh started
+        session.execute(
+            update(BillingAccountSnapshot)
+            .where(BillingAccountSnapshot.account_id == a.id)
+            .values(stale_since=earlier - timedelta(seconds=1))
+        )
+        return rows
+
+    monkeypatch.setattr(revenue_snapshots, "compute_account_snapshots", compute_then_restamp)
+    assert refresh_account_snapshots(db) == 2
+    db.expire_all()
+    assert db.get(BillingAccountSnapshot, a.id).stale_since == earlier - timedelta(seconds=1)
+    assert db.get(BillingAccountSnapshot, b.id).stale_since is None
+
+
+def test_list_filters_sorts_pages_without_per_account_queries(db):
+    plans, cohort, a, b, c = _seed(db)
+    assert [i["id"] for i in list_revenue_accounts_v2(db, plan_code="start")["items"]] == [b.id]
+    assert [i["id"] for i in list_revenue_accounts_v2(db, cohort_id=cohort["id"])["items"]] == [a.id]
+    assert [i["id"] for i in list_revenue_accounts_v2(db, subscription_status="none")["items"]] == [c.id]
+    assert [i["id"] for i in list_revenue_accounts_v2(db, q="gam")["items"]] == [c.id]
+    page = list_revenue_accounts_v2(db, sort="-final_price_month", limit=2)
+    assert [i["id"] for i in page["items"]] == [a.id, b.id]
+    assert page["total"] == 3
+
+    statements: list[str] = []
+    engine = db.get_bind()
+    listener = lambda *args: statements.append(args[2])  # noqa: E731
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        statements.clear()
+        list_revenue_accounts_v2(db)
+        small = len(statements)
+        for i in range(20):
+            _account(db, f"Extra {i}", plan=plans["business"])
+        list_revenue_accounts_v2(db)
+        statements.clear()
+        list_revenue_accounts_v2(db)
+        large = len(statements)
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    assert large == small
@@ -0,0 +1,37 @@
+"""Startup cost: lazy lemmatizer, worker preload, import-time profile parsing."""
+import gc
+import subprocess
+import sys
+
+from apps.backend.services import startup
+from apps.backend.services.startup import parse_importtime, preload
+
+IMPORTTIME = """import time: self [us] | cumulative | imported package
+import time:       120 |        120 |     zipimport
+import time:      2500 |       3100 |   fastapi
+import time:     54200 |      74670 | apps.backend.services.kb_rag
+"""
+
+
+def test_parse_importtime_rows():
+    rows = parse_importtime(IMPORTTIME)
+    assert [(r["module"], r["self_us"], r["depth"]) for r in rows] == [
+        ("zipimport", 120, 2),
+        ("fastapi", 2500, 1),
+        ("apps.backend.services.kb_rag", 54200, 0),
+    ]
+
+
+def test_kb_rag_import_does_not_build_the_analyzer():
+    code = "import sys, apps.backend.services.kb_rag as k; print('pymorphy3' in sys.modules, k._MORPH is k._MORPH_UNSET)"
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout.split()
+    assert out == ["False", "True"]
+
+
+def test_preload_imports_modules_and_skips_missing_optional(monkeypatch):
+    monkeypatch.setattr(gc, "freeze", lambda: None)
+    report = preload(modules=("apps.worker.jobs",), optional=("no_such_parser_lib",))
+    assert "apps.worker.jobs" in report["steps_ms"]
+    assert "pymorphy3.MorphAnalyzer" in report["steps_ms"]
+    assert report["skipped"] == ["no_such_parser_lib"]
+    assert startup.startup_report()["preload"]["skipped"] == ["no_such_parser_lib"]
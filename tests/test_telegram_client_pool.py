@@ -0,0 +1,176 @@
+"""Pooled Telegram client and long-polling against a local fake Bot API server."""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from apps.backend.clients import telegram as tg
+from apps.backend.config import get_settings
+from apps.backend.database import Base, get_test_engine
+from apps.backend.models.portal import Portal
+from apps.backend.services import telegram_polling
+from apps.backend.services.telegram_settings import list_polling_telegram_bots, set_portal_telegram_settings
+
+FILE_BYTES = b"x" * (256 * 1024)
+
+
+class _FakeBotApi(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    calls: list[tuple[str, dict]] = []
+    ports: set[int] = set()
+    updates: list[dict] = []
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status: int, body: bytes, ctype: str = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        _FakeBotApi.ports.add(self.client_address[1])
+        if self.path == "/file/botT1/docs/a.pdf":
+            self._reply(200, FILE_BYTES, "application/octet-stream")
+        else:
+            self._reply(404, b"{}")
+
+    def do_POST(self):
+        _FakeBotApi.ports.add(self.client_address[1])
+        length = int(self.headers.get("Content-Length") or 0)
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        method = self.path.rsplit("/", 1)[-1]
+        _FakeBotApi.calls.append((method, payload))
+        if method == "getUpdates":
+            offset = payload.get("offset") or 0
+            result = [u for u in _FakeBotApi.updates if u["update_id"] >= offset]
+        elif method == "getFile":
+            result = {"file_id": payload["file_id"], "file_path": "docs/a.pdf"}
+        elif method == "sendMessage":
+            result = {"message_id": len(_FakeBotApi.calls)}
+        else:
+            result = True
+        self._reply(200, json.dumps({"ok": True, "result": result}).encode())
+
+
+@pytest.fixture
+def bot_api(monkeypatch):
+    _FakeBotApi.calls = []
+    _FakeBotApi.ports = set()
+    _FakeBotApi.updates = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeBotApi)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(get_settings(), "telegram_api_base_url", f"http://127.0.0.1:{server.server_address[1]}")
+    tg.close_client()
+    try:
+        yield _FakeBotApi
+    finally:
+        tg.close_client()
+        server.shutdown()
+        server.server_close()
+
+
+def test_send_messages_reuse_one_connection(bot_api, monkeypatch):
+    monkeypatch.setattr(get_settings(), "telegram_chat_rate_per_second", 1000.0)
+    monkeypatch.setattr(get_settings(), "telegram_global_rate_per_second", 1000.0)
+    for i in range(5):
+        assert tg.telegram_send_message("T1", 42, f"hi {i}") == (True, None)
+    assert [c[0] for c in bot_api.calls] == ["sendMessage"] * 5
+    assert len(bot_api.ports) == 1
+
+
+def test_rate_limiter_spaces_bot_and_chat_slots(monkeypatch):
+    monkeypatch.setattr(get_settings(), "telegram_global_rate_per_second", 30.0)
+    monkeypatch.setattr(get_settings(), "telegram_chat_rate_per_second", 1.0)
+    limiter = tg._RateLimiter()
+    assert limiter.reserve("T1", 1, now=100.0) == 0
+    assert limiter.reserve("T1", 1, now=100.0) == pytest.approx(1.0)
+    assert limiter.reserve("T1", 2, now=100.0) == pytest.approx(2 / 30)
+    assert limiter.reserve("T2", 1, now=100.0) == 0
+
+
+def test_download_streams_file_to_disk(bot_api, tmp_path):
+    info, err = tg.telegram_get_file("T1", "f1")
+    assert err is None
+    dst = tmp_path / "a.pdf"
+    ok, err = tg.telegram_download_file("T1", info["file_path"], str(dst))
+    assert (ok, err) == (True, None)
+    assert dst.read_bytes() == FILE_BYTES
+    assert not (tmp_path / "a.pdf.part").exists()
+
+    ok, err = tg.telegram_download_file("T1", "docs/missing.pdf", str(tmp_path / "b.pdf"))
+    assert (ok, err) == (False, "http_404")
+    assert list(tmp_path.iterdir()) == [dst]
+
+
+def test_poll_bot_once_dispatches_updates_and_advances_offset(bot_api, monkeypatch):
+    bot_api.updates = [
+        {"update_id": 10, "message": {"message_id": 1, "chat": {"id": 5, "type": "private"}, "text": "a"}},
+        {"update_id": 11, "message": {"message_id": 2, "chat": {"id": 5, "type": "private"}, "text": "b"}},
+    ]
+    seen = []
+    monkeypatch.setattr(telegram_polling.database, "get_session_factory", lambda: (lambda: _NullSession()))
+    monkeypatch.setattr(
+        telegram_polling,
+        "dispatch_telegram_update",
+        lambda db, portal_id, kind, update: seen.append((portal_id, kind, update["update_id"])),
+    )
+
+    offset = telegram_polling.poll_bot_once(7, "client", "T1", None, timeout=0)
+    assert offset == 12
+    assert seen == [(7, "client", 10), (7, "client", 11)]
+    assert telegram_polling.poll_bot_once(7, "client", "T1", offset, timeout=0) == 12
+    assert len(seen) == 2
+    assert bot_api.calls[-1] == ("getUpdates", {"timeout": 0, "limit": 100, "allowed_updates": ["message", "edited_message"], "offset": 12})
+
+
+def test_poll_bot_once_checkpoints_each_update_and_stops_when_the_lease_is_lost(bot_api, monkeypatch):
+    bot_api.updates = [
+        {"update_id": n, "message": {"message_id": n, "chat": {"id": 5, "type": "private"}, "text": "a"}}
+        for n in (20, 21, 22)
+    ]
+    seen, checkpoints = [], []
+    monkeypatch.setattr(telegram_polling.database, "get_session_factory", lambda: (lambda: _NullSession()))
+    monkeypatch.setattr(
+        telegram_polling,
+        "dispatch_telegram_update",
+        lambda db, portal_id, kind, update: seen.append(update["update_id"]),
+    )
+
+    def checkpoint(offset):
+        checkpoints.append(offset)
+        return len(checkpoints) < 3  # the lease expires while update 21 is handled
+
+    offset = telegram_polling.poll_bot_once(7, "client", "T1", 20, timeout=0, checkpoint=checkpoint)
+    assert seen == [20, 21]
+    assert checkpoints == [20, 21, 22]  # the handled offset is stored before every next update
+    assert offset == 22
+
+
+def test_only_bots_switched_to_polling_are_polled():
+    engine = get_test_engine()
+    Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    try:
+        portal = Portal(domain="nat.bitrix24.ru", status="active")
+        db.add(portal)
+        db.commit()
+        set_portal_telegram_settings(db, portal.id, kind="staff", bot_token="S1", enabled=True)
+        settings = set_portal_telegram_settings(db, portal.id, kind="client", bot_token="C1", enabled=True, polling=True)
+        assert (settings["staff"]["polling"], settings["client"]["polling"]) == (False, True)
+        assert list_polling_telegram_bots(db) == [(portal.id, "client", "C1")]
+    finally:
+        db.close()
+
+
+class _NullSession:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
@@ -0,0 +1,136 @@
+"""Expiry-ordered token refresh scheduler: due selection, lease, backoff."""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from apps.backend.config import get_settings
+from apps.backend.database import Base, get_test_engine
+from apps.backend.models.portal import Portal, PortalToken
+from apps.backend.services import portal_tokens, token_refresh_daemon as daemon
+from apps.backend.services.portal_tokens import BitrixAuthError, save_tokens
+
+
+class _FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    def ping(self):
+        return True
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value.encode() if isinstance(value, str) else value
+        return True
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+@pytest.fixture
+def env(monkeypatch):
+    engine = get_test_engine()
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine)
+    redis = _FakeRedis()
+    refreshed: list[int] = []
+
+    def _fake_refresh(db, portal_id, trace_id=None):
+        refreshed.append(portal_id)
+        save_tokens(db, portal_id, f"access_{portal_id}", f"refresh_{portal_id}", expires_in=3600)
+        return {"access_token": f"access_{portal_id}"}
+
+    monkeypatch.setattr(daemon, "get_session_factory", lambda: factory)
+    monkeypatch.setattr(daemon, "_redis", lambda: redis)
+    monkeypatch.setattr(portal_tokens, "refresh_portal_tokens", _fake_refresh)
+    monkeypatch.setattr(get_settings(), "token_refresh_lead_seconds", 600)
+    monkeypatch.setattr(get_settings(), "token_refresh_jitter_seconds", 300)
+    monkeypatch.setattr(get_settings(), "token_refresh_per_domain_rps", 0.0)
+    daemon._in_flight.clear()
+    db = factory()
+    try:
+        yield db, redis, refreshed
+    finally:
+        db.close()
+
+
+def _portal(db, domain: str, expires_in_seconds: int | None) -> int:
+    p = Portal(domain=domain, status="active")
+    db.add(p)
+    db.commit()
+    save_tokens(db, p.id, "a", "r", expires_in=3600)
+    row = db.query(PortalToken).filter(PortalToken.portal_id == p.id).one()
+    row.expires_at = None if expires_in_seconds is None else datetime.utcnow() + timedelta(seconds=expires_in_seconds)
+    db.commit()
+    return p.id
+
+
+def test_select_due_tokens_orders_by_expiry_and_skips_fresh(env):
+    db, _redis, _refreshed = env
+    fresh = _portal(db, "fresh.example", 3000)
+    soon = _portal(db, "soon.example", 400)
+    expired = _portal(db, "expired.example", -60)
+    unknown = _portal(db, "unknown.example", None)
+
+    due = daemon.select_due_tokens(db, datetime.utcnow(), 600, 300, 100)
+    assert [d[0] for d in due] == [unknown, expired, soon]
+    assert fresh not in [d[0] for d in due]
+    assert due[1][1] == "expired.example"
+    assert 600 <= due[2][2] <= 900
+
+
+def test_jitter_is_stable_and_bounded():
+    values = {daemon._jitter_seconds(pid, 300) for pid in range(1, 200)}
+    assert all(0 <= v <= 300 for v in values)
+    assert len(values) > 50
+    assert daemon._jitter_seconds(42, 300) == daemon._jitter_seconds(42, 300)
+
+
+def test_tick_refreshes_due_once_and_respects_foreign_lease(env):
+    db, redis, refreshed = env
+    a = _portal(db, "a.example", 100)
+    b = _portal(db, "b.example", 100)
+    redis.set(f"token_refresh:lease:{b}", "other-replica")
+
+    stats = daemon.refresh_tokens_once(wait=True)
+    assert stats["due"] == 2
+    assert stats.get("refreshed") == 1
+    assert stats.get("leased") == 1
+    assert refreshed == [a]
+    assert f"token_refresh:lease:{a}" not in redis.data
+
+    # The refreshed token moved an hour out; a second tick does nothing for it.
+    stats = daemon.refresh_tokens_once(wait=True)
+    assert refreshed == [a]
+    assert stats["due"] == 1
+
+
+def test_failed_refresh_backs_off_on_the_token_row(env, monkeypatch):
+    db, _redis, refreshed = env
+    broken = _portal(db, "broken.example", -60)  # soonest expiry: would lead every batch
+    healthy = _portal(db, "healthy.example", 100)
+    monkeypatch.setattr(get_settings(), "token_refresh_batch_size", 1)
+    calls = []
+    real_refresh = portal_tokens.refresh_portal_tokens
+
+    def _fail_broken(db, portal_id, trace_id=None):
+        calls.append(portal_id)
+        if portal_id == broken:
+            raise BitrixAuthError("bitrix_refresh_failed", "invalid_grant")
+        return real_refresh(db, portal_id, trace_id=trace_id)
+
+    monkeypatch.setattr(portal_tokens, "refresh_portal_tokens", _fail_broken)
+    assert daemon.refresh_tokens_once(wait=True).get("failed") == 1
+    db.expire_all()
+    row = db.query(PortalToken).filter(PortalToken.portal_id == broken).one()
+    assert row.refresh_failures == 1
+    assert row.refresh_retry_at > datetime.utcnow() + timedelta(seconds=20)
+
+    # the backed-off portal is filtered in SQL, so the healthy one gets the slot
+    stats = daemon.refresh_tokens_once(wait=True)
+    assert (stats["due"], stats.get("refreshed")) == (1, 1)
+    assert calls == [broken, healthy] and refreshed == [healthy]
@@ -0,0 +1,70 @@
+import json
+import os
+
+from apps.backend.services import transcript_store
+
+
+def _write_rows(path, rows):
+    with open(path, "w", encoding="utf-8") as f:
+        for r in rows:
+            f.write(json.dumps(r, ensure_ascii=False) + "\n")
+
+
+def _rows(n):
+    out = []
+    for i in range(n):
+        speaker = "Спикер A" if (i // 2) % 2 == 0 else "Спикер B"
+        out.append({"speaker": speaker, "text": f"фраза {i}", "start_ms": i * 1000, "end_ms": i * 1000 + 800})
+    return out
+
+
+def test_build_store_writes_merged_and_counts(tmp_path):
+    media = str(tmp_path / "call.mp3")
+    _write_rows(media + ".transcript.jsonl", _rows(10))
+
+    meta = transcript_store.build_transcript_store(media)
+
+    assert meta["raw_count"] == 10
+    assert meta["merged_count"] == 5
+    assert meta["duration_ms"] == 9800
+    assert os.path.getsize(media + ".transcript.raw.idx") == 10 * transcript_store._RECORD.size
+    merged = transcript_store.read_window(media, mode="merged", limit=100)
+    assert [it["text"] for it in merged["items"][:2]] == ["фраза 0 фраза 1", "фраза 2 фраза 3"]
+    assert merged["items"][1]["chunk_index"] == 2
+    assert merged["next_cursor"] is None
+
+
+def test_read_window_by_cursor_and_time(tmp_path):
+    media = str(tmp_path / "meeting.mp4")
+    _write_rows(media + ".transcript.jsonl", _rows(50))
+    transcript_store.build_transcript_store(media)
+
+    page1 = transcript_store.read_window(media, mode="raw", cursor=0, limit=20)
+    page2 = transcript_store.read_window(media, mode="raw", cursor=page1["next_cursor"], limit=20)
+    assert page1["next_cursor"] == 20
+    assert page2["items"][0]["id"] == -21
+    assert page2["items"][0]["text"] == "фраза 20"
+    assert page2["total"] == 50
+
+    window = transcript_store.read_window(media, mode="raw", from_ms=30500, to_ms=33000, limit=100)
+    assert [it["text"] for it in window["items"]] == ["фраза 30", "фраза 31", "фраза 32", "фраза 33"]
+    assert window["next_cursor"] is None
+
+
+def test_load_meta_rebuilds_when_source_changes(tmp_path):
+    media = str(tmp_path / "call.ogg")
+    source = media + ".transcript.jsonl"
+    _write_rows(source, _rows(3))
+    first = transcript_store.load_meta(media)
+    assert first["raw_count"] == 3
+
+    _write_rows(source, _rows(6))
+    os.utime(source, ns=(1, 1))
+    second = transcript_store.load_meta(media)
+    assert second["raw_count"] == 6
+    assert second["etag"] != first["etag"]
+
+
+def test_missing_transcript_has_no_meta(tmp_path):
+    assert transcript_store.load_meta(str(tmp_path / "none.mp3")) is None
+    assert transcript_store.read_window(str(tmp_path / "none.mp3"))["items"] == []
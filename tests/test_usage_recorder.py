@@ -0,0 +1,172 @@
+"""Buffered usage/activity recording: group commit, worker scope flush, fallbacks."""
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import event, func, select
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from apps.backend import database
+from apps.backend.database import Base, get_test_engine
+from apps.backend.models.account import Account
+from apps.backend.models.activity_event import ActivityEvent
+from apps.backend.models.billing import BillingUsage
+from apps.backend.models.portal import Portal
+from apps.backend.services import usage_recorder
+from apps.backend.services.billing import record_usage
+from apps.backend.services.usage_recorder import UsageRecord, UsageRecorder, buffered_recording
+from apps.backend.services.usage_rollup import get_requests_used, get_usage_totals
+
+
+@pytest.fixture
+def env(monkeypatch):
+    engine = get_test_engine()
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine)
+    monkeypatch.setattr(database, "get_session_factory", lambda: factory)
+    recorder = UsageRecorder(max_events=1000, batch_size=500, flush_interval=1.0, sample_watermark=1.0)
+    monkeypatch.setattr(usage_recorder, "_recorder", recorder)
+    db = factory()
+    account = Account(name="rec")
+    db.add(account)
+    db.commit()
+    portal = Portal(domain="rec.example", status="active", account_id=account.id)
+    db.add(portal)
+    db.commit()
+    try:
+        yield db, portal, recorder
+    finally:
+        db.close()
+
+
+def _record(db, portal_id: int, **kw):
+    record_usage(
+        db,
+        portal_id=portal_id,
+        user_id="1",
+        request_id=None,
+        kind="chat",
+        model="m",
+        tokens_prompt=None,
+        tokens_completion=None,
+        tokens_total=10,
+        cost_rub=Decimal("0.25"),
+        **kw,
+    )
+
+
+def _count(db, model) -> int:
+    return int(db.execute(select(func.count()).select_from(model)).scalar() or 0)
+
+
+def test_unbuffered_record_usage_commits_once(env):
+    db, portal, _recorder = env
+    commits = []
+    event.listen(db, "after_commit", lambda s: commits.append(1))
+    _record(db, portal.id)
+    assert len(commits) == 1
+    assert _count(db, BillingUsage) == 1
+    assert _count(db, ActivityEvent) == 1
+    assert get_requests_used(db, "account", portal.account_id) == 1
+
+
+def test_worker_scope_buffers_and_flushes_in_one_batch(env):
+    db, portal, recorder = env
+    commits = []
+    event.listen(db, "after_commit", lambda s: commits.append(1))
+    with buffered_recording():
+        for _ in range(40):
+            _record(db, portal.id)
+        assert recorder.stats()["queued"] == 80
+        assert _count(db, BillingUsage) == 0
+    assert commits == []
+    stats = recorder.stats()
+    assert (stats["queued"], stats["written"], stats["flushes"]) == (0, 80, 1)
+    assert stats["last_flush_ms"] >= 0
+    db.expire_all()
+    assert _count(db, BillingUsage) == 40
+    assert _count(db, ActivityEvent) == 40
+    assert get_requests_used(db, "portal", portal.id) == 40
+    assert get_usage_totals(db, "account", portal.account_id)["tokens_total"] == 400
+
+
+def test_full_queue_falls_back_to_synchronous_write(env, monkeypatch):
+    db, portal, _recorder = env
+    small = UsageRecorder(max_events=3, batch_size=10, flush_interval=1.0, sample_watermark=1.0)
+    monkeypatch.setattr(usage_recorder, "_recorder", small)
+    with buffered_recording():
+        for _ in range(3):
+            _record(db, portal.id)
+    assert small.stats()["dropped"] == 3
+    db.expire_all()
+    assert _count(db, BillingUsage) == 3
+    assert get_requests_used(db, "portal", portal.id) == 3
+
+
+def test_transactional_mode_follows_callers_transaction(env):
+    db, portal, recorder = env
+    with buffered_recording():
+        _record(db, portal.id, transactional=True)
+        assert recorder.stats()["queued"] == 0
+        db.rollback()
+    assert _count(db, BillingUsage) == 0
+
+    _record(db, portal.id, transactional=True)
+    db.commit()
+    assert _count(db, BillingUsage) == 1
+    assert _count(db, ActivityEvent) == 1
+    assert get_requests_used(db, "portal", portal.id) == 1
+
+
+def test_failed_flush_is_retried_and_a_rejected_row_drops_alone(env, monkeypatch, caplog):
+    db, portal, recorder = env
+    monkeypatch.setattr(usage_recorder, "_RETRY_DELAYS", (0, 0))
+    write = usage_recorder.write_usage_records
+    transient = [OperationalError("INSERT", {}, Exception("connection reset"))]
+
+    def flaky(session, records):
+        if transient:
+            raise transient.pop()
+        if any(r.values.get("model") == "bad" for r in records):
+            raise IntegrityError("INSERT", {}, Exception("foreign key violation"))
+        return write(session, records)
+
+    monkeypatch.setattr(usage_recorder, "write_usage_records", flaky)
+    with buffered_recording():
+        for _ in range(3):
+            _record(db, portal.id)
+    db.expire_all()
+    assert _count(db, BillingUsage) == 3  # the transient error was retried
+
+    with buffered_recording():
+        _record(db, portal.id)
+        recorder.submit(UsageRecord("usage", {"portal_id": portal.id, "model": "bad"}), force=True)
+        _record(db, portal.id)
+    db.expire_all()
+    assert _count(db, BillingUsage) == 5
+    assert get_requests_used(db, "portal", portal.id) == 5
+    assert [r.levelname for r in caplog.records if "row rejected" in r.getMessage()] == ["ERROR"]
+
+
+def test_rows_are_carried_over_while_the_database_is_down(env, monkeypatch):
+    db, portal, recorder = env
+    monkeypatch.setattr(usage_recorder, "_RETRY_DELAYS", (0,))
+    write = usage_recorder.write_usage_records
+    down = [True]
+
+    def unreachable(session, records):
+        if down[0]:
+            raise OperationalError("INSERT", {}, Exception("could not connect"))
+        return write(session, records)
+
+    monkeypatch.setattr(usage_recorder, "write_usage_records", unreachable)
+    with buffered_recording():
+        _record(db, portal.id)
+    assert recorder.stats()["carried"] == 2
+    assert _count(db, BillingUsage) == 0
+
+    down[0] = False
+    recorder.flush()
+    db.expire_all()
+    assert recorder.stats()["carried"] == 0
+    assert _count(db, BillingUsage) == 1 and _count(db, ActivityEvent) == 1
@@ -0,0 +1,120 @@
+"""Billing usage counters: in-transaction increments, lazy seed, reconciliation."""
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from apps.backend.database import Base, get_test_engine
+from apps.backend.models.account import Account
+from apps.backend.models.billing import BillingUsage, BillingUsageCounter, BillingUsageDaily
+from apps.backend.models.portal import Portal
+from apps.backend.services.billing import is_limit_exceeded, record_usage, set_portal_limit
+from apps.backend.services.usage_rollup import (
+    get_requests_used,
+    get_usage_totals,
+    period_start,
+    reconcile_usage_counters,
+)
+
+
+@pytest.fixture
+def db():
+    engine = get_test_engine()
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def _portal(db, domain: str) -> Portal:
+    account = Account(name=domain)
+    db.add(account)
+    db.commit()
+    portal = Portal(domain=domain, status="active", account_id=account.id)
+    db.add(portal)
+    db.commit()
+    return portal
+
+
+def _record(db, portal_id: int, *, status: str = "ok", kind: str = "chat", tokens: int = 10, cost: str = "0.5"):
+    record_usage(
+        db,
+        portal_id=portal_id,
+        user_id="1",
+        request_id=None,
+        kind=kind,
+        model="m",
+        tokens_prompt=None,
+        tokens_completion=None,
+        tokens_total=tokens,
+        cost_rub=Decimal(cost),
+        status=status,
+    )
+
+
+def test_record_usage_updates_counters_and_daily(db):
+    portal = _portal(db, "a.example")
+    _record(db, portal.id)
+    _record(db, portal.id)
+    _record(db, portal.id, status="error")
+    _record(db, portal.id, kind="embed", tokens=100, cost="0.1")
+
+    month = period_start()
+    chat = db.get(BillingUsageCounter, ("portal", portal.id, month, "chat"))
+    assert (chat.requests_ok, chat.events, chat.tokens_total) == (2, 3, 30)
+    assert db.get(BillingUsageCounter, ("account", portal.account_id, month, "chat")).requests_ok == 2
+    daily = db.get(BillingUsageDaily, (portal.id, datetime.utcnow().date(), "embed"))
+    assert (daily.events, daily.tokens_total, daily.account_id) == (1, 100, portal.account_id)
+
+    assert get_requests_used(db, "portal", portal.id) == 2
+    totals = get_usage_totals(db, "account", portal.account_id)
+    assert totals["tokens_total"] == 130
+    assert totals["cost_rub"] == pytest.approx(1.6)
+
+    set_portal_limit(db, portal.id, 2)
+    assert is_limit_exceeded(db, portal.id) is True
+    set_portal_limit(db, portal.id, 3)
+    assert is_limit_exceeded(db, portal.id) is False
+
+
+def test_missing_counters_are_seeded_from_raw_rows(db):
+    portal = _portal(db, "b.example")
+    db.add_all([BillingUsage(portal_id=portal.id, kind="chat", status="ok", tokens_total=5, created_at=datetime.utcnow()) for _ in range(4)])
+    db.add(BillingUsage(portal_id=portal.id, kind="chat", status="ok", created_at=datetime.utcnow() - timedelta(days=40)))
+    db.commit()
+
+    assert get_requests_used(db, "portal", portal.id) == 4
+    assert get_usage_totals(db, "account", portal.account_id)["tokens_total"] == 20
+    other = _portal(db, "c.example")
+    assert get_requests_used(db, "portal", other.id) == 0
+    assert db.get(BillingUsageCounter, ("portal", other.id, period_start(), "chat")) is not None
+
+
+def test_reconcile_reports_and_repairs_drift(db):
+    portal = _portal(db, "d.example")
+    _record(db, portal.id)
+    _record(db, portal.id, tokens=7)
+    assert reconcile_usage_counters(db)["mismatches"] == []
+
+    # Drift: a raw row written outside record_usage and a corrupted counter.
+    db.add(BillingUsage(portal_id=portal.id, kind="chat", status="ok", tokens_total=3, created_at=datetime.utcnow()))
+    counter = db.get(BillingUsageCounter, ("account", portal.account_id, period_start(), "chat"))
+    counter.requests_ok = 99
+    db.commit()
+
+    report = reconcile_usage_counters(db, fix=False)
+    keys = {tuple(m["key"][:3]) for m in report["mismatches"]}
+    assert ("counter", "portal", str(portal.id)) in keys
+    assert ("counter", "account", str(portal.account_id)) in keys
+    assert report["fixed"] == 0
+
+    report = reconcile_usage_counters(db, fix=True)
+    assert report["fixed"] == len(report["mismatches"]) >= 3
+    db.expire_all()
+    assert get_requests_used(db, "portal", portal.id) == 3
+    assert get_requests_used(db, "account", portal.account_id) == 3
+    assert db.get(BillingUsageDaily, (portal.id, datetime.utcnow().date(), "chat")).tokens_total == 20
+    assert reconcile_usage_counters(db)["mismatches"] == []
@@ -12,6 +12,7 @@ from apps.backend.models.account import Account, AccountMembership, AppUser, App
 from apps.backend.models.portal import Portal
 from apps.backend.models.web_user import WebSession, WebUser
 from apps.backend.routers import web_auth
+from apps.backend.services import bitrix_user_sync
 
 
 app = FastAPI()
@@ -133,9 +134,9 @@ def test_sync_bitrix_users_links_existing_email_across_accounts_and_creates_memb
 
     monkeypatch.setattr(web_auth, "get_valid_access_token", lambda db, portal_id: "bitrix-token")
     monkeypatch.setattr(
-        web_auth,
-        "user_get",
-        lambda domain_full, access_token, start=0, limit=200: (
+        bitrix_user_sync,
+        "user_get_page",
+        lambda domain_full, access_token, start=0, filter=None: (
             [
                 {
                     "ID": "42",
@@ -144,6 +145,7 @@ def test_sync_bitrix_users_links_existing_email_across_accounts_and_creates_memb
                     "LAST_NAME": "User",
                 }
             ],
+            1,
             None,
         ),
     )
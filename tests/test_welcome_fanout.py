@@ -0,0 +1,81 @@
+"""Welcome fan-out: batched imbot.message.add, bulk outcomes, idempotent resume."""
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.orm import sessionmaker
+
+from apps.backend.database import Base, get_test_engine
+from apps.backend.models.bitrix_log import BitrixHttpLog
+from apps.backend.models.portal import Portal, PortalUsersAccess
+from apps.backend.services import welcome_fanout
+from apps.backend.services.welcome_fanout import create_fanout, enqueue_fanout, run_fanout
+
+USERS = list(range(1, 121))
+
+
+@pytest.fixture
+def env(monkeypatch):
+    engine = get_test_engine()
+    Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    portal = Portal(domain="welcome.bitrix24.ru", status="active")
+    db.add(portal)
+    db.flush()
+    db.add_all(PortalUsersAccess(portal_id=portal.id, user_id=str(uid), kind="bitrix") for uid in USERS)
+    db.commit()
+
+    calls: list[list[str]] = []
+    limited_once: set[str] = set()
+
+    def batch(domain, token, commands, halt=False, timeout_sec=60):
+        calls.append(sorted(commands))
+        results, errors = {}, {}
+        for key in commands:
+            if key == "u7" and key not in limited_once:
+                limited_once.add(key)
+                errors[key] = {"error": "QUERY_LIMIT_EXCEEDED", "error_description": "Too many requests"}
+            elif key == "u9":
+                errors[key] = {"error": "USER_NOT_FOUND", "error_description": "no such user"}
+            else:
+                results[key] = 1000 + int(key[1:])
+        return results, errors, None, ""
+
+    monkeypatch.setattr(welcome_fanout.bitrix_client, "rest_batch", batch)
+    monkeypatch.setattr(welcome_fanout, "wait_portal_slot", lambda portal_id: None)
+    monkeypatch.setattr(welcome_fanout, "_RETRY_PAUSE_SEC", 0)
+    try:
+        yield db, portal.id, calls
+    finally:
+        db.close()
+
+
+def test_fanout_sends_in_batches_and_records_outcomes(env):
+    db, portal_id, calls = env
+    fanout = create_fanout(db, portal_id=portal_id, bot_id=5, user_ids=USERS, trace_id="tr-1", welcome_message="Привет")
+    result = run_fanout(db, fanout.id, domain="welcome.bitrix24.ru", access_token="t")
+
+    # 120 recipients -> 3 batch calls; the rate-limited command rides along in a later batch
+    assert [len(c) for c in calls] == [50, 50, 21]
+    assert "u7" in calls[2]
+    assert result["status"] == "partial_fail" and result["ok"] == 119
+    assert [(f["user_id"], f["code"]) for f in result["failed"]] == [(9, "USER_NOT_FOUND")]
+    logs = db.execute(select(func.count()).select_from(BitrixHttpLog).where(BitrixHttpLog.kind == "imbot_message_add")).scalar()
+    assert logs == 121
+    assert db.execute(select(BitrixHttpLog.kind).where(BitrixHttpLog.trace_id == "tr-1")).scalar() == "prepare_chats"
+    marked = db.execute(select(func.count()).select_from(PortalUsersAccess).where(PortalUsersAccess.last_welcome_hash.is_not(None))).scalar()
+    assert marked == 119
+
+
+def test_second_run_only_sends_to_the_rest(env, monkeypatch):
+    db, portal_id, calls = env
+    first = create_fanout(db, portal_id=portal_id, bot_id=5, user_ids=USERS, trace_id="tr-1", welcome_message="Привет")
+    run_fanout(db, first.id, domain="welcome.bitrix24.ru", access_token="t")
+    calls.clear()
+
+    def no_queue():
+        raise ConnectionError("redis down")
+
+    monkeypatch.setattr(welcome_fanout, "_redis", no_queue)
+    second = create_fanout(db, portal_id=portal_id, bot_id=5, user_ids=USERS, trace_id="tr-2", welcome_message="Привет")
+    handle = enqueue_fanout(db, second, domain="welcome.bitrix24.ru", access_token="t")  # runs inline
+    assert calls == [["u9"]]
+    assert handle["done"] and (handle["skipped"], handle["sent"], handle["failed_count"]) == (119, 0, 1)